@@ -648,8 +648,7 @@ def dashboard():
         logger.info(f"实例ID已在恢复过程中更新为: {instance_id}")
 
     # 更新好友列表
-    client.get_online_friends()  # 获取在线好友
-    all_friends = client.get_all_friends()  # 获取所有好友
+    all_friends = client.refresh_friend_lists()  # 并行获取在线好友和所有好友
 
     return render_template('main.html',
                            username=username,
@@ -678,8 +677,7 @@ def add_friend():
                 parts = key.split(':')
                 if len(parts) >= 1 and parts[0] == friend_username:
                     # 更新被添加方的好友列表
-                    friend_client.get_online_friends()
-                    friend_client.get_all_friends()
+                    friend_client.refresh_friend_lists()
                     # 通过SocketIO通知被添加方
                     if hasattr(friend_client, 'current_socketio_sid') and friend_client.current_socketio_sid:
                         socketio.emit('friend_added', {
@@ -730,8 +728,7 @@ def chat_window(recipient_username):
         return redirect(url_for('logout'))
     
     # 获取在线好友和所有好友信息
-    client.get_online_friends()
-    all_friends = client.get_all_friends()
+    all_friends = client.refresh_friend_lists()
     
     return render_template('main.html',
                            username=username,
@@ -979,8 +976,7 @@ def api_add_friend():
             for key, friend_client in active_clients.items():
                 if key.startswith(f"{friend_username}:") or key == friend_username:
                     # 更新被添加方的好友列表
-                    friend_client.get_online_friends()
-                    friend_client.get_all_friends()
+                    friend_client.refresh_friend_lists()
                     # 通过SocketIO通知被添加方
                     if hasattr(friend_client, 'current_socketio_sid') and friend_client.current_socketio_sid:
                         socketio.emit('friend_added', {
@@ -1120,8 +1116,7 @@ def api_refresh_friends():
     if client:
         try:
             # 更新在线好友和所有好友列表
-            client.get_online_friends()
-            all_friends = client.get_all_friends()
+            all_friends = client.refresh_friend_lists()
             return jsonify({
                 'success': True, 
                 'online_friends': list(client.online_friends_info.values()),
@@ -1437,35 +1432,15 @@ def api_search_user():
         return jsonify({'success': False, 'message': '客户端实例丢失'})
     
     try:
-        # 向服务器发送获取所有用户的请求
-        logger.info(f"搜索用户API：向服务器发送GET_ALL_USERS命令")
-        if client._send_request("GET_ALL_USERS"):
-            response = client._receive_response()
-            if response and response.get("status") == "success":
-                all_users = response["data"]["users"]
-                logger.info(f"搜索用户API：从服务器获取了 {len(all_users)} 个用户")
-                
-                # 根据搜索词过滤用户
-                filtered_users = []
-                for user in all_users:
-                    if search_term.lower() in user["username"].lower():
-                        filtered_users.append({
-                            "username": user["username"],
-                            "user_id": user["user_id"]
-                        })
-                
-                # 排除当前用户自己
-                filtered_users = [user for user in filtered_users if user["username"] != session['username']]
-                
-                logger.info(f"搜索用户API：找到 {len(filtered_users)} 个匹配 '{search_term}' 的用户")
-                return jsonify({'success': True, 'users': filtered_users})
-            else:
-                error_msg = response.get('message', '未知错误') if response else '服务器无响应'
-                logger.error(f"搜索用户API：获取用户列表失败: {error_msg}")
-                return jsonify({'success': False, 'message': f'获取用户列表失败: {error_msg}'})
-        else:
-            logger.error("搜索用户API：向服务器发送GET_ALL_USERS命令失败")
-            return jsonify({'success': False, 'message': '服务器请求失败'})
+        # 由服务器端的用户名索引完成前缀/子串匹配，只返回匹配的用户（已排除当前用户自己）
+        logger.info(f"搜索用户API：向服务器发送SEARCH_USERS命令")
+        users = client.search_users(search_term)
+        if users is None:
+            logger.error("搜索用户API：服务器搜索用户失败")
+            return jsonify({'success': False, 'message': '搜索用户失败'})
+
+        logger.info(f"搜索用户API：找到 {len(users)} 个匹配 '{search_term}' 的用户")
+        return jsonify({'success': True, 'users': users})
     except Exception as e:
         logger.error(f"搜索用户API：搜索用户时出错: {str(e)}")
         return jsonify({'success': False, 'message': f'搜索用户时出错: {str(e)}'})
@@ -1749,11 +1724,8 @@ def handle_refresh_friends():
 
     client = get_client_instance(session.get('username'))
     if client:
-        client.get_online_friends()
-        client.get_all_friends()
-        
         # 从客户端实例中获取在线好友和所有好友信息
-        all_friends = client.get_all_friends()
+        all_friends = client.refresh_friend_lists()
         
         socketio.emit('friends_refreshed', {
             'online_friends': list(client.online_friends_info.values()),
@@ -3,20 +3,44 @@ import json
 import os
 import time
 import base64
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 from config import SERVER_HOST, SERVER_PORT, P2P_LISTEN_HOST, P2P_LISTEN_PORT, BUFFER_SIZE, PRIVATE_KEY_FILE, \
-    PUBLIC_KEY_FILE
+    PUBLIC_KEY_FILE, MAX_FRAME_SIZE, SERVER_RESPONSE_TIMEOUT, LIST_PAGE_SIZE, KEY_CACHE_FILE, RESUME_ATTEMPTS, \
+    RESUME_RETRY_INTERVAL, P2P_MAX_FRAME_SIZE, P2P_RECV_BUFFER_SIZE, P2P_WORKER_THREADS, P2P_MAX_PENDING_MESSAGES, \
+    P2P_SESSION_MAX_MESSAGES, P2P_SESSION_MAX_AGE, PUBLIC_KEY_OBJECT_CACHE_SIZE
 from utils.RSA import RSAUtils  # 导入 RSA 工具类
 from utils.AES import AESUtils  # 导入 AES 工具类
 from p2p_manager import P2PManager  # 导入P2P管理器
 from utils.STEG import StegUtils  # 导入隐写术工具类
 from utils.AUDIO import AudioUtils  # 导入音频工具类
+from utils.KEYCACHE import PublicKeyCache  # 导入公钥指纹缓存
+from utils.SESSION import SessionKeyStore, SESSION_NONCE, SESSION_ASSOCIATED_DATA, SESSION_ID_SIZE  # 导入P2P会话密钥
+from utils.PROTOCOL import FrameReader, FrameTooLargeError, FRAMING_LENGTH_PREFIXED, EVENT_PRESENCE_DELTA, \
+    ENCODING_JSON, SUPPORTED_ENCODINGS, encode_message, decode_message, MessageDecodeError, \
+    rows_from_columns, P2PEnvelope, encode_p2p_envelope, P2P_ENVELOPE_CHAT, P2P_ENVELOPE_AUDIO, \
+    P2P_ENVELOPE_STEG_IMAGE, P2P_ENVELOPE_SESSION_INIT, P2P_ENVELOPE_SESSION, \
+    P2P_SESSION_VERSION  # 控制连接分帧协议与消息编码、P2P二进制信封与会话密钥
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class FriendInfo(dict):
+    """
+    online_friends_info 中的好友信息。public_key 属性保存解析后的公钥对象（首次发送消息时设置），
+    它不是字典的键，好友信息原样交给 jsonify / 模板时不会出现在里面。
+    """
+    __slots__ = ("public_key",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.public_key = None
+
+
 class ChatClient:
     """
     ChatClient 是即时通讯客户端的核心类。
@@ -25,8 +49,21 @@ class ChatClient:
 
     def __init__(self, socketio_instance):  # 构造函数中接收 SocketIO 实例
         self.server_socket = None  # 与中心服务器通信的socket对象
+        self.server_framed = False  # 与服务器的控制连接是否已协商为长度前缀分帧协议
+        self.server_encoding = ENCODING_JSON  # 分帧协议下与服务器协商的消息编码
+        # 分帧协议下由后台线程读取控制连接：服务器推送的事件直接处理，命令响应按 request_id 交给等待中的 Future，
+        # 因此同一连接上可以同时有多个请求在途（不同 greenlet/线程发起的请求不会读到彼此的响应）
+        self._server_reader_thread = None
+        self._request_ids = itertools.count(1)
+        self._pending_requests = {}  # {request_id: Future}；读取线程退出后置为 None，表示连接已关闭
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()  # 串行化 sendall，避免并发请求的帧交错
+        self._legacy_request_lock = threading.Lock()  # 旧协议下一次只能有一个请求在途
         self.logged_in_user_id = None  # 当前登录用户的唯一ID（由服务器分配）
         self.logged_in_username = None  # 当前登录用户的用户名
+        # LOGIN 返回的恢复令牌：控制连接意外断开后凭它重连并恢复会话（RESUME），无需再次输入密码
+        self._resume_token = None
+        self._resume_lock = threading.Lock()  # 同一时间只进行一次会话恢复（恢复期间新连接再次断开时不再嵌套恢复）
         self.my_public_key = None  # 当前用户的公钥对象（RSA公钥）
         self.my_public_key_pem = None  # 当前用户的公钥PEM格式字符串，用于网络传输和存储
 
@@ -35,14 +72,19 @@ class ChatClient:
         # 用于存储当前 SocketIO 会话ID，以便向特定浏览器推送消息
         self.current_socketio_sid = None
 
-        # 初始化 RSAUtils 实例，负责所有 RSA 加密相关操作
-        self.rsa_util = RSAUtils()
+        # 初始化 RSAUtils 实例，负责所有 RSA 加密相关操作（内含已解析公钥对象的 LRU 缓存）
+        self.rsa_util = RSAUtils(public_key_cache_size=PUBLIC_KEY_OBJECT_CACHE_SIZE)
         # 初始化 AESUtils 实例，负责所有 AES 对称加密相关操作
         self.aes_util = AESUtils()
         # 初始化 StegUtils 实例，负责图片隐写术操作
         self.steg_util = StegUtils()
         # 初始化 AudioUtils 实例，负责音频处理操作
         self.audio_util = AudioUtils()
+        # 初始化 PublicKeyCache 实例，按指纹缓存好友公钥PEM（持久化到磁盘）
+        self.key_cache = PublicKeyCache(KEY_CACHE_FILE)
+        self._key_fingerprints = {}  # {username: 公钥指纹}，用于 GET_PUBLIC_KEY 的条件请求
+        # 与各好友的P2P会话密钥（每个P2P连接用RSA建立一次，之后的消息只做AES-GCM加密）
+        self.p2p_sessions = SessionKeyStore(P2P_SESSION_MAX_MESSAGES, P2P_SESSION_MAX_AGE)
 
         self._load_or_generate_key_pair()  # 在客户端启动时加载或生成密钥对
 
@@ -54,11 +96,24 @@ class ChatClient:
             socketio_instance=self.socketio_instance,
             sid_getter_callback=self._get_current_socketio_sid,
             decrypt_and_process_callback=self._handle_p2p_received_raw_data,  # 收到加密数据后的解密处理回调
-            identity_info={"username": "初始化用户", "public_key_pem": self.my_public_key_pem}
+            identity_info={"username": "初始化用户", "public_key_pem": self.my_public_key_pem},
+            max_frame_size=P2P_MAX_FRAME_SIZE,
+            recv_buffer_size=P2P_RECV_BUFFER_SIZE,
+            worker_threads=P2P_WORKER_THREADS,
+            max_pending_messages=P2P_MAX_PENDING_MESSAGES
         )
 
         # 存储在线好友的信息 {username: {user_id, ip, port, public_key_pem}}
+        # 写入时整体替换为新字典（读取方无需加锁即可安全遍历），_friends_lock 只用于串行化写入
         self.online_friends_info = {}
+        self._friends_lock = threading.Lock()
+        # 为 True 时 online_friends_info 由服务器推送的 PRESENCE_DELTA 事件保持最新，无需再向服务器查询
+        self._online_friends_synced = False
+        # 版本化的好友缓存（SYNC_FRIENDS）：所有好友 {user_id: 好友记录} 及其版本，服务器只返回该版本之后的变化
+        self._all_friends = {}
+        self._friend_version = None
+        self._friend_sync_supported = True  # 旧服务器不认识 SYNC_FRIENDS 时置为 False，改用分页查询
+        self._fingerprints_announced = False  # 本连接上是否已向服务器声明过本地缓存的公钥指纹
 
     def _get_current_socketio_sid(self):
         """获取当前SocketIO会话ID。"""
@@ -103,15 +158,25 @@ class ChatClient:
         self.my_public_key = public_key
         self.my_public_key_pem = self.rsa_util.get_public_key_pem(public_key)
 
-    def _send_request(self, command, payload={}):
-        """向中心服务器发送JSON请求。"""
+    def _send_request(self, command, payload={}, request_id=None):
+        """
+        向中心服务器发送请求（旧协议为JSON，分帧协议下使用协商的编码）。
+        request_id 不为空时随请求发送，服务器在响应中原样带回。
+        """
         if not self.server_socket:
             logger.error("未连接到服务器。")
             return None
 
         request = {"command": command, "payload": payload}
+        if request_id is not None:
+            request["request_id"] = request_id
         try:
-            self.server_socket.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8'))
+            if self.server_framed:
+                data = FrameReader.encode_frame(encode_message(request, self.server_encoding))
+            else:
+                data = json.dumps(request, ensure_ascii=False).encode('utf-8')
+            with self._send_lock:
+                self.server_socket.sendall(data)
             logger.debug(f"已发送请求: {command} {payload}")
             return True
         except socket.error as e:
@@ -120,20 +185,21 @@ class ChatClient:
             return False
 
     def _receive_response(self):
-        """从中心服务器接收JSON响应。"""
+        """从中心服务器接收JSON响应（仅旧协议下使用，分帧协议下响应由后台读取线程分发）。"""
         if not self.server_socket:
             return None
 
+        data = None
         try:
-            data = self.server_socket.recv(BUFFER_SIZE).decode('utf-8')
+            data = self.server_socket.recv(BUFFER_SIZE)
             if not data:
                 logger.warning("服务器连接断开。")
                 self.disconnect_server()
                 return None
-            response = json.loads(data)
+            response = json.loads(data.decode('utf-8'))
             logger.debug(f"收到响应: {response}")
             return response
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, UnicodeDecodeError):
             logger.error(f"收到无效的JSON响应: {data}")
             return None
         except socket.error as e:
@@ -141,6 +207,279 @@ class ChatClient:
             self.disconnect_server()
             return None
 
+    def _request_async(self, command, payload=None):
+        """
+        发送一条请求，返回一个 Future，结果为服务器的响应字典（发送失败或连接断开时为 None）。
+        分帧协议下请求带上 request_id 后立即返回，多个请求可以同时在途；
+        旧协议下无法区分响应，只能在锁内同步完成一问一答。
+        """
+        payload = {} if payload is None else payload
+        future = Future()
+        if not self.server_framed:
+            with self._legacy_request_lock:
+                future.set_result(self._receive_response() if self._send_request(command, payload) else None)
+            return future
+
+        request_id = next(self._request_ids)
+        with self._pending_lock:
+            pending = self._pending_requests
+            if pending is not None:
+                pending[request_id] = future
+        if pending is None:
+            logger.warning("服务器连接断开。")
+            self.disconnect_server()
+            future.set_result(None)
+            return future
+        future.request_id = request_id
+        if not self._send_request(command, payload, request_id):
+            self._discard_pending(request_id)
+            future.set_result(None)
+        return future
+
+    def _wait_response(self, future, timeout=SERVER_RESPONSE_TIMEOUT):
+        """等待 _request_async 返回的 Future；超时返回 None（迟到的响应会被读取线程丢弃，不影响后续请求）。"""
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.error(f"等待服务器响应超时 ({timeout}s)。")
+            self._discard_pending(getattr(future, "request_id", None))
+            return None
+
+    def _request(self, command, payload=None, timeout=SERVER_RESPONSE_TIMEOUT):
+        """发送一条请求并等待其响应，返回响应字典；失败时返回 None。"""
+        return self._wait_response(self._request_async(command, payload), timeout)
+
+    def _discard_pending(self, request_id):
+        with self._pending_lock:
+            if self._pending_requests is not None:
+                self._pending_requests.pop(request_id, None)
+
+    def _start_server_reader(self):
+        """启动读取控制连接的后台线程（仅分帧协议下使用）。"""
+        with self._pending_lock:
+            self._pending_requests = {}
+            pending = self._pending_requests
+        self._server_reader_thread = threading.Thread(
+            target=self._server_reader_loop, args=(self.server_socket, pending),
+            name="server-reader", daemon=True)
+        self._server_reader_thread.start()
+
+    def _server_reader_loop(self, sock, pending):
+        """
+        持续读取控制连接上的帧：带 event 字段的是服务器推送的事件，立即处理；
+        其余为命令响应，按 request_id 交给 pending 中对应的 Future。
+        连接关闭时，所有仍在等待的请求都以 None 结束。
+        """
+        frame_reader = FrameReader(MAX_FRAME_SIZE)
+        try:
+            while True:
+                chunk = sock.recv(BUFFER_SIZE)
+                if not chunk:
+                    break
+                for frame in frame_reader.feed(chunk):
+                    try:
+                        message = decode_message(frame, self.server_encoding)
+                    except MessageDecodeError:
+                        logger.error(f"收到无效的{self.server_encoding}响应: {frame[:256]!r}")
+                        continue
+                    if isinstance(message, dict) and "event" in message and "status" not in message:
+                        self._handle_server_event(message)
+                    else:
+                        self._resolve_pending(pending, message)
+        except FrameTooLargeError as e:
+            logger.error(f"收到的响应帧过大，断开连接: {e}")
+        except OSError as e:
+            logger.debug(f"控制连接读取线程结束: {e}")
+        finally:
+            with self._pending_lock:
+                futures = list(pending.values())
+                pending.clear()
+                if self._pending_requests is pending:
+                    self._pending_requests = None
+            for future in futures:
+                future.set_result(None)
+            if sock is self.server_socket and self.logged_in_username and self._resume_token \
+                    and self._resume_lock.acquire(blocking=False):
+                # 不是本地主动断开（disconnect_server 会先清空 server_socket）：尝试恢复会话
+                logger.warning("与服务器的控制连接意外断开，尝试恢复会话。")
+                try:
+                    self._resume_session(sock)
+                finally:
+                    self._resume_lock.release()
+
+    def _resolve_pending(self, pending, response):
+        """把一条命令响应交给等待它的 Future。"""
+        request_id = response.get("request_id") if isinstance(response, dict) else None
+        with self._pending_lock:
+            if request_id is not None:
+                future = pending.pop(request_id, None)
+            elif pending:
+                # 不回显 request_id 的服务器按顺序处理请求，响应对应最早的在途请求
+                future = pending.pop(next(iter(pending)))
+            else:
+                future = None
+        if future is None:
+            logger.warning(f"收到无人等待的响应（可能已超时），丢弃: request_id={request_id}")
+            return
+        logger.debug(f"收到响应: {response}")
+        future.set_result(response)
+
+    def _handle_server_event(self, message):
+        """处理服务器主动推送的事件。"""
+        event = message.get("event")
+        try:
+            if event == EVENT_PRESENCE_DELTA:
+                self._apply_presence_delta(message.get("data") or {})
+            else:
+                logger.debug(f"忽略未知的服务器事件: {event}")
+        except Exception as e:
+            logger.error(f"处理服务器事件 {event} 时出错: {e}", exc_info=True)
+
+    def _normalize_friend_info(self, friend):
+        """统一服务器返回的好友信息字段名，并用公钥缓存补全/记录好友公钥。返回 FriendInfo。"""
+        friend = FriendInfo(friend)
+        # 确保字段名一致：ip_address 和 p2p_port
+        if 'IPAddress' in friend and 'ip_address' not in friend:
+            friend['ip_address'] = friend['IPAddress']
+        if 'P2PPort' in friend and 'p2p_port' not in friend:
+            friend['p2p_port'] = friend['P2PPort']
+
+        # 自服务器数据库已修改，服务器现在直接提供public_key_pem字段
+        # 确保历史代码兼容性，如果有其他字段名也进行处理
+        if 'PublicKey' in friend and 'public_key_pem' not in friend:
+            friend['public_key_pem'] = friend['PublicKey']
+
+        # 服务器对本地已缓存的公钥只返回指纹，这里从缓存补全PEM；收到完整PEM时则加入缓存
+        if friend.get('public_key_pem'):
+            friend['public_key_fingerprint'] = self.key_cache.put(friend['public_key_pem'])
+        elif friend.get('public_key_fingerprint'):
+            friend['public_key_pem'] = self.key_cache.get_pem(friend['public_key_fingerprint'])
+            if not friend['public_key_pem']:
+                logger.warning(f"好友 {friend.get('username')} 的公钥 {friend['public_key_fingerprint'][:12]}… 不在本地缓存中。")
+        if friend.get('public_key_fingerprint') and friend.get('username'):
+            self._key_fingerprints[friend['username']] = friend['public_key_fingerprint']
+        return friend
+
+    def _friend_public_key(self, friend_info, friend_public_key_pem):
+        """
+        取好友的公钥对象，避免每条消息都重新解析PEM：FriendInfo 上已保存的对象直接使用，
+        否则从 RSAUtils 的 LRU 缓存中取（按指纹，未缓存时解析）并保存到 FriendInfo 上。解析失败时退回PEM字符串。
+        """
+        public_key = getattr(friend_info, "public_key", None)
+        if public_key is not None:
+            return public_key
+        try:
+            public_key = self.rsa_util.load_public_key(friend_public_key_pem, friend_info.get("public_key_fingerprint"))
+        except (ValueError, TypeError) as e:
+            logger.error(f"解析好友 {friend_info.get('username')} 的公钥失败: {e}")
+            return friend_public_key_pem
+        if isinstance(friend_info, FriendInfo):
+            friend_info.public_key = public_key
+        return public_key
+
+    def _apply_presence_delta(self, delta):
+        """将服务器推送的在线状态增量合并到 online_friends_info，并通知前端更新在线好友列表。"""
+        offline_ids = set(delta.get("offline", []))
+        with self._friends_lock:
+            friends = {name: friend for name, friend in self.online_friends_info.items()
+                       if friend.get("user_id") not in offline_ids}
+            for friend in delta.get("online", []):
+                friends[friend["username"]] = self._normalize_friend_info(friend)
+            self.online_friends_info = friends
+        self.key_cache.save()
+        logger.info(f"收到在线状态变化: 上线 {[f['username'] for f in delta.get('online', [])]}, "
+                    f"下线 {list(offline_ids)}。当前在线好友: {list(friends.keys())}")
+
+        sid = self.current_socketio_sid
+        if self.socketio_instance and sid:
+            self.socketio_instance.emit('online_friends_updated',
+                                        {'online_friends': list(friends.values())}, room=sid)
+
+    def _negotiate_framing(self):
+        """
+        连接建立后用旧格式发送 HELLO，协商长度前缀分帧协议、消息编码（本机可用的 msgpack / cbor，否则 JSON）
+        和列式好友列表。旧服务器不认识 HELLO 会返回错误，此时继续使用旧协议。
+        """
+        self.server_framed = False
+        self.server_encoding = ENCODING_JSON
+        response = self._request("HELLO", {"framing": [FRAMING_LENGTH_PREFIXED], "pipelining": True,
+                                           "encodings": list(SUPPORTED_ENCODINGS), "columnar": True})
+        if response and response.get("status") == "success" \
+                and response.get("data", {}).get("framing") == FRAMING_LENGTH_PREFIXED:
+            # 不认识 encodings 的旧服务器不返回 encoding，继续使用 JSON
+            encoding = response["data"].get("encoding", ENCODING_JSON)
+            self.server_encoding = encoding if encoding in SUPPORTED_ENCODINGS else ENCODING_JSON
+            self.server_framed = True
+            self._fingerprints_announced = False
+            self._start_server_reader()
+            logger.info(f"已与服务器协商使用分帧协议，编码 {self.server_encoding}"
+                        f"{'（请求流水线）' if response['data'].get('pipelining') else ''}。")
+        else:
+            logger.info("服务器不支持分帧协议，使用旧协议通信。")
+        return self.server_socket is not None
+
+    def _resume_session(self, lost_sock):
+        """
+        控制连接意外断开后重新连接，并用恢复令牌发送 RESUME（服务器在宽限期内保留着本用户的在线状态）。
+        P2P监听器保持运行；恢复失败时清理本地登录状态，需要用户重新登录。
+        :return: 是否恢复成功。
+        """
+        self._reset_server_connection(lost_sock)
+        for attempt in range(RESUME_ATTEMPTS):
+            if attempt:
+                time.sleep(RESUME_RETRY_INTERVAL)
+            if not self.logged_in_username or not self._resume_token:
+                return False  # 重连期间用户已登出
+            if not self.connect_server():
+                continue
+            # 期间其他请求失败时可能已调用 disconnect_server 停止了P2P监听器，这里确保它在运行
+            if not self.p2p_manager.start_p2p_listener():
+                break
+            response = self._request("RESUME", {"resume_token": self._resume_token,
+                                                "p2p_ip": self._detect_local_ip(),
+                                                "p2p_port": self.p2p_manager.p2p_actual_port})
+            if response is None:
+                self._reset_server_connection(self.server_socket)
+                continue
+            if response.get("status") == "success":
+                self._resume_token = response["data"].get("resume_token", self._resume_token)
+                logger.info(f"已恢复与服务器的会话: {self.logged_in_username}")
+                self.refresh_friend_lists()  # 断开期间的在线状态推送已丢失，重新同步
+                return True
+            if (response.get("data") or {}).get("retry_after") is None:
+                logger.error(f"恢复会话失败: {response.get('message', '未知错误')}")
+                break
+        logger.error("无法恢复与服务器的会话，请重新登录。")
+        self._cleanup_local_resources()
+        return False
+
+    def _reset_server_connection(self, sock):
+        """关闭已断开的控制连接，但不停止P2P监听器（与 disconnect_server 不同），以便重连后恢复会话。"""
+        if sock is None or sock is not self.server_socket:
+            return
+        self.server_socket = None
+        self.server_framed = False
+        self.server_encoding = ENCODING_JSON
+        with self._friends_lock:
+            self._online_friends_synced = False  # 连接断开后不再收到推送，需要重新查询
+        try:
+            sock.close()
+        except socket.error as e:
+            logger.debug(f"关闭已断开的服务器连接时出错: {e}")
+
+    @staticmethod
+    def _detect_local_ip():
+        """确定本机可被其他客户端访问的IP（作为P2P监听地址告知服务器），无法确定时返回 127.0.0.1。"""
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            local_ip = s.getsockname()[0]
+            s.close()
+            return local_ip
+        except Exception:
+            logger.warning("无法确定外部可访问的本地IP，使用127.0.0.1。")
+            return '127.0.0.1'
+
     def connect_server(self):
         """连接到中心服务器。"""
         if self.server_socket:
@@ -150,23 +489,27 @@ class ChatClient:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.connect((SERVER_HOST, SERVER_PORT))
             logger.info(f"成功连接到服务器 {SERVER_HOST}:{SERVER_PORT}")
-            return True
         except socket.error as e:
             logger.error(f"连接服务器失败: {e}")
             self.server_socket = None
             return False
+        return self._negotiate_framing()
 
     def disconnect_server(self):
         """断开与中心服务器的连接，并清理所有P2P相关资源。"""
-        if self.server_socket:
+        # 先清空 server_socket，读取线程据此区分主动断开与意外断开
+        sock, self.server_socket = self.server_socket, None
+        if sock:
             try:
-                self.server_socket.shutdown(socket.SHUT_RDWR)
-                self.server_socket.close()
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
                 logger.info("已断开与服务器的连接。")
             except socket.error as e:
                 logger.warning(f"关闭服务器连接时出错: {e}")
             finally:
-                self.server_socket = None
+                self.server_framed = False
+                self.server_encoding = ENCODING_JSON
+                self._online_friends_synced = False  # 连接断开后不再收到推送，需要重新查询
                 # 移除重复的用户信息清理，由 logout 方法统一处理
                 self.p2p_manager.stop_p2p_listener()
                 self.p2p_manager.close_all_p2p_connections()
@@ -180,13 +523,11 @@ class ChatClient:
             return False
 
         payload = {"username": username, "password": password, "public_key": self.my_public_key_pem}
-        if self._send_request("REGISTER", payload):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                logger.info(f"注册成功: {response.get('message')}")
-                return True
-            else:
-                logger.error(f"注册失败: {response.get('message', '未知错误')}")
+        response = self._request("REGISTER", payload)
+        if response and response.get("status") == "success":
+            logger.info(f"注册成功: {response.get('message')}")
+            return True
+        logger.error(f"注册失败: {response.get('message', '未知错误') if response else '服务器无响应'}")
         return False
 
     def login(self, username, password):
@@ -204,20 +545,12 @@ class ChatClient:
 
         # 确保p2p_listen_socket存在后再使用
         if self.p2p_manager.p2p_listen_socket:
-            self.p2p_manager.p2p_listen_socket.settimeout(None)
             self.p2p_manager.p2p_actual_port = self.p2p_manager.p2p_listen_socket.getsockname()[1]
         else:
             logger.error("P2P监听socket未初始化，无法登录。")
             return False
 
-        local_ip = '127.0.0.1'
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-            s.close()
-        except Exception:
-            logger.warning("无法确定外部可访问的本地IP，使用127.0.0.1。")
+        local_ip = self._detect_local_ip()
 
         self.p2p_manager.update_identity_info(username, self.my_public_key_pem)
 
@@ -227,18 +560,16 @@ class ChatClient:
             "p2p_ip": local_ip,
             "p2p_port": self.p2p_manager.p2p_actual_port
         }
-        if self._send_request("LOGIN", payload):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                self.logged_in_username = response["data"]["username"]
-                self.logged_in_user_id = response["data"]["user_id"]
-                logger.info(f"登录成功: {self.logged_in_username}")
-                self.get_online_friends()
-                self.get_all_friends()
-                self._notify_online_friends()
-                return True
-            else:
-                logger.error(f"登录失败: {response.get('message', '未知错误')}")
+        response = self._request("LOGIN", payload)
+        if response and response.get("status") == "success":
+            self.logged_in_username = response["data"]["username"]
+            self.logged_in_user_id = response["data"]["user_id"]
+            self._resume_token = response["data"].get("resume_token")  # 旧服务器不返回恢复令牌
+            logger.info(f"登录成功: {self.logged_in_username}")
+            self.refresh_friend_lists()
+            self._notify_online_friends()
+            return True
+        logger.error(f"登录失败: {response.get('message', '未知错误') if response else '服务器无响应'}")
         return False
 
     def _notify_online_friends(self):
@@ -261,12 +592,11 @@ class ChatClient:
 
         try:
             # 尝试向服务器发送登出请求
-            if self._send_request("LOGOUT"):
-                response = self._receive_response()
-                if response and response.get("status") == "success":
-                    logger.info(f"登出成功: {response.get('message')}")
-                else:
-                    logger.warning(f"服务器登出响应异常: {response.get('message', '未知错误')}")
+            response = self._request("LOGOUT")
+            if response and response.get("status") == "success":
+                logger.info(f"登出成功: {response.get('message')}")
+            elif response:
+                logger.warning(f"服务器登出响应异常: {response.get('message', '未知错误')}")
             else:
                 logger.warning("无法向服务器发送登出请求，可能连接已断开")
         except Exception as e:
@@ -281,12 +611,21 @@ class ChatClient:
             # 清理用户信息
             self.logged_in_username = None
             self.logged_in_user_id = None
+            self._resume_token = None
+            self._all_friends = {}
+            self._friend_version = None
             
             # 清理好友信息缓存
-            self.online_friends_info.clear()
+            with self._friends_lock:
+                self.online_friends_info = {}
+                self._online_friends_synced = False
             
             # 清理 SocketIO 相关
             self.current_socketio_sid = None
+
+            # 清理P2P会话密钥
+            self.p2p_sessions.clear()
+            logger.info(f"公钥对象缓存统计: {self.rsa_util.public_key_cache_stats()}")
             
             # 断开服务器连接和P2P连接
             self.disconnect_server()
@@ -303,16 +642,13 @@ class ChatClient:
             logger.warning("请先登录。")
             return False
         payload = {"friend_username": friend_username}
-        if self._send_request("ADD_FRIEND", payload):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                logger.info(f"添加好友成功: {response.get('message')}")
-                # 更新当前用户的好友列表
-                self.get_online_friends()
-                self.get_all_friends()
-                return True
-            else:
-                logger.error(f"添加好友失败: {response.get('message', '未知错误')}")
+        response = self._request("ADD_FRIEND", payload)
+        if response and response.get("status") == "success":
+            logger.info(f"添加好友成功: {response.get('message')}")
+            # 更新当前用户的好友列表
+            self.refresh_friend_lists()
+            return True
+        logger.error(f"添加好友失败: {response.get('message', '未知错误') if response else '服务器无响应'}")
         return False
 
     def remove_friend(self, friend_username):
@@ -321,62 +657,190 @@ class ChatClient:
             logger.warning("请先登录。")
             return False
         payload = {"friend_username": friend_username}
-        if self._send_request("REMOVE_FRIEND", payload):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                logger.info(f"删除好友成功: {response.get('message')}")
-                self.get_online_friends()
-                return True
-            else:
-                logger.error(f"删除好友失败: {response.get('message', '未知错误')}")
+        response = self._request("REMOVE_FRIEND", payload)
+        if response and response.get("status") == "success":
+            logger.info(f"删除好友成功: {response.get('message')}")
+            # 与添加好友相同，同时刷新在线好友缓存和所有好友列表（get_online_friends 在已同步时只返回缓存）
+            self.refresh_friend_lists()
+            return True
+        logger.error(f"删除好友失败: {response.get('message', '未知错误') if response else '服务器无响应'}")
         return False
 
-    def get_online_friends(self):
-        """从服务器获取在线好友列表，并更新本地缓存。"""
+    def _request_page(self, command, after_user_id, extra_payload=None):
+        """异步请求列表类命令的一页，返回 Future。"""
+        payload = {"after_user_id": after_user_id, "limit": LIST_PAGE_SIZE}
+        if extra_payload:
+            payload.update(extra_payload)
+        return self._request_async(command, payload)
+
+    def _collect_pages(self, command, key, first_future):
+        """
+        等待第一页响应，再按 UserID 游标逐页请求，直到服务器返回的 next_after_user_id 为空。
+        :return: (全部结果列表, None)；失败时返回 (None, 错误信息)。
+        """
+        items = []
+        future = first_future
+        while True:
+            response = self._wait_response(future)
+            if not (response and response.get("status") == "success"):
+                return None, response.get('message', '未知错误') if response else '服务器无响应'
+            data = response.get("data", {})
+            items.extend(rows_from_columns(data.get(key, [])))
+            after_user_id = data.get("next_after_user_id")
+            if not after_user_id:
+                return items, None
+            future = self._request_page(command, after_user_id)
+
+    def _request_all_pages(self, command, key, first_page_payload=None):
+        """
+        逐页请求列表类命令的全部结果。
+        :param first_page_payload: 只随第一页请求发送的额外参数。
+        :return: (全部结果列表, None)；失败时返回 (None, 错误信息)。
+        """
+        return self._collect_pages(command, key, self._request_page(command, 0, first_page_payload))
+
+    def _request_online_friends_page(self):
+        """异步请求在线好友的第一页；告诉服务器本地已缓存的公钥指纹，这些好友只返回指纹而不是完整PEM。"""
+        return self._request_page("GET_ONLINE_FRIENDS", 0, {"known_fingerprints": self.key_cache.fingerprints()})
+
+    def get_online_friends(self, force=False):
+        """
+        从服务器获取在线好友列表，并更新本地缓存。
+        与服务器的连接支持事件推送时，首次获取之后缓存由 PRESENCE_DELTA 事件保持最新，
+        除非 force 为 True，否则直接使用缓存而不再向服务器查询。
+        """
         if not self.logged_in_username:
             logger.warning("请先登录。")
             return False
 
-        if self._send_request("GET_ONLINE_FRIENDS"):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                friends_list = response["data"]["friends"]
-                self.online_friends_info.clear()
-                for friend in friends_list:
-                    # 确保字段名一致：ip_address 和 p2p_port
-                    if 'IPAddress' in friend and 'ip_address' not in friend:
-                        friend['ip_address'] = friend['IPAddress']
-                    if 'P2PPort' in friend and 'p2p_port' not in friend:
-                        friend['p2p_port'] = friend['P2PPort']
-                    
-                    # 自服务器数据库已修改，服务器现在直接提供public_key_pem字段
-                    # 确保历史代码兼容性，如果有其他字段名也进行处理
-                    if 'PublicKey' in friend and 'public_key_pem' not in friend:
-                        friend['public_key_pem'] = friend['PublicKey']
-                    
-                    self.online_friends_info[friend["username"]] = friend
-                    logger.info(f"friend: {friend}")
-                    # logger.info(f"friend: {friend['public_key']}")
-                logger.info(f"已更新在线好友列表。当前在线好友: {list(self.online_friends_info.keys())}")
-                return True
-            else:
-                logger.error(f"获取在线好友失败: {response.get('message', '未知错误')}")
-        return False
+        if self._online_friends_synced and not force:
+            return True
+        return self._finish_online_friends(self._request_online_friends_page())
+
+    def _finish_online_friends(self, first_future):
+        """收取在线好友列表的全部分页并更新本地缓存。"""
+        friends_list, error = self._collect_pages("GET_ONLINE_FRIENDS", "friends", first_future)
+        if friends_list is None:
+            logger.error(f"获取在线好友失败: {error}")
+            return False
+
+        friends = {}
+        for friend in friends_list:
+            friends[friend["username"]] = self._normalize_friend_info(friend)
+            logger.info(f"friend: {friend}")
+            # logger.info(f"friend: {friend['public_key']}")
+        with self._friends_lock:
+            self.online_friends_info = friends
+            self._online_friends_synced = self.server_framed
+        self.key_cache.save()
+        logger.info(f"已更新在线好友列表。当前在线好友: {list(self.online_friends_info.keys())}")
+        return True
 
     def get_all_friends(self):
         """获取所有好友列表（无论在线或离线）。"""
         if not self.logged_in_username:
             logger.warning("请先登录。")
             return None
+        return self._finish_all_friends(self._request_page("GET_ALL_FRIENDS", 0))
 
-        if self._send_request("GET_ALL_FRIENDS"):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                friends_list = response["data"]["friends"]
-                logger.info(f"已获取所有好友列表。共 {len(friends_list)} 位好友。")
-                return friends_list
+    def _finish_all_friends(self, first_future):
+        """收取所有好友列表的全部分页。"""
+        friends_list, error = self._collect_pages("GET_ALL_FRIENDS", "friends", first_future)
+        if friends_list is None:
+            logger.error(f"获取所有好友失败: {error}")
+            return None
+        logger.info(f"已获取所有好友列表。共 {len(friends_list)} 位好友。")
+        return friends_list
+
+    def sync_friends(self):
+        """
+        按版本增量同步好友列表（SYNC_FRIENDS）：发送上次同步得到的版本，服务器只返回此后增删的好友和在线状态变化，
+        没有变化时响应中只有版本号；版本过旧或未知时服务器返回完整快照。
+        :return: 所有好友列表（按 UserID 排序）；失败或服务器不支持时返回 None。
+        """
+        payload = {"version": self._friend_version}
+        if not self._fingerprints_announced:
+            payload["known_fingerprints"] = self.key_cache.fingerprints()
+        response = self._request("SYNC_FRIENDS", payload)
+        if not (response and response.get("status") == "success"):
+            if response and response.get("message") == "未知命令。":
+                logger.info("服务器不支持 SYNC_FRIENDS，改用分页查询好友列表。")
+                self._friend_sync_supported = False
+            else:
+                logger.error(f"同步好友列表失败: {response.get('message', '未知错误') if response else '服务器无响应'}")
+            return None
+        self._fingerprints_announced = True
+
+        data = response.get("data", {})
+        online = [self._normalize_friend_info(friend) for friend in rows_from_columns(data.get("online", []))]
+        with self._friends_lock:
+            if data.get("full"):
+                all_friends, online_friends = {}, {}
             else:
-                logger.error(f"获取所有好友失败: {response.get('message', '未知错误')}")
+                removed = set(data.get("removed", []))
+                gone = removed | set(data.get("offline", []))
+                all_friends = {uid: friend for uid, friend in self._all_friends.items() if uid not in removed}
+                online_friends = {name: friend for name, friend in self.online_friends_info.items()
+                                  if friend.get("user_id") not in gone}
+                for uid in data.get("offline", []):
+                    if uid in all_friends:
+                        all_friends[uid] = dict(all_friends[uid], ip_address=None, p2p_port=None)
+            for friend in rows_from_columns(data.get("friends", [])):
+                all_friends[friend["user_id"]] = friend
+            for friend in online:
+                online_friends[friend["username"]] = friend
+                if friend["user_id"] in all_friends:
+                    all_friends[friend["user_id"]] = dict(all_friends[friend["user_id"]],
+                                                          ip_address=friend.get("ip"), p2p_port=friend.get("port"))
+            self._all_friends = all_friends
+            self.online_friends_info = online_friends
+            self._friend_version = data.get("version")
+        if online:
+            self.key_cache.save()
+        logger.info(f"已同步好友列表（{'完整快照' if data.get('full') else '增量'}，版本 {self._friend_version}）。"
+                    f"共 {len(all_friends)} 位好友，在线 {list(online_friends.keys())}")
+        return [all_friends[uid] for uid in sorted(all_friends)]
+
+    def refresh_friend_lists(self):
+        """
+        刷新在线好友缓存并获取所有好友列表。
+        服务器支持 SYNC_FRIENDS 时只同步上次以来的变化；否则两个分页查询同时发出
+        （分帧协议下在同一连接上并行处理），总耗时约为较慢的一个而不是两者之和。
+        :return: 所有好友列表，失败时返回 None。
+        """
+        if not self.logged_in_username:
+            logger.warning("请先登录。")
+            return None
+
+        if self._friend_sync_supported:
+            all_friends = self.sync_friends()
+            if all_friends is not None or self._friend_sync_supported:
+                return all_friends
+
+        online_future = None if self._online_friends_synced else self._request_online_friends_page()
+        all_future = self._request_page("GET_ALL_FRIENDS", 0)
+        if online_future is not None:
+            self._finish_online_friends(online_future)
+        return self._finish_all_friends(all_future)
+
+    def search_users(self, query, limit=None):
+        """
+        按用户名前缀/子串在服务器端搜索用户（不包括自己）。
+        :return: [{"user_id": .., "username": ..}]，失败时返回 None。
+        """
+        if not self.logged_in_username:
+            logger.warning("请先登录。")
+            return None
+
+        payload = {"query": query}
+        if limit is not None:
+            payload["limit"] = limit
+        response = self._request("SEARCH_USERS", payload)
+        if response and response.get("status") == "success":
+            users = response["data"]["users"]
+            logger.info(f"搜索用户 '{query}' 返回 {len(users)} 个结果。")
+            return users
+        logger.error(f"搜索用户失败: {response.get('message', '未知错误') if response else '服务器无响应'}")
         return None
 
     def get_public_key_from_server(self, username):
@@ -389,26 +853,43 @@ class ChatClient:
             return self.online_friends_info[username]["public_key_pem"]
 
         payload = {"username": username}
-        if self._send_request("GET_PUBLIC_KEY", payload):
-            response = self._receive_response()
-            if response and response.get("status") == "success":
-                logger.info(f"成功从服务器获取 {username} 的公钥。")
-                return response["data"]["public_key_pem"]
-            else:
-                logger.error(f"从服务器获取 {username} 公钥失败: {response.get('message', '未知错误')}")
+        known_fingerprint = self._key_fingerprints.get(username)
+        if known_fingerprint and self.key_cache.get_pem(known_fingerprint):
+            payload["known_fingerprint"] = known_fingerprint  # 公钥未变化时服务器只确认指纹
+        response = self._request("GET_PUBLIC_KEY", payload)
+        if response and response.get("status") == "success":
+            data = response["data"]
+            if data.get("not_modified"):
+                logger.info(f"{username} 的公钥未变化，使用本地缓存。")
+                return self.key_cache.get_pem(known_fingerprint)
+            logger.info(f"成功从服务器获取 {username} 的公钥。")
+            public_key_pem = data.get("public_key") or data.get("public_key_pem")
+            fingerprint = self.key_cache.put(public_key_pem, data.get("public_key_fingerprint"))
+            if fingerprint:
+                self._key_fingerprints[username] = fingerprint
+                self.key_cache.save()
+            return public_key_pem
+        logger.error(f"从服务器获取 {username} 公钥失败: "
+                     f"{response.get('message', '未知错误') if response else '服务器无响应'}")
         return None
 
-    def _handle_p2p_received_raw_data(self, peer_username, peer_public_key_pem, raw_data_bytes, sid=None):
+    def _handle_p2p_received_raw_data(self, peer_username, peer_public_key_pem, raw_data_bytes, sid=None,
+                                      session_nonce=None):
         """
         P2PManager回调此函数，处理从P2P连接收到的原始（加密）数据。
         在此处进行解密操作，并将解密后的消息通过SocketIO推送到浏览器。
         支持处理完整JSON消息和大型二进制数据包。
         :param peer_username: 发送方的用户名。
         :param peer_public_key_pem: 发送方的公钥PEM格式字符串。
-        :param raw_data_bytes: 从P2P连接收到的原始字节数据（加密的JSON）。
+        :param raw_data_bytes: 从P2P连接收到的原始字节数据（加密的JSON），或分帧连接上解析后的二进制信封 P2PEnvelope。
         :param sid: 接收到消息的Web客户端的SocketIO会话ID，用于精确推送。
+        :param session_nonce: 本端在收到消息的连接握手中提供的随机数，用于验证会话建立消息；不支持会话密钥时为 None。
         """
         try:
+            if isinstance(raw_data_bytes, P2PEnvelope):
+                self._handle_p2p_envelope(peer_username, peer_public_key_pem, raw_data_bytes, sid, session_nonce)
+                return
+
             # 尝试解析为JSON
             try:
                 received_payload = json.loads(raw_data_bytes.decode('utf-8'))
@@ -506,57 +987,7 @@ class ChatClient:
                     decrypted_message = decrypted_message_bytes.decode('utf-8')
                     logger.info(f"✓✓✓ 成功接收并解密来自 {peer_username} 的消息: \"{decrypted_message}\"")
 
-                    # 使用当前SocketIO SID，如果没有提供
-                    if not sid:
-                        sid = self.current_socketio_sid
-                        logger.info(f"使用当前客户端SID: {sid} (未提供SID)")
-
-                    if sid:
-                        # 先发送解密状态
-                        self.socketio_instance.emit('message_status',
-                                                   {'status': 'decrypting', 'message': ''},
-                                                   room=sid)
-                        
-                        # 短暂延迟后显示解密后的消息
-                        time.sleep(0.2)  # 模拟解密过程，实际上已经解密完成
-                        
-                        # 确保当前用户ID和用户名正确配置
-                        user_id = str(self.logged_in_user_id) if self.logged_in_user_id else None
-                        username = self.logged_in_username
-                        logger.info(f"当前用户信息: ID={user_id}, 用户名={username}")
-                        
-                        # 发送解密后的消息，确保包含正确的发送者和接收者信息
-                        logger.info(f"准备向SID: {sid} 发送来自 {peer_username} 的消息: \"{decrypted_message}\"")
-                        self.socketio_instance.emit('receive_message',
-                                                    {'sender': peer_username, 
-                                                     'recipient': user_id, 
-                                                     'message': decrypted_message},
-                                                    room=sid)
-                        logger.info(f"已完成向SID: {sid} 发送来自 {peer_username} 的消息")
-                        
-                        # 发送解密完成状态
-                        self.socketio_instance.emit('message_status',
-                                                   {'status': 'decrypted', 'message': ''},
-                                                   room=sid)
-                        
-                        logger.info(f"UI通知: 接收到 {peer_username} 的消息并显示在用户界面，使用SID: {sid}")
-                    else:
-                        logger.warning(f"没有可用的SocketIO SID，聊天消息无法推送到浏览器。当前sid: {sid}")
-                        # 广播消息到所有连接，尝试确保消息能被接收
-                        try:
-                            logger.info(f"尝试广播消息给所有连接")
-                            
-                            # 确保当前用户ID和用户名正确配置
-                            user_id = str(self.logged_in_user_id) if self.logged_in_user_id else None
-                            logger.info(f"广播消息时当前用户ID={user_id}")
-                            
-                            self.socketio_instance.emit('receive_message',
-                                                        {'sender': peer_username, 
-                                                         'recipient': user_id, 
-                                                         'message': decrypted_message},
-                                                        broadcast=True)
-                        except Exception as e:
-                            logger.error(f"广播消息失败: {e}")
+                    self._process_chat_message(peer_username, decrypted_message, sid)
                 elif message_type == "steg_image":
                     # 提取隐写图片相关的数据
                     encrypted_image_data_b64 = received_payload.get("encrypted_image_data")
@@ -668,6 +1099,255 @@ class ChatClient:
         except Exception as ex:
             logger.error(f"处理或解密来自 {peer_username} 的P2P消息时出错: {ex}", exc_info=True)
     
+    def _handle_p2p_envelope(self, peer_username, peer_public_key_pem, envelope, sid=None, session_nonce=None):
+        """
+        处理分帧连接上收到的二进制信封：会话建立消息记录对方的会话密钥；会话消息用该会话密钥解密；
+        其他信封先用自己的RSA私钥解密一次性对称密钥，再用它逐段解密。
+        密文是接收缓冲区的 memoryview 切片，直接交给 AES-GCM，解密后按消息类型分别处理。
+        :param envelope: P2PManager 解析得到的 P2PEnvelope。
+        """
+        if envelope.kind == P2P_ENVELOPE_SESSION_INIT:
+            if session_nonce is None:
+                logger.warning(f"收到来自 {peer_username} 的会话建立消息，但该连接没有协商会话密钥，已忽略。")
+            elif len(envelope.segments) == 1:
+                self._accept_p2p_session(peer_username, peer_public_key_pem, envelope, session_nonce)
+            else:
+                logger.warning(f"收到来自 {peer_username} 的不完整的会话建立消息（{len(envelope.segments)} 段）。")
+            return
+        kind = envelope.kind & ~P2P_ENVELOPE_SESSION
+        expected_segments = {P2P_ENVELOPE_CHAT: 1, P2P_ENVELOPE_AUDIO: 1, P2P_ENVELOPE_STEG_IMAGE: 2}.get(kind)
+        if expected_segments is None or len(envelope.segments) != expected_segments:
+            logger.warning(f"收到来自 {peer_username} 的未知或不完整的二进制信封（类型 {envelope.kind}，{len(envelope.segments)} 段）。")
+            return
+
+        if envelope.kind & P2P_ENVELOPE_SESSION:
+            plaintexts = self._decrypt_p2p_session_envelope(peer_username, envelope)
+        else:
+            plaintexts = self._decrypt_p2p_envelope(peer_username, envelope)
+        if plaintexts is None:
+            return
+
+        if kind == P2P_ENVELOPE_CHAT:
+            decrypted_message = plaintexts[0].decode('utf-8')
+            logger.info(f"✓✓✓ 成功接收并解密来自 {peer_username} 的消息: \"{decrypted_message}\"")
+            self._process_chat_message(peer_username, decrypted_message, sid)
+        elif kind == P2P_ENVELOPE_AUDIO:
+            # 二进制信封中的音频是原始字节，不需要再做 Base64 解码
+            logger.info(f"成功接收并解密来自 {peer_username} 的语音消息")
+            self._process_audio_message(peer_username, plaintexts[0], sid)
+        else:
+            decrypted_hidden_message = plaintexts[0].decode('utf-8')
+            logger.info(f"隐写消息解密成功！[P2P隐藏消息 from {peer_username}]: {decrypted_hidden_message}")
+            self._process_steg_image(peer_username, plaintexts[1], decrypted_hidden_message, sid)
+
+    def _decrypt_p2p_envelope(self, peer_username, envelope):
+        """解密每条消息自带RSA加密的一次性对称密钥的信封，返回各段明文；失败时返回 None。"""
+        # 1. 使用自己的RSA私钥解密出一次性对称密钥 (AES Key)
+        symmetric_key = self.rsa_util.decrypt_symmetric_key(envelope.encrypted_key)
+        if not symmetric_key:
+            logger.error(f"无法解密来自 {peer_username} 的消息的对称密钥。")
+            return None
+
+        # 2. 使用解密出的对称密钥逐段解密
+        plaintexts = []
+        for nonce, tag, ciphertext in envelope.segments:
+            plaintext = self.aes_util.decrypt_message(ciphertext, nonce, tag, symmetric_key)
+            if plaintext is None:
+                logger.error(f"✗✗✗ 无法解密来自 {peer_username} 的消息，可能被篡改或密钥错误")
+                return None
+            plaintexts.append(plaintext)
+        return plaintexts
+
+    def _decrypt_p2p_session_envelope(self, peer_username, envelope):
+        """用对方建立的会话密钥解密信封（密钥字段为会话ID），返回各段明文；会话未知、重放或解密失败时返回 None。"""
+        session = self.p2p_sessions.incoming(peer_username, envelope.encrypted_key)
+        if session is None:
+            logger.error(f"收到来自 {peer_username} 的消息使用了未知的会话密钥，无法解密。")
+            return None
+        last_counter = session.check_nonces([nonce for nonce, _, _ in envelope.segments])
+        if last_counter is None:
+            logger.error(f"✗✗✗ 来自 {peer_username} 的消息计数器无效（重放或乱序），已丢弃")
+            return None
+        associated_data = SESSION_ASSOCIATED_DATA.pack(envelope.kind, session.session_id)
+        plaintexts = []
+        for nonce, tag, ciphertext in envelope.segments:
+            plaintext = self.aes_util.decrypt_message(ciphertext, nonce, tag, session.key, associated_data)
+            if plaintext is None:
+                logger.error(f"✗✗✗ 无法解密来自 {peer_username} 的消息，可能被篡改或密钥错误")
+                return None
+            plaintexts.append(plaintext)
+        session.counter = last_counter
+        return plaintexts
+
+    @staticmethod
+    def _p2p_session_signed_data(connection_nonce, previous_session_id, key_field):
+        """
+        会话建立消息中签名的数据：协议版本 + 接收方在本连接握手中提供的随机数 + 本连接上的上一个会话ID + 密钥字段。
+        随机数把签名绑定到当前连接，上一个会话ID把同一连接上的多次换钥串成链，重放的会话建立消息因此验证失败。
+        """
+        return P2P_SESSION_VERSION.encode('utf-8') + connection_nonce + previous_session_id + key_field
+
+    def _accept_p2p_session(self, peer_username, peer_public_key_pem, envelope, session_nonce):
+        """
+        处理对方的会话建立消息：用自己的RSA私钥解密会话密钥，用会话密钥解密对方的签名，
+        再用对方的RSA公钥验证签名，验证通过后记录该会话，之后对方发来的会话消息用它解密。
+        :param session_nonce: 本端在收到该消息的连接握手中提供的随机数。
+        """
+        key_field = envelope.encrypted_key
+        session_id, encrypted_key = key_field[:SESSION_ID_SIZE], key_field[SESSION_ID_SIZE:]
+        session_key = self.rsa_util.decrypt_symmetric_key(encrypted_key)
+        if not session_key:
+            logger.error(f"无法解密来自 {peer_username} 的会话密钥。")
+            return
+        nonce, tag, ciphertext = envelope.segments[0]
+        signature = self.aes_util.decrypt_message(
+            ciphertext, nonce, tag, session_key, SESSION_ASSOCIATED_DATA.pack(envelope.kind, session_id))
+        if signature is None:
+            logger.error(f"无法解密来自 {peer_username} 的会话密钥签名。")
+            return
+
+        # 对方是在线好友时用服务器提供的公钥验证签名，握手中对方声称的公钥与它不一致时拒绝
+        signer_public_key = peer_public_key_pem
+        friend_info = self.online_friends_info.get(peer_username)
+        friend_public_key_pem = friend_info.get("public_key_pem") if friend_info else None
+        if friend_public_key_pem:
+            if peer_public_key_pem and peer_public_key_pem.strip() != friend_public_key_pem.strip():
+                logger.error(f"{peer_username} 在P2P握手中提供的公钥与服务器记录的不一致，拒绝其会话密钥。")
+                return
+            signer_public_key = self._friend_public_key(friend_info, friend_public_key_pem)
+        previous_id = self.p2p_sessions.previous_incoming_id(peer_username, session_nonce)
+        if not signer_public_key or not self.rsa_util.verify_signature(
+                signer_public_key, signature, self._p2p_session_signed_data(session_nonce, previous_id, key_field)):
+            logger.error(f"✗✗✗ 来自 {peer_username} 的会话密钥签名无效（可能是重放的会话建立消息），已拒绝。")
+            return
+        if not self.p2p_sessions.set_incoming(peer_username, session_id, session_key, session_nonce,
+                                              previous_id):
+            logger.error(f"来自 {peer_username} 的会话建立消息验证期间接收会话已经变化，已拒绝。")
+            return
+        logger.info(f"已接受来自 {peer_username} 的P2P会话密钥。")
+
+    def _start_p2p_session(self, recipient_username, connection, friend_info, friend_public_key_pem):
+        """
+        在当前P2P连接上建立新的发送会话：会话密钥用对方的RSA公钥加密，会话ID和加密后的会话密钥连同对方在本连接握手中
+        提供的随机数、本连接上的上一个会话ID一起用自己的RSA私钥签名，签名用会话密钥加密（计数器 0），
+        以会话建立信封发给对方。调用方须持有该好友的发送锁。
+        :return: 新的 P2PSession；失败时返回 None。
+        """
+        connection_nonce = self.p2p_manager.p2p_session_nonce(connection)
+        if connection_nonce is None:
+            logger.error(f"与 {recipient_username} 的P2P连接已关闭或不支持会话密钥，无法建立会话。")
+            return None
+        previous_id = self.p2p_sessions.previous_outgoing_id(recipient_username, connection)
+        session = self.p2p_sessions.new_outgoing(connection)
+        encrypted_key = self.rsa_util.encrypt_symmetric_key(
+            self._friend_public_key(friend_info, friend_public_key_pem), session.key)
+        if encrypted_key is None:
+            logger.error(f"无法加密与 {recipient_username} 的会话密钥。")
+            return None
+        key_field = session.session_id + encrypted_key
+        signature = self.rsa_util.sign(self._p2p_session_signed_data(connection_nonce, previous_id, key_field))
+        if signature is None:
+            logger.error(f"无法对与 {recipient_username} 的会话密钥签名。")
+            return None
+        encrypted_signature, nonce, tag = self.aes_util.encrypt_message(
+            signature, session.key, SESSION_NONCE.pack(0),
+            SESSION_ASSOCIATED_DATA.pack(P2P_ENVELOPE_SESSION_INIT, session.session_id))
+        if encrypted_signature is None:
+            return None
+        if not self.p2p_manager.send_p2p_envelope(recipient_username, encode_p2p_envelope(
+                P2P_ENVELOPE_SESSION_INIT, key_field, [(nonce, tag, encrypted_signature)])):
+            logger.error(f"发送会话密钥给 {recipient_username} 失败。")
+            return None
+        self.p2p_sessions.set_outgoing(recipient_username, session)
+        logger.info(f"已与 {recipient_username} 建立新的P2P会话密钥。")
+        return session
+
+    def _send_p2p_session_envelope(self, recipient_username, kind, plaintexts, friend_info, friend_public_key_pem):
+        """
+        用与该好友的会话密钥加密并发送一个二进制信封（双方都支持会话密钥时使用），每段使用递增的计数器作为 nonce。
+        当前连接上还没有会话、或会话达到使用上限时，先用RSA建立新的会话；之后的消息不再需要任何RSA运算。
+        :param kind: 信封的消息类型（P2P_ENVELOPE_CHAT 等）。
+        :param plaintexts: 各段明文，顺序与该消息类型规定的段一致。
+        :return: True发送成功，False失败。
+        """
+        with self.p2p_sessions.send_lock(recipient_username):
+            connection = self.p2p_manager.active_p2p_connections.get(recipient_username)
+            session = self.p2p_sessions.outgoing(recipient_username, connection, len(plaintexts))
+            if session is None:
+                session = self._start_p2p_session(recipient_username, connection, friend_info, friend_public_key_pem)
+                if session is None:
+                    return False
+            kind |= P2P_ENVELOPE_SESSION
+            associated_data = SESSION_ASSOCIATED_DATA.pack(kind, session.session_id)
+            segments = []
+            for plaintext in plaintexts:
+                ciphertext, nonce, tag = self.aes_util.encrypt_message(
+                    plaintext, session.key, session.next_nonce(), associated_data)
+                if ciphertext is None:
+                    return False
+                segments.append((nonce, tag, ciphertext))
+            return self.p2p_manager.send_p2p_envelope(
+                recipient_username, encode_p2p_envelope(kind, session.session_id, segments))
+
+    def _process_chat_message(self, peer_username, decrypted_message, sid=None):
+        """
+        将解密后的聊天消息通过SocketIO推送到浏览器。
+        :param peer_username: 发送方用户名
+        :param decrypted_message: 解密后的消息文本
+        :param sid: SocketIO会话ID
+        """
+        # 使用当前SocketIO SID，如果没有提供
+        if not sid:
+            sid = self.current_socketio_sid
+            logger.info(f"使用当前客户端SID: {sid} (未提供SID)")
+
+        if sid:
+            # 先发送解密状态
+            self.socketio_instance.emit('message_status',
+                                       {'status': 'decrypting', 'message': ''},
+                                       room=sid)
+
+            # 短暂延迟后显示解密后的消息
+            time.sleep(0.2)  # 模拟解密过程，实际上已经解密完成
+
+            # 确保当前用户ID和用户名正确配置
+            user_id = str(self.logged_in_user_id) if self.logged_in_user_id else None
+            username = self.logged_in_username
+            logger.info(f"当前用户信息: ID={user_id}, 用户名={username}")
+
+            # 发送解密后的消息，确保包含正确的发送者和接收者信息
+            logger.info(f"准备向SID: {sid} 发送来自 {peer_username} 的消息: \"{decrypted_message}\"")
+            self.socketio_instance.emit('receive_message',
+                                        {'sender': peer_username, 
+                                         'recipient': user_id, 
+                                         'message': decrypted_message},
+                                        room=sid)
+            logger.info(f"已完成向SID: {sid} 发送来自 {peer_username} 的消息")
+
+            # 发送解密完成状态
+            self.socketio_instance.emit('message_status',
+                                       {'status': 'decrypted', 'message': ''},
+                                       room=sid)
+
+            logger.info(f"UI通知: 接收到 {peer_username} 的消息并显示在用户界面，使用SID: {sid}")
+        else:
+            logger.warning(f"没有可用的SocketIO SID，聊天消息无法推送到浏览器。当前sid: {sid}")
+            # 广播消息到所有连接，尝试确保消息能被接收
+            try:
+                logger.info(f"尝试广播消息给所有连接")
+
+                # 确保当前用户ID和用户名正确配置
+                user_id = str(self.logged_in_user_id) if self.logged_in_user_id else None
+                logger.info(f"广播消息时当前用户ID={user_id}")
+
+                self.socketio_instance.emit('receive_message',
+                                            {'sender': peer_username, 
+                                             'recipient': user_id, 
+                                             'message': decrypted_message},
+                                            broadcast=True)
+            except Exception as e:
+                logger.error(f"广播消息失败: {e}")
+
     def _process_steg_image(self, peer_username, image_data_bytes, hidden_message, sid=None):
         """
         处理隐写图片数据和隐藏消息，将其显示在用户界面上。
@@ -783,12 +1463,22 @@ class ChatClient:
             time.sleep(0.1)  # 给线程启动和握手一点时间，避免立即发送数据失败
 
         try:
+            # 双方都支持会话密钥时用会话密钥加密，不再为每条消息做RSA加密
+            if self.p2p_manager.supports_p2p_session(recipient_username):
+                if self._send_p2p_session_envelope(recipient_username, P2P_ENVELOPE_CHAT, [message.encode('utf-8')],
+                                                   friend_info, friend_public_key_pem):
+                    logger.info(f"✓✓✓ 成功发送加密消息给 {recipient_username}")
+                    return True
+                logger.error(f"✗✗✗ 发送加密消息给 {recipient_username} 失败")
+                return False
+
             # 1. 生成一次性对称密钥 (AES Key)
             aes_key = os.urandom(32)  # AES-256 需要32字节的密钥
             logger.debug(f"生成AES密钥用于与 {recipient_username} 的通信")
 
             # 2. 使用接收方的RSA公钥加密这个对称密钥
-            encrypted_aes_key = self.rsa_util.encrypt_symmetric_key(friend_public_key_pem, aes_key)
+            encrypted_aes_key = self.rsa_util.encrypt_symmetric_key(
+                self._friend_public_key(friend_info, friend_public_key_pem), aes_key)
             if encrypted_aes_key is None:
                 logger.error("无法加密对称密钥，消息发送失败。")
                 return False
@@ -801,7 +1491,16 @@ class ChatClient:
                 return False
             logger.info(f"===> 消息已使用AES加密，准备发送给 {recipient_username}")
 
-            # 将所有加密后的二进制数据（密文、密钥、Nonce、Tag）转换为Base64编码，
+            # 分帧连接上以二进制信封发送，密钥、Nonce、Tag 和密文都是原始字节
+            if self.p2p_manager.supports_p2p_envelope(recipient_username):
+                if self.p2p_manager.send_p2p_envelope(recipient_username, encode_p2p_envelope(
+                        P2P_ENVELOPE_CHAT, encrypted_aes_key, [(nonce, tag, encrypted_message)])):
+                    logger.info(f"✓✓✓ 成功发送加密消息给 {recipient_username}")
+                    return True
+                logger.error(f"✗✗✗ 发送加密消息给 {recipient_username} 失败")
+                return False
+
+            # 对方是旧版本客户端：将所有加密后的二进制数据（密文、密钥、Nonce、Tag）转换为Base64编码，
             # 因为JSON协议通常传输文本，二进制数据需要先编码。
             encrypted_payload = {
                 "type": "chat_message",  # 明确消息类型
@@ -889,10 +1588,35 @@ class ChatClient:
                 return False
             logger.info(f"隐写成功，处理后图片大小: {len(steg_image_bytes)} 字节")
 
+            # 确保 P2P 连接存在
+            logger.info(f"检查与 {recipient_username} 的P2P连接")
+            conn_socket = self.p2p_manager.active_p2p_connections.get(recipient_username)
+            if not conn_socket:
+                logger.info(f"尝试建立与 {recipient_username} 的P2P连接")
+                conn_socket = self.p2p_manager.connect_p2p_peer(
+                    recipient_username, friend_ip, friend_port,
+                    self.logged_in_username, self.my_public_key_pem
+                )
+                if not conn_socket:
+                    logger.error(f"无法与 {recipient_username} 建立P2P连接，隐写图片发送失败。")
+                    return False
+                logger.info(f"成功建立与 {recipient_username} 的P2P连接")
+                time.sleep(0.1)  # 给连接一点稳定的时间
+
+            # 双方都支持会话密钥时，隐藏消息和图片两段都用会话密钥加密，不再做RSA加密
+            if self.p2p_manager.supports_p2p_session(recipient_username):
+                if self._send_p2p_session_envelope(recipient_username, P2P_ENVELOPE_STEG_IMAGE,
+                                                   [hidden_message_text.encode('utf-8'), steg_image_bytes],
+                                                   friend_info, friend_public_key_pem):
+                    logger.info(f"已成功发送加密隐写图片消息给 {recipient_username}.")
+                    return True
+                logger.error(f"通过P2PManager发送隐写图片消息给 {recipient_username} 失败。")
+                return False
+
             # 2. 为隐藏消息本身生成一个一次性AES密钥，并用RSA加密这个密钥
             aes_key_for_hidden_msg = os.urandom(32)
-            encrypted_aes_key_for_hidden_msg = self.rsa_util.encrypt_symmetric_key(friend_public_key_pem,
-                                                                                aes_key_for_hidden_msg)
+            encrypted_aes_key_for_hidden_msg = self.rsa_util.encrypt_symmetric_key(
+                self._friend_public_key(friend_info, friend_public_key_pem), aes_key_for_hidden_msg)
             if encrypted_aes_key_for_hidden_msg is None:
                 logger.error("无法加密隐藏消息的对称密钥。")
                 return False
@@ -917,23 +1641,20 @@ class ChatClient:
                 return False
             logger.info(f"成功加密隐写图片数据，加密后大小: {len(encrypted_image_data)} 字节")
 
-            # 确保 P2P 连接存在
-            logger.info(f"检查与 {recipient_username} 的P2P连接")
-            conn_socket = self.p2p_manager.active_p2p_connections.get(recipient_username)
-            if not conn_socket:
-                logger.info(f"尝试建立与 {recipient_username} 的P2P连接")
-                conn_socket = self.p2p_manager.connect_p2p_peer(
-                    recipient_username, friend_ip, friend_port,
-                    self.logged_in_username, self.my_public_key_pem
-                )
-                if not conn_socket:
-                    logger.error(f"无法与 {recipient_username} 建立P2P连接，隐写图片发送失败。")
+            try:
+                # 分帧连接上以二进制信封发送：隐藏消息和图片两段密文共用一个对称密钥，各自有独立的Nonce和Tag
+                if self.p2p_manager.supports_p2p_envelope(recipient_username):
+                    envelope = encode_p2p_envelope(P2P_ENVELOPE_STEG_IMAGE, encrypted_aes_key_for_hidden_msg, [
+                        (nonce_hidden_msg, tag_hidden_msg, encrypted_hidden_msg),
+                        (image_nonce, image_tag, encrypted_image_data),
+                    ])
+                    if self.p2p_manager.send_p2p_envelope(recipient_username, envelope):
+                        logger.info(f"已成功发送加密隐写图片消息给 {recipient_username}.")
+                        return True
+                    logger.error(f"通过P2PManager发送隐写图片消息给 {recipient_username} 失败。")
                     return False
-                logger.info(f"成功建立与 {recipient_username} 的P2P连接")
-                time.sleep(0.1)  # 给连接一点稳定的时间
 
-            try:
-                # 封装所有加密后的数据为JSON，并Base64编码
+                # 对方是旧版本客户端：封装所有加密后的数据为JSON，并Base64编码
                 encrypted_payload = {
                     "type": "steg_image",  # 明确消息类型为隐写图片
                     "encrypted_image_data": base64.b64encode(encrypted_image_data).decode('utf-8'),
@@ -1034,24 +1755,39 @@ class ChatClient:
             time.sleep(0.1)  # 给连接一点稳定的时间
 
         try:
-            # 编码音频数据
-            encoded_audio = self.audio_util.encode_audio(audio_data_bytes)
-            if encoded_audio is None:
-                logger.error("编码音频数据失败。")
+            # 双方都支持会话密钥时用会话密钥加密原始音频，不再做RSA加密
+            if self.p2p_manager.supports_p2p_session(recipient_username):
+                if self._send_p2p_session_envelope(recipient_username, P2P_ENVELOPE_AUDIO, [audio_data_bytes],
+                                                   friend_info, friend_public_key_pem):
+                    logger.info(f"已成功发送加密语音消息给 {recipient_username}.")
+                    return True
+                logger.error(f"通过P2PManager发送语音消息给 {recipient_username} 失败。")
                 return False
-            
+
+            # 分帧连接上以二进制信封发送原始音频；对方是旧版本客户端时先把音频编码为文本，放入JSON发送
+            use_envelope = self.p2p_manager.supports_p2p_envelope(recipient_username)
+            if use_envelope:
+                audio_plaintext = audio_data_bytes
+            else:
+                encoded_audio = self.audio_util.encode_audio(audio_data_bytes)
+                if encoded_audio is None:
+                    logger.error("编码音频数据失败。")
+                    return False
+                audio_plaintext = encoded_audio.encode('utf-8')
+
             # 1. 生成一次性对称密钥 (AES Key)
             aes_key = os.urandom(32)  # AES-256 需要32字节的密钥
             logger.debug(f"生成AES密钥用于与 {recipient_username} 的语音通信")
 
             # 2. 使用接收方的RSA公钥加密这个对称密钥
-            encrypted_aes_key = self.rsa_util.encrypt_symmetric_key(friend_public_key_pem, aes_key)
+            encrypted_aes_key = self.rsa_util.encrypt_symmetric_key(
+                self._friend_public_key(friend_info, friend_public_key_pem), aes_key)
             if encrypted_aes_key is None:
                 logger.error("无法加密对称密钥，语音消息发送失败。")
                 return False
             
             # 3. 使用对称密钥加密音频数据
-            encrypted_audio_data = self.aes_util.encrypt_message(encoded_audio.encode('utf-8'), aes_key)
+            encrypted_audio_data = self.aes_util.encrypt_message(audio_plaintext, aes_key)
             if encrypted_audio_data is None:
                 logger.error("无法加密音频数据。")
                 return False
@@ -1059,6 +1795,14 @@ class ChatClient:
             encrypted_message, nonce, tag = encrypted_audio_data
             logger.info(f"音频数据已加密，准备发送给 {recipient_username}")
 
+            if use_envelope:
+                if self.p2p_manager.send_p2p_envelope(recipient_username, encode_p2p_envelope(
+                        P2P_ENVELOPE_AUDIO, encrypted_aes_key, [(nonce, tag, encrypted_message)])):
+                    logger.info(f"已成功发送加密语音消息给 {recipient_username}.")
+                    return True
+                logger.error(f"通过P2PManager发送语音消息给 {recipient_username} 失败。")
+                return False
+
             # 封装所有加密后的数据为JSON，并Base64编码
             encrypted_payload = {
                 "type": "audio_message",  # 明确消息类型为语音消息
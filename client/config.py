@@ -41,3 +41,35 @@ CHUNK = 1024  # 每个缓冲区的帧数
 CHANNELS = 1  # 单声道
 RATE = 16000  # 采样率
 RECORD_SECONDS = 5  # 默认录音时长
+
+# 与服务器控制连接的分帧协议下单帧允许的最大长度（字节）
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# 分帧协议下等待服务器响应的最长时间（秒），超时后断开连接以免响应错位
+SERVER_RESPONSE_TIMEOUT = 30
+
+# 列表类请求（在线好友 / 所有好友）每页请求的条数，服务器按 UserID 游标分页返回
+LIST_PAGE_SIZE = 500
+
+# 公钥缓存文件：按指纹保存好友公钥，服务器对已缓存的公钥只返回指纹
+KEY_CACHE_FILE = "public_key_cache.json"
+# 内存中缓存的已解析公钥对象的最大数量（LRU），发送消息时不必每次都重新解析好友的公钥PEM
+PUBLIC_KEY_OBJECT_CACHE_SIZE = 256
+
+# 控制连接意外断开后，用 LOGIN 返回的恢复令牌自动重连并恢复会话（RESUME）的最多尝试次数和重试间隔（秒）；
+# 服务器只在断开后的宽限期内保留会话，超过后需要重新登录
+RESUME_ATTEMPTS = 5
+RESUME_RETRY_INTERVAL = 1.0
+
+# P2P连接分帧协议下单条消息（加密后的文本、图片、语音）允许的最大长度（字节），以及每次 recv 的缓冲区大小（字节）
+P2P_MAX_FRAME_SIZE = 100 * 1024 * 1024
+P2P_RECV_BUFFER_SIZE = 256 * 1024
+
+# 处理收到的P2P消息（解密、推送到浏览器）的工作线程数，以及已收到但尚未处理完的P2P消息数上限（达到上限时暂停接收）
+P2P_WORKER_THREADS = 4
+P2P_MAX_PENDING_MESSAGES = 256
+
+# P2P会话密钥：每个P2P连接用RSA建立一次，之后的消息只做AES-GCM加密；
+# 一个会话密钥加密的消息段数或使用时长（秒）超过上限时重新建立（换钥）
+P2P_SESSION_MAX_MESSAGES = 100000
+P2P_SESSION_MAX_AGE = 3600
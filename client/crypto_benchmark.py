@@ -0,0 +1,131 @@
+"""
+P2P 消息加密基准测试工具。
+
+不经过网络，比较两种加密方式下每条文本消息在发送方（加密）和接收方（解密）的 CPU 开销：
+- per-message：每条消息生成一次性 AES 密钥并用接收方的 RSA 公钥加密，接收方每条消息做一次 RSA 私钥解密（旧方式）；
+- session：每个P2P连接用 RSA 建立一次会话密钥（加密、签名、验证，与 ChatClient 相同），之后每条消息只做 AES-GCM。
+输出每秒消息数和每条消息的 CPU 时间（微秒）；session 的结果包含建立会话的开销，按 --count 条消息分摊。
+
+示例:
+    python crypto_benchmark.py
+    python crypto_benchmark.py --size 4k --count 5000 --json crypto.json
+"""
+import argparse
+import json
+import os
+import time
+
+from utils.RSA import RSAUtils
+from utils.AES import AESUtils
+from utils.SESSION import SessionKeyStore, SESSION_ASSOCIATED_DATA, SESSION_NONCE, NO_SESSION_ID
+from utils.PROTOCOL import P2P_ENVELOPE_CHAT, P2P_ENVELOPE_SESSION, P2P_ENVELOPE_SESSION_INIT, P2P_SESSION_VERSION, \
+    P2P_SESSION_NONCE_SIZE
+
+_UNITS = {"k": 1024, "m": 1024 * 1024}
+
+
+def parse_size(text):
+    """把 "64" / "4k" / "1m" 之类的字符串解析为字节数。"""
+    text = text.strip().lower()
+    if text[-1:] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+
+def make_rsa():
+    rsa_util = RSAUtils()
+    private_key, public_key = rsa_util.generate_key_pair()
+    rsa_util.set_keys(private_key, public_key)
+    return rsa_util, public_key
+
+
+def run_per_message(sender, receiver, receiver_public_key, aes, message, count):
+    """旧方式：每条消息一个 RSA 加密的一次性密钥。返回 (发送方CPU秒数, 接收方CPU秒数)。"""
+    start = time.process_time()
+    envelopes = []
+    for _ in range(count):
+        key = os.urandom(32)
+        envelopes.append((sender.encrypt_symmetric_key(receiver_public_key, key), aes.encrypt_message(message, key)))
+    send_cpu = time.process_time() - start
+
+    start = time.process_time()
+    for encrypted_key, (ciphertext, nonce, tag) in envelopes:
+        key = receiver.decrypt_symmetric_key(encrypted_key)
+        if aes.decrypt_message(ciphertext, nonce, tag, key) != message:
+            raise RuntimeError("解密结果与原消息不一致")
+    return send_cpu, time.process_time() - start
+
+
+def run_session(sender, sender_public_key, receiver, receiver_public_key, aes, message, count):
+    """会话密钥：建立一次会话，之后每条消息只做 AES-GCM。返回 (发送方CPU秒数, 接收方CPU秒数)。"""
+    # 签名的数据与 ChatClient 相同：协议版本 + 接收方的连接随机数 + 上一个会话ID（连接上的第一个会话）+ 密钥字段
+    connection_nonce = os.urandom(P2P_SESSION_NONCE_SIZE)
+    start = time.process_time()
+    session = SessionKeyStore.new_outgoing(None)
+    key_field = session.session_id + sender.encrypt_symmetric_key(receiver_public_key, session.key)
+    signed_data = P2P_SESSION_VERSION.encode('utf-8') + connection_nonce + NO_SESSION_ID + key_field
+    signature = sender.sign(signed_data)
+    init_associated_data = SESSION_ASSOCIATED_DATA.pack(P2P_ENVELOPE_SESSION_INIT, session.session_id)
+    init = aes.encrypt_message(signature, session.key, SESSION_NONCE.pack(0), init_associated_data)
+    associated_data = SESSION_ASSOCIATED_DATA.pack(P2P_ENVELOPE_CHAT | P2P_ENVELOPE_SESSION, session.session_id)
+    messages = [aes.encrypt_message(message, session.key, session.next_nonce(), associated_data)
+                for _ in range(count)]
+    send_cpu = time.process_time() - start
+
+    start = time.process_time()
+    session_key = receiver.decrypt_symmetric_key(key_field[len(session.session_id):])
+    encrypted_signature, nonce, tag = init
+    signature = aes.decrypt_message(encrypted_signature, nonce, tag, session_key, init_associated_data)
+    if not receiver.verify_signature(sender_public_key, signature,
+                                     P2P_SESSION_VERSION.encode('utf-8') + connection_nonce + NO_SESSION_ID + key_field):
+        raise RuntimeError("会话密钥签名验证失败")
+    for ciphertext, nonce, tag in messages:
+        if aes.decrypt_message(ciphertext, nonce, tag, session_key, associated_data) != message:
+            raise RuntimeError("解密结果与原消息不一致")
+    return send_cpu, time.process_time() - start
+
+
+def run_benchmark(args):
+    size = parse_size(args.size)
+    message = b"a" * size
+    sender, sender_public_key = make_rsa()
+    receiver, receiver_public_key = make_rsa()
+    aes = AESUtils()
+    results = []
+    for mode in args.modes.split(","):
+        if mode == "per-message":
+            send_cpu, receive_cpu = run_per_message(sender, receiver, receiver_public_key, aes, message, args.count)
+        elif mode == "session":
+            send_cpu, receive_cpu = run_session(sender, sender_public_key, receiver, receiver_public_key, aes,
+                                                message, args.count)
+        else:
+            raise ValueError(f"未知的模式: {mode}")
+        row = {
+            "mode": mode,
+            "size": size,
+            "count": args.count,
+            "send_us_per_message": round(send_cpu / args.count * 1e6, 1),
+            "receive_us_per_message": round(receive_cpu / args.count * 1e6, 1),
+            # 接收方是瓶颈（RSA 私钥解密远比公钥加密慢），按接收方的 CPU 时间计算单核每秒能处理的消息数
+            "messages_per_second": round(args.count / max(receive_cpu, 1e-9)),
+        }
+        results.append(row)
+        print(f"[{mode:11}] {args.size:>5} x {args.count}: 发送 {row['send_us_per_message']:8} µs/条, "
+              f"接收 {row['receive_us_per_message']:8} µs/条, 接收方单核 {row['messages_per_second']:8} 条/s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="P2P 消息加密基准测试（每条消息RSA vs 会话密钥）")
+    parser.add_argument("--size", default="64", help="消息大小（支持 k/m 后缀）")
+    parser.add_argument("--count", type=int, default=2000, help="每种模式加密/解密的消息条数")
+    parser.add_argument("--modes", default="per-message,session", help="per-message / session，逗号分隔")
+    parser.add_argument("--json", help="将结果以JSON格式写入该文件")
+    return parser
+
+
+if __name__ == "__main__":
+    run_benchmark(build_parser().parse_args())
@@ -0,0 +1,177 @@
+"""
+P2P 传输基准测试工具。
+
+在本机回环地址上启动两个 P2PManager（不需要中心服务器，也不加密），发送方依次发送指定大小的消息，
+接收方每收到一条完整消息就通知发送方发送下一条，测量每种消息大小下的吞吐量 (MB/s)、每秒消息数和单条消息的延迟。
+--modes 可以同时测量分帧协议 (framed) 与旧的无分帧格式 (legacy)：旧格式每收到一块数据都要把整个缓冲区重新解析一遍，
+大消息的耗时随消息大小平方增长（50m 的消息在 legacy 模式下需要很长时间），默认只测 framed。
+--idle-peers N 另外建立 N 个空闲的P2P连接，测量它们在 --idle-seconds 秒内占用的 CPU 时间（应接近于零）。
+
+示例:
+    python p2p_benchmark.py --sizes 1k,1m,50m
+    python p2p_benchmark.py --sizes 1k,1m --modes framed,legacy --count 20
+    python p2p_benchmark.py --sizes 1k --idle-peers 200 --idle-seconds 5
+"""
+import argparse
+import json
+import logging
+import queue
+import statistics
+import sys
+import time
+
+from p2p_manager import P2PManager
+
+# 与 config.py 中的默认值一致（config.py 依赖 pyaudio，基准测试不导入它）
+BUFFER_SIZE = 4096
+P2P_MAX_FRAME_SIZE = 100 * 1024 * 1024
+P2P_RECV_BUFFER_SIZE = 256 * 1024
+P2P_WORKER_THREADS = 4
+P2P_MAX_PENDING_MESSAGES = 256
+
+_UNITS = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+
+
+def parse_size(text):
+    """把 "1k" / "1m" / "50m" / "4096" 之类的字符串解析为字节数。"""
+    text = text.strip().lower()
+    if text[-1:] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+
+def make_payload(size):
+    """生成指定大小的消息：与真实的加密消息一样是一个 JSON 对象，旧的无分帧格式也能判断出它已经完整。"""
+    prefix = b'{"type": "benchmark", "data": "'
+    suffix = b'"}'
+    return prefix + b"a" * max(0, size - len(prefix) - len(suffix)) + suffix
+
+
+def make_manager(username, received, recv_buffer_size):
+    return P2PManager(
+        p2p_listen_host="127.0.0.1",
+        p2p_listen_port=0,
+        buffer_size=BUFFER_SIZE,
+        socketio_instance=None,
+        sid_getter_callback=lambda: "benchmark",
+        decrypt_and_process_callback=lambda peer, pem, data, sid, session_nonce: received.put(len(data)),
+        identity_info={"username": username, "public_key_pem": f"{username}-public-key"},
+        max_frame_size=P2P_MAX_FRAME_SIZE,
+        recv_buffer_size=recv_buffer_size,
+        worker_threads=P2P_WORKER_THREADS,
+        max_pending_messages=P2P_MAX_PENDING_MESSAGES,
+    )
+
+
+def run_size(mode, size, count, recv_buffer_size, timeout):
+    """在一对新建立的 P2P 连接上依次发送 count 条 size 字节的消息，返回结果行；超时返回 None。"""
+    received = queue.Queue()
+    receiver = make_manager("receiver", received, recv_buffer_size)
+    sender = make_manager("sender", queue.Queue(), recv_buffer_size)
+    if mode == "legacy":
+        receiver.p2p_framing = None  # 接收方模拟旧版本客户端，握手时不确认分帧协议
+    if not receiver.start_p2p_listener():
+        raise RuntimeError("无法启动P2P监听器")
+    try:
+        if not sender.connect_p2p_peer("receiver", "127.0.0.1", receiver.p2p_actual_port,
+                                       "sender", "sender-public-key"):
+            raise RuntimeError("无法建立P2P连接")
+        payload = make_payload(size)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(count):
+            sent_at = time.perf_counter()
+            if not sender.send_p2p_raw_data("receiver", payload):
+                raise RuntimeError("发送失败")
+            try:
+                length = received.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if length != len(payload):
+                raise RuntimeError(f"收到的消息长度 {length} 与发送的 {len(payload)} 不一致")
+            latencies.append(time.perf_counter() - sent_at)
+        elapsed = time.perf_counter() - start
+    finally:
+        sender.close_all_p2p_connections()
+        receiver.stop_p2p_listener()
+        receiver.close_all_p2p_connections()
+    return {
+        "mode": mode,
+        "size": size,
+        "count": count,
+        "mb_per_second": round(size * count / elapsed / 1024 / 1024, 1),
+        "messages_per_second": round(count / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+
+def run_idle(peers, seconds, recv_buffer_size):
+    """建立 peers 个空闲的P2P连接（接收方一侧共 peers 个连接，每个发送方一个），返回本进程在 seconds 秒内的 CPU 占用率。"""
+    receiver = make_manager("receiver", queue.Queue(), recv_buffer_size)
+    if not receiver.start_p2p_listener():
+        raise RuntimeError("无法启动P2P监听器")
+    senders = []
+    try:
+        for i in range(peers):
+            sender = make_manager(f"sender{i}", queue.Queue(), recv_buffer_size)
+            senders.append(sender)
+            if not sender.connect_p2p_peer("receiver", "127.0.0.1", receiver.p2p_actual_port,
+                                           f"sender{i}", "sender-public-key"):
+                raise RuntimeError("无法建立P2P连接")
+        time.sleep(0.5)  # 等待握手全部完成
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        time.sleep(seconds)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+    finally:
+        for sender in senders:
+            sender.close_all_p2p_connections()
+        receiver.stop_p2p_listener()
+        receiver.close_all_p2p_connections()
+    return {"idle_peers": peers, "seconds": round(wall, 2), "cpu_seconds": round(cpu, 4),
+            "cpu_percent": round(cpu / wall * 100, 2)}
+
+
+def run_benchmark(args):
+    results = []
+    for mode in args.modes.split(","):
+        for size_text in args.sizes.split(","):
+            size = parse_size(size_text)
+            # 未指定条数时每种大小发送约 --total 字节（至少 3 条、至多 1000 条）
+            count = args.count or max(3, min(1000, parse_size(args.total) // size))
+            row = run_size(mode, size, count, parse_size(args.recv_buffer), args.timeout)
+            if row is None:
+                print(f"[{mode:6}] {size_text:>5}: {args.timeout}s 内未收到完整消息，跳过")
+                continue
+            results.append(row)
+            print(f"[{mode:6}] {size_text:>5} x {count:4}: {row['mb_per_second']:8} MB/s, "
+                  f"{row['messages_per_second']:9} 条/s, p50={row['p50_ms']}ms max={row['max_ms']}ms")
+    if args.idle_peers:
+        row = run_idle(args.idle_peers, args.idle_seconds, parse_size(args.recv_buffer))
+        results.append(row)
+        print(f"[idle  ] {row['idle_peers']} 个空闲连接 {row['seconds']}s 内占用 CPU {row['cpu_seconds']}s "
+              f"({row['cpu_percent']}%)")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="P2P 传输基准测试（本机回环）")
+    parser.add_argument("--sizes", default="1k,1m,50m", help="消息大小，逗号分隔（支持 k/m 后缀）")
+    parser.add_argument("--modes", default="framed", help="P2P 传输格式 framed / legacy，逗号分隔")
+    parser.add_argument("--count", type=int, default=0, help="每种大小发送的消息条数，0 表示按 --total 自动计算")
+    parser.add_argument("--total", default="256m", help="未指定 --count 时每种大小大约发送的总字节数")
+    parser.add_argument("--recv-buffer", default="256k", help="分帧协议下每次 recv 的缓冲区大小")
+    parser.add_argument("--timeout", type=float, default=120.0, help="等待单条消息到达的最长时间（秒）")
+    parser.add_argument("--idle-peers", type=int, default=0, help="测量空闲CPU占用时建立的空闲P2P连接数，0 表示不测")
+    parser.add_argument("--idle-seconds", type=float, default=5.0, help="测量空闲CPU占用的时长（秒）")
+    parser.add_argument("--json", help="将结果以JSON格式写入该文件")
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    run_benchmark(build_parser().parse_args())
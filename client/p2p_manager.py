@@ -1,24 +1,68 @@
+import os
 import socket
 import threading
+import selectors
 import json
 import time
 import logging
 import base64  # P2P Manager 转发 Base64 编码的加密数据
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from utils.PROTOCOL import P2P_FRAMING, P2P_FRAME_DATA, P2P_FRAME_ENVELOPE, P2PFrameReader, \
+    P2PEnvelopeError, encode_p2p_frame_header, decode_p2p_envelope, P2P_SESSION_VERSION, P2P_SESSION_NONCE_SIZE
 
 # from flask_socketio import SocketIO # 不能直接导入，否则会循环依赖
 
 logger = logging.getLogger(__name__)
 
 
+class _PeerConnection:
+    """I/O 线程中的一个P2P连接。入站连接在握手完成前 username 为 None。"""
+    __slots__ = ("sock", "addr", "username", "public_key_pem", "framed", "sessions", "local_nonce", "remote_nonce",
+                 "reader", "buffer", "deadline", "send_lock", "inbox", "draining")
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.username = None
+        self.public_key_pem = None
+        self.framed = False
+        self.sessions = False  # 双方是否都支持会话密钥（只用于分帧连接）
+        # 会话密钥协议下双方在握手中交换的随机数：会话建立消息签名接收方的随机数，重放到其他连接上时验证失败
+        self.local_nonce = os.urandom(P2P_SESSION_NONCE_SIZE)
+        self.remote_nonce = None
+        self.reader = None  # 分帧协议下的 P2PFrameReader
+        self.buffer = bytearray()  # 握手阶段以及旧的无分帧格式下累积的数据
+        self.deadline = None  # 握手超时 / 旧格式空闲超时的时刻（time.monotonic），None 表示没有超时
+        self.send_lock = threading.Lock()  # 保证多个线程同时发送时帧不会交错
+        self.inbox = deque()  # 等待工作线程处理的完整消息，同一连接的消息按到达顺序依次处理
+        self.draining = False  # 是否已有工作线程在处理 inbox
+
+
 class P2PManager:
     """
     P2PManager 负责点对点连接的建立、监听和数据的发送/接收。
     它不处理加密/解密逻辑，只处理原始的字节数据传输。
     当接收到数据时，它通过回调函数通知 ChatClient 进行解密。
+
+    监听socket和所有P2P连接由一个 I/O 线程上的 selectors 事件循环统一处理（没有连接时该线程退出），
+    空闲时不会被唤醒；收到的完整消息交给有界的工作线程池调用回调（解密、推送到浏览器），
+    同一连接的消息按顺序处理，工作线程池积压过多时 I/O 线程暂停读取，由 TCP 流控反压发送方。
+    发送在调用方线程中用阻塞的 sendall 完成，不经过 I/O 线程。
     """
 
+    # 不超过此大小的缓冲区与帧头合并为一次 sendall（分开发送小的帧头会与 Nagle 算法和延迟确认相互等待）
+    SEND_COALESCE_LIMIT = 64 * 1024
+    HANDSHAKE_TIMEOUT = 10.0  # 等待对方握手数据的最长时间（秒）
+    MAX_HANDSHAKE_SIZE = 64 * 1024  # 握手数据的最大长度（字节）
+    LEGACY_IDLE_TIMEOUT = 5.0  # 旧的无分帧格式下，数据不完整且空闲超过此时间（秒）时按已收到的数据处理
+    LEGACY_FLUSH_SIZE = 100 * 1024  # 空闲超时时只有累积的数据超过此大小（可能是图片数据）才尝试处理
+
     def __init__(self, p2p_listen_host, p2p_listen_port, buffer_size, socketio_instance, sid_getter_callback,
-                 decrypt_and_process_callback, identity_info):
+                 decrypt_and_process_callback, identity_info, max_frame_size, recv_buffer_size,
+                 worker_threads, max_pending_messages):
         """
         P2P管理器初始化。
         :param p2p_listen_host: P2P监听的IP地址。
@@ -26,9 +70,16 @@ class P2PManager:
         :param buffer_size: 接收缓冲区大小。
         :param socketio_instance: Flask-SocketIO 实例，用于向客户端浏览器发送实时消息。
         :param sid_getter_callback: 一个回调函数，用于获取当前用户的 SocketIO 会话ID (sid)。
-        :param decrypt_and_process_callback: 当接收到P2P消息时调用的回调函数 (peer_username, peer_public_key_pem, raw_data_bytes)。
-                                             这个回调函数将原始数据传回给ChatClient进行解密。
+        :param decrypt_and_process_callback: 当接收到P2P消息时调用的回调函数
+                                             (peer_username, peer_public_key_pem, raw_data_bytes, sid, session_nonce)。
+                                             这个回调函数将原始数据传回给ChatClient进行解密；
+                                             二进制信封帧以解析后的 P2PEnvelope 代替 raw_data_bytes 传入；
+                                             session_nonce 为本端在该连接握手中提供的随机数（不支持会话密钥时为 None）。
         :param identity_info: 包含当前用户用户名和公钥PEM字符串的字典，用于P2P握手时发送自己的身份。
+        :param max_frame_size: 分帧协议下单条P2P消息允许的最大长度（字节）。
+        :param recv_buffer_size: 分帧协议下每次 recv 的缓冲区大小（字节）。
+        :param worker_threads: 调用 decrypt_and_process_callback 的工作线程数。
+        :param max_pending_messages: 已收到但尚未处理完的消息数上限，达到上限时暂停读取所有连接。
         """
         self._p2p_listen_host = p2p_listen_host
         self._p2p_listen_port = p2p_listen_port
@@ -37,15 +88,37 @@ class P2PManager:
         self._get_sid_callback = sid_getter_callback  # 用于获取当前用户的sid
         self._decrypt_and_process_callback = decrypt_and_process_callback  # 收到加密消息后回调 ChatClient 解密
         self._identity_info = identity_info  # 当前客户端的身份信息，用于P2P握手
+        self._max_frame_size = max_frame_size
+        # 本端在握手中提供的分帧协议；对方也支持时该连接上的消息使用 P2P 分帧格式，否则使用旧的无分帧格式
+        self.p2p_framing = P2P_FRAMING
+        # 本端在握手中提供的会话密钥协议；对方也支持时 ChatClient 在该连接上使用会话密钥而不是每条消息一个RSA加密的密钥
+        self.p2p_session = P2P_SESSION_VERSION
 
         self.p2p_listen_socket = None  # P2P监听socket
         self.p2p_actual_port = None  # P2P实际监听的端口号（由操作系统分配）
-        self.p2p_listener_thread = None  # P2P监听线程对象
-        self.stop_p2p_listener_event = threading.Event()  # 用于控制监听线程停止的事件
 
         # 存储活跃的P2P连接 {对等体用户名: socket对象}
         self.active_p2p_connections = {}
         self.p2p_connections_lock = threading.Lock()  # 用于保护 active_p2p_connections 字典的线程锁，防止多线程访问冲突
+        self._connections = {}  # 已完成握手的连接 {socket对象: _PeerConnection}，同样由 p2p_connections_lock 保护
+
+        # I/O 线程：selectors 事件循环。其他线程通过 _call_in_loop 把对 selector 的修改交给它执行
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, self._drain_wakeup)
+        self._io_thread = None
+        self._io_tasks = deque()
+        self._io_lock = threading.Lock()  # 保护 _io_thread 和 _io_tasks
+        self._timed = set()  # 有超时时刻的连接（只在 I/O 线程中访问）
+        self._recv_buffer = bytearray(recv_buffer_size)  # 分帧连接共用的接收缓冲区（只在 I/O 线程中使用）
+        self._recv_view = memoryview(self._recv_buffer)
+
+        # 处理收到的消息的有界工作线程池
+        self._workers = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix="p2p-worker")
+        self._pending_slots = threading.BoundedSemaphore(max_pending_messages)
+        self._dispatch_lock = threading.Lock()  # 保护各连接的 inbox / draining
 
     def update_identity_info(self, username, public_key_pem):
         """更新P2P管理器中的身份信息，主要在登录成功后调用。"""
@@ -54,362 +127,73 @@ class P2PManager:
         logger.debug(f"P2PManager: 身份信息更新为 {username}.")
 
     def start_p2p_listener(self):
-        """启动一个线程来监听P2P连接。"""
-        if self.p2p_listener_thread and self.p2p_listener_thread.is_alive():
+        """启动P2P监听，由 I/O 线程接受传入连接。"""
+        if self.p2p_listen_socket is not None:
             logger.info("P2PManager: P2P监听器已在运行。")
             return True
 
-        self.stop_p2p_listener_event.clear()  # 清除停止事件，准备启动新监听
-        self.p2p_listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 创建TCP socket
-        self.p2p_listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 允许端口重用，避免重启时端口被占用
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 创建TCP socket
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 允许端口重用，避免重启时端口被占用
         try:
-            self.p2p_listen_socket.bind((self._p2p_listen_host, self._p2p_listen_port))  # 绑定地址和端口
-            self.p2p_actual_port = self.p2p_listen_socket.getsockname()[1]  # 获取操作系统实际分配的端口
-            self.p2p_listen_socket.listen(5)  # 开始监听，最多5个挂起连接
-            logger.info(f"P2PManager: P2P监听器已在 {self._p2p_listen_host}:{self.p2p_actual_port} 启动。")
-
-            # 创建并启动监听线程
-            self.p2p_listener_thread = threading.Thread(target=self._p2p_listener_loop)
-            self.p2p_listener_thread.daemon = True  # 设置为守护线程，主程序退出时它也会退出
-            self.p2p_listener_thread.start()
-            return True
+            listen_socket.bind((self._p2p_listen_host, self._p2p_listen_port))  # 绑定地址和端口
+            listen_socket.listen(5)  # 开始监听，最多5个挂起连接
+            listen_socket.setblocking(False)
         except socket.error as e:
             logger.error(f"P2PManager: 启动P2P监听器失败: {e}", exc_info=True)
-            if self.p2p_listen_socket:
-                try:
-                    if self.p2p_listen_socket.fileno() != -1:
-                        self.p2p_listen_socket.close()  # 失败时关闭socket
-                except socket.error as close_error:
-                    logger.debug(f"P2PManager: 关闭失败的监听socket时出错: {close_error}")
-                except Exception as close_error:
-                    logger.debug(f"P2PManager: 关闭失败的监听socket时发生未知错误: {close_error}")
-            self.p2p_listen_socket = None
-            self.p2p_actual_port = None
+            try:
+                listen_socket.close()  # 失败时关闭socket
+            except socket.error as close_error:
+                logger.debug(f"P2PManager: 关闭失败的监听socket时出错: {close_error}")
             return False
 
-    def _p2p_listener_loop(self):
-        """P2P监听线程的主循环，负责接受传入连接。"""
-        while not self.stop_p2p_listener_event.is_set():  # 循环直到收到停止事件
-            try:
-                # 检查监听socket是否有效
-                if not self.p2p_listen_socket or self.p2p_listen_socket.fileno() == -1:
-                    logger.warning("P2PManager: 监听socket无效，退出监听循环")
-                    break
-                    
-                self.p2p_listen_socket.settimeout(1.0)  # 设置accept超时，以便每隔1秒检查停止事件
-                conn, addr = self.p2p_listen_socket.accept()  # 接受新的连接，此方法会阻塞直到有连接或超时
-                logger.info(f"P2PManager: 接收到来自 {addr} 的P2P连接。")
-
-                # P2P连接建立后的初步握手：接收对方的身份信息和公钥
-                initial_data_raw = conn.recv(self._buffer_size)
-                if not initial_data_raw:
-                    try:
-                        if conn.fileno() != -1:
-                            conn.close()
-                    except socket.error as e:
-                        logger.debug(f"P2PManager: 关闭无效连接时出错: {e}")
-                    except Exception as e:
-                        logger.debug(f"P2PManager: 关闭无效连接时发生未知错误: {e}")
-                    logger.warning(f"P2PManager: P2P连接从 {addr} 接收到空初始化数据。")
-                    continue
+        self.p2p_listen_socket = listen_socket
+        self.p2p_actual_port = listen_socket.getsockname()[1]  # 获取操作系统实际分配的端口
+        self._call_in_loop(lambda: self._selector.register(
+            listen_socket, selectors.EVENT_READ, partial(self._accept_p2p_connections, listen_socket)))
+        logger.info(f"P2PManager: P2P监听器已在 {self._p2p_listen_host}:{self.p2p_actual_port} 启动。")
+        return True
 
-                try:
-                    initial_payload = json.loads(initial_data_raw.decode('utf-8'))
-                    peer_username = initial_payload.get("username")
-                    peer_public_key_pem = initial_payload.get("public_key")
-
-                    if peer_username and peer_public_key_pem:
-                        logger.info(f"P2PManager: P2P连接握手成功，对方是: {peer_username}")
-
-                        # 配置持久连接
-                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                        # 在某些操作系统上设置更多的TCP keepalive参数
-                        try:
-                            # TCP_KEEPIDLE: 连接闲置多久后开始发送keepalive探测包
-                            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
-                            # TCP_KEEPINTVL: 两次keepalive探测间的间隔时间
-                            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
-                            # TCP_KEEPCNT: 探测失败的次数，超过这个次数后断开连接
-                            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
-                        except (AttributeError, socket.error):
-                            # 如果当前系统不支持这些选项，忽略错误
-                            logger.debug("P2PManager: 当前系统不支持详细的TCP keepalive配置")
-
-                        # 立即发送自己的身份信息，完成双向握手（确认身份）
-                        my_initial_payload = {
-                            "username": self._identity_info["username"],
-                            "public_key": self._identity_info["public_key_pem"]
-                        }
-                        conn.sendall(json.dumps(my_initial_payload, ensure_ascii=False).encode('utf-8'))
-
-                        # 将新连接添加到活跃P2P连接列表
-                        with self.p2p_connections_lock:
-                            # 避免重复添加，如果已存在同名用户的连接，则关闭旧的
-                            if peer_username in self.active_p2p_connections:
-                                old_sock = self.active_p2p_connections[peer_username]
-                                try:
-                                    # 检查socket是否有效
-                                    if old_sock and old_sock.fileno() != -1:
-                                        old_sock.close()  # 尝试关闭旧连接
-                                except socket.error as e:
-                                    logger.debug(f"P2PManager: 关闭与 {peer_username} 的旧连接时出错: {e}")
-                                except Exception as e:
-                                    logger.debug(f"P2PManager: 关闭与 {peer_username} 的旧连接时发生未知错误: {e}")
-                            self.active_p2p_connections[peer_username] = conn
-
-                        # 启动一个新线程来处理该P2P连接的消息接收
-                        p2p_handler_thread = threading.Thread(target=self._handle_p2p_connection,
-                                                              args=(conn, peer_username, peer_public_key_pem))
-                        p2p_handler_thread.daemon = True
-                        p2p_handler_thread.start()
-                    else:
-                        logger.warning(f"P2PManager: 接收到无效的P2P连接初始化数据 from {addr}: {initial_payload}")
-                        try:
-                            if conn.fileno() != -1:
-                                conn.close()  # 关闭无效连接
-                        except socket.error as e:
-                            logger.debug(f"P2PManager: 关闭无效连接时出错: {e}")
-                        except Exception as e:
-                            logger.debug(f"P2PManager: 关闭无效连接时发生未知错误: {e}")
-
-                except json.JSONDecodeError:
-                    logger.error(
-                        f"P2PManager: 收到来自 {addr} 的无效P2P连接初始化JSON: {initial_data_raw.decode(errors='ignore')}",
-                        exc_info=True)
-                    try:
-                        if conn.fileno() != -1:
-                            conn.close()
-                    except socket.error as e:
-                        logger.debug(f"P2PManager: 关闭无效JSON连接时出错: {e}")
-                    except Exception as e:
-                        logger.debug(f"P2PManager: 关闭无效JSON连接时发生未知错误: {e}")
-            except socket.timeout:
-                continue  # 超时是正常的，循环继续检查停止事件
-            except socket.error as e:
-                # 检查是否是由于监听器停止而导致的错误
-                if self.stop_p2p_listener_event.is_set():
-                    break  # 正常关闭，退出循环
-                logger.error(f"P2PManager: P2P监听器出错: {e}", exc_info=True)
-                break  # 出现其他错误则退出监听循环
-            except Exception as e:
-                logger.error(f"P2PManager: P2P监听循环中发生未知错误: {e}", exc_info=True)
-                break
-        logger.info("P2PManager: P2P监听器已停止。")
-        if self.p2p_listen_socket:
-            try:
-                # 检查socket是否有效
-                if self.p2p_listen_socket.fileno() != -1:
-                    self.p2p_listen_socket.close()  # 关闭监听socket
-            except socket.error as e:
-                logger.warning(f"P2PManager: 关闭P2P监听socket时出错: {e}")
-            except Exception as e:
-                logger.warning(f"P2PManager: 关闭P2P监听socket时发生未知错误: {e}")
+    def stop_p2p_listener(self):
+        """停止P2P监听。已建立的P2P连接不受影响（由 close_all_p2p_connections 关闭）。"""
+        listen_socket = self.p2p_listen_socket
+        if listen_socket is None:
+            return
+        logger.info("P2PManager: 正在停止P2P监听器...")
         self.p2p_listen_socket = None
         self.p2p_actual_port = None
+        closed = threading.Event()
 
-    def _handle_p2p_connection(self, conn_socket, peer_username, peer_public_key_pem):
-        """
-        处理来自单个P2P连接的消息接收。
-        此线程持续接收数据，并将接收到的原始数据通过回调函数传递给ChatClient处理。
-        支持大型数据包的接收和重组，例如图片和隐写图片数据。
-        :param conn_socket: 与对等体建立的socket连接。
-        :param peer_username: 对等体的用户名。
-        :param peer_public_key_pem: 对等体的公钥PEM格式字符串。
-        """
-        logger.info(f"P2PManager: P2P消息处理器为 {peer_username} 启动。")
-        
-        # 添加消息缓冲和消息边界检测的变量
-        message_buffer = bytearray()  # 用于累积接收到的数据
-        message_complete = False      # 标志消息是否完整
-        message_end_marker = b'}'     # JSON结束标记
-        chunk_timeout = 5.0           # 数据块接收超时时间(秒)，增加到5秒以处理大型数据
-        last_chunk_time = time.time() # 上次接收数据块的时间
-        max_buffer_size = 100 * 1024 * 1024  # 最大缓冲区大小(100MB)，增加以支持大型图片
-
-        try:
-            # 设置非阻塞模式，用于实现超时检测
-            conn_socket.setblocking(False)
-            
-            while True:
-                try:
-                    # 尝试接收数据，非阻塞模式
-                    raw_data = conn_socket.recv(self._buffer_size)
-                    if not raw_data:  # 如果收到空数据，表示连接已关闭
-                        logger.info(f"P2PManager: P2P连接与 {peer_username} 断开。")
-                        break
-                    
-                    # 记录收到数据
-                    logger.info(f"P2PManager: ↓↓↓ 从 {peer_username} 接收到数据 ({len(raw_data)} 字节)")
-                    
-                    # 更新最后一次接收数据的时间
-                    last_chunk_time = time.time()
-                    
-                    # 将接收到的数据添加到缓冲区
-                    message_buffer.extend(raw_data)
-                    
-                    # 检查缓冲区大小，防止内存溢出
-                    if len(message_buffer) > max_buffer_size:
-                        logger.error(f"P2PManager: 接收缓冲区超过最大限制({max_buffer_size/1024/1024:.2f}MB)，丢弃消息")
-                        message_buffer = bytearray()
-                        continue
-                    
-                    # 检查是否是一个完整的JSON消息
-                    try:
-                        # 尝试加载累积的数据为JSON，如果成功则表示消息完整
-                        json_data = json.loads(message_buffer.decode('utf-8'))
-                        message_complete = True
-                    except json.JSONDecodeError:
-                        # JSON解析失败，可能消息不完整或格式错误
-                        if message_buffer.endswith(message_end_marker):
-                            # 如果以JSON结束符'}'结尾，可能是一个完整的JSON，但格式错误
-                            # 尝试寻找最后一个有效的JSON对象
-                            try:
-                                # 查找最后一个可能的JSON开始和结束位置
-                                start_pos = message_buffer.rfind(b'{')
-                                end_pos = len(message_buffer)
-                                
-                                if start_pos != -1 and start_pos < end_pos:
-                                    # 尝试解析最后一段JSON
-                                    potential_json = message_buffer[start_pos:end_pos]
-                                    json_data = json.loads(potential_json.decode('utf-8'))
-                                    message_buffer = bytearray(potential_json)
-                                    message_complete = True
-                            except:
-                                # 仍然无法解析，继续等待更多数据
-                                message_complete = False
-                        else:
-                            # 消息不完整，继续接收
-                            message_complete = False
-                    
-                    # 如果消息完整，处理它
-                    if message_complete:
-                        logger.info(f"P2PManager: 收到来自 {peer_username} 的完整消息，大小: {len(message_buffer)} 字节")
-                        
-                        # 处理完整的消息
-                        if self._decrypt_and_process_callback:
-                            current_sid = self._get_sid_callback()
-                            if current_sid:
-                                self._decrypt_and_process_callback(peer_username, peer_public_key_pem, bytes(message_buffer), current_sid)
-                            else:
-                                logger.warning(f"P2PManager: 无法获取用户 {self._identity_info['username']} 的SID，无法推送消息。")
-                                # 即使无法推送，也要尝试解密和记录
-                                self._decrypt_and_process_callback(peer_username, peer_public_key_pem, bytes(message_buffer), None)
-                        
-                        # 清空缓冲区，准备接收下一条消息
-                        message_buffer = bytearray()
-                        message_complete = False
-                
-                except BlockingIOError:
-                    # 非阻塞模式下，暂时没有数据可读
-                    # 检查是否超时
-                    if message_buffer and (time.time() - last_chunk_time > chunk_timeout):
-                        # 如果有部分数据且超时，可能是一条不完整的消息
-                        # 如果数据足够大(超过100KB)，可能是图片数据，尝试作为完整消息处理
-                        if len(message_buffer) > 100 * 1024:  # 100KB
-                            logger.warning(f"P2PManager: 接收超时，但缓冲区已累积 {len(message_buffer)/1024:.2f}KB 数据，尝试处理")
-                            
-                            if self._decrypt_and_process_callback:
-                                current_sid = self._get_sid_callback()
-                                if current_sid:
-                                    self._decrypt_and_process_callback(peer_username, peer_public_key_pem, bytes(message_buffer), current_sid)
-                                else:
-                                    self._decrypt_and_process_callback(peer_username, peer_public_key_pem, bytes(message_buffer), None)
-                            
-                            # 清空缓冲区，准备接收下一条消息
-                            message_buffer = bytearray()
-                        
-                        # 更新最后接收时间，避免持续尝试处理同一条不完整消息
-                        last_chunk_time = time.time()
-                    
-                    # 短暂休眠避免CPU占用过高
-                    time.sleep(0.01)
-                    continue
-
-        except socket.error as e:
-            logger.error(f"P2PManager: P2P连接与 {peer_username} 发生错误: {e}", exc_info=True)
-        except Exception as e:
-            logger.error(f"P2PManager: 处理 {peer_username} 的P2P消息时发生未知错误: {e}", exc_info=True)
-        finally:
+        def close_listener():
+            self._unregister(listen_socket)
             try:
-                # 检查socket是否有效
-                if conn_socket and conn_socket.fileno() != -1:
-                    conn_socket.close()  # 关闭此P2P连接的socket
+                listen_socket.close()
             except socket.error as e:
-                logger.warning(f"P2PManager: 关闭与 {peer_username} 的P2P连接socket时出错: {e}")
-            except Exception as e:
-                logger.warning(f"P2PManager: 关闭与 {peer_username} 的P2P连接socket时发生未知错误: {e}")
-            
-            with self.p2p_connections_lock:
-                if peer_username in self.active_p2p_connections:
-                    del self.active_p2p_connections[peer_username]  # 从活跃连接列表中移除
-            logger.info(f"P2PManager: P2P消息处理器为 {peer_username} 停止。")
+                logger.warning(f"P2PManager: 关闭P2P监听socket时出错: {e}")
+            closed.set()
 
-    def stop_p2p_listener(self):
-        """停止P2P监听器线程。"""
-        if self.p2p_listener_thread and self.p2p_listener_thread.is_alive():
-            logger.info("P2PManager: 正在停止P2P监听器...")
-            self.stop_p2p_listener_event.set()  # 设置停止事件，通知监听线程退出循环
-            
-            # 优雅地关闭监听socket
-            if self.p2p_listen_socket:
-                try:
-                    # 在Windows上，如果socket没有连接，shutdown会抛出错误
-                    # 先检查socket是否有效，再尝试shutdown
-                    if self.p2p_listen_socket.fileno() != -1:
-                        try:
-                            self.p2p_listen_socket.shutdown(socket.SHUT_RDWR)  # 关闭socket，解除accept()的阻塞
-                        except socket.error as e:
-                            # Windows上常见的错误，socket没有连接时shutdown会失败
-                            if e.winerror == 10057:  # [WinError 10057] 由于套接字没有连接
-                                logger.debug("P2PManager: 监听socket未连接，跳过shutdown操作")
-                            else:
-                                logger.warning(f"P2PManager: shutdown监听socket时出错: {e}")
-                        finally:
-                            self.p2p_listen_socket.close()
-                except socket.error as e:
-                    logger.warning(f"P2PManager: 关闭P2P监听socket时出错: {e}")
-                except Exception as e:
-                    logger.warning(f"P2PManager: 关闭P2P监听socket时发生未知错误: {e}")
-            
-            self.p2p_listener_thread.join(timeout=2)  # 等待监听线程结束，设置超时防止卡死
-            if self.p2p_listener_thread.is_alive():
-                logger.warning("P2PManager: P2P监听线程未能优雅关闭。")
-            else:
-                logger.info("P2PManager: P2P监听线程已正常关闭。")
-            self.p2p_listener_thread = None
+        self._call_in_loop(close_listener)
+        if closed.wait(timeout=2):  # 等待 I/O 线程关闭监听socket，设置超时防止卡死
+            logger.info("P2PManager: P2P监听器已停止。")
+        else:
+            logger.warning("P2PManager: P2P监听器未能在2秒内关闭。")
 
     def close_all_p2p_connections(self):
-        """关闭所有活跃的P2P连接。"""
+        """
+        关闭所有活跃的P2P连接。
+        这里只 shutdown 各个socket（立即断开对方），socket 由 I/O 线程读到连接结束后注销并关闭。
+        """
         with self.p2p_connections_lock:  # 使用锁保护字典操作
-            # 遍历字典的副本，因为在循环中会修改字典
-            for username, sock in list(self.active_p2p_connections.items()):
-                try:
-                    # 检查socket是否有效
-                    if sock and sock.fileno() != -1:
-                        try:
-                            sock.shutdown(socket.SHUT_RDWR)  # 关闭读写
-                        except socket.error as e:
-                            # Windows上常见的错误，socket没有连接时shutdown会失败
-                            if hasattr(e, 'winerror') and e.winerror == 10057:  # [WinError 10057] 由于套接字没有连接
-                                logger.debug(f"P2PManager: 与 {username} 的连接未建立，跳过shutdown操作")
-                            else:
-                                logger.warning(f"P2PManager: shutdown与 {username} 的连接时出错: {e}")
-                        finally:
-                            sock.close()  # 关闭socket
-                            logger.info(f"P2PManager: 已关闭与 {username} 的P2P连接。")
-                    else:
-                        logger.debug(f"P2PManager: 与 {username} 的连接已无效，跳过关闭操作")
-                except socket.error as e:
-                    logger.warning(f"P2PManager: 关闭与 {username} 的P2P连接时出错: {e}")
-                except Exception as e:
-                    logger.warning(f"P2PManager: 关闭与 {username} 的P2P连接时发生未知错误: {e}")
-                finally:
-                    del self.active_p2p_connections[username]  # 从字典中移除
+            peers = list(self._connections.values())
+            self._connections.clear()
+            self.active_p2p_connections.clear()
+        for peer in peers:
+            self._shutdown_socket(peer.sock, peer.username)
+            logger.info(f"P2PManager: 已关闭与 {peer.username} 的P2P连接。")
 
     def connect_p2p_peer(self, recipient_username, friend_ip, friend_port, my_username, my_public_key_pem):
         """
         尝试与一个P2P对等体建立持久连接。
-        这是一个出站连接，会发送自己的身份信息，并等待对方响应完成握手。
+        这是一个出站连接，会发送自己的身份信息，并等待对方响应完成握手；握手完成后连接交给 I/O 线程接收数据。
         :param recipient_username: 目标对等体的用户名。
         :param friend_ip: 目标对等体的IP地址。
         :param friend_port: 目标对等体的P2P监听端口。
@@ -419,173 +203,533 @@ class P2PManager:
         """
         # 检查是否已经有与该用户的有效连接
         with self.p2p_connections_lock:
-            if recipient_username in self.active_p2p_connections:
-                conn = self.active_p2p_connections[recipient_username]
-                try:
-                    # 测试连接是否有效
-                    if conn.fileno() != -1:
-                        logger.info(f"P2PManager: 已经存在与 {recipient_username} 的有效连接，直接使用。")
-                        return conn
-                    else:
-                        logger.info(f"P2PManager: 与 {recipient_username} 的连接已关闭，将重新建立。")
-                except socket.error:
-                    logger.info(f"P2PManager: 与 {recipient_username} 的连接已失效，将重新建立。")
+            conn = self.active_p2p_connections.get(recipient_username)
+            if conn is not None:
+                if conn.fileno() != -1:
+                    logger.info(f"P2PManager: 已经存在与 {recipient_username} 的有效连接，直接使用。")
+                    return conn
+                logger.info(f"P2PManager: 与 {recipient_username} 的连接已关闭，将重新建立。")
                 # 如果连接无效，从活跃连接中移除
-                if recipient_username in self.active_p2p_connections:
-                    del self.active_p2p_connections[recipient_username]
+                del self.active_p2p_connections[recipient_username]
+                self._connections.pop(conn, None)
 
         logger.info(f"P2PManager: 正在尝试与 {recipient_username} ({friend_ip}:{friend_port}) 建立P2P连接...")
+        conn_socket = None
         try:
             conn_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 创建TCP socket
-            
-            # 配置持久连接
-            # 设置TCP keepalive
-            conn_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            # 在某些操作系统上设置更多的TCP keepalive参数
-            try:
-                # TCP_KEEPIDLE: 连接闲置多久后开始发送keepalive探测包
-                conn_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
-                # TCP_KEEPINTVL: 两次keepalive探测间的间隔时间
-                conn_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
-                # TCP_KEEPCNT: 探测失败的次数，超过这个次数后断开连接
-                conn_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
-            except (AttributeError, socket.error):
-                # 如果当前系统不支持这些选项，忽略错误
-                logger.debug("P2PManager: 当前系统不支持详细的TCP keepalive配置")
-                
+            self._configure_keepalive(conn_socket)  # 配置持久连接
             conn_socket.connect((friend_ip, int(friend_port)))  # 连接到目标P2P地址
 
             # 首次连接时发送自己的身份和公钥，作为简单的握手请求
+            peer = _PeerConnection(conn_socket, (friend_ip, int(friend_port)))
             initial_payload = {"username": my_username, "public_key": my_public_key_pem}
+            if self.p2p_framing is not None:
+                initial_payload["framing"] = self.p2p_framing
+                if self.p2p_session is not None:
+                    initial_payload["session"] = self.p2p_session
+                    initial_payload["session_nonce"] = base64.b64encode(peer.local_nonce).decode('ascii')
             conn_socket.sendall(json.dumps(initial_payload, ensure_ascii=False).encode('utf-8'))
 
-            # 等待对方也发送身份信息，完成简单的双向握手（确认对方身份）
-            response_data_raw = conn_socket.recv(self._buffer_size)
-            if not response_data_raw:
-                try:
-                    if conn_socket.fileno() != -1:
-                        conn_socket.close()
-                except socket.error as e:
-                    logger.debug(f"P2PManager: 关闭空响应连接时出错: {e}")
-                except Exception as e:
-                    logger.debug(f"P2PManager: 关闭空响应连接时发生未知错误: {e}")
-                logger.warning(f"P2PManager: 从 {recipient_username} 接收到空握手响应。")
-                return None
-
-            try:
-                response_payload = json.loads(response_data_raw.decode('utf-8'))
-                # 简单验证：检查对方返回的用户名是否与预期匹配
-                if response_payload.get("username") == recipient_username:
-                    logger.info(f"P2PManager: ⟷⟷⟷ 成功与 {recipient_username} 建立P2P持久连接")
-                    # 将新连接添加到活跃P2P连接列表
-                    with self.p2p_connections_lock:
-                        # 如果已存在同名用户的连接，则关闭旧的并替换
-                        if recipient_username in self.active_p2p_connections:
-                            old_sock = self.active_p2p_connections[recipient_username]
-                            try:
-                                # 检查socket是否有效
-                                if old_sock and old_sock.fileno() != -1:
-                                    old_sock.close()  # 关闭旧连接
-                            except socket.error as e:
-                                logger.debug(f"P2PManager: 关闭与 {recipient_username} 的旧连接时出错: {e}")
-                            except Exception as e:
-                                logger.debug(f"P2PManager: 关闭与 {recipient_username} 的旧连接时发生未知错误: {e}")
-                        self.active_p2p_connections[recipient_username] = conn_socket
-
-                    # 启动一个新线程来处理这个出站连接的消息接收
-                    # 传入从对方握手响应中获取的公钥，以便后续解密来自此对等体的消息
-                    peer_public_key_from_response = response_payload.get("public_key")
-                    p2p_handler_thread = threading.Thread(target=self._handle_p2p_connection,
-                                     args=(conn_socket, recipient_username, peer_public_key_from_response))
-                    p2p_handler_thread.daemon = True
-                    p2p_handler_thread.start()
-                    return conn_socket
-                else:
-                    logger.warning(
-                        f"P2PManager: 握手失败，对等体身份不匹配: 预期'{recipient_username}', 实际'{response_payload.get('username')}'")
-                    try:
-                        if conn_socket.fileno() != -1:
-                            conn_socket.close()
-                    except socket.error as e:
-                        logger.debug(f"P2PManager: 关闭身份不匹配连接时出错: {e}")
-                    except Exception as e:
-                        logger.debug(f"P2PManager: 关闭身份不匹配连接时发生未知错误: {e}")
+            # 等待对方也发送身份信息，完成简单的双向握手（确认对方身份）；响应可能分多次到达，也可能后面紧跟着消息数据
+            conn_socket.settimeout(self.HANDSHAKE_TIMEOUT)
+            response = bytearray()
+            parsed = None
+            while parsed is None:
+                data = conn_socket.recv(self._buffer_size)
+                if not data:
+                    logger.warning(f"P2PManager: 从 {recipient_username} 接收到空握手响应。")
+                    conn_socket.close()
                     return None
-            except json.JSONDecodeError:
-                logger.error(f"P2PManager: 从 {recipient_username} 收到无效的握手响应JSON。", exc_info=True)
-                try:
-                    if conn_socket.fileno() != -1:
-                        conn_socket.close()
-                except socket.error as e:
-                    logger.debug(f"P2PManager: 关闭无效JSON响应连接时出错: {e}")
-                except Exception as e:
-                    logger.debug(f"P2PManager: 关闭无效JSON响应连接时发生未知错误: {e}")
+                response += data
+                parsed = self._parse_handshake(response)
+            conn_socket.settimeout(None)
+            response_payload, rest = parsed
+
+            # 简单验证：检查对方返回的用户名是否与预期匹配
+            if response_payload.get("username") != recipient_username:
+                logger.warning(
+                    f"P2PManager: 握手失败，对等体身份不匹配: 预期'{recipient_username}', 实际'{response_payload.get('username')}'")
+                conn_socket.close()
                 return None
 
+            # 对方在响应中确认了分帧协议才使用它（旧版本客户端不返回该字段）；
+            # 保存从对方握手响应中获取的公钥，以便后续解密来自此对等体的消息
+            framed = self.p2p_framing is not None and response_payload.get("framing") == self.p2p_framing
+            self._set_peer_identity(peer, recipient_username, response_payload.get("public_key"), framed,
+                                    self._session_nonce(response_payload) if framed else None)
+            self._add_p2p_connection(peer)
+            self._call_in_loop(partial(self._register_p2p_connection, peer, rest))
+            logger.info(f"P2PManager: ⟷⟷⟷ 成功与 {recipient_username} 建立P2P持久连接"
+                        f"{'（分帧协议）' if peer.framed else '（旧的无分帧格式）'}")
+            return conn_socket
+        except ValueError as e:
+            logger.error(f"P2PManager: 从 {recipient_username} 收到无效的握手响应: {e}")
         except socket.error as e:
             logger.error(f"P2PManager: 建立与 {recipient_username} 的P2P连接失败: {e}", exc_info=True)
-            return None
         except Exception as e:
             logger.error(f"P2PManager: 连接P2P对等体 {recipient_username} 时发生未知错误: {e}", exc_info=True)
-            return None
+        if conn_socket is not None:
+            try:
+                conn_socket.close()
+            except socket.error as e:
+                logger.debug(f"P2PManager: 关闭失败的P2P连接时出错: {e}")
+        return None
+
+    def supports_p2p_envelope(self, recipient_username):
+        """与该用户的活跃连接是否使用分帧协议，可以发送二进制信封（旧版本客户端只能接收 JSON 消息）。"""
+        with self.p2p_connections_lock:
+            peer = self._connections.get(self.active_p2p_connections.get(recipient_username))
+            return peer is not None and peer.framed
+
+    def supports_p2p_session(self, recipient_username):
+        """与该用户的活跃连接上双方是否都支持会话密钥（此时也一定支持二进制信封）。"""
+        with self.p2p_connections_lock:
+            peer = self._connections.get(self.active_p2p_connections.get(recipient_username))
+            return peer is not None and peer.sessions
+
+    def p2p_session_nonce(self, connection):
+        """返回对方在该连接（active_p2p_connections 中的 socket）握手中提供的随机数；连接已关闭或不支持会话密钥时返回 None。"""
+        with self.p2p_connections_lock:
+            peer = self._connections.get(connection)
+            return peer.remote_nonce if peer is not None else None
 
     def send_p2p_raw_data(self, recipient_username, data_bytes):
         """
-        向指定的活跃P2P连接发送原始字节数据（通常是加密后的消息载荷）。
-        支持大型数据的分块发送，如图片和隐写图片数据。
+        向指定的活跃P2P连接发送原始字节数据（通常是加密后的JSON消息载荷）。
+        使用分帧协议的连接在数据前加上帧头，接收方据此确定消息边界；旧版本客户端的连接直接发送数据。
         :param recipient_username: 接收方的用户名。
         :param data_bytes: 要发送的原始字节数据。
         :return: True如果发送成功，False失败。
         """
-        conn_socket = self.active_p2p_connections.get(recipient_username)
-        if not conn_socket:
+        return self._send_p2p_frame(recipient_username, P2P_FRAME_DATA, (data_bytes,))
+
+    def send_p2p_envelope(self, recipient_username, envelope_buffers):
+        """
+        以一个帧发送 encode_p2p_envelope() 生成的二进制信封，各缓冲区（密文）不拼接、不复制。
+        只能用于 supports_p2p_envelope() 为 True 的连接。
+        :return: True如果发送成功，False失败。
+        """
+        return self._send_p2p_frame(recipient_username, P2P_FRAME_ENVELOPE, envelope_buffers)
+
+    def _send_p2p_frame(self, recipient_username, frame_type, buffers):
+        """把若干缓冲区作为一帧发送；连续的小缓冲区与帧头合并为一次 sendall，大缓冲区单独发送以免复制。"""
+        with self.p2p_connections_lock:
+            conn_socket = self.active_p2p_connections.get(recipient_username)
+            peer = self._connections.get(conn_socket)
+        if not conn_socket or peer is None:
             logger.error(f"P2PManager: 未找到与 {recipient_username} 的活跃P2P连接。")
             return False
 
         try:
-            # 记录发送数据的大小
-            data_size = len(data_bytes)
-            logger.info(f"P2PManager: 准备向 {recipient_username} 发送数据 ({data_size} 字节)")
-            
-            # 对于大型数据，使用分块发送
-            if data_size > 1024 * 1024:  # 如果数据超过1MB，分块发送
-                chunk_size = 65536  # 64KB的块大小
-                total_chunks = (data_size + chunk_size - 1) // chunk_size
-                logger.info(f"P2PManager: 数据大小超过1MB，将分成 {total_chunks} 个块发送")
-                
-                # 分块发送
-                bytes_sent = 0
-                for i in range(0, data_size, chunk_size):
-                    chunk = data_bytes[i:i+chunk_size]
-                    conn_socket.sendall(chunk)
-                    bytes_sent += len(chunk)
-                    logger.info(f"P2PManager: 已发送块 {(i//chunk_size)+1}/{total_chunks} ({bytes_sent}/{data_size} 字节)")
-                    time.sleep(0.01)  # 短暂暂停，避免网络拥塞
-                
-                logger.info(f"P2PManager: ↑↑↑ 向 {recipient_username} 分块发送数据成功 (总计 {bytes_sent} 字节)")
+            data_size = sum(len(buffer) for buffer in buffers)
+            if not peer.framed:
+                if frame_type != P2P_FRAME_DATA:
+                    logger.error(f"P2PManager: 与 {recipient_username} 的连接未使用分帧协议，无法发送二进制信封")
+                    return False
+                with peer.send_lock:
+                    conn_socket.sendall(buffers[0])
+            elif data_size > self._max_frame_size:
+                logger.error(f"P2PManager: 数据大小 {data_size} 字节超过P2P单条消息上限 {self._max_frame_size} 字节，无法发送")
+                return False
             else:
-                # 小型数据直接发送
-                conn_socket.sendall(data_bytes)
-                logger.info(f"P2PManager: ↑↑↑ 向 {recipient_username} 发送数据成功 ({data_size} 字节)")
-            
+                pending = [encode_p2p_frame_header(data_size, frame_type)]
+                with peer.send_lock:
+                    for buffer in buffers:
+                        if len(buffer) <= self.SEND_COALESCE_LIMIT:
+                            pending.append(buffer)
+                            continue
+                        # 大型数据（图片、语音）不复制，由 sendall 直接写入内核
+                        conn_socket.sendall(b"".join(pending))
+                        pending = []
+                        conn_socket.sendall(buffer)
+                    if pending:
+                        conn_socket.sendall(b"".join(pending))
+            logger.info(f"P2PManager: ↑↑↑ 向 {recipient_username} 发送数据成功 ({data_size} 字节)")
             return True
         except socket.error as e:
             logger.error(f"P2PManager: ↓↓↓ 向 {recipient_username} 发送数据失败: {e}")
-            # 发送失败通常意味着连接断开，进行清理
+            # 发送失败通常意味着连接断开，进行清理（socket 由 I/O 线程关闭）
             with self.p2p_connections_lock:
-                if recipient_username in self.active_p2p_connections:
-                    try:
-                        sock = self.active_p2p_connections[recipient_username]
-                        if sock and sock.fileno() != -1:
-                            sock.close()
-                    except socket.error as e:
-                        logger.debug(f"P2PManager: 清理与 {recipient_username} 的连接时出错: {e}")
-                    except Exception as e:
-                        logger.debug(f"P2PManager: 清理与 {recipient_username} 的连接时发生未知错误: {e}")
-                    finally:
-                        del self.active_p2p_connections[recipient_username]
+                if self.active_p2p_connections.get(recipient_username) is conn_socket:
+                    del self.active_p2p_connections[recipient_username]
+                self._connections.pop(conn_socket, None)
+            self._shutdown_socket(conn_socket, recipient_username)
             logger.info(f"P2PManager: 与 {recipient_username} 的P2P连接已断开。")
             return False
         except Exception as e:
             logger.error(f"P2PManager: 发送P2P原始数据时发生未知错误: {e}", exc_info=True)
-            return False
\ No newline at end of file
+            return False
+
+    # ---- 连接管理 ----
+
+    @staticmethod
+    def _configure_keepalive(conn):
+        """为P2P持久连接开启TCP keepalive。"""
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # 在某些操作系统上设置更多的TCP keepalive参数
+        try:
+            # TCP_KEEPIDLE: 连接闲置多久后开始发送keepalive探测包
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+            # TCP_KEEPINTVL: 两次keepalive探测间的间隔时间
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            # TCP_KEEPCNT: 探测失败的次数，超过这个次数后断开连接
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
+        except (AttributeError, socket.error):
+            # 如果当前系统不支持这些选项，忽略错误
+            logger.debug("P2PManager: 当前系统不支持详细的TCP keepalive配置")
+
+    @staticmethod
+    def _shutdown_socket(sock, username):
+        """关闭socket的读写方向：对方立即看到连接断开，I/O 线程读到连接结束后注销并关闭它。"""
+        try:
+            if sock.fileno() != -1:
+                sock.shutdown(socket.SHUT_RDWR)
+        except socket.error as e:
+            # Windows上常见的错误，socket没有连接时shutdown会失败
+            if getattr(e, 'winerror', None) == 10057:  # [WinError 10057] 由于套接字没有连接
+                logger.debug(f"P2PManager: 与 {username} 的连接未建立，跳过shutdown操作")
+            else:
+                logger.debug(f"P2PManager: shutdown与 {username} 的连接时出错: {e}")
+
+    @staticmethod
+    def _parse_handshake(buffer):
+        """
+        从缓冲区开头解析握手JSON。
+        :return: (握手字典, 其后紧跟的剩余数据 bytes)；数据还不完整时返回 None。
+        :raises ValueError: 握手数据无效或过长。
+        """
+        # surrogateescape 保证不完整的多字节字符和握手之后的二进制数据不会导致解码失败，且能按原样还原为字节
+        text = bytes(buffer).decode('utf-8', 'surrogateescape').lstrip()
+        if text and not text.startswith('{'):
+            raise ValueError("握手数据不是JSON对象")
+        try:
+            payload, end = json.JSONDecoder().raw_decode(text)
+        except json.JSONDecodeError:
+            if len(buffer) > P2PManager.MAX_HANDSHAKE_SIZE:
+                raise ValueError(f"握手数据超过 {P2PManager.MAX_HANDSHAKE_SIZE} 字节")
+            return None
+        return payload, text[end:].encode('utf-8', 'surrogateescape')
+
+    def _session_nonce(self, payload):
+        """对方在握手中确认了会话密钥协议时返回其随机数，否则返回 None。"""
+        if self.p2p_session is None or payload.get("session") != self.p2p_session:
+            return None
+        try:
+            nonce = base64.b64decode(payload.get("session_nonce") or "", validate=True)
+        except (TypeError, ValueError):
+            return None
+        return nonce if len(nonce) == P2P_SESSION_NONCE_SIZE else None
+
+    def _set_peer_identity(self, peer, username, public_key_pem, framed, remote_nonce=None):
+        peer.username = username
+        peer.public_key_pem = public_key_pem
+        peer.framed = framed
+        peer.sessions = remote_nonce is not None
+        peer.remote_nonce = remote_nonce
+        peer.reader = P2PFrameReader(self._max_frame_size) if framed else None
+        peer.buffer = bytearray()
+
+    def _add_p2p_connection(self, peer):
+        """将握手完成的连接添加到活跃P2P连接列表；已存在同名用户的连接时断开旧连接。"""
+        with self.p2p_connections_lock:
+            old_sock = self.active_p2p_connections.get(peer.username)
+            if old_sock is not None:
+                self._connections.pop(old_sock, None)
+                self._shutdown_socket(old_sock, peer.username)
+            self.active_p2p_connections[peer.username] = peer.sock
+            self._connections[peer.sock] = peer
+
+    # ---- I/O 线程 ----
+
+    def _call_in_loop(self, task):
+        """在 I/O 线程中执行 task（selector 不是线程安全的，对它的修改都在 I/O 线程中进行），必要时启动 I/O 线程。"""
+        with self._io_lock:
+            self._io_tasks.append(task)
+            if self._io_thread is None:
+                self._io_thread = threading.Thread(target=self._io_loop, name="p2p-io", daemon=True)
+                self._io_thread.start()
+        try:
+            self._wakeup_send.send(b"\0")
+        except socket.error:
+            pass  # 唤醒socket的缓冲区已满，I/O 线程必然会被唤醒
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _io_loop(self):
+        """I/O 线程主循环：等待任一socket可读或最近的超时时刻，没有监听socket和连接时退出。"""
+        logger.info("P2PManager: P2P I/O 线程启动。")
+        while True:
+            with self._io_lock:
+                tasks = list(self._io_tasks)
+                self._io_tasks.clear()
+                if not tasks and len(self._selector.get_map()) <= 1:  # 只剩下唤醒socket
+                    self._io_thread = None
+                    break
+            for task in tasks:
+                try:
+                    task()
+                except Exception as e:
+                    logger.error(f"P2PManager: I/O 线程执行任务时出错: {e}", exc_info=True)
+            if tasks:
+                continue  # 任务可能注销了最后一个socket，重新检查是否应当退出
+            for key, _ in self._selector.select(self._select_timeout()):
+                key.data()
+            self._check_deadlines()
+        logger.info("P2PManager: P2P I/O 线程退出。")
+
+    def _select_timeout(self):
+        if not self._timed:
+            return None
+        return max(0.0, min(peer.deadline for peer in self._timed) - time.monotonic())
+
+    def _unregister(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _accept_p2p_connections(self, listen_socket):
+        """接受所有挂起的传入连接，等待对方发送身份信息和公钥（握手）。"""
+        while True:
+            try:
+                conn, addr = listen_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                logger.error(f"P2PManager: 接受P2P连接时出错: {e}")
+                return
+            logger.info(f"P2PManager: 接收到来自 {addr} 的P2P连接。")
+            conn.setblocking(True)  # 发送在调用方线程中用阻塞的 sendall 完成；接收只在可读时进行，不会阻塞
+            peer = _PeerConnection(conn, addr)
+            peer.deadline = time.monotonic() + self.HANDSHAKE_TIMEOUT
+            self._timed.add(peer)
+            self._selector.register(conn, selectors.EVENT_READ, partial(self._on_p2p_readable, peer))
+
+    def _register_p2p_connection(self, peer, rest):
+        """开始接收出站连接上的数据；rest 为握手响应之后已经收到的数据。"""
+        if peer.sock.fileno() == -1:
+            return
+        self._selector.register(peer.sock, selectors.EVENT_READ, partial(self._on_p2p_readable, peer))
+        if rest:
+            self._guard_p2p_io(peer, self._consume_p2p_data, peer, rest)
+
+    def _on_p2p_readable(self, peer):
+        self._guard_p2p_io(peer, self._read_p2p_connection, peer)
+
+    def _guard_p2p_io(self, peer, func, *args):
+        """执行连接上的一次读取/处理；func 返回 False（对方关闭连接）或出错时关闭连接。"""
+        name = peer.username or peer.addr
+        try:
+            if func(*args) is False:
+                self._close_p2p_connection(peer)
+        except ValueError as e:
+            # 握手无效，或帧边界已经丢失（之后的数据都无法解析），只能断开连接
+            logger.error(f"P2PManager: 来自 {name} 的P2P数据无效，断开连接: {e}")
+            self._close_p2p_connection(peer)
+        except socket.error as e:
+            logger.info(f"P2PManager: P2P连接与 {name} 出错: {e}")
+            self._close_p2p_connection(peer)
+        except Exception as e:
+            logger.error(f"P2PManager: 处理 {name} 的P2P数据时发生未知错误: {e}", exc_info=True)
+            self._close_p2p_connection(peer)
+
+    def _read_p2p_connection(self, peer):
+        """读取一次可读连接上的数据；对方关闭连接时返回 False。"""
+        if peer.framed:
+            received = peer.sock.recv_into(self._recv_buffer)
+            data = self._recv_view[:received]
+        else:
+            data = peer.sock.recv(self._buffer_size)
+        if not data:  # 如果收到空数据，表示连接已关闭
+            if peer.username is None:
+                logger.warning(f"P2PManager: P2P连接从 {peer.addr} 接收到空初始化数据。")
+            else:
+                logger.info(f"P2PManager: P2P连接与 {peer.username} 断开。")
+            return False
+        return self._consume_p2p_data(peer, data)
+
+    def _consume_p2p_data(self, peer, data):
+        """按连接当前所处的阶段处理收到的数据：握手、分帧协议或旧的无分帧格式。"""
+        if peer.username is None:
+            return self._consume_handshake(peer, data)
+        if peer.framed:
+            return self._consume_p2p_frames(peer, data)
+        return self._consume_legacy_p2p_data(peer, data)
+
+    def _consume_handshake(self, peer, data):
+        """入站连接的握手：接收对方的身份信息和公钥，回复自己的身份信息。"""
+        peer.buffer += data
+        parsed = self._parse_handshake(peer.buffer)
+        if parsed is None:
+            return True
+        initial_payload, rest = parsed
+        peer_username = initial_payload.get("username") if isinstance(initial_payload, dict) else None
+        peer_public_key_pem = initial_payload.get("public_key") if isinstance(initial_payload, dict) else None
+        if not peer_username or not peer_public_key_pem:
+            logger.warning(f"P2PManager: 接收到无效的P2P连接初始化数据 from {peer.addr}: {initial_payload}")
+            return False
+        logger.info(f"P2PManager: P2P连接握手成功，对方是: {peer_username}")
+        self._configure_keepalive(peer.sock)
+
+        # 立即发送自己的身份信息，完成双向握手（确认身份）；双方都支持时确认使用分帧协议和会话密钥
+        framed = self.p2p_framing is not None and initial_payload.get("framing") == self.p2p_framing
+        my_initial_payload = {
+            "username": self._identity_info["username"],
+            "public_key": self._identity_info["public_key_pem"]
+        }
+        remote_nonce = self._session_nonce(initial_payload) if framed else None
+        if framed:
+            my_initial_payload["framing"] = self.p2p_framing
+        if remote_nonce is not None:
+            my_initial_payload["session"] = self.p2p_session
+            my_initial_payload["session_nonce"] = base64.b64encode(peer.local_nonce).decode('ascii')
+        peer.sock.sendall(json.dumps(my_initial_payload, ensure_ascii=False).encode('utf-8'))
+
+        self._timed.discard(peer)
+        peer.deadline = None
+        self._set_peer_identity(peer, peer_username, peer_public_key_pem, framed, remote_nonce)
+        self._add_p2p_connection(peer)
+        return self._consume_p2p_data(peer, rest) if rest else True
+
+    def _consume_p2p_frames(self, peer, data):
+        """分帧协议：由 P2PFrameReader 增量拼出完整的帧，每个数据块只处理一次，不需要猜测消息边界。"""
+        for frame_type, payload in peer.reader.feed(data):
+            if frame_type == P2P_FRAME_ENVELOPE:
+                try:
+                    message = decode_p2p_envelope(payload)
+                except P2PEnvelopeError as e:
+                    logger.warning(f"P2PManager: 忽略来自 {peer.username} 的无效二进制信封: {e}")
+                    continue
+            elif frame_type == P2P_FRAME_DATA:
+                message = payload
+            else:
+                logger.warning(f"P2PManager: 忽略来自 {peer.username} 的未知P2P帧类型 {frame_type}")
+                continue
+            logger.info(f"P2PManager: ↓↓↓ 收到来自 {peer.username} 的完整消息，大小: {len(payload)} 字节")
+            self._dispatch_p2p_message(peer, message)
+        return True
+
+    def _consume_legacy_p2p_data(self, peer, data):
+        """
+        旧版本客户端（握手时未确认分帧协议）的数据：消息之间没有边界，
+        每收到一块数据就尝试把累积的数据解析为 JSON 判断消息是否完整，空闲超时后按已收到的数据处理。
+        """
+        logger.debug(f"P2PManager: ↓↓↓ 从 {peer.username} 接收到数据 ({len(data)} 字节)")
+        peer.buffer.extend(data)
+        # 检查缓冲区大小，防止内存溢出
+        if len(peer.buffer) > self._max_frame_size:
+            logger.error(f"P2PManager: 接收缓冲区超过最大限制({self._max_frame_size/1024/1024:.2f}MB)，丢弃消息")
+            peer.buffer = bytearray()
+            self._timed.discard(peer)
+            return True
+
+        message = self._complete_legacy_message(peer.buffer)
+        if message is None:
+            peer.deadline = time.monotonic() + self.LEGACY_IDLE_TIMEOUT
+            self._timed.add(peer)
+            return True
+        logger.info(f"P2PManager: 收到来自 {peer.username} 的完整消息，大小: {len(message)} 字节")
+        peer.buffer = bytearray()
+        self._timed.discard(peer)
+        self._dispatch_p2p_message(peer, message)
+        return True
+
+    @staticmethod
+    def _complete_legacy_message(buffer):
+        """旧格式缓冲区中的数据是一个完整的JSON消息时返回该消息的字节，否则返回 None。"""
+        try:
+            json.loads(buffer.decode('utf-8'))
+            return bytes(buffer)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            pass
+        if buffer.endswith(b'}'):
+            # 如果以JSON结束符'}'结尾，可能是一个完整的JSON，但格式错误，尝试解析最后一段JSON
+            start_pos = buffer.rfind(b'{')
+            if start_pos != -1:
+                potential_json = bytes(buffer[start_pos:])
+                try:
+                    json.loads(potential_json.decode('utf-8'))
+                    return potential_json
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    pass  # 仍然无法解析，继续等待更多数据
+        return None
+
+    def _check_deadlines(self):
+        """处理到期的握手超时和旧格式的空闲超时。"""
+        now = time.monotonic()
+        for peer in [peer for peer in self._timed if peer.deadline <= now]:
+            self._timed.discard(peer)
+            peer.deadline = None
+            if peer.username is None:
+                logger.warning(f"P2PManager: 等待 {peer.addr} 的P2P握手超时，关闭连接。")
+                self._close_p2p_connection(peer)
+            elif len(peer.buffer) > self.LEGACY_FLUSH_SIZE:
+                # 有部分数据且超时，数据足够大时可能是图片数据，尝试作为完整消息处理
+                logger.warning(f"P2PManager: 接收超时，但缓冲区已累积 {len(peer.buffer)/1024:.2f}KB 数据，尝试处理")
+                message = bytes(peer.buffer)
+                peer.buffer = bytearray()
+                self._dispatch_p2p_message(peer, message)
+
+    def _close_p2p_connection(self, peer):
+        """注销并关闭连接，从活跃连接列表中移除。"""
+        self._unregister(peer.sock)
+        self._timed.discard(peer)
+        try:
+            peer.sock.close()  # 关闭此P2P连接的socket
+        except socket.error as e:
+            logger.warning(f"P2PManager: 关闭与 {peer.username or peer.addr} 的P2P连接socket时出错: {e}")
+        if peer.username is None:
+            return
+        with self.p2p_connections_lock:
+            if self._connections.get(peer.sock) is peer:
+                del self._connections[peer.sock]
+            # 只移除本连接；对方重连后该用户名可能已指向新的连接
+            if self.active_p2p_connections.get(peer.username) is peer.sock:
+                del self.active_p2p_connections[peer.username]  # 从活跃连接列表中移除
+        logger.info(f"P2PManager: 与 {peer.username} 的P2P连接已关闭。")
+
+    # ---- 工作线程池 ----
+
+    def _dispatch_p2p_message(self, peer, message):
+        """
+        把一条完整消息放入连接的 inbox，由工作线程依次处理。
+        积压的消息达到上限时在这里阻塞，I/O 线程暂停读取，发送方由 TCP 流控减速。
+        """
+        self._pending_slots.acquire()
+        with self._dispatch_lock:
+            peer.inbox.append(message)
+            if peer.draining:
+                return
+            peer.draining = True
+        self._workers.submit(self._drain_p2p_inbox, peer)
+
+    def _drain_p2p_inbox(self, peer):
+        """（工作线程）按到达顺序处理一个连接上积压的消息。"""
+        while True:
+            with self._dispatch_lock:
+                if not peer.inbox:
+                    peer.draining = False
+                    return
+                message = peer.inbox.popleft()
+            try:
+                self._deliver_p2p_message(peer.username, peer.public_key_pem, message,
+                                          peer.local_nonce if peer.sessions else None)
+            except Exception as e:
+                logger.error(f"P2PManager: 处理 {peer.username} 的P2P消息时发生未知错误: {e}", exc_info=True)
+            finally:
+                self._pending_slots.release()
+
+    def _deliver_p2p_message(self, peer_username, peer_public_key_pem, data, session_nonce=None):
+        """把一条完整消息的原始数据交给 ChatClient 解密处理。"""
+        if not self._decrypt_and_process_callback:
+            return
+        current_sid = self._get_sid_callback()
+        if not current_sid:
+            # 即使无法推送，也要尝试解密和记录
+            logger.warning(f"P2PManager: 无法获取用户 {self._identity_info['username']} 的SID，无法推送消息。")
+        self._decrypt_and_process_callback(peer_username, peer_public_key_pem, data, current_sid, session_nonce)
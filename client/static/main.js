@@ -112,6 +112,23 @@ document.addEventListener('DOMContentLoaded', function() {
         updateFriendStatus(data.username, data.status);
         fetchFriendsList(); // 刷新好友列表
     });
+
+    // 服务器推送的在线好友变化：直接使用推送的列表更新界面，无需再请求 /api/refresh_friends
+    window.updateOnlineFriends = function(friends) {
+        onlineFriendsList = (Array.isArray(friends) ? friends : []).filter(friend => friend && friend.username);
+        console.log('在线好友已更新:', onlineFriendsList.map(friend => friend.username));
+        try {
+            renderContacts();
+            if (typeof updateChatListFriendStatus === 'function') {
+                updateChatListFriendStatus();
+            }
+        } catch (err) {
+            console.error('更新在线好友时出错:', err);
+        }
+    };
+    socket.on('online_friends_updated', function(data) {
+        window.updateOnlineFriends(data.online_friends);
+    });
     
     // 添加好友请求事件处理
     socket.on('friend_request', function(data) {
@@ -506,6 +523,7 @@ document.addEventListener('DOMContentLoaded', function() {
     setTimeout(runConnectionDiagnostics, 3000);
     
     // 设置定期刷新好友列表的计时器
+    // 在线状态由服务器推送实时更新（online_friends_updated 事件），定时刷新只作为兜底
     setInterval(function() {
         if (socket && socket.connected) {
             console.log('定期刷新好友列表...');
@@ -513,7 +531,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 .then(() => console.log('定期刷新好友列表成功'))
                 .catch(err => console.error('定期刷新好友列表失败:', err));
         }
-    }, 30000); // 每30秒刷新一次
+    }, 300000); // 每5分钟刷新一次
     
     // 自动诊断和恢复功能
     function autoRecovery() {
@@ -3401,7 +3419,8 @@ $(document).ready(function() {
     refreshFriendsList();
     
     // 设置自动刷新好友列表的间隔
-    setInterval(refreshFriendsList, 30000); // 每30秒刷新一次好友列表
+    // 在线状态由服务器推送实时更新（online_friends_updated 事件），定时刷新只作为兜底
+    setInterval(refreshFriendsList, 300000); // 每5分钟刷新一次好友列表
 });
 
 // 初始化聊天功能
@@ -17,12 +17,19 @@ class AESUtils:
     def __init__(self):
         pass
 
-    def encrypt_message(self, message_bytes, symmetric_key_bytes):
-        """使用AES对称密钥加密消息（GCM模式）。"""
+    def encrypt_message(self, message_bytes, symmetric_key_bytes, nonce=None, associated_data=None):
+        """
+        使用AES对称密钥加密消息（GCM模式）。
+        :param nonce: 12字节的 nonce；None 时随机生成。同一密钥下 nonce 绝不能重复（会话密钥使用递增的计数器）。
+        :param associated_data: 不加密但需要认证的附加数据（例如信封头），解密时必须提供相同的数据。
+        """
         try:
-            nonce = os.urandom(12)  # AES GCM 需要一个唯一的 nonce (IV)，长度为12字节
+            if nonce is None:
+                nonce = os.urandom(12)  # AES GCM 需要一个唯一的 nonce (IV)，长度为12字节
             cipher = Cipher(algorithms.AES(symmetric_key_bytes), modes.GCM(nonce), backend=default_backend())
             encryptor = cipher.encryptor()
+            if associated_data:
+                encryptor.authenticate_additional_data(associated_data)
             ciphertext = encryptor.update(message_bytes) + encryptor.finalize()
             tag = encryptor.tag  # 认证标签
             logger.debug("AESUtils: 消息已使用AES对称密钥加密。")
@@ -31,12 +38,14 @@ class AESUtils:
             logger.error(f"AESUtils: AES加密消息时出错: {e}", exc_info=True)
             return None, None, None
 
-    def decrypt_message(self, ciphertext_bytes, nonce_bytes, tag_bytes, symmetric_key_bytes):
-        """使用AES对称密钥解密消息（GCM模式）。"""
+    def decrypt_message(self, ciphertext_bytes, nonce_bytes, tag_bytes, symmetric_key_bytes, associated_data=None):
+        """使用AES对称密钥解密消息（GCM模式）。associated_data 须与加密时相同。"""
         try:
             cipher = Cipher(algorithms.AES(symmetric_key_bytes), modes.GCM(nonce_bytes, tag_bytes),
                             backend=default_backend())
             decryptor = cipher.decryptor()
+            if associated_data:
+                decryptor.authenticate_additional_data(associated_data)
             plaintext = decryptor.update(ciphertext_bytes) + decryptor.finalize()
             logger.debug("AESUtils: 消息已使用AES对称密钥解密。")
             return plaintext
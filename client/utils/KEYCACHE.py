@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PublicKeyCache:
+    """
+    以公钥指纹为键的公钥PEM缓存：磁盘上保存 {指纹: PEM}，重启后仍然有效，
+    请求在线好友时把已有指纹告诉服务器，服务器不再重复发送这些PEM（解析后的公钥对象由 RSAUtils 的 LRU 缓存保存）。
+    指纹算法与服务器 server/utils.py 中的 key_fingerprint 一致。
+    """
+
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._pems = {}  # {fingerprint: pem}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def fingerprint(public_key_pem):
+        """计算公钥PEM的 SHA-256 指纹。"""
+        return hashlib.sha256(public_key_pem.strip().encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, "r", encoding="utf-8") as f:
+                pems = json.load(f)
+            # 只接受指纹与内容一致的条目，避免缓存文件被篡改后使用错误的公钥
+            self._pems = {fp: pem for fp, pem in pems.items() if self.fingerprint(pem) == fp}
+            logger.info(f"PublicKeyCache: 已从 {self._cache_file} 加载 {len(self._pems)} 个公钥。")
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"PublicKeyCache: 加载公钥缓存文件失败，忽略: {e}")
+
+    def save(self):
+        """有新公钥时写回磁盘（先写临时文件再替换，避免写到一半的文件）。"""
+        with self._lock:
+            if not self._dirty or not self._cache_file:
+                return
+            pems = dict(self._pems)
+            self._dirty = False
+        tmp_file = self._cache_file + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(pems, f)
+            os.replace(tmp_file, self._cache_file)
+        except OSError as e:
+            logger.warning(f"PublicKeyCache: 保存公钥缓存文件失败: {e}")
+
+    def fingerprints(self):
+        """返回已缓存公钥的指纹列表。"""
+        with self._lock:
+            return list(self._pems)
+
+    def put(self, public_key_pem, fingerprint=None):
+        """
+        缓存一个公钥PEM（需要时再调用 save() 写盘）。
+        :param fingerprint: 服务器给出的指纹，与本地计算结果不一致时拒绝缓存。
+        :return: 公钥指纹；校验失败时返回 None。
+        """
+        actual = self.fingerprint(public_key_pem)
+        if fingerprint and fingerprint != actual:
+            logger.warning(f"PublicKeyCache: 公钥指纹不匹配 (声明 {fingerprint[:12]}…, 实际 {actual[:12]}…)，拒绝缓存。")
+            return None
+        with self._lock:
+            if actual not in self._pems:
+                self._pems[actual] = public_key_pem
+                self._dirty = True
+        return actual
+
+    def get_pem(self, fingerprint):
+        """按指纹取公钥PEM，未缓存时返回 None。"""
+        with self._lock:
+            return self._pems.get(fingerprint)
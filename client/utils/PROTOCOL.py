@@ -0,0 +1,247 @@
+import json
+import struct
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+# 与服务器 server/protocol.py 保持一致的控制连接分帧协议：4字节大端长度头 + 消息体
+FRAMING_LENGTH_PREFIXED = "length-prefixed-v1"
+
+# 服务器主动推送的事件：{"event": <事件名>, "data": {...}}，没有 status 字段
+EVENT_PRESENCE_DELTA = "PRESENCE_DELTA"  # data: {"online": [好友信息, ...], "offline": [user_id, ...]}
+
+# 分帧消息的编码，在 HELLO 中协商（HELLO 的请求和回复本身始终是 JSON）；msgpack / cbor2 为可选依赖
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODING_CBOR = "cbor"
+
+_CODECS = {}
+if msgpack is not None:
+    _CODECS[ENCODING_MSGPACK] = (lambda obj: msgpack.packb(obj, use_bin_type=True),
+                                 lambda data: msgpack.unpackb(data, raw=False))
+if cbor2 is not None:
+    _CODECS[ENCODING_CBOR] = (cbor2.dumps, cbor2.loads)
+_CODECS[ENCODING_JSON] = (lambda obj: json.dumps(obj, ensure_ascii=False).encode('utf-8'),
+                          lambda data: json.loads(data.decode('utf-8')))
+SUPPORTED_ENCODINGS = tuple(_CODECS)  # 本机可用的编码，按偏好排序，HELLO 时提供给服务器
+
+FRAME_HEADER = struct.Struct("!I")
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+
+
+class FrameTooLargeError(ValueError):
+    """帧长度超过允许的最大值。"""
+
+
+class MessageDecodeError(ValueError):
+    """消息体不是所协商编码下的有效数据。"""
+
+
+def encode_message(message, encoding=ENCODING_JSON):
+    """按协商的编码序列化一条消息（字典），返回消息体字节。"""
+    return _CODECS[encoding][0](message)
+
+
+def decode_message(data, encoding=ENCODING_JSON):
+    """按协商的编码解析一条消息体，数据无效时抛出 MessageDecodeError。"""
+    try:
+        return _CODECS[encoding][1](data)
+    except ValueError as e:
+        raise MessageDecodeError(str(e)) from e
+
+
+def rows_from_columns(columns):
+    """把服务器以列式布局 {字段名: [值, ...]} 发送的列表还原为字典列表；已经是列表时原样返回。"""
+    if not isinstance(columns, dict):
+        return columns
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+class FrameReader:
+    """
+    流式分帧读取器，用于客户端与中心服务器之间的控制连接：
+    - 将 recv() 得到的任意长度数据喂入缓冲区。
+    - 取出其中已完整的帧，不完整的部分留待后续数据拼接。
+    """
+
+    def __init__(self, max_frame_size):
+        self._max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    @staticmethod
+    def encode_frame(body_bytes):
+        """为消息体加上长度头。"""
+        return FRAME_HEADER.pack(len(body_bytes)) + body_bytes
+
+    def feed(self, data):
+        """追加数据并返回所有完整帧的消息体列表（可能为空）。"""
+        self._buffer.extend(data)
+        frames = []
+        offset = 0
+        buffer_len = len(self._buffer)
+        while buffer_len - offset >= FRAME_HEADER_SIZE:
+            (body_len,) = FRAME_HEADER.unpack_from(self._buffer, offset)
+            if body_len > self._max_frame_size:
+                raise FrameTooLargeError(f"帧长度 {body_len} 超过上限 {self._max_frame_size}")
+            frame_end = offset + FRAME_HEADER_SIZE + body_len
+            if frame_end > buffer_len:
+                break
+            frames.append(bytes(self._buffer[offset + FRAME_HEADER_SIZE:frame_end]))
+            offset = frame_end
+        if offset:
+            del self._buffer[:offset]
+        return frames
+
+    def reset(self):
+        """丢弃缓冲区中的残留数据（断开连接时调用）。"""
+        self._buffer.clear()
+
+
+# 客户端之间 P2P 连接的分帧协议，在 P2P 握手中协商（握手本身仍是 JSON，旧版本客户端忽略该字段并继续使用无分帧的格式）
+P2P_FRAMING = "p2p-frame-v1"
+P2P_FRAME_MAGIC = b"SC"
+P2P_FRAME_VERSION = 1
+P2P_FRAME_DATA = 1  # 载荷为一条加密后的消息（JSON），交给 ChatClient 解密
+P2P_FRAME_ENVELOPE = 2  # 载荷为二进制信封（见 encode_p2p_envelope），密文不经 Base64 编码
+# 帧头：魔数(2字节) + 版本(1字节) + 帧类型(1字节) + 载荷长度(4字节大端)，其后是载荷
+P2P_FRAME_HEADER = struct.Struct("!2sBBI")
+P2P_FRAME_HEADER_SIZE = P2P_FRAME_HEADER.size
+
+
+class P2PFrameError(ValueError):
+    """P2P 帧头无效（魔数或版本不符）或载荷超过允许的最大值，连接上的数据已无法继续解析。"""
+
+
+def encode_p2p_frame_header(payload_len, frame_type=P2P_FRAME_DATA):
+    """生成 P2P 帧头，载荷紧随其后发送。"""
+    return P2P_FRAME_HEADER.pack(P2P_FRAME_MAGIC, P2P_FRAME_VERSION, frame_type, payload_len)
+
+
+class P2PFrameReader:
+    """
+    P2P 连接的增量分帧读取器。
+    帧头解析后按载荷长度一次性分配缓冲区，之后每次 feed() 只把新数据复制到缓冲区的对应位置，
+    不会重新扫描或解析已收到的数据，因此大载荷（图片、语音）的接收代价与数据量成线性关系。
+    """
+
+    def __init__(self, max_frame_size):
+        self._max_frame_size = max_frame_size
+        self._header = bytearray()
+        self._frame_type = None
+        self._payload = None  # 当前帧的载荷缓冲区，帧头未收齐时为 None
+        self._filled = 0
+
+    def feed(self, data):
+        """
+        追加 recv() 得到的数据（bytes 或 memoryview），返回所有完整帧的 [(帧类型, 载荷 bytearray)]（可能为空）。
+        帧头无效时抛出 P2PFrameError。
+        """
+        view = memoryview(data)
+        frames = []
+        pos = 0
+        end = len(view)
+        while pos < end:
+            if self._payload is None:
+                needed = P2P_FRAME_HEADER_SIZE - len(self._header)
+                self._header += view[pos:pos + needed]
+                pos += min(needed, end - pos)
+                if len(self._header) < P2P_FRAME_HEADER_SIZE:
+                    break
+                magic, version, frame_type, payload_len = P2P_FRAME_HEADER.unpack(self._header)
+                self._header.clear()
+                if magic != P2P_FRAME_MAGIC or version != P2P_FRAME_VERSION:
+                    raise P2PFrameError(f"无效的P2P帧头: magic={magic!r}, version={version}")
+                if payload_len > self._max_frame_size:
+                    raise P2PFrameError(f"P2P帧长度 {payload_len} 超过上限 {self._max_frame_size}")
+                self._frame_type = frame_type
+                self._payload = bytearray(payload_len)
+                self._filled = 0
+            else:
+                n = min(len(self._payload) - self._filled, end - pos)
+                self._payload[self._filled:self._filled + n] = view[pos:pos + n]
+                self._filled += n
+                pos += n
+            if self._payload is not None and self._filled == len(self._payload):
+                frames.append((self._frame_type, self._payload))
+                self._payload = None
+        return frames
+
+
+# 二进制信封的消息类型及其密文段
+P2P_ENVELOPE_CHAT = 1  # [消息文本]
+P2P_ENVELOPE_AUDIO = 2  # [音频数据]
+P2P_ENVELOPE_STEG_IMAGE = 3  # [隐藏消息, 隐写图片]
+P2P_ENVELOPE_SESSION_INIT = 4  # 建立会话密钥：密钥字段为 会话ID + RSA加密的会话密钥，[发送方对它们的RSA签名]
+# 消息类型带此标志时使用会话密钥加密：密钥字段为会话ID，nonce 为递增的计数器
+P2P_ENVELOPE_SESSION = 0x80
+# 信封头：消息类型(1字节) + RSA加密的对称密钥长度(2字节) + 密文段数(1字节)，之后依次是加密的对称密钥、
+# 每段的段头（AES-GCM nonce 12字节 + tag 16字节 + 密文长度4字节）和各段密文
+P2P_ENVELOPE_HEADER = struct.Struct("!BHB")
+P2P_ENVELOPE_SEGMENT = struct.Struct("!12s16sI")
+# 握手中协商的会话密钥协议：双方都支持时，分帧连接上的消息改用每个连接建立一次的会话密钥加密。
+# 协商时双方各提供一个随机数（session_nonce，Base64），会话建立消息的签名包含接收方的随机数
+P2P_SESSION_VERSION = "p2p-session-v2"
+P2P_SESSION_NONCE_SIZE = 16
+
+
+class P2PEnvelopeError(ValueError):
+    """二进制信封的结构无效。"""
+
+
+class P2PEnvelope:
+    """解析后的二进制信封。segments 为 [(nonce, tag, 密文 memoryview)]，密文直接引用接收缓冲区，没有复制。"""
+    __slots__ = ("kind", "encrypted_key", "segments")
+
+    def __init__(self, kind, encrypted_key, segments):
+        self.kind = kind
+        self.encrypted_key = encrypted_key
+        self.segments = segments
+
+
+def encode_p2p_envelope(kind, encrypted_key, segments):
+    """
+    生成二进制信封。
+    :param segments: [(nonce, tag, 密文)]，nonce 为 12 字节、tag 为 16 字节（AES-GCM）。
+    :return: 缓冲区列表 [信封头 + 密钥 + 段头, 密文1, 密文2, ...]，密文不复制，由 P2PManager 作为同一帧依次发送。
+    """
+    parts = [P2P_ENVELOPE_HEADER.pack(kind, len(encrypted_key), len(segments)), encrypted_key]
+    for nonce, tag, ciphertext in segments:
+        if len(nonce) != 12 or len(tag) != 16:
+            raise P2PEnvelopeError("nonce 必须为 12 字节，tag 必须为 16 字节")
+        parts.append(P2P_ENVELOPE_SEGMENT.pack(nonce, tag, len(ciphertext)))
+    return [b"".join(parts)] + [ciphertext for _, _, ciphertext in segments]
+
+
+def decode_p2p_envelope(payload):
+    """解析二进制信封，密文以 memoryview 切片返回。结构无效时抛出 P2PEnvelopeError。"""
+    view = memoryview(payload)
+    try:
+        kind, key_len, segment_count = P2P_ENVELOPE_HEADER.unpack_from(view, 0)
+        offset = P2P_ENVELOPE_HEADER.size
+        encrypted_key = bytes(view[offset:offset + key_len])
+        offset += key_len
+        segment_headers = []
+        for _ in range(segment_count):
+            segment_headers.append(P2P_ENVELOPE_SEGMENT.unpack_from(view, offset))
+            offset += P2P_ENVELOPE_SEGMENT.size
+    except struct.error as e:
+        raise P2PEnvelopeError(f"信封头不完整: {e}") from e
+    if len(encrypted_key) != key_len:
+        raise P2PEnvelopeError("信封中的加密密钥不完整")
+    segments = []
+    for nonce, tag, length in segment_headers:
+        segments.append((nonce, tag, view[offset:offset + length]))
+        offset += length
+    if offset != len(view):
+        raise P2PEnvelopeError(f"信封长度 {len(view)} 与段头声明的长度 {offset} 不一致")
+    return P2PEnvelope(kind, encrypted_key, segments)
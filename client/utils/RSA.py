@@ -1,7 +1,11 @@
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidSignature
 
 logger = logging.getLogger(__name__)
 
@@ -12,12 +16,19 @@ class RSAUtils:
     - RSA 密钥对的生成、加载和保存。
     - 使用 RSA 公钥加密对称密钥（用于密钥交换）。
     - 使用 RSA 私钥解密对称密钥。
+    - 使用 RSA 私钥签名、公钥验证签名（PSS，用于认证P2P会话密钥）。
     - 获取密钥的 PEM 格式字符串。
+    - 以PEM指纹为键、有大小上限的 LRU 缓存解析后的公钥对象，同一个公钥不会每条消息都重新解析。
     """
 
-    def __init__(self, private_key=None, public_key=None):
+    def __init__(self, private_key=None, public_key=None, public_key_cache_size=256):
         self._private_key = private_key
         self._public_key = public_key
+        self._public_key_cache_size = public_key_cache_size
+        self._public_keys = OrderedDict()  # {PEM指纹: 公钥对象}，最近使用的在末尾
+        self._public_key_lock = threading.Lock()
+        self._public_key_hits = 0
+        self._public_key_misses = 0
 
     def set_keys(self, private_key, public_key):
         """设置当前实例将使用的RSA私钥和公钥对象。"""
@@ -80,13 +91,45 @@ class RSAUtils:
             logger.error(f"RSAUtils: 加载密钥对时出错: {e}", exc_info=True)
             return None, None
 
+    @staticmethod
+    def public_key_fingerprint(public_key_pem):
+        """公钥PEM的 SHA-256 指纹（与 PublicKeyCache.fingerprint 和服务器的 key_fingerprint 一致）。"""
+        return hashlib.sha256(public_key_pem.strip().encode('utf-8')).hexdigest()
+
+    def load_public_key(self, public_key_pem, fingerprint=None):
+        """
+        解析公钥PEM，解析结果按指纹保存在 LRU 缓存中，超过上限时淘汰最久未使用的公钥。
+        :param fingerprint: 已知的PEM指纹（例如服务器给出、已校验过的指纹），省去一次哈希计算。
+        :return: 公钥对象。PEM无效时抛出 ValueError。
+        """
+        fingerprint = fingerprint or self.public_key_fingerprint(public_key_pem)
+        with self._public_key_lock:
+            public_key = self._public_keys.get(fingerprint)
+            if public_key is not None:
+                self._public_keys.move_to_end(fingerprint)
+                self._public_key_hits += 1
+                return public_key
+            self._public_key_misses += 1
+        public_key = serialization.load_pem_public_key(public_key_pem.encode('utf-8'), backend=default_backend())
+        with self._public_key_lock:
+            self._public_keys[fingerprint] = public_key
+            self._public_keys.move_to_end(fingerprint)
+            while len(self._public_keys) > self._public_key_cache_size:
+                self._public_keys.popitem(last=False)
+        return public_key
+
+    def public_key_cache_stats(self):
+        """返回公钥对象缓存的大小和命中/未命中次数。"""
+        with self._public_key_lock:
+            return {"size": len(self._public_keys), "hits": self._public_key_hits, "misses": self._public_key_misses}
+
     def encrypt_symmetric_key(self, recipient_public_key_pem, symmetric_key_bytes):
-        """使用接收方的RSA公钥加密对称密钥。"""
+        """使用接收方的RSA公钥加密对称密钥。recipient_public_key_pem 可以是PEM字符串，也可以是已解析的公钥对象。"""
         try:
-            recipient_public_key = serialization.load_pem_public_key(
-                recipient_public_key_pem.encode('utf-8'),
-                backend=default_backend()
-            )
+            if isinstance(recipient_public_key_pem, str):
+                recipient_public_key = self.load_public_key(recipient_public_key_pem)
+            else:
+                recipient_public_key = recipient_public_key_pem
             encrypted_key = recipient_public_key.encrypt(
                 symmetric_key_bytes,
                 padding.OAEP(
@@ -121,6 +164,42 @@ class RSAUtils:
             logger.error(f"RSAUtils: RSA解密对称密钥时出错: {e}", exc_info=True)
             return None
 
+    def sign(self, data_bytes):
+        """使用自己的RSA私钥对数据签名（PSS + SHA-256）。"""
+        if not self._private_key:
+            logger.error("RSAUtils: 私钥未加载，无法签名。")
+            return None
+        try:
+            return self._private_key.sign(
+                data_bytes,
+                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                hashes.SHA256()
+            )
+        except Exception as e:
+            logger.error(f"RSAUtils: RSA签名时出错: {e}", exc_info=True)
+            return None
+
+    def verify_signature(self, signer_public_key_pem, signature_bytes, data_bytes):
+        """使用签名方的RSA公钥验证签名。signer_public_key_pem 可以是PEM字符串，也可以是已解析的公钥对象。"""
+        try:
+            if isinstance(signer_public_key_pem, str):
+                signer_public_key = self.load_public_key(signer_public_key_pem)
+            else:
+                signer_public_key = signer_public_key_pem
+            signer_public_key.verify(
+                signature_bytes,
+                data_bytes,
+                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                hashes.SHA256()
+            )
+            return True
+        except InvalidSignature:
+            logger.error("RSAUtils: 签名验证失败。")
+            return False
+        except Exception as e:
+            logger.error(f"RSAUtils: 验证RSA签名时出错: {e}", exc_info=True)
+            return False
+
     def get_public_key_pem(self, public_key_object):
         """将公钥对象转换为PEM格式字符串。"""
         if public_key_object:
@@ -0,0 +1,140 @@
+import os
+import time
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 会话消息的 AES-GCM nonce：4 字节 0 + 8 字节递增计数器。计数器 0 留给建立会话的消息本身
+SESSION_NONCE = struct.Struct("!4xQ")
+# 会话消息的附加认证数据：信封的消息类型 + 会话ID，防止密文被挪到其他类型的消息或其他会话中
+SESSION_ASSOCIATED_DATA = struct.Struct("!B8s")
+SESSION_ID_SIZE = 8
+# 连接上还没有会话时，会话建立消息签名中的“上一个会话ID”
+NO_SESSION_ID = bytes(SESSION_ID_SIZE)
+SESSION_KEY_SIZE = 32  # AES-256
+
+
+class P2PSession:
+    """一个方向上的会话密钥。发送方为每条消息段分配递增的 nonce，接收方只接受比上一次更大的计数器（防重放）。"""
+    __slots__ = ("session_id", "key", "counter", "created", "connection")
+
+    def __init__(self, session_id, key, connection=None):
+        self.session_id = session_id
+        self.key = key
+        self.counter = 0  # 发送方：上一个已分配的计数器；接收方：上一个已接受的计数器
+        self.created = time.monotonic()
+        # 发送方：会话所属的P2P连接（socket对象），连接变化后需要重新建立会话；
+        # 接收方：会话建立消息到达的P2P连接（本端在该连接的握手中提供的随机数）
+        self.connection = connection
+
+    def next_nonce(self):
+        self.counter += 1
+        return SESSION_NONCE.pack(self.counter)
+
+    def check_nonces(self, nonces):
+        """
+        接收方检查一条消息各段的 nonce：计数器须严格递增且大于上一次接受的计数器。
+        :return: 最后一段的计数器（解密成功后记入 counter）；重放、乱序或格式错误时返回 None。
+        """
+        last = self.counter
+        for nonce in nonces:
+            try:
+                counter, = SESSION_NONCE.unpack(nonce)
+            except struct.error:
+                return None
+            if counter <= last:
+                return None
+            last = counter
+        return last
+
+
+class SessionKeyStore:
+    """
+    P2P会话密钥的存储，线程安全：
+    - 发送方向：每个好友一个会话，绑定到建立它时的P2P连接；连接变化、消息段数或使用时长超过上限时需要重新建立。
+    - 接收方向：每个好友保留最近建立的会话，收到新的会话密钥时替换。
+    会话建立消息的签名包含接收方在本连接握手中提供的随机数和本连接上的上一个会话ID（previous_*_id），
+    重放的会话建立消息（来自旧连接，或本连接上较早的一次换钥）因此验证失败，不能把接收计数器重置为 0。
+    会话密钥的建立（RSA加密、签名和验证）由 ChatClient 完成，这里只负责密钥、计数器和换钥判断。
+    """
+
+    def __init__(self, max_messages, max_age):
+        self._max_messages = max_messages
+        self._max_age = max_age
+        self._outgoing = {}  # {好友用户名: P2PSession}
+        self._incoming = {}  # {好友用户名: P2PSession}
+        self._send_locks = {}  # {好友用户名: threading.Lock}
+        self._lock = threading.Lock()
+
+    def send_lock(self, username):
+        """
+        发送给该好友时持有的锁：分配 nonce、加密和发送在同一把锁内完成，
+        保证会话建立消息先于使用它的消息发出、计数器按发送顺序递增。
+        """
+        with self._lock:
+            lock = self._send_locks.get(username)
+            if lock is None:
+                lock = self._send_locks[username] = threading.Lock()
+            return lock
+
+    def outgoing(self, username, connection, segments=1):
+        """返回发送给该好友时可以继续使用的会话；没有、连接已变化或需要换钥时返回 None。"""
+        with self._lock:
+            session = self._outgoing.get(username)
+        if session is None or session.connection is not connection:
+            return None
+        if session.counter + segments > self._max_messages or time.monotonic() - session.created > self._max_age:
+            logger.info(f"SessionKeyStore: 与 {username} 的会话密钥已达到使用上限，重新建立。")
+            return None
+        return session
+
+    def previous_outgoing_id(self, username, connection):
+        """在该连接上建立新的发送会话时签名的上一个会话ID：该连接上当前的发送会话ID，没有时为 NO_SESSION_ID。"""
+        with self._lock:
+            session = self._outgoing.get(username)
+        return session.session_id if session is not None and session.connection is connection else NO_SESSION_ID
+
+    @staticmethod
+    def new_outgoing(connection):
+        """生成新的发送会话（随机的会话ID和密钥）。会话建立消息发送成功后再用 set_outgoing 启用。"""
+        return P2PSession(os.urandom(SESSION_ID_SIZE), os.urandom(SESSION_KEY_SIZE), connection)
+
+    def set_outgoing(self, username, session):
+        with self._lock:
+            self._outgoing[username] = session
+
+    def previous_incoming_id(self, username, connection):
+        """验证该连接上收到的会话建立消息时期望的上一个会话ID：该连接上当前的接收会话ID，没有时为 NO_SESSION_ID。"""
+        with self._lock:
+            return self._incoming_id(username, connection)
+
+    def _incoming_id(self, username, connection):
+        session = self._incoming.get(username)
+        return session.session_id if session is not None and session.connection == connection else NO_SESSION_ID
+
+    def set_incoming(self, username, session_id, key, connection, previous_id):
+        """
+        启用对方在该连接上建立的接收会话。
+        :param previous_id: 验证签名时使用的 previous_incoming_id()。
+        :return: True 已启用；False 验证期间该连接上的接收会话已经变化，当前会话保持不变。
+        """
+        with self._lock:
+            if self._incoming_id(username, connection) != previous_id:
+                return False
+            self._incoming[username] = P2PSession(session_id, key, connection)
+        return True
+
+    def incoming(self, username, session_id):
+        """返回该好友发来的、会话ID匹配的接收会话，未知时返回 None。"""
+        with self._lock:
+            session = self._incoming.get(username)
+        return session if session is not None and session.session_id == session_id else None
+
+    def clear(self):
+        """注销时清除会话密钥。"""
+        with self._lock:
+            self._outgoing.clear()
+            self._incoming.clear()
+            self._send_locks.clear()
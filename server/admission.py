@@ -0,0 +1,179 @@
+"""
+准入控制与背压：在过载时快速拒绝请求，而不是让线程、DB 连接和内存被耗尽。
+
+- TokenBucket:          令牌桶限流，每个连接一个（ClientSession.rate_limiter）；
+- KeyedRateLimiter:     按键（用户ID / 登录用户名）的令牌桶集合，用户断线重连后仍使用同一个桶；
+- ConcurrencyLimiter:   全局限制同时执行的 DB 操作数，并限制排队数，队列满时立即拒绝；
+- ConnectionLimiter:    连接数上限，超出时按策略立即拒绝（reject）或让新连接等待（queue）。
+被拒绝的请求收到 status=error 的响应，data 中带有 retry_after（秒），客户端应等待后重试。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# 拒绝原因（响应 data.reason 以及指标标签）
+REASON_RATE_LIMITED = "rate_limited"
+REASON_BUSY = "busy"
+REASON_TOO_MANY_CONNECTIONS = "too_many_connections"
+
+CONNECTION_POLICIES = ("reject", "queue")
+
+
+class TokenBucket:
+    """线程安全的令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个。"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1.0):
+        """
+        尝试取出令牌。
+        :return: 0.0 表示成功；否则为需要等待的秒数（令牌不足时不扣除）。
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+
+class KeyedRateLimiter:
+    """
+    按键的令牌桶集合。最多保留 max_keys 个桶，超出时淘汰最久未使用的
+    （长时间未使用的桶已经补满，淘汰后重新创建的桶与原来等价）。
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key, tokens=1.0):
+        """:return: 0.0 表示成功；否则为需要等待的秒数。"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_acquire(tokens)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+
+class ConcurrencyLimiter:
+    """
+    限制同时执行的操作数为 max_concurrent，另外最多 max_queue 个操作排队等待。
+    admit() 非阻塞地接纳操作（执行中 + 排队中已满时立即返回 False）；
+    被接纳的操作随后在执行它的线程中调用 run()，等待执行名额最多 queue_timeout 秒。
+    asyncio 模式下在事件循环中 admit()，再把 run() 提交到线程池，线程池队列因此也是有界的。
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._admitted = 0  # 已接纳、尚未完成的操作数（执行中 + 排队中）
+        self._running = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._completed = 0
+
+    def admit(self):
+        with self._lock:
+            if self._admitted >= self.max_concurrent + self.max_queue:
+                self._rejected += 1
+                return False
+            self._admitted += 1
+            return True
+
+    def run(self, func, *args):
+        """
+        执行一个已被 admit() 接纳的操作。
+        :return: (True, func 的返回值)；等待执行名额超时时返回 (False, None)。
+        """
+        try:
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                with self._lock:
+                    self._timed_out += 1
+                return False, None
+            with self._lock:
+                self._running += 1
+            try:
+                return True, func(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                self._slots.release()
+        finally:
+            with self._lock:
+                self._admitted -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._admitted - self._running,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+            }
+
+
+class ConnectionLimiter:
+    """
+    连接数上限。policy:
+    - "reject": 超出上限的新连接立即收到“连接数已满”的响应并被关闭；
+    - "queue":  新连接等待已有连接关闭（threaded 模式下暂停 accept，由内核 listen 队列排队；
+                asyncio 模式下连接已被接受，最多等待 queue_timeout 秒后仍无名额则拒绝）。
+    """
+
+    def __init__(self, max_connections, policy="reject", queue_timeout=10.0):
+        if policy not in CONNECTION_POLICIES:
+            raise ValueError(f"未知的连接溢出策略: {policy}（可选: {', '.join(CONNECTION_POLICIES)}）")
+        self.max_connections = max_connections
+        self.policy = policy
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._active = 0
+
+    def try_acquire(self):
+        """不等待地占用一个连接名额。:return: 是否成功。"""
+        with self._cond:
+            if self._active >= self.max_connections:
+                return False
+            self._active += 1
+            return True
+
+    def acquire(self):
+        """占用一个连接名额，名额用完时阻塞到有连接关闭为止。"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._active < self.max_connections)
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {"max_connections": self.max_connections, "active": self._active}
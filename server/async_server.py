@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from server import SecureChatServer, ClientSession
+from protocol import FRAME_HEADER, FRAME_HEADER_SIZE, FrameTooLargeError
+from admission import REASON_TOO_MANY_CONNECTIONS
+from config import BUFFER_SIZE, DB_EXECUTOR_WORKERS, MAX_FRAME_SIZE, MAX_PIPELINED_REQUESTS, AUTH_EXECUTOR_WORKERS, \
+    BUSY_RETRY_AFTER, PUSH_WRITE_BUFFER_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSecureChatServer(SecureChatServer):
+    """
+    基于 asyncio 事件循环的服务器实现。
+    每个连接由一个协程处理，而不是一个操作系统线程；命令语义与 SecureChatServer 完全相同。
+    会阻塞的命令处理（DatabaseManager 调用）统一提交到一个有界的线程池执行，事件循环本身只负责网络I/O。
+    LOGIN / REGISTER 要等待密码哈希进程池，使用单独的线程池，登录高峰时不会占满 DB 线程池。
+    """
+
+    def __init__(self, *args, db_executor_workers=DB_EXECUTOR_WORKERS, auth_executor_workers=AUTH_EXECUTOR_WORKERS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db_executor_workers = db_executor_workers
+        self.auth_executor_workers = auth_executor_workers
+        self.db_executor = None  # 在 start() 中创建
+        self.auth_executor = None  # 在 start() 中创建
+        self.loop = None
+        self.connection_available = None  # 连接名额释放时通知排队的新连接（asyncio.Condition），在 _serve() 中创建
+
+    def start(self):
+        try:
+            self.server_socket.bind((self.host, self.port))
+            self._start_metrics_server()
+            self.db_executor = ThreadPoolExecutor(max_workers=self.db_executor_workers,
+                                                  thread_name_prefix="db-worker")
+            self.auth_executor = ThreadPoolExecutor(max_workers=self.auth_executor_workers,
+                                                    thread_name_prefix="auth-worker")
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            logger.info("AsyncSecureChatServer: 收到中断信号，正在关闭服务器。")
+        except Exception as e:
+            logger.critical(f"AsyncSecureChatServer: 服务器启动错误: {e}", exc_info=True)
+        finally:
+            for executor in (self.db_executor, self.auth_executor):
+                if executor:
+                    executor.shutdown(wait=False)
+            try:
+                self.server_socket.close()
+                logger.info("AsyncSecureChatServer: 服务器socket已关闭。")
+            except OSError as e:
+                logger.error(f"AsyncSecureChatServer: 关闭服务器socket时出错: {e}", exc_info=True)
+            self._stop_metrics_server()
+            if self.presence_broker:
+                self.presence_broker.close()
+            self.detached_sessions.stop()
+            self.presence_writer.stop()
+            self.password_hasher.close()
+            self.db_manager.close()
+            logger.info("AsyncSecureChatServer: 服务器已关闭。")
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.connection_available = asyncio.Condition()
+        server = await asyncio.start_server(self._handle_client_async, sock=self.server_socket,
+                                            backlog=self.backlog, limit=BUFFER_SIZE)
+        logger.info(f"AsyncSecureChatServer: 服务器正在监听 {self.host}:{self.port} "
+                    f"(backlog={self.backlog}, DB线程池={self.db_executor_workers}, "
+                    f"最大连接数={self.connection_limiter.max_connections}, 超出策略={self.connection_limiter.policy})")
+        async with server:
+            await server.serve_forever()
+
+    def _make_session(self, client_address, writer):
+        """
+        创建会话对象；其他线程（如线程池中的命令处理）通过事件循环安全地写入该连接。
+        推送事件不等待 drain()：发送缓冲区中积压的数据超过 PUSH_WRITE_BUFFER_LIMIT 时关闭连接。
+        """
+        loop = self.loop
+        transport = writer.transport
+
+        def write_push(data_bytes):
+            # 在事件循环中执行：此时缓冲区大小包含了之前排队的所有推送
+            if writer.is_closing():
+                return
+            if transport.get_write_buffer_size() + len(data_bytes) > PUSH_WRITE_BUFFER_LIMIT:
+                logger.warning(f"AsyncSecureChatServer: 客户端 {client_address} 读取过慢，未发送的推送超过 "
+                               f"{PUSH_WRITE_BUFFER_LIMIT} 字节，关闭连接。")
+                transport.abort()
+                return
+            writer.write(data_bytes)
+            self.metrics.add_sent_bytes(len(data_bytes))
+
+        def send_threadsafe(data_bytes):
+            if writer.is_closing():
+                raise ConnectionResetError("连接已关闭")
+            if transport.get_write_buffer_size() > PUSH_WRITE_BUFFER_LIMIT:
+                raise ConnectionResetError("发送缓冲区已满")
+            loop.call_soon_threadsafe(write_push, data_bytes)
+
+        return ClientSession(client_address, send_threadsafe, self._make_rate_limiter())
+
+    async def _acquire_connection_slot(self):
+        """
+        占用一个连接名额。"queue" 策略下等待已有连接关闭，最多等待 CONNECTION_QUEUE_TIMEOUT 秒。
+        :return: 是否成功。
+        """
+        limiter = self.connection_limiter
+        if limiter.try_acquire():
+            return True
+        if limiter.policy != "queue":
+            return False
+        try:
+            async with self.connection_available:
+                await asyncio.wait_for(self.connection_available.wait_for(limiter.try_acquire), limiter.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _release_connection_slot(self):
+        self.connection_limiter.release()
+        async with self.connection_available:
+            self.connection_available.notify()
+
+    async def _reject_connection_async(self, client_address, writer):
+        """连接数已满：以旧协议格式（客户端尚未发送 HELLO）回复拒绝原因后立即关闭连接。"""
+        logger.warning(f"AsyncSecureChatServer: 连接数已达上限 {self.connection_limiter.max_connections}，"
+                       f"拒绝来自 {client_address} 的连接。")
+        response = self._make_overload_response(REASON_TOO_MANY_CONNECTIONS, BUSY_RETRY_AFTER)
+        writer.write(self._encode_response(response, framed=False))
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    async def _run_blocking(self, func, *args, executor=None):
+        """在有界线程池中执行会阻塞的函数（默认使用 DB 线程池）。"""
+        return await self.loop.run_in_executor(executor or self.db_executor, func, *args)
+
+    async def _read_request(self, reader, session):
+        """
+        读取一条请求。分帧协议下先读4字节长度头再精确读取消息体；旧协议下一次 read 即一条请求。
+        :return: 请求数据字节；连接正常关闭时返回 None。
+        """
+        if not session.framed:
+            data = await reader.read(BUFFER_SIZE)
+            self.metrics.add_received_bytes(len(data))
+            return data or None
+        try:
+            header = await reader.readexactly(FRAME_HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        (body_len,) = FRAME_HEADER.unpack(header)
+        if body_len > MAX_FRAME_SIZE:
+            raise FrameTooLargeError(f"帧长度 {body_len} 超过上限 {MAX_FRAME_SIZE}")
+        self.metrics.add_received_bytes(FRAME_HEADER_SIZE + body_len)
+        return await reader.readexactly(body_len)
+
+    async def _process_and_respond(self, session, data, writer, framed):
+        """
+        在线程池中处理一条请求并写回响应。处理或编码响应时出错，同样回复一条带 request_id 的错误响应，
+        流水线上的客户端因此不会一直等待这条请求。
+        """
+        request = self._decode_request(session, data)
+        start = time.perf_counter()
+        try:
+            if request is None:
+                response = self._make_response("error", "无效的JSON格式。")
+            else:
+                # 准入检查在事件循环中完成：被拒绝的请求不进入线程池，被接纳的 DB 命令数有上限，线程池队列因此有界
+                rejection = self._admit(session, request)
+                if rejection is not None:
+                    response = self._finish_request(request, rejection, start)
+                else:
+                    executor = self.auth_executor if request["command"] in self.AUTH_COMMANDS else self.db_executor
+                    response = await self._run_blocking(self._process_request, session, request, True,
+                                                        executor=executor)
+            response_bytes = self._encode_response(response, framed, session.encoding)
+        except Exception as e:
+            logger.error(f"AsyncSecureChatServer: 处理来自 {session.client_address} 的请求时出错: {e}", exc_info=True)
+            response = self._make_response("error", f"服务器内部错误: {str(e)}")
+            if request is not None and request.get("request_id") is not None:
+                response["request_id"] = request["request_id"]
+            response_bytes = self._encode_response(response, framed, session.encoding)
+        writer.write(response_bytes)
+        self.metrics.add_sent_bytes(len(response_bytes))
+        await writer.drain()
+        logger.debug(f"AsyncSecureChatServer: 已向客户端发送响应: status={response.get('status')}, "
+                     f"message={response.get('message')}")
+
+    async def _process_pipelined(self, session, data, writer, slots):
+        """流水线连接上的单条请求：与同一连接上的其他请求并发处理，完成后释放并发名额。"""
+        try:
+            await self._process_and_respond(session, data, writer, framed=True)
+        except (ConnectionError, OSError) as e:
+            logger.debug(f"AsyncSecureChatServer: 向 {session.client_address} 写回流水线响应失败: {e}")
+        except Exception as e:
+            logger.error(f"AsyncSecureChatServer: 处理 {session.client_address} 的流水线请求时出错: {e}", exc_info=True)
+        finally:
+            slots.release()
+
+    async def _handle_client_async(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        if not await self._acquire_connection_slot():
+            await self._reject_connection_async(client_address, writer)
+            return
+        logger.info(f"AsyncSecureChatServer: 收到来自 {client_address} 的新连接。")
+        session = self._make_session(client_address, writer)
+        self.metrics.session_opened()
+        # 流水线连接上并发处理的请求；名额用完时暂停读取，形成背压
+        slots = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+        in_flight = set()
+
+        try:
+            while True:
+                data = await self._read_request(reader, session)
+                if data is None:
+                    logger.info(f"AsyncSecureChatServer: 客户端 {client_address} 断开连接。")
+                    break
+
+                if session.pipelined:
+                    await slots.acquire()
+                    task = asyncio.create_task(self._process_pipelined(session, data, writer, slots))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    continue
+
+                # 响应使用请求到达时的协议格式，HELLO 的回复因此仍是旧格式
+                await self._process_and_respond(session, data, writer, session.framed)
+
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.info(f"AsyncSecureChatServer: 与 {client_address} 的连接异常断开: {e}")
+        except FrameTooLargeError as e:
+            logger.warning(f"AsyncSecureChatServer: 客户端 {client_address} 发送了超长的帧，关闭连接: {e}")
+            writer.write(self._encode_response(self._make_response("error", "请求过大。"), framed=True,
+                                               encoding=session.encoding))
+        except Exception as e:
+            logger.error(f"AsyncSecureChatServer: 客户端 {client_address} 处理程序发生错误: {e}", exc_info=True)
+        finally:
+            if in_flight:
+                # 连接关闭前等待已经开始处理的请求结束，再清理会话
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            try:
+                await self._run_blocking(self._cleanup_session, session)
+            except Exception as e:
+                logger.error(f"AsyncSecureChatServer: 清理 {client_address} 的会话时出错: {e}", exc_info=True)
+            self.metrics.session_closed()
+            await self._release_connection_slot()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            logger.info(f"AsyncSecureChatServer: 与 {client_address} 的连接已关闭。")
@@ -0,0 +1,814 @@
+"""
+服务器基准测试工具。
+
+sessions: 分别以 threaded / asyncio 模式启动服务器子进程，测量单个进程能同时保持多少空闲会话与活跃会话，
+          以及对应的内存 (RSS)、线程数和请求延迟。
+friends:  在本地 SQLite 数据库中生成随机好友关系图（作为 SQL Server 的替身），分别测量旧的 OR 连接查询
+          （无 FriendID 索引）与 UNION ALL 查询（有 IX_Friendships_FriendID 索引）的 p50/p99 延迟。
+logins:   启动服务器子进程，先测量空闲时非认证命令的延迟，再在大量并发 LOGIN/LOGOUT
+          （登录风暴）的同时测量一次，得到登录吞吐量以及非认证命令延迟受到的影响。
+workers:  以 --workers 1,2,4... 启动多进程服务器，先检查连接在不同工作进程上的好友能否互相看到在线状态，
+          以及断开连接（未登出）后凭密码重新登录（新连接可能落到另一个工作进程）能否成功，
+          再由多个负载进程以闭环方式发送请求，测量总吞吐量随工作进程数的扩展效率。
+encoding: 比较 1k 好友的 GET_ONLINE_FRIENDS 响应在 json / msgpack / cbor 编码与逐行 / 列式布局下的
+          字节数和序列化/反序列化 CPU 耗时（不启动服务器）。
+sessions、logins 和 workers 默认让服务器使用 SQLite 存储后端（每次一个临时数据库文件），不需要 SQL Server。
+
+示例:
+    python benchmark.py sessions --sessions 1000,5000,10000 --modes threaded,asyncio
+    python benchmark.py friends --users 1000000 --edges 50000000 --db friends_bench.db
+    python benchmark.py logins --storm 200 --probes 50 --duration 10
+    python benchmark.py workers --workers 1,2,4 --load-procs 8 --connections 50
+    python benchmark.py encoding --friends 1000
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from protocol import SUPPORTED_ENCODINGS, ENCODING_JSON, FRAME_HEADER_SIZE, encode_message, decode_message, to_columns
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 未登录时的 GET_ONLINE_FRIENDS 只走协议与命令分发路径，不访问数据库，用来衡量服务器本身的连接处理能力
+PROBE_REQUEST = json.dumps({"command": "GET_ONLINE_FRIENDS", "payload": {}}).encode('utf-8')
+# 测量服务器极限吞吐量的基准测试关闭请求限流（闭环负载的请求速率远高于单个真实客户端）
+CAPACITY_ARGS = ["--no-rate-limits"]
+
+
+def raise_fd_limit():
+    """尽量提高本进程可打开的文件描述符数量。"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def percentile(values, pct):
+    """返回列表的近似百分位数 (pct 取 0-100)。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def read_proc_status(pid):
+    """读取 /proc/<pid>/status 中的 RSS (KB) 和线程数。"""
+    rss_kb, threads = None, None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss_kb, threads
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def storage_args(args, workdir):
+    """
+    生成传给服务器子进程的存储后端参数。sqlite 后端每次使用 workdir 下的全新数据库文件，
+    不需要数据库服务，结果可以在任意机器上复现。
+    """
+    if args.db_backend != "sqlite":
+        return ["--db-backend", args.db_backend]
+    fd, path = tempfile.mkstemp(prefix="bench_", suffix=".db", dir=workdir)
+    os.close(fd)
+    os.unlink(path)
+    return ["--db-backend", "sqlite", "--sqlite-file", path]
+
+
+def start_server(mode, port, extra_args=()):
+    """以子进程方式启动服务器，并等待端口可连接。"""
+    cmd = [sys.executable, "main.py", "--mode", mode, "--port", str(port)] + list(extra_args)
+    proc = subprocess.Popen(cmd, cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            preexec_fn=raise_fd_limit)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"服务器进程提前退出 (exit={proc.returncode})")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("等待服务器启动超时")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+async def probe(reader, writer, timeout):
+    """发送一次探测请求，返回延迟（秒）。"""
+    start = time.perf_counter()
+    writer.write(PROBE_REQUEST)
+    await writer.drain()
+    data = await asyncio.wait_for(reader.read(65536), timeout)
+    if not data:
+        raise ConnectionError("服务器关闭了连接")
+    return time.perf_counter() - start
+
+
+async def open_sessions(port, count, concurrency, timeout):
+    """以有限并发打开 count 个连接，返回成功建立的 (reader, writer) 列表和失败数。"""
+    sem = asyncio.Semaphore(concurrency)
+    connections, failures = [], 0
+
+    async def open_one():
+        nonlocal failures
+        async with sem:
+            try:
+                conn = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+                # 每个会话先完成一次往返，确认服务器确实已经为其分配了处理者
+                await probe(*conn, timeout)
+                connections.append(conn)
+            except (OSError, asyncio.TimeoutError, ConnectionError):
+                failures += 1
+
+    await asyncio.gather(*(open_one() for _ in range(count)))
+    return connections, failures
+
+
+async def drive_active(connections, duration, interval, timeout):
+    """让所有会话在 duration 秒内每隔 interval 秒发送一次请求，返回延迟列表和错误数。"""
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def run(conn, offset):
+        nonlocal errors
+        await asyncio.sleep(offset)
+        while time.perf_counter() < deadline:
+            try:
+                latencies.append(await probe(*conn, timeout))
+            except (OSError, asyncio.TimeoutError, ConnectionError):
+                errors += 1
+                return
+            await asyncio.sleep(interval)
+
+    step = interval / max(1, len(connections))
+    await asyncio.gather(*(run(conn, i * step) for i, conn in enumerate(connections)))
+    return latencies, errors
+
+
+async def close_sessions(connections):
+    for _, writer in connections:
+        writer.close()
+    await asyncio.sleep(0.5)
+
+
+async def measure_level(proc, port, count, args):
+    base_rss, base_threads = read_proc_status(proc.pid)
+    start = time.perf_counter()
+    connections, failures = await open_sessions(port, count, args.concurrency, args.timeout)
+    open_seconds = time.perf_counter() - start
+    await asyncio.sleep(1.0)
+    idle_rss, idle_threads = read_proc_status(proc.pid)
+
+    latencies, errors = await drive_active(connections, args.duration, args.interval, args.timeout)
+    active_rss, active_threads = read_proc_status(proc.pid)
+    await close_sessions(connections)
+
+    return {
+        "sessions_requested": count,
+        "sessions_held": len(connections),
+        "connect_failures": failures,
+        "open_seconds": round(open_seconds, 3),
+        "baseline_rss_kb": base_rss,
+        "idle_rss_kb": idle_rss,
+        "idle_threads": idle_threads,
+        "active_rss_kb": active_rss,
+        "active_threads": active_threads,
+        "active_requests": len(latencies),
+        "active_errors": errors,
+        "throughput_rps": round(len(latencies) / args.duration, 1),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "latency_mean_ms": round(statistics.mean(latencies) * 1000, 3) if latencies else None,
+    }
+
+
+def run_sessions_benchmark(args):
+    fd_limit = raise_fd_limit()
+    levels = [int(x) for x in args.sessions.split(",")]
+    if max(levels) * 2 + 64 > fd_limit:
+        print(f"警告: 文件描述符上限为 {fd_limit}，较大的会话数可能因客户端自身限制而失败。", file=sys.stderr)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes.split(","):
+            for count in levels:
+                port = free_port()
+                proc = start_server(mode, port, ["--backlog", str(args.backlog), "--max-connections", str(count + 64)]
+                                    + CAPACITY_ARGS + storage_args(args, workdir))
+                try:
+                    row = asyncio.run(measure_level(proc, port, count, args))
+                finally:
+                    stop_server(proc)
+                row["mode"] = mode
+                results.append(row)
+                print(f"[{mode:8}] 请求 {count:6} 会话: 保持 {row['sessions_held']:6}, "
+                      f"失败 {row['connect_failures']:5}, 空闲RSS {row['idle_rss_kb']} KB / {row['idle_threads']} 线程, "
+                      f"活跃 {row['throughput_rps']} req/s p50={row['latency_p50_ms']}ms "
+                      f"p99={row['latency_p99_ms']}ms, 错误 {row['active_errors']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+# 与 db.py 保持一致的好友查询（SQLite 与 SQL Server 对这些语句的语法相同）
+FRIEND_IDS_SQL = """
+    SELECT FriendID AS FriendUserID FROM Friendships WHERE UserID = ?
+    UNION ALL
+    SELECT UserID AS FriendUserID FROM Friendships WHERE FriendID = ?
+"""
+
+FRIEND_QUERIES = {
+    # 改写前：OR 连接条件，参数 (uid, uid, uid, uid)
+    "online_friends_or": ("""
+        SELECT os.UserID, u.Username, os.IPAddress, os.P2PPort, u.PublicKey
+        FROM Friendships fs
+        JOIN OnlineStatus os ON ((fs.UserID = ? AND os.UserID = fs.FriendID) OR
+                                 (fs.FriendID = ? AND os.UserID = fs.UserID))
+        JOIN Users u ON os.UserID = u.UserID
+        WHERE (fs.UserID = ? OR fs.FriendID = ?)
+    """, 4),
+    "all_friends_or": ("""
+        SELECT u.UserID, u.Username, os.IPAddress, os.P2PPort
+        FROM Friendships fs
+        JOIN Users u ON ((fs.UserID = ? AND u.UserID = fs.FriendID) OR
+                         (fs.FriendID = ? AND u.UserID = fs.UserID))
+        LEFT JOIN OnlineStatus os ON u.UserID = os.UserID
+        WHERE (fs.UserID = ? OR fs.FriendID = ?)
+    """, 4),
+    # 改写后：两个方向分别查找再 UNION ALL，参数 (uid, uid)
+    "online_friends_union": (f"""
+        SELECT os.UserID, u.Username, os.IPAddress, os.P2PPort, u.PublicKey
+        FROM ({FRIEND_IDS_SQL}) f
+        JOIN OnlineStatus os ON os.UserID = f.FriendUserID
+        JOIN Users u ON u.UserID = f.FriendUserID
+    """, 2),
+    "all_friends_union": (f"""
+        SELECT u.UserID, u.Username, os.IPAddress, os.P2PPort
+        FROM ({FRIEND_IDS_SQL}) f
+        JOIN Users u ON u.UserID = f.FriendUserID
+        LEFT JOIN OnlineStatus os ON os.UserID = f.FriendUserID
+    """, 2),
+}
+
+
+def seed_friend_graph(conn, users, edges, online_ratio, batch_size=200000, seed=42):
+    """生成 users 个用户、约 edges 条好友关系（UserID < FriendID，重复的随机边会被忽略）和部分在线用户。"""
+    rng = random.Random(seed)
+    conn.executescript("""
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE Users (
+            UserID INTEGER PRIMARY KEY,
+            Username TEXT NOT NULL UNIQUE,
+            Password TEXT NOT NULL,
+            PublicKey TEXT NOT NULL
+        );
+        CREATE TABLE Friendships (
+            UserID INTEGER NOT NULL,
+            FriendID INTEGER NOT NULL,
+            PRIMARY KEY (UserID, FriendID),
+            CHECK (UserID < FriendID)
+        ) WITHOUT ROWID;
+        CREATE TABLE OnlineStatus (
+            UserID INTEGER PRIMARY KEY,
+            IPAddress TEXT NOT NULL,
+            P2PPort INTEGER NOT NULL
+        );
+    """)
+    start = time.perf_counter()
+    for base in range(1, users + 1, batch_size):
+        rows = [(uid, f"user{uid}", "x" * 64, f"-----BEGIN PUBLIC KEY-----{uid}")
+                for uid in range(base, min(base + batch_size, users + 1))]
+        conn.executemany("INSERT INTO Users VALUES (?, ?, ?, ?)", rows)
+    online = [(uid, "127.0.0.1", 40000 + uid % 20000)
+              for uid in range(1, users + 1) if rng.random() < online_ratio]
+    conn.executemany("INSERT INTO OnlineStatus VALUES (?, ?, ?)", online)
+    conn.commit()
+
+    inserted = 0
+    while inserted < edges:
+        batch = set()
+        while len(batch) < min(batch_size, edges - inserted):
+            a, b = rng.randint(1, users), rng.randint(1, users)
+            if a != b:
+                batch.add((a, b) if a < b else (b, a))
+        # 排序后插入，减少 B 树随机写
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO Friendships VALUES (?, ?)", sorted(batch))
+        conn.commit()
+        inserted += conn.total_changes - before
+        print(f"  已生成 {inserted}/{edges} 条好友关系 ({time.perf_counter() - start:.0f}s)", file=sys.stderr)
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+def time_friend_query(conn, sql, param_count, user_ids):
+    """对每个用户执行一次查询并取完全部结果，返回延迟列表（秒）和平均结果行数。"""
+    latencies, rows = [], 0
+    for uid in user_ids:
+        start = time.perf_counter()
+        rows += len(conn.execute(sql, (uid,) * param_count).fetchall())
+        latencies.append(time.perf_counter() - start)
+    return latencies, rows / max(1, len(user_ids))
+
+
+def run_friends_benchmark(args):
+    fresh = args.db == ":memory:" or not os.path.exists(args.db)
+    conn = sqlite3.connect(args.db)
+    if fresh:
+        print(f"生成测试数据: {args.users} 用户, {args.edges} 条好友关系 ...", file=sys.stderr)
+        seed_friend_graph(conn, args.users, args.edges, args.online_ratio)
+    else:
+        print(f"复用已有的测试数据库 {args.db}", file=sys.stderr)
+    max_uid = conn.execute("SELECT MAX(UserID) FROM Users").fetchone()[0]
+    edge_count = conn.execute("SELECT COUNT(*) FROM Friendships").fetchone()[0]
+
+    rng = random.Random(7)
+    user_ids = [rng.randint(1, max_uid) for _ in range(args.queries)]
+    phases = (
+        ("before", False, ("online_friends_or", "all_friends_or")),
+        ("after", True, ("online_friends_union", "all_friends_union")),
+    )
+    if args.all_combinations:
+        phases = tuple((name, indexed, tuple(FRIEND_QUERIES)) for name, indexed, _ in phases)
+
+    results = []
+    for phase, indexed, query_names in phases:
+        conn.execute("DROP INDEX IF EXISTS IX_Friendships_FriendID")
+        if indexed:
+            start = time.perf_counter()
+            conn.execute("CREATE INDEX IX_Friendships_FriendID ON Friendships (FriendID, UserID)")
+            conn.execute("ANALYZE")
+            print(f"  创建索引 IX_Friendships_FriendID 耗时 {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        for name in query_names:
+            sql, param_count = FRIEND_QUERIES[name]
+            latencies, avg_rows = time_friend_query(conn, sql, param_count, user_ids)
+            row = {
+                "phase": phase,
+                "friend_id_index": indexed,
+                "query": name,
+                "queries": len(latencies),
+                "avg_rows": round(avg_rows, 1),
+                "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+                "latency_mean_ms": round(statistics.mean(latencies) * 1000, 3),
+            }
+            results.append(row)
+            print(f"[{phase:6}] {name:22} 索引={'有' if indexed else '无'} 平均 {row['avg_rows']} 行, "
+                  f"p50={row['latency_p50_ms']}ms p99={row['latency_p99_ms']}ms")
+    conn.close()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"users": max_uid, "edges": edge_count, "results": results}, f, ensure_ascii=False, indent=2)
+    return results
+
+
+async def send_command(reader, writer, command, payload, timeout):
+    """以旧协议发送一条命令并读取响应（基准测试中的响应都很小，一次 read 即完整）。"""
+    writer.write(json.dumps({"command": command, "payload": payload}).encode('utf-8'))
+    await writer.drain()
+    data = await asyncio.wait_for(reader.read(65536), timeout)
+    if not data:
+        raise ConnectionError("服务器关闭了连接")
+    return json.loads(data.decode('utf-8'))
+
+
+async def register_users(port, usernames, password, concurrency, timeout):
+    """注册测试用户（已存在的用户视为成功，要求之前用相同密码注册），返回失败数。"""
+    sem = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def register_one(username):
+        nonlocal failures
+        async with sem:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+                try:
+                    await send_command(reader, writer, "REGISTER",
+                                       {"username": username, "password": password,
+                                        "public_key": f"benchmark-key-{username}"}, timeout)
+                finally:
+                    writer.close()
+            except (OSError, asyncio.TimeoutError, ConnectionError, ValueError):
+                failures += 1
+
+    await asyncio.gather(*(register_one(name) for name in usernames))
+    return failures
+
+
+async def login_storm(port, usernames, password, duration, timeout):
+    """每个用户一个连接，在 duration 秒内反复 LOGIN/LOGOUT，返回登录延迟列表和错误数。"""
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def run(index, username):
+        nonlocal errors
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            errors += 1
+            return
+        try:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await send_command(reader, writer, "LOGIN",
+                                              {"username": username, "password": password,
+                                               "p2p_ip": "127.0.0.1", "p2p_port": 20000 + index}, timeout)
+                if response.get("status") != "success":
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+                await send_command(reader, writer, "LOGOUT", {}, timeout)
+        except (OSError, asyncio.TimeoutError, ConnectionError, ValueError):
+            errors += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(run(i, name) for i, name in enumerate(usernames)))
+    return latencies, errors
+
+
+def latency_summary(prefix, latencies):
+    return {
+        f"{prefix}_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        f"{prefix}_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+
+async def measure_login_storm(port, args):
+    usernames = [f"{args.user_prefix}{i}" for i in range(args.storm)]
+    register_failures = await register_users(port, usernames, args.password, args.concurrency, args.timeout)
+    probes, probe_failures = await open_sessions(port, args.probes, args.concurrency, args.timeout)
+
+    # 基线：没有登录请求时非认证命令的延迟
+    baseline, baseline_errors = await drive_active(probes, args.duration, args.interval, args.timeout)
+    # 登录风暴期间同样的探测
+    storm_task = asyncio.ensure_future(login_storm(port, usernames, args.password, args.duration, args.timeout))
+    during, during_errors = await drive_active(probes, args.duration, args.interval, args.timeout)
+    login_latencies, login_errors = await storm_task
+    await close_sessions(probes)
+
+    row = {
+        "storm_users": args.storm,
+        "register_failures": register_failures,
+        "probe_sessions": len(probes),
+        "probe_connect_failures": probe_failures,
+        "logins": len(login_latencies),
+        "login_errors": login_errors,
+        "logins_per_second": round(len(login_latencies) / args.duration, 1),
+        "probe_errors": baseline_errors + during_errors,
+    }
+    row.update(latency_summary("login", login_latencies))
+    row.update(latency_summary("probe_idle", baseline))
+    row.update(latency_summary("probe_storm", during))
+    return row
+
+
+def run_logins_benchmark(args):
+    raise_fd_limit()
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes.split(","):
+            port = free_port()
+            proc = start_server(mode, port, ["--backlog", str(args.backlog)] + CAPACITY_ARGS + storage_args(args, workdir))
+            try:
+                row = asyncio.run(measure_login_storm(port, args))
+            finally:
+                stop_server(proc)
+            row["mode"] = mode
+            results.append(row)
+            print(f"[{mode:8}] 登录 {row['logins_per_second']} 次/s (p50={row['login_p50_ms']}ms "
+                  f"p99={row['login_p99_ms']}ms, 错误 {row['login_errors']}); 非认证命令 空闲 "
+                  f"p50={row['probe_idle_p50_ms']}ms p99={row['probe_idle_p99_ms']}ms -> 登录风暴期间 "
+                  f"p50={row['probe_storm_p50_ms']}ms p99={row['probe_storm_p99_ms']}ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+async def check_shared_presence(port, args):
+    """
+    注册 args.ring_users 个用户并全部登录（每个用户一个连接，由内核分配到不同工作进程），好友关系连成一个环，
+    然后检查每个用户的 GET_ONLINE_FRIENDS 是否恰好是环上相邻的两个用户。
+    :return: (检查的用户数, 结果不正确的用户数)
+    """
+    count = args.ring_users
+    usernames = [f"{args.user_prefix}{i}" for i in range(count)]
+    await register_users(port, usernames, args.password, args.concurrency, args.timeout)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def login(index, username):
+        async with sem:
+            conn = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), args.timeout)
+            response = await send_command(*conn, "LOGIN", {"username": username, "password": args.password,
+                                                           "p2p_ip": "127.0.0.1", "p2p_port": 20000 + index},
+                                          args.timeout)
+            if response.get("status") != "success":
+                raise RuntimeError(f"用户 {username} 登录失败: {response.get('message')}")
+            return conn
+
+    connections = await asyncio.gather(*(login(i, name) for i, name in enumerate(usernames)))
+    try:
+        for i, conn in enumerate(connections):
+            await send_command(*conn, "ADD_FRIEND", {"friend_username": usernames[(i + 1) % count]}, args.timeout)
+        await asyncio.sleep(0.5)  # 等待好友关系变化经 presence broker 传到所有工作进程
+        mismatches = 0
+        for i, conn in enumerate(connections):
+            response = await send_command(*conn, "GET_ONLINE_FRIENDS", {}, args.timeout)
+            names = {friend["username"] for friend in response.get("data", {}).get("friends", [])}
+            if names != {usernames[(i - 1) % count], usernames[(i + 1) % count]}:
+                mismatches += 1
+        return count, mismatches
+    finally:
+        await close_sessions(connections)
+
+
+async def check_relogin_after_drop(port, args):
+    """
+    注册 args.ring_users 个用户，每个用户登录后直接断开连接（不登出，会话转为待恢复），
+    再用新连接凭密码重新登录；新连接由内核分配，多进程模式下相当一部分会落到另一个工作进程上。
+    :return: (检查的用户数, 重新登录失败的用户数)
+    """
+    count = args.ring_users
+    usernames = [f"{args.user_prefix}relogin_{i}" for i in range(count)]
+    await register_users(port, usernames, args.password, args.concurrency, args.timeout)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def login(index, username):
+        conn = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), args.timeout)
+        response = await send_command(*conn, "LOGIN", {"username": username, "password": args.password,
+                                                       "p2p_ip": "127.0.0.1", "p2p_port": 20000 + index},
+                                      args.timeout)
+        return conn, response.get("status") == "success"
+
+    async def relogin(index, username):
+        async with sem:
+            try:
+                (_, writer), ok = await login(index, username)
+                writer.close()
+                if not ok:
+                    return False
+                await asyncio.sleep(0.2)  # 等待服务器发现连接断开
+                (_, writer), ok = await login(index, username)
+                writer.close()
+                return ok
+            except (OSError, asyncio.TimeoutError, ConnectionError, ValueError):
+                return False
+
+    results = await asyncio.gather(*(relogin(i, name) for i, name in enumerate(usernames)))
+    return count, results.count(False)
+
+
+def drive_load(port, connections, duration, timeout):
+    """负载进程：打开 connections 个连接，每个连接在 duration 秒内收到响应后立即发送下一个请求。"""
+    async def run():
+        conns, failures = await open_sessions(port, connections, connections, timeout)
+        latencies, errors = await drive_active(conns, duration, 0, timeout)
+        await close_sessions(conns)
+        return len(latencies), failures + errors, [percentile(latencies, 50), percentile(latencies, 99)]
+
+    return asyncio.run(run())
+
+
+def run_workers_benchmark(args):
+    raise_fd_limit()
+    results = []
+    baseline = None
+    with tempfile.TemporaryDirectory() as workdir:
+        for workers in (int(n) for n in args.workers.split(",")):
+            port = free_port()
+            broker_socket = os.path.join(workdir, f"presence_{port}.sock")
+            proc = start_server(args.mode, port, ["--workers", str(workers), "--backlog", str(args.backlog),
+                                                  "--presence-broker-socket", broker_socket]
+                                + CAPACITY_ARGS + storage_args(args, workdir))
+            try:
+                time.sleep(args.warmup)  # 等待所有工作进程都绑定端口
+                checked, mismatches = asyncio.run(check_shared_presence(port, args))
+                relogins, relogin_failures = asyncio.run(check_relogin_after_drop(port, args))
+                with multiprocessing.Pool(args.load_procs) as pool:
+                    rows = pool.starmap(drive_load, [(port, args.connections, args.duration, args.timeout)]
+                                        * args.load_procs)
+            finally:
+                stop_server(proc)
+
+            requests = sum(row[0] for row in rows)
+            throughput = requests / args.duration
+            baseline = baseline or throughput / workers
+            row = {
+                "mode": args.mode,
+                "workers": workers,
+                "presence_users_checked": checked,
+                "presence_mismatches": mismatches,
+                "relogins_checked": relogins,
+                "relogin_failures": relogin_failures,
+                "requests": requests,
+                "errors": sum(row[1] for row in rows),
+                "throughput_rps": round(throughput, 1),
+                "scaling_efficiency": round(throughput / (baseline * workers), 3),
+                # 各负载进程 p50/p99 的最大值
+                "latency_p50_ms": round(max(row[2][0] or 0 for row in rows) * 1000, 3),
+                "latency_p99_ms": round(max(row[2][1] or 0 for row in rows) * 1000, 3),
+            }
+            results.append(row)
+            print(f"[workers={workers}] 在线状态检查 {checked} 个用户，错误 {mismatches}; "
+                  f"断开后重新登录 {relogins} 个用户，失败 {relogin_failures}; "
+                  f"吞吐量 {row['throughput_rps']} 请求/s (扩展效率 {row['scaling_efficiency']:.0%}, "
+                  f"p50={row['latency_p50_ms']}ms p99={row['latency_p99_ms']}ms, 错误 {row['errors']})")
+
+    print(f"本机 CPU 核数: {os.cpu_count()}；工作进程数超过核数（含负载进程占用的核）后吞吐量不再线性增长。")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def fake_friend_infos(count, include_key, seed=42):
+    """生成 count 个与 PresenceEntry.to_friend_info() 格式相同的好友信息（PEM 长度与 2048 位 RSA 公钥相同）。"""
+    rng = random.Random(seed)
+    friends = []
+    for uid in range(1, count + 1):
+        der = bytes(rng.getrandbits(8) for _ in range(294))  # 2048 位 RSA 公钥的 SubjectPublicKeyInfo 长度
+        b64 = base64.b64encode(der).decode('ascii')
+        pem = "-----BEGIN PUBLIC KEY-----\n" + "\n".join(b64[i:i + 64] for i in range(0, len(b64), 64)) \
+              + "\n-----END PUBLIC KEY-----\n"
+        info = {"user_id": uid, "username": f"friend_{uid}", "ip": f"10.0.{uid // 256 % 256}.{uid % 256}",
+                "port": 20000 + uid, "public_key_fingerprint": hashlib.sha256(pem.encode('ascii')).hexdigest()}
+        if include_key:
+            info["public_key_pem"] = pem
+        friends.append(info)
+    return friends
+
+
+def time_per_call(func, repeat):
+    """执行 func repeat 次，返回单次的中位数耗时（秒）。"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def run_encoding_benchmark(args):
+    """
+    比较 GET_ONLINE_FRIENDS 响应在各种编码（json / msgpack / cbor，只测本机已安装的）与布局（逐行字典 / 列式）下
+    的字节数，以及服务器序列化、客户端反序列化（含列式还原为字典列表）的 CPU 耗时。
+    """
+    results = []
+    for include_key in (True, False):
+        friends = fake_friend_infos(args.friends, include_key)
+        baseline = None
+        # 第一种组合（json + 逐行字典，即改动前的格式）作为比较基准
+        for encoding in sorted(SUPPORTED_ENCODINGS, key=lambda name: name != ENCODING_JSON):
+            for columnar in (False, True):
+                data = {"friends": to_columns(friends) if columnar else friends, "next_after_user_id": None}
+                response = {"status": "success", "message": "在线好友已检索。", "data": data}
+                body = encode_message(response, encoding)
+
+                def decode():
+                    items = decode_message(body, encoding)["data"]["friends"]
+                    if isinstance(items, dict):
+                        keys = list(items)
+                        items = [dict(zip(keys, values)) for values in zip(*items.values())]
+                    return items
+
+                assert decode() == friends
+                row = {
+                    "keys": "pem" if include_key else "fingerprint",
+                    "encoding": encoding,
+                    "layout": "columnar" if columnar else "rows",
+                    "friends": args.friends,
+                    "bytes": len(body) + FRAME_HEADER_SIZE,
+                    "encode_us": round(time_per_call(lambda: encode_message(response, encoding), args.repeat) * 1e6, 1),
+                    "decode_us": round(time_per_call(decode, args.repeat) * 1e6, 1),
+                }
+                baseline = baseline or row
+                row["bytes_saved"] = baseline["bytes"] - row["bytes"]
+                row["cpu_saved_us"] = round(baseline["encode_us"] + baseline["decode_us"]
+                                            - row["encode_us"] - row["decode_us"], 1)
+                results.append(row)
+                print(f"[{row['keys']:11}] {encoding:8} {row['layout']:8}: {row['bytes']:8} 字节 "
+                      f"(节省 {row['bytes_saved'] / baseline['bytes']:6.1%}), 序列化 {row['encode_us']:8}us, "
+                      f"反序列化 {row['decode_us']:8}us (共节省 {row['cpu_saved_us']}us)")
+    missing = [name for name in ("msgpack", "cbor") if name not in SUPPORTED_ENCODINGS]
+    if missing:
+        print(f"未安装的编码库（pip install msgpack cbor2）: {', '.join(missing)}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="安全聊天目录服务器基准测试")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    sessions = sub.add_parser("sessions", help="比较 threaded 与 asyncio 模式下单进程可保持的会话数")
+    sessions.add_argument("--modes", default="threaded,asyncio", help="要测试的服务器模式，逗号分隔")
+    sessions.add_argument("--sessions", default="1000,5000,10000", help="会话数梯度，逗号分隔")
+    sessions.add_argument("--concurrency", type=int, default=500, help="建立连接时的并发数")
+    sessions.add_argument("--duration", type=float, default=10.0, help="活跃阶段持续时间（秒）")
+    sessions.add_argument("--interval", type=float, default=1.0, help="活跃阶段每个会话的请求间隔（秒）")
+    sessions.add_argument("--timeout", type=float, default=10.0, help="单次连接/请求超时（秒）")
+    sessions.add_argument("--backlog", type=int, default=1024, help="传给服务器的 listen backlog")
+    sessions.add_argument("--db-backend", choices=("sqlite", "sqlserver"), default="sqlite",
+                          help="服务器使用的存储后端；sqlite 每次使用临时数据库文件，不需要数据库服务")
+    sessions.add_argument("--json", help="将结果以JSON格式写入该文件")
+    sessions.set_defaults(func=run_sessions_benchmark)
+
+    friends = sub.add_parser("friends", help="比较好友查询改写（OR -> UNION ALL）与 FriendID 索引前后的延迟")
+    friends.add_argument("--users", type=int, default=1000000, help="生成的用户数")
+    friends.add_argument("--edges", type=int, default=50000000, help="生成的好友关系数")
+    friends.add_argument("--online-ratio", type=float, default=0.1, help="在线用户比例")
+    friends.add_argument("--db", default=":memory:",
+                         help="SQLite 数据库文件；文件已存在时直接复用其中的数据，默认使用内存数据库")
+    friends.add_argument("--queries", type=int, default=200, help="每种查询执行的次数（随机用户）")
+    friends.add_argument("--all-combinations", action="store_true",
+                         help="在有/无索引两个阶段都测量 OR 与 UNION ALL 两种写法")
+    friends.add_argument("--json", help="将结果以JSON格式写入该文件")
+    friends.set_defaults(func=run_friends_benchmark)
+
+    logins = sub.add_parser("logins", help="测量登录吞吐量，以及登录风暴期间非认证命令的延迟")
+    logins.add_argument("--modes", default="asyncio,threaded", help="要测试的服务器模式，逗号分隔")
+    logins.add_argument("--storm", type=int, default=200, help="同时反复登录/登出的用户（连接）数")
+    logins.add_argument("--probes", type=int, default=50, help="测量非认证命令延迟的会话数")
+    logins.add_argument("--duration", type=float, default=10.0, help="空闲阶段和登录风暴阶段各自的持续时间（秒）")
+    logins.add_argument("--interval", type=float, default=0.2, help="探测会话的请求间隔（秒）")
+    logins.add_argument("--concurrency", type=int, default=100, help="注册用户、建立探测连接时的并发数")
+    logins.add_argument("--timeout", type=float, default=30.0, help="单次连接/请求超时（秒）")
+    logins.add_argument("--backlog", type=int, default=1024, help="传给服务器的 listen backlog")
+    logins.add_argument("--user-prefix", default="login_bench_", help="测试用户名前缀")
+    logins.add_argument("--password", default="login-bench-password", help="测试用户的密码")
+    logins.add_argument("--db-backend", choices=("sqlite", "sqlserver"), default="sqlite",
+                        help="服务器使用的存储后端；sqlite 每次使用临时数据库文件，不需要数据库服务")
+    logins.add_argument("--json", help="将结果以JSON格式写入该文件")
+    logins.set_defaults(func=run_logins_benchmark)
+
+    workers = sub.add_parser("workers", help="测量多进程模式（--workers）的吞吐量扩展效率与跨进程在线状态的正确性")
+    workers.add_argument("--mode", choices=("asyncio", "threaded"), default="asyncio", help="工作进程的服务器模式")
+    workers.add_argument("--workers", default="1,2,4", help="工作进程数梯度，逗号分隔")
+    workers.add_argument("--load-procs", type=int, default=4, help="负载进程数")
+    workers.add_argument("--connections", type=int, default=50, help="每个负载进程的连接数")
+    workers.add_argument("--duration", type=float, default=10.0, help="每个梯度的负载持续时间（秒）")
+    workers.add_argument("--ring-users", type=int, default=50, help="在线状态检查中登录并连成好友环的用户数，也是断开后重新登录检查的用户数")
+    workers.add_argument("--warmup", type=float, default=2.0, help="服务器启动后等待所有工作进程就绪的时间（秒）")
+    workers.add_argument("--concurrency", type=int, default=50, help="注册、登录测试用户时的并发数")
+    workers.add_argument("--timeout", type=float, default=30.0, help="单次连接/请求超时（秒）")
+    workers.add_argument("--backlog", type=int, default=1024, help="传给服务器的 listen backlog")
+    workers.add_argument("--user-prefix", default="workers_bench_", help="测试用户名前缀")
+    workers.add_argument("--password", default="workers-bench-password", help="测试用户的密码")
+    workers.add_argument("--db-backend", choices=("sqlite", "sqlserver"), default="sqlite",
+                         help="服务器使用的存储后端；sqlite 每次使用临时数据库文件，不需要数据库服务")
+    workers.add_argument("--json", help="将结果以JSON格式写入该文件")
+    workers.set_defaults(func=run_workers_benchmark)
+
+    encoding = sub.add_parser("encoding", help="比较 GET_ONLINE_FRIENDS 响应在各种编码与列式布局下的字节数和序列化耗时")
+    encoding.add_argument("--friends", type=int, default=1000, help="响应中的好友数")
+    encoding.add_argument("--repeat", type=int, default=200, help="每种组合序列化/反序列化的次数（取中位数）")
+    encoding.add_argument("--json", help="将结果以JSON格式写入该文件")
+    encoding.set_defaults(func=run_encoding_benchmark)
+    return parser
+
+
+if __name__ == "__main__":
+    cli_args = build_parser().parse_args()
+    cli_args.func(cli_args)
@@ -13,3 +13,105 @@ LOG_FILE = ''
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 50000
 BUFFER_SIZE = 4096
+
+# 服务器运行模式: "asyncio" (事件循环 + 协程, 默认) 或 "threaded" (每个连接一个线程)
+SERVER_MODE = "asyncio"
+# listen() 的待处理连接队列长度，实际上限还受系统 somaxconn 限制
+SERVER_BACKLOG = 1024
+# asyncio 模式下执行数据库等阻塞操作的线程池大小
+DB_EXECUTOR_WORKERS = 32
+# 分帧协议下单帧允许的最大长度（字节）
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# 存储后端: "sqlserver" (pyodbc + SQL Server, 默认) 或 "sqlite" (内嵌数据库，单节点部署/CI/本地基准测试)
+DB_BACKEND = "sqlserver"
+# SQLite 后端配置
+SQLITE_DB_FILE = "secure_chat.db"     # 数据库文件路径
+SQLITE_BUSY_TIMEOUT = 5.0             # 等待其他连接释放写锁的最长时间（秒）
+SQLITE_CACHE_SIZE_KB = 64 * 1024      # 每个连接的页缓存大小
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # 内存映射读取的最大字节数
+SQLITE_STATEMENT_CACHE_SIZE = 128     # 每个连接缓存的预编译语句数
+
+# 数据库连接池配置（时间单位：秒）
+DB_POOL_MAX_SIZE = 20                 # 最大物理连接数
+DB_POOL_MIN_SIZE = 2                  # 空闲回收时至少保留的连接数
+DB_POOL_ACQUIRE_TIMEOUT = 5.0         # 连接池已满时获取连接的最长等待时间
+DB_POOL_IDLE_TIMEOUT = 300.0          # 空闲超过该时间的连接被回收
+DB_POOL_MAX_LIFETIME = 1800.0         # 连接最长存活时间，超过后归还时重建
+DB_POOL_HEALTH_CHECK_INTERVAL = 30.0  # 空闲超过该时间的连接在借出前执行健康检查
+
+# SEARCH_USERS 命令：未指定 limit 时返回的结果数，以及允许的最大结果数
+SEARCH_USERS_DEFAULT_LIMIT = 20
+SEARCH_USERS_MAX_LIMIT = 100
+# 不足3个字符的搜索词无法使用三元组索引，子串匹配改为按用户名顺序扫描，最多检查的用户数
+SEARCH_USERS_SHORT_QUERY_SCAN_LIMIT = 100000
+
+# 列表类命令（GET_ALL_USERS / GET_ALL_FRIENDS / GET_ONLINE_FRIENDS）按 UserID 游标分页：
+# 未指定 limit 时每页返回的条数、允许的最大条数，以及数据库游标每批 fetchmany 的行数
+LIST_PAGE_DEFAULT_LIMIT = 500
+LIST_PAGE_MAX_LIMIT = 1000
+DB_FETCH_BATCH_SIZE = 200
+
+# 每个连接最多记录多少个客户端已缓存的公钥指纹（客户端在 GET_ONLINE_FRIENDS 中通过 known_fingerprints 声明）
+KNOWN_KEY_FINGERPRINTS_MAX = 5000
+
+# 协商了请求流水线（HELLO 中 pipelining=true）的连接上，asyncio 模式下同时处理的最大请求数
+MAX_PIPELINED_REQUESTS = 32
+# asyncio 模式下推送事件时，连接的发送缓冲区中未被客户端读走的数据上限（字节）；
+# 超过时说明客户端读取过慢或已停止读取，关闭连接而不是无限制地缓存推送（客户端重连后用 SYNC_FRIENDS 补齐）
+PUSH_WRITE_BUFFER_LIMIT = 1024 * 1024
+
+# 密码哈希 (scrypt)：在独立的进程池中计算，避免哈希计算持有服务器进程的 GIL
+PASSWORD_HASH_WORKERS = 4             # 密码哈希进程池大小
+SCRYPT_N = 2 ** 14                    # CPU/内存开销参数（2的幂），内存占用约 128 * N * r 字节
+SCRYPT_R = 8                          # 块大小
+SCRYPT_P = 1                          # 并行度
+# asyncio 模式下处理 LOGIN / REGISTER 的专用线程数（这些线程主要在等待进程池的结果），
+# 与 DB 线程池分开，登录高峰时其他命令不会排在密码哈希后面
+AUTH_EXECUTOR_WORKERS = 16
+
+# 在线状态批量写入（PresenceWriter）：第一条变化到达后最多等待的时间（秒），以及单批最多包含的用户数
+PRESENCE_FLUSH_INTERVAL = 0.05
+PRESENCE_FLUSH_BATCH_SIZE = 500
+
+# 多进程模式（main.py --workers N）：工作进程数（1 表示单进程，不启动 presence broker），
+# presence broker 的 Unix 域套接字路径（为空时使用系统临时目录下按端口命名的文件），以及等待 broker 确认的超时（秒）
+SERVER_WORKERS = 1
+PRESENCE_BROKER_SOCKET = ""
+PRESENCE_BROKER_TIMEOUT = 5.0
+
+# Prometheus 指标端点（GET http://METRICS_HOST:METRICS_PORT/metrics），METRICS_PORT 为 0 时不启动；
+# 多进程模式下第 i 个工作进程使用 METRICS_PORT + i
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 50080
+
+# 准入控制（过载保护）：超出限制的请求立即收到 status=error 的响应，data 中带 reason 和 retry_after（秒）
+# 令牌桶限流（每秒请求数 / 允许的突发请求数）：每个连接、每个已登录用户（断线重连后仍是同一个桶）、每个用户名的登录尝试
+CONNECTION_RATE_LIMIT = 50.0
+CONNECTION_RATE_BURST = 100
+USER_RATE_LIMIT = 50.0
+USER_RATE_BURST = 100
+LOGIN_ATTEMPT_RATE_LIMIT = 0.5
+LOGIN_ATTEMPT_BURST = 10
+# 同时执行的访问数据库的命令数上限、额外允许排队的命令数，以及排队等待执行的最长时间（秒）；执行与排队都满时立即拒绝
+DB_MAX_CONCURRENT_OPERATIONS = DB_POOL_MAX_SIZE
+DB_MAX_QUEUED_OPERATIONS = 200
+DB_QUEUE_TIMEOUT = 2.0
+# 服务器繁忙（DB 操作队列满、连接数已满）时建议客户端等待的时间（秒）
+BUSY_RETRY_AFTER = 1.0
+# 每个进程的最大客户端连接数，以及超出时的策略："reject" 立即拒绝新连接；
+# "queue" 让新连接等待已有连接关闭（threaded 模式暂停 accept；asyncio 模式最多等待 CONNECTION_QUEUE_TIMEOUT 秒）
+MAX_CONNECTIONS = 10000
+CONNECTION_OVERFLOW_POLICY = "reject"
+CONNECTION_QUEUE_TIMEOUT = 10.0
+
+# 断线会话恢复：控制连接意外断开后保留在线状态的宽限期（秒，为 0 时断开即下线），
+# 在此期间客户端可用 LOGIN 返回的恢复令牌发送 RESUME 恢复会话，不需要重新登录；
+# 恢复令牌自签发起的最长有效期（秒），以及签名密钥（为空时每次启动随机生成，多进程模式下由主进程生成后传给各工作进程）
+RESUME_GRACE_PERIOD = 30.0
+RESUME_TOKEN_TTL = 7 * 24 * 3600
+RESUME_TOKEN_SECRET = ""
+
+# 好友列表增量同步（SYNC_FRIENDS）：每个在线用户保留的好友变更记录数，
+# 客户端的版本早于保留的最早记录时返回完整快照
+FRIEND_SYNC_LOG_SIZE = 256
@@ -1,10 +1,13 @@
 """
-完成各类数据库操作
+完成各类数据库操作（SQL Server 存储后端）
 """
 import pyodbc
-from config import db_info
+from config import db_info, DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE, DB_POOL_ACQUIRE_TIMEOUT, DB_POOL_IDLE_TIMEOUT, \
+    DB_POOL_MAX_LIFETIME, DB_POOL_HEALTH_CHECK_INTERVAL, DB_FETCH_BATCH_SIZE, LIST_PAGE_DEFAULT_LIMIT
 import logging
-from utils import hash_password
+from utils import key_fingerprint
+from db_pool import ConnectionPool, PoolError, PoolTimeoutError
+from storage import StorageBackend
 
 SQL_CONNECTION_STRING = ("DRIVER={ODBC Driver 17 for SQL Server};"
                          f"SERVER=localhost;DATABASE={db_info['database']};"
@@ -14,25 +17,109 @@ SQL_CONNECTION_STRING = ("DRIVER={ODBC Driver 17 for SQL Server};"
 # 获取logger实例，名称通常与模块名一致
 logger = logging.getLogger(__name__)
 
+# 某用户所有好友的UserID。Friendships 每条关系只存一行 (UserID < FriendID)，
+# 两个方向分别按主键 (UserID, FriendID) 和索引 IX_Friendships_FriendID 查找后 UNION ALL，
+# 避免 "fs.UserID = ? OR fs.FriendID = ?" 导致的全表扫描。参数: (user_id, user_id)
+FRIEND_IDS_SQL = """
+    SELECT FriendID AS FriendUserID FROM Friendships WHERE UserID = ?
+    UNION ALL
+    SELECT UserID AS FriendUserID FROM Friendships WHERE FriendID = ?
+"""
+
+# 分页版本：只取 UserID 大于游标的好友，两个方向仍然都是范围查找。参数: (user_id, after_user_id, user_id, after_user_id)
+FRIEND_IDS_PAGE_SQL = """
+    SELECT FriendID AS FriendUserID FROM Friendships WHERE UserID = ? AND FriendID > ?
+    UNION ALL
+    SELECT UserID AS FriendUserID FROM Friendships WHERE FriendID = ? AND UserID > ?
+"""
+
+# 各方法捕获的错误：驱动错误，以及连接池满（超时）或已关闭（服务器退出中）时借不到连接
+DB_ERRORS = (pyodbc.Error, PoolError)
+
+# SQL Server 单条语句最多 2100 个参数，批量写入在线状态时按以下行数拆分语句
+ONLINE_STATUS_MERGE_CHUNK = 500  # 每行 3 个参数
+ONLINE_STATUS_DELETE_CHUNK = 1000
+
+
+def _iter_rows(cursor, batch_size=DB_FETCH_BATCH_SIZE):
+    """按批 fetchmany 逐行读取结果集，避免 fetchall 一次性把全部行读入内存。"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+class DatabaseManager(StorageBackend):
+    """基于 pyodbc 的 SQL Server 存储后端。"""
 
-class DatabaseManager:
     def __init__(self):
         self.conn_str = SQL_CONNECTION_STRING
+        # 所有方法共享的连接池：close() 归还连接而不是断开，避免每条查询都重新建立 ODBC 连接
+        self.pool = ConnectionPool(
+            self._connect,
+            max_size=DB_POOL_MAX_SIZE,
+            min_size=DB_POOL_MIN_SIZE,
+            acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+            idle_timeout=DB_POOL_IDLE_TIMEOUT,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+        )
         logger.info("DatabaseManager: 正在初始化并尝试连接到数据库。")
         self.create_tables()
         logger.info("DatabaseManager: 数据库管理器初始化完成。")
 
-    def _get_connection(self):
-        """获取一个新的数据库连接。"""
+    def _connect(self):
+        """建立一个新的物理数据库连接（仅由连接池调用）。"""
         try:
             conn = pyodbc.connect(self.conn_str, autocommit=True)
-            logger.debug("DatabaseManager: 成功获取数据库连接。")
+            logger.debug("DatabaseManager: 成功建立新的数据库连接。")
             return conn
         except pyodbc.Error as ex:
             sqlstate = ex.args[0]
             logger.error(f"DatabaseManager: 数据库连接失败! SQLSTATE: {sqlstate} - {ex}", exc_info=True)
             raise
 
+    def _get_connection(self):
+        """
+        从连接池借出一个数据库连接，调用 close() 即归还。
+        :raises PoolError: 等待超时或连接池已关闭；调用方与驱动错误一起按 DB_ERRORS 捕获。
+        """
+        try:
+            conn = self.pool.acquire()
+            logger.debug("DatabaseManager: 成功获取数据库连接。")
+            return conn
+        except PoolTimeoutError as ex:
+            logger.error(f"DatabaseManager: 获取数据库连接超时: {ex} 连接池状态: {self.pool.stats()}")
+            raise
+        except PoolError as ex:
+            logger.warning(f"DatabaseManager: 无法获取数据库连接: {ex}")
+            raise
+
+    @staticmethod
+    def _handle_query_error(conn, ex):
+        """
+        查询出错后处理借出的连接（在 finally 中 close() 归还之前调用）：
+        连接类错误（SQLSTATE 08xxx、超时等 OperationalError）说明连接已损坏，作废而不放回池中；
+        其他错误照常归还，但下次借出前先做健康检查，避免同一个坏连接被反复借出。
+        """
+        if conn is None:
+            return
+        sqlstate = ex.args[0] if ex.args else ""
+        if isinstance(ex, pyodbc.OperationalError) or (isinstance(sqlstate, str) and sqlstate.startswith("08")):
+            logger.warning(f"DatabaseManager: 数据库连接已损坏 (SQLSTATE: {sqlstate})，不再放回连接池。")
+            conn.invalidate()
+        else:
+            conn.mark_suspect()
+
+    def get_pool_stats(self):
+        """返回连接池指标（等待时间、使用中连接数、借出延迟等）。"""
+        return self.pool.stats()
+
+    def close(self):
+        """关闭连接池中的所有连接（服务器退出时调用）。"""
+        self.pool.close()
+
     def create_tables(self):
         """如果不存在，则创建数据库表。"""
         conn = None
@@ -46,11 +133,22 @@ class DatabaseManager:
                 CREATE TABLE Users (
                     UserID INT IDENTITY(1,1) PRIMARY KEY,
                     Username NVARCHAR(50) NOT NULL UNIQUE,
-                    Password NVARCHAR(64) NOT NULL,
+                    Password NVARCHAR(255) NOT NULL,                             -- 带版本前缀的 scrypt 哈希
                     PublicKey NVARCHAR(MAX) NOT NULL,
+                    PublicKeyFingerprint CHAR(64) NULL,                          -- 公钥的 SHA-256 指纹
                     RegistrationDate DATETIME DEFAULT GETDATE()
                 );
             """)
+            # 旧版本创建的 Users 表没有指纹列
+            cursor.execute("""
+                IF COL_LENGTH('Users', 'PublicKeyFingerprint') IS NULL
+                ALTER TABLE Users ADD PublicKeyFingerprint CHAR(64) NULL;
+            """)
+            # 旧版本的 Password 列只能容纳 SHA-256 十六进制值（COL_LENGTH 以字节计，NVARCHAR(255) 为 510）
+            cursor.execute("""
+                IF COL_LENGTH('Users', 'Password') < 510
+                ALTER TABLE Users ALTER COLUMN Password NVARCHAR(255) NOT NULL;
+            """)
 
             logger.info("DatabaseManager: 检查并创建 'Friendships' 表...")
             cursor.execute("""
@@ -66,6 +164,14 @@ class DatabaseManager:
                 );
             """)
 
+            # 主键只能支持按 UserID 查找，按 FriendID 查找另一方向的好友需要单独的非聚集索引
+            logger.info("DatabaseManager: 检查并创建 'IX_Friendships_FriendID' 索引...")
+            cursor.execute("""
+                IF NOT EXISTS (SELECT * FROM sys.indexes
+                               WHERE name='IX_Friendships_FriendID' AND object_id = OBJECT_ID('Friendships'))
+                CREATE NONCLUSTERED INDEX IX_Friendships_FriendID ON Friendships (FriendID, UserID);
+            """)
+
             logger.info("DatabaseManager: 检查并创建 'OnlineStatus' 表...")
             cursor.execute("""
                 IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='OnlineStatus' and xtype='U')
@@ -81,24 +187,43 @@ class DatabaseManager:
             # 显式提交确保表创建
             conn.commit()
             logger.info("DatabaseManager: 数据库表检查/创建完成。")
-        except pyodbc.Error as ex:
+            self._backfill_key_fingerprints(cursor)
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 创建数据库表时出错: {ex}", exc_info=True)
         finally:
             if conn:
                 conn.close()
                 logger.debug("DatabaseManager: 已关闭创建表时的数据库连接。")
 
-    def register_user(self, username, password, public_key):
-        """注册一个新用户并将其信息存储到数据库。"""
+    def _backfill_key_fingerprints(self, cursor, batch_size=DB_FETCH_BATCH_SIZE):
+        """为旧数据中还没有指纹的用户补算公钥指纹。已更新的行不再满足条件，因此每次都从头取下一批。"""
+        total = 0
+        while True:
+            cursor.execute("SELECT TOP (?) UserID, PublicKey FROM Users WHERE PublicKeyFingerprint IS NULL "
+                           "ORDER BY UserID", batch_size)
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            cursor.executemany("UPDATE Users SET PublicKeyFingerprint = ? WHERE UserID = ?",
+                               [(key_fingerprint(row.PublicKey), row.UserID) for row in rows])
+            total += len(rows)
+        if total:
+            logger.info(f"DatabaseManager: 已为 {total} 个用户补算公钥指纹。")
+
+    def register_user(self, username, password_hash, public_key):
+        """
+        注册一个新用户并将其信息存储到数据库。
+        :param password_hash: 已计算好的密码哈希（由 PasswordHasher 在进程池中计算）。
+        """
         conn = None
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
-            password_hash = hash_password(password)
 
-            sql = "INSERT INTO Users (Username, Password, PublicKey) VALUES (?, ?, ?)"
+            sql = "INSERT INTO Users (Username, Password, PublicKey, PublicKeyFingerprint) VALUES (?, ?, ?, ?)"
             logger.debug(f"DatabaseManager: 执行SQL注册用户: {sql} with username={username}")
-            cursor.execute(sql, username, password_hash, public_key)
+            cursor.execute(sql, username, password_hash, public_key, key_fingerprint(public_key))
             logger.info(f"DatabaseManager: 用户 '{username}' 注册成功。")
             return True
         except pyodbc.IntegrityError as ex:
@@ -108,7 +233,8 @@ class DatabaseManager:
                 return False
             logger.error(f"DatabaseManager: 注册用户 '{username}' 时发生完整性错误: {ex}", exc_info=True)
             return False
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 注册用户 '{username}' 时出错: {ex}", exc_info=True)
             return False
         finally:
@@ -116,30 +242,48 @@ class DatabaseManager:
                 conn.close()
                 logger.debug("DatabaseManager: 已关闭注册用户时的数据库连接。")
 
-    def authenticate_user(self, username, password):
-        """验证用户凭据，如果成功则返回 UserID 和 PublicKey。"""
+    def get_user_credentials(self, username):
+        """
+        获取用户的认证信息。密码校验由调用方在密码哈希进程池中完成。
+        :return: (UserID, 密码哈希, PublicKey)；用户不存在或出错时返回 (None, None, None)。
+        """
         conn = None
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
-            password_hash = hash_password(password)
-
-            sql = "SELECT UserID, PublicKey FROM Users WHERE Username = ? AND Password = ?"
-            logger.debug(f"DatabaseManager: 执行SQL认证用户: {sql} with username={username}")
-            cursor.execute(sql, username, password_hash)
+            sql = "SELECT UserID, Password, PublicKey FROM Users WHERE Username = ?"
+            logger.debug(f"DatabaseManager: 执行SQL获取认证信息: {sql} with username={username}")
+            cursor.execute(sql, username)
             row = cursor.fetchone()
             if row:
-                logger.info(f"DatabaseManager: 用户 '{username}' 认证成功。")
-                return row.UserID, row.PublicKey
-            logger.warning(f"DatabaseManager: 用户 '{username}' 认证失败 (用户名或密码无效)。")
-            return None, None
-        except pyodbc.Error as ex:
-            logger.error(f"DatabaseManager: 认证用户 '{username}' 时出错: {ex}", exc_info=True)
-            return None, None
+                return row.UserID, row.Password, row.PublicKey
+            logger.warning(f"DatabaseManager: 用户 '{username}' 不存在。")
+            return None, None, None
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"DatabaseManager: 获取用户 '{username}' 的认证信息时出错: {ex}", exc_info=True)
+            return None, None, None
         finally:
             if conn:
                 conn.close()
-                logger.debug("DatabaseManager: 已关闭认证用户时的数据库连接。")
+                logger.debug("DatabaseManager: 已关闭获取认证信息时的数据库连接。")
+
+    def update_password_hash(self, user_id, password_hash):
+        """更新用户的密码哈希（旧格式或旧参数的哈希在登录成功后升级）。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute("UPDATE Users SET Password = ? WHERE UserID = ?", password_hash, user_id)
+            return cursor.rowcount > 0
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"DatabaseManager: 更新用户 {user_id} 的密码哈希时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+                logger.debug("DatabaseManager: 已关闭更新密码哈希时的数据库连接。")
 
     def get_user_id(self, username):
         """根据用户名获取用户ID。"""
@@ -156,7 +300,8 @@ class DatabaseManager:
                 return row.UserID
             logger.warning(f"DatabaseManager: 未找到用户名 '{username}' 对应的用户ID。")
             return None
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 获取用户ID '{username}' 时出错: {ex}", exc_info=True)
             return None
         finally:
@@ -179,7 +324,8 @@ class DatabaseManager:
                 return row.Username
             logger.warning(f"DatabaseManager: 未找到用户ID {user_id} 对应的用户名。")
             return None
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 根据ID获取用户名 {user_id} 时出错: {ex}", exc_info=True)
             return None
         finally:
@@ -187,24 +333,25 @@ class DatabaseManager:
                 conn.close()
                 logger.debug("DatabaseManager: 已关闭根据ID获取用户名时的数据库连接。")
 
-    def get_public_key(self, username):
-        """根据用户名获取用户的公钥。"""
+    def get_public_key_info(self, username):
+        """根据用户名获取用户的公钥及其指纹，返回 (PublicKey, PublicKeyFingerprint)，未找到时返回 (None, None)。"""
         conn = None
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
-            sql = "SELECT PublicKey FROM Users WHERE Username = ?"
+            sql = "SELECT PublicKey, PublicKeyFingerprint FROM Users WHERE Username = ?"
             logger.debug(f"DatabaseManager: 执行SQL获取公钥: {sql} with username={username}")
             cursor.execute(sql, username)
             row = cursor.fetchone()
             if row:
                 logger.debug(f"DatabaseManager: 成功获取用户 '{username}' 的公钥。")
-                return row.PublicKey
+                return row.PublicKey, row.PublicKeyFingerprint or key_fingerprint(row.PublicKey)
             logger.warning(f"DatabaseManager: 未找到用户 '{username}' 的公钥。")
-            return None
-        except pyodbc.Error as ex:
+            return None, None
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 获取公钥 '{username}' 时出错: {ex}", exc_info=True)
-            return None
+            return None, None
         finally:
             if conn:
                 conn.close()
@@ -240,7 +387,8 @@ class DatabaseManager:
             cursor.execute(sql_insert, user_id, friend_id)
             logger.info(f"DatabaseManager: 用户 {user_id} 添加好友 {friend_id} 成功。")
             return True
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 添加好友关系 UserID={user_id}, FriendID={friend_id} 时出错: {ex}",
                          exc_info=True)
             return False
@@ -274,7 +422,8 @@ class DatabaseManager:
             else:
                 logger.warning(f"DatabaseManager: 尝试移除好友失败: 用户 {user_id} 和 {friend_id} 可能不是好友。")
                 return False
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 删除好友关系 UserID={user_id}, FriendID={friend_id} 时出错: {ex}",
                          exc_info=True)
             return False
@@ -307,7 +456,8 @@ class DatabaseManager:
             cursor.execute(sql, user_id, ip_address, p2p_port)
             logger.info(f"DatabaseManager: 用户 {user_id} 在线状态更新成功: {ip_address}:{p2p_port}。")
             return True
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 设置在线状态 UserID={user_id} 时出错: {ex}", exc_info=True)
             return False
         finally:
@@ -335,7 +485,8 @@ class DatabaseManager:
             else:
                 logger.warning(f"DatabaseManager: 尝试清除用户 {user_id} 在线状态，但记录不存在。")
                 return False
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 清除在线状态 UserID={user_id} 时出错: {ex}", exc_info=True)
             return False
         finally:
@@ -343,32 +494,134 @@ class DatabaseManager:
                 conn.close()
                 logger.debug("DatabaseManager: 已关闭清除在线状态时的数据库连接。")
 
-    def get_online_friends_info(self, user_id):
-        """获取指定用户所有在线好友的信息（UserID、IP、端口、公钥）。"""
+    def set_online_status_batch(self, rows):
+        """
+        用多行 MERGE 批量设置或更新多个用户的在线状态（PresenceWriter 调用）。
+        :param rows: [(user_id, ip_address, p2p_port)]，UserID 不能重复（MERGE 的源数据不允许重复键）。
+        """
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            for start in range(0, len(rows), ONLINE_STATUS_MERGE_CHUNK):
+                chunk = rows[start:start + ONLINE_STATUS_MERGE_CHUNK]
+                sql = f"""
+                    MERGE OnlineStatus AS target
+                    USING (VALUES {", ".join(["(?, ?, ?)"] * len(chunk))}) AS source (UserID, IPAddress, P2PPort)
+                    ON (target.UserID = source.UserID)
+                    WHEN MATCHED THEN
+                        UPDATE SET target.IPAddress = source.IPAddress,
+                                   target.P2PPort = source.P2PPort,
+                                   target.LastActive = GETDATE()
+                    WHEN NOT MATCHED THEN
+                        INSERT (UserID, IPAddress, P2PPort)
+                        VALUES (source.UserID, source.IPAddress, source.P2PPort);
+                """
+                cursor.execute(sql, [value for row in chunk for value in row])
+            logger.info(f"DatabaseManager: 已批量更新 {len(rows)} 个用户的在线状态。")
+            return True
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"DatabaseManager: 批量设置 {len(rows)} 个用户的在线状态时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+                logger.debug("DatabaseManager: 已关闭批量设置在线状态时的数据库连接。")
+
+    def clear_online_status_batch(self, user_ids):
+        """用多行 DELETE 批量清除多个用户的在线状态（PresenceWriter 调用）。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            deleted = 0
+            for start in range(0, len(user_ids), ONLINE_STATUS_DELETE_CHUNK):
+                chunk = list(user_ids[start:start + ONLINE_STATUS_DELETE_CHUNK])
+                sql = f"DELETE FROM OnlineStatus WHERE UserID IN ({', '.join(['?'] * len(chunk))})"
+                cursor.execute(sql, chunk)
+                deleted += cursor.rowcount
+            logger.info(f"DatabaseManager: 已批量清除 {deleted}/{len(user_ids)} 个用户的在线状态。")
+            return True
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"DatabaseManager: 批量清除 {len(user_ids)} 个用户的在线状态时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+                logger.debug("DatabaseManager: 已关闭批量清除在线状态时的数据库连接。")
+
+    def clear_all_online_status(self):
+        """清空 OnlineStatus 表。服务器启动时调用，丢弃上次进程遗留的在线记录（在线状态以内存为准）。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            sql = "DELETE FROM OnlineStatus"
+            logger.debug(f"DatabaseManager: 执行SQL清空在线状态表: {sql}")
+            cursor.execute(sql)
+            logger.info(f"DatabaseManager: 已清空在线状态表 ({cursor.rowcount} 条遗留记录)。")
+            return True
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"DatabaseManager: 清空在线状态表时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+                logger.debug("DatabaseManager: 已关闭清空在线状态表时的数据库连接。")
+
+    def get_friend_ids(self, user_id):
+        """获取指定用户所有好友的UserID集合（两个方向分别走主键/索引查找），出错时返回 None。"""
+        conn = None
+        friend_ids = set()
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            sql = FRIEND_IDS_SQL
+            logger.debug(f"DatabaseManager: 执行SQL获取好友ID: {sql.strip()} for UserID={user_id}")
+            cursor.execute(sql, user_id, user_id)
+            for row in cursor.fetchall():
+                friend_ids.add(row.FriendUserID)
+            logger.debug(f"DatabaseManager: 用户 {user_id} 共有 {len(friend_ids)} 个好友。")
+            return friend_ids
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"DatabaseManager: 获取好友ID UserID={user_id} 时出错: {ex}", exc_info=True)
+            return None
+        finally:
+            if conn:
+                conn.close()
+                logger.debug("DatabaseManager: 已关闭获取好友ID时的数据库连接。")
+
+    def get_online_friends_info(self, user_id, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """
+        获取指定用户在线好友的信息（UserID、IP、端口、公钥），按 UserID 升序分页：
+        返回 UserID 大于 after_user_id 的前 limit 个。
+        """
         conn = None
         online_friends = []
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
-            sql = """
-                SELECT
+            sql = f"""
+                SELECT TOP (?)
                     os.UserID,
                     u.Username,
                     os.IPAddress,
                     os.P2PPort,
                     u.PublicKey
-                FROM Friendships fs
-                JOIN OnlineStatus os ON (
-                    (fs.UserID = ? AND os.UserID = fs.FriendID) OR   -- 当前用户是 UserID，查找 FriendID
-                    (fs.FriendID = ? AND os.UserID = fs.UserID)      -- 当前用户是 FriendID，查找 UserID
-                )
-                JOIN Users u ON os.UserID = u.UserID
-                WHERE (fs.UserID = ? OR fs.FriendID = ?)
+                FROM ({FRIEND_IDS_PAGE_SQL}) f
+                JOIN OnlineStatus os ON os.UserID = f.FriendUserID
+                JOIN Users u ON u.UserID = f.FriendUserID
+                ORDER BY f.FriendUserID
             """
-            logger.debug(f"DatabaseManager: 执行SQL获取在线好友信息: {sql.strip()} for UserID={user_id}")
-            cursor.execute(sql, user_id, user_id, user_id, user_id)
+            logger.debug(f"DatabaseManager: 执行SQL获取在线好友信息: {sql.strip()} for UserID={user_id}, "
+                         f"after={after_user_id}, limit={limit}")
+            cursor.execute(sql, limit, user_id, after_user_id, user_id, after_user_id)
 
-            for row in cursor.fetchall():
+            for row in _iter_rows(cursor):
                 online_friends.append({
                     "user_id": row.UserID,
                     "username": row.Username,
@@ -378,7 +631,8 @@ class DatabaseManager:
                 })
             logger.info(f"DatabaseManager: 已为用户 {user_id} 检索到 {len(online_friends)} 个在线好友信息。")
             return online_friends
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 获取在线好友信息 UserID={user_id} 时出错: {ex}", exc_info=True)
             return []
         finally:
@@ -386,32 +640,33 @@ class DatabaseManager:
                 conn.close()
                 logger.debug("DatabaseManager: 已关闭获取在线好友信息时的数据库连接。")
 
-    def get_all_friends_info(self, user_id):
-        """获取指定用户的所有好友信息（UserID、用户名、IP、端口，包括在线和离线）。"""
+    def get_all_friends_info(self, user_id, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """
+        获取指定用户的好友信息（UserID、用户名、IP、端口，包括在线和离线），按 UserID 升序分页：
+        返回 UserID 大于 after_user_id 的前 limit 个。
+        """
         conn = None
         all_friends = []
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
             # 查询作为 UserID 或 FriendID 的好友，并获取在线状态信息
-            sql = """
-                SELECT
+            sql = f"""
+                SELECT TOP (?)
                     u.UserID,
                     u.Username,
                     os.IPAddress,
                     os.P2PPort
-                FROM Friendships fs
-                JOIN Users u ON (
-                    (fs.UserID = ? AND u.UserID = fs.FriendID) OR   -- 当前用户是 UserID，查找 FriendID
-                    (fs.FriendID = ? AND u.UserID = fs.UserID)      -- 当前用户是 FriendID，查找 UserID
-                )
-                LEFT JOIN OnlineStatus os ON u.UserID = os.UserID
-                WHERE (fs.UserID = ? OR fs.FriendID = ?)
+                FROM ({FRIEND_IDS_PAGE_SQL}) f
+                JOIN Users u ON u.UserID = f.FriendUserID
+                LEFT JOIN OnlineStatus os ON os.UserID = f.FriendUserID
+                ORDER BY f.FriendUserID
             """
-            logger.debug(f"DatabaseManager: 执行SQL获取所有好友信息: {sql.strip()} for UserID={user_id}")
-            cursor.execute(sql, user_id, user_id, user_id, user_id)
+            logger.debug(f"DatabaseManager: 执行SQL获取所有好友信息: {sql.strip()} for UserID={user_id}, "
+                         f"after={after_user_id}, limit={limit}")
+            cursor.execute(sql, limit, user_id, after_user_id, user_id, after_user_id)
 
-            for row in cursor.fetchall():
+            for row in _iter_rows(cursor):
                 friend_info = {
                     "user_id": row.UserID,
                     "username": row.Username,
@@ -421,7 +676,8 @@ class DatabaseManager:
                 all_friends.append(friend_info)
             logger.info(f"DatabaseManager: 已为用户 {user_id} 检索到 {len(all_friends)} 个所有好友信息。")
             return all_friends
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 获取所有好友信息 UserID={user_id} 时出错: {ex}", exc_info=True)
             return []
         finally:
@@ -429,24 +685,25 @@ class DatabaseManager:
                 conn.close()
                 logger.debug("DatabaseManager: 已关闭获取所有好友信息时的数据库连接。")
 
-    def get_all_users_info(self):
-        """获取所有注册用户的信息（用于查找好友等）。"""
+    def get_all_users_info(self, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """获取注册用户的信息（用于查找好友等），按 UserID 升序分页：返回 UserID 大于 after_user_id 的前 limit 个。"""
         conn = None
         users_info = []
         try:
             conn = self._get_connection()
             cursor = conn.cursor()
-            sql = "SELECT UserID, Username FROM Users"
-            logger.debug(f"DatabaseManager: 执行SQL获取所有用户信息: {sql}")
-            cursor.execute(sql)
-            for row in cursor.fetchall():
+            sql = "SELECT TOP (?) UserID, Username FROM Users WHERE UserID > ? ORDER BY UserID"
+            logger.debug(f"DatabaseManager: 执行SQL获取所有用户信息: {sql} after={after_user_id}, limit={limit}")
+            cursor.execute(sql, limit, after_user_id)
+            for row in _iter_rows(cursor):
                 users_info.append({"user_id": row.UserID, "username": row.Username})
-            logger.info(f"DatabaseManager: 已检索到所有 {len(users_info)} 个注册用户信息。")
+            logger.info(f"DatabaseManager: 已检索到 {len(users_info)} 个注册用户信息 (after={after_user_id})。")
             return users_info
-        except pyodbc.Error as ex:
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
             logger.error(f"DatabaseManager: 获取所有用户信息时出错: {ex}", exc_info=True)
             return []
         finally:
             if conn:
                 conn.close()
-                logger.debug("DatabaseManager: 已关闭获取所有用户信息时的数据库连接。")
\ No newline at end of file
+                logger.debug("DatabaseManager: 已关闭获取所有用户信息时的数据库连接。")
@@ -0,0 +1,348 @@
+"""
+线程安全、有界的数据库连接池。
+
+DatabaseManager 的各个方法仍然按照“获取连接 -> 使用 -> close()”的方式编写，
+只是 close() 现在把连接归还到池中，而不是真正断开，避免每条查询都重新做一次 ODBC/TDS 握手。
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PoolError(Exception):
+    """连接池错误的基类：存储后端的方法捕获它，与数据库驱动的错误一样返回失败值。"""
+
+
+class PoolTimeoutError(PoolError):
+    """在 acquire_timeout 内没有可用的连接。"""
+
+
+class PoolClosedError(PoolError):
+    """连接池已关闭。"""
+
+
+class _PoolEntry:
+    """池中的一个物理连接及其生命周期信息。"""
+    __slots__ = ("raw", "created_at", "last_used", "suspect")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.suspect = False  # 使用中出过错：下次借出前无论空闲多久都先做健康检查
+
+
+class PooledConnection:
+    """
+    借出给调用方的连接包装。
+    cursor() 创建的游标在归还时统一关闭；其余属性访问（commit 等）都转发给底层连接。
+    """
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+        self._invalid = False
+        self._cursors = []  # 本次借出期间打开的游标，归还前统一关闭，避免残留结果集影响下一个使用者
+
+    def __getattr__(self, name):
+        entry = self.__dict__.get("_entry")
+        if entry is None:
+            raise AttributeError(f"连接已归还到连接池，无法访问属性 '{name}'")
+        return getattr(entry.raw, name)
+
+    def cursor(self):
+        """创建游标；游标会在连接归还时自动关闭。"""
+        if self._entry is None:
+            raise PoolClosedError("连接已归还到连接池")
+        cursor = self._entry.raw.cursor()
+        self._cursors.append(cursor)
+        return cursor
+
+    def invalidate(self):
+        """标记该连接已损坏，归还时直接关闭而不是放回池中。"""
+        self._invalid = True
+
+    def mark_suspect(self):
+        """查询出错但不确定连接是否损坏：照常归还，下次借出前先做健康检查。"""
+        if self._entry is not None:
+            self._entry.suspect = True
+
+    def close(self):
+        """归还连接到池中。重复调用是安全的。"""
+        entry, self._entry = self._entry, None
+        if entry is None:
+            return
+        cursors, self._cursors = self._cursors, []
+        for cursor in cursors:
+            try:
+                cursor.close()
+            except Exception:
+                # 关闭游标失败说明底层连接可能已经损坏，不再放回池中
+                self._invalid = True
+        self._pool._release(entry, discard=self._invalid)
+
+
+class ConnectionPool:
+    """
+    有界连接池：
+    - 最多 max_size 个物理连接，超过时 acquire() 最多等待 acquire_timeout 秒。
+    - 连接空闲超过 health_check_interval 秒后再次借出前执行一次健康检查查询。
+    - 空闲超过 idle_timeout 秒的连接被回收（保留 min_size 个）；存活超过 max_lifetime 秒的连接在归还时重建。
+    - 记录等待时间、借出延迟、使用中连接数等指标，供 stats() 查询。
+    """
+
+    def __init__(self, connect_func, max_size=20, min_size=0, acquire_timeout=5.0, idle_timeout=300.0,
+                 max_lifetime=1800.0, health_check_interval=30.0, health_check_query="SELECT 1",
+                 reaper_interval=30.0):
+        """
+        :param connect_func: 无参函数，返回一个新的物理连接。
+        """
+        if max_size < 1:
+            raise ValueError("max_size 必须大于 0")
+        self._connect_func = connect_func
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.health_check_query = health_check_query
+
+        self._idle = deque()  # 空闲连接，右端是最近归还的（优先复用，保持热连接）
+        self._size = 0  # 物理连接总数（空闲 + 借出 + 正在创建）
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+        # 指标
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._recycled = 0
+        self._evicted_idle = 0
+        self._health_check_failures = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._checkout_latency_total = 0.0
+        self._checkout_latency_max = 0.0
+
+        self._reaper_stop = threading.Event()
+        self._reaper_thread = None
+        if reaper_interval and (idle_timeout or max_lifetime):
+            self._reaper_thread = threading.Thread(target=self._reaper_loop, args=(reaper_interval,),
+                                                   name="db-pool-reaper", daemon=True)
+            self._reaper_thread.start()
+
+    # ------------------------------------------------------------------ 借出 / 归还
+
+    def acquire(self, timeout=None):
+        """
+        借出一个连接。
+        :param timeout: 最长等待时间（秒），默认使用 acquire_timeout。
+        :return: PooledConnection，使用完毕后调用 close() 归还。
+        :raises PoolTimeoutError: 超时仍没有可用连接。
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = 0.0
+
+        while True:
+            entry = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolClosedError("连接池已关闭")
+                    entry = self._pop_idle_locked()
+                    if entry is not None:
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(f"等待数据库连接超时 ({timeout:.1f}s)，"
+                                               f"连接池已满 ({self.max_size})")
+                    wait_start = time.monotonic()
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                        waited += time.monotonic() - wait_start
+
+            # 建立连接与健康检查都在锁外进行，避免阻塞其他线程
+            if create:
+                try:
+                    entry = _PoolEntry(self._connect_func())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created += 1
+            elif not self._check_health(entry):
+                self._close_entry(entry)
+                with self._cond:
+                    self._size -= 1
+                    self._health_check_failures += 1
+                    self._discarded += 1
+                    self._cond.notify()
+                if time.monotonic() >= deadline:
+                    with self._cond:
+                        self._timeouts += 1
+                    raise PoolTimeoutError("等待数据库连接超时：空闲连接健康检查失败")
+                continue
+
+            latency = time.monotonic() - start
+            with self._cond:
+                self._in_use += 1
+                self._checkouts += 1
+                self._wait_time_total += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
+                self._checkout_latency_total += latency
+                self._checkout_latency_max = max(self._checkout_latency_max, latency)
+            return PooledConnection(self, entry)
+
+    def _release(self, entry, discard=False):
+        """由 PooledConnection.close() 调用，归还或丢弃连接。"""
+        now = time.monotonic()
+        expired = self.max_lifetime and now - entry.created_at >= self.max_lifetime
+        close_it = False
+        with self._cond:
+            self._in_use -= 1
+            if self._closed or discard or expired:
+                self._size -= 1
+                close_it = True
+                if expired and not discard:
+                    self._recycled += 1
+                else:
+                    self._discarded += 1
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+            self._cond.notify()
+        if close_it:
+            self._close_entry(entry)
+
+    def _pop_idle_locked(self):
+        """取出一个可用的空闲连接，顺便丢弃已超过空闲时间或生命周期的连接。调用方需持有锁。"""
+        now = time.monotonic()
+        while self._idle:
+            entry = self._idle.pop()
+            if self._is_stale(entry, now):
+                self._size -= 1
+                self._evicted_idle += 1
+                # 在锁内关闭：物理连接已不可达，关闭通常很快
+                self._close_entry(entry)
+                continue
+            return entry
+        return None
+
+    def _is_stale(self, entry, now):
+        if self.max_lifetime and now - entry.created_at >= self.max_lifetime:
+            return True
+        if self.idle_timeout and now - entry.last_used >= self.idle_timeout:
+            return True
+        return False
+
+    def _check_health(self, entry):
+        """空闲时间较长或上次使用时出过错的连接在借出前执行一次轻量查询，确认仍然可用。"""
+        if not entry.suspect and (not self.health_check_interval
+                                  or time.monotonic() - entry.last_used < self.health_check_interval):
+            return True
+        entry.suspect = False
+        try:
+            cursor = entry.raw.cursor()
+            cursor.execute(self.health_check_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception as e:
+            logger.warning(f"ConnectionPool: 连接健康检查失败，丢弃该连接: {e}")
+            return False
+
+    def _close_entry(self, entry):
+        try:
+            entry.raw.close()
+        except Exception as e:
+            logger.debug(f"ConnectionPool: 关闭物理连接时出错: {e}")
+
+    # ------------------------------------------------------------------ 维护
+
+    def _reaper_loop(self, interval):
+        """后台回收空闲过久或超过最大生命周期的连接。"""
+        while not self._reaper_stop.wait(interval):
+            self.evict_idle()
+
+    def evict_idle(self):
+        """回收空闲过久/超龄的连接，保留至少 min_size 个物理连接。返回回收数量。"""
+        now = time.monotonic()
+        to_close = []
+        with self._cond:
+            keep = deque()
+            while self._idle:
+                entry = self._idle.popleft()
+                if self._size > self.min_size and self._is_stale(entry, now):
+                    self._size -= 1
+                    self._evicted_idle += 1
+                    to_close.append(entry)
+                else:
+                    keep.append(entry)
+            self._idle = keep
+            if to_close:
+                self._cond.notify_all()
+        for entry in to_close:
+            self._close_entry(entry)
+        if to_close:
+            logger.debug(f"ConnectionPool: 回收了 {len(to_close)} 个空闲连接。")
+        return len(to_close)
+
+    def close(self):
+        """关闭连接池：停止回收线程并等待它退出，关闭所有空闲连接，借出中的连接归还时会被关闭。"""
+        self._reaper_stop.set()
+        if self._reaper_thread is not None and self._reaper_thread is not threading.current_thread():
+            self._reaper_thread.join()
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close_entry(entry)
+        logger.info("ConnectionPool: 连接池已关闭。")
+
+    # ------------------------------------------------------------------ 指标
+
+    def stats(self):
+        """返回连接池指标快照（时间单位：毫秒）。"""
+        with self._cond:
+            checkouts = self._checkouts
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "created": self._created,
+                "discarded": self._discarded,
+                "recycled": self._recycled,
+                "evicted_idle": self._evicted_idle,
+                "health_check_failures": self._health_check_failures,
+                "wait_time_total_ms": self._wait_time_total * 1000,
+                "wait_time_avg_ms": (self._wait_time_total / checkouts * 1000) if checkouts else 0.0,
+                "wait_time_max_ms": self._wait_time_max * 1000,
+                "checkout_latency_avg_ms": (self._checkout_latency_total / checkouts * 1000) if checkouts else 0.0,
+                "checkout_latency_max_ms": self._checkout_latency_max * 1000,
+            }
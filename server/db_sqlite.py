@@ -0,0 +1,449 @@
+"""
+完成各类数据库操作（SQLite 存储后端）
+
+与 db.DatabaseManager 的表结构和返回值保持一致，但不需要数据库服务，适合单节点部署、CI 和本地基准测试：
+- WAL 日志模式：读操作不阻塞写操作，多个连接可以同时读取。
+- 每个连接设置 synchronous=NORMAL、页缓存、内存映射等 PRAGMA，并开启外键约束。
+- SQL 语句都是固定的字符串，由 sqlite3 的语句缓存（cached_statements）在每个连接上复用预编译结果。
+"""
+import logging
+import sqlite3
+
+from config import DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE, DB_POOL_ACQUIRE_TIMEOUT, DB_POOL_IDLE_TIMEOUT, \
+    DB_POOL_MAX_LIFETIME, DB_POOL_HEALTH_CHECK_INTERVAL, DB_FETCH_BATCH_SIZE, LIST_PAGE_DEFAULT_LIMIT, \
+    SQLITE_DB_FILE, SQLITE_BUSY_TIMEOUT, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE, SQLITE_STATEMENT_CACHE_SIZE
+from utils import key_fingerprint
+from db_pool import ConnectionPool, PoolError, PoolTimeoutError
+from storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+# 各方法捕获的错误：SQLite 错误，以及连接池满（超时）或已关闭（服务器退出中）时借不到连接
+DB_ERRORS = (sqlite3.Error, PoolError)
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS Users (
+        UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Username TEXT NOT NULL UNIQUE COLLATE NOCASE,     -- 与 SQL Server 默认排序规则一致：用户名不区分大小写
+        Password TEXT NOT NULL,
+        PublicKey TEXT NOT NULL,
+        PublicKeyFingerprint TEXT,
+        RegistrationDate TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS Friendships (
+        UserID INTEGER NOT NULL REFERENCES Users(UserID),
+        FriendID INTEGER NOT NULL REFERENCES Users(UserID),
+        PRIMARY KEY (UserID, FriendID),
+        CHECK (UserID < FriendID)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS IX_Friendships_FriendID ON Friendships (FriendID, UserID);
+    CREATE TABLE IF NOT EXISTS OnlineStatus (
+        UserID INTEGER PRIMARY KEY REFERENCES Users(UserID),
+        IPAddress TEXT NOT NULL,
+        P2PPort INTEGER NOT NULL,
+        LastActive TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# 与 db.py 中的查询相同：两个方向分别按主键和 IX_Friendships_FriendID 查找后 UNION ALL。
+# 参数: (user_id, after_user_id, user_id, after_user_id)
+FRIEND_IDS_PAGE_SQL = """
+    SELECT FriendID AS FriendUserID FROM Friendships WHERE UserID = ? AND FriendID > ?
+    UNION ALL
+    SELECT UserID AS FriendUserID FROM Friendships WHERE FriendID = ? AND UserID > ?
+"""
+
+FRIEND_IDS_SQL = """
+    SELECT FriendID FROM Friendships WHERE UserID = ?
+    UNION ALL
+    SELECT UserID FROM Friendships WHERE FriendID = ?
+"""
+
+ONLINE_FRIENDS_PAGE_SQL = f"""
+    SELECT os.UserID, u.Username, os.IPAddress, os.P2PPort, u.PublicKey
+    FROM ({FRIEND_IDS_PAGE_SQL}) f
+    JOIN OnlineStatus os ON os.UserID = f.FriendUserID
+    JOIN Users u ON u.UserID = f.FriendUserID
+    ORDER BY f.FriendUserID
+    LIMIT ?
+"""
+
+ALL_FRIENDS_PAGE_SQL = f"""
+    SELECT u.UserID, u.Username, os.IPAddress, os.P2PPort
+    FROM ({FRIEND_IDS_PAGE_SQL}) f
+    JOIN Users u ON u.UserID = f.FriendUserID
+    LEFT JOIN OnlineStatus os ON os.UserID = f.FriendUserID
+    ORDER BY f.FriendUserID
+    LIMIT ?
+"""
+
+SET_ONLINE_STATUS_SQL = """
+    INSERT INTO OnlineStatus (UserID, IPAddress, P2PPort, LastActive)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (UserID) DO UPDATE SET
+        IPAddress = excluded.IPAddress,
+        P2PPort = excluded.P2PPort,
+        LastActive = excluded.LastActive
+"""
+
+
+def _iter_rows(cursor, batch_size=DB_FETCH_BATCH_SIZE):
+    """按批 fetchmany 逐行读取结果集。"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _ordered_pair(uid1, uid2):
+    """Friendships 每条关系只存一行，较小的ID在前。"""
+    return (uid1, uid2) if uid1 < uid2 else (uid2, uid1)
+
+
+class SQLiteDatabaseManager(StorageBackend):
+    """基于内嵌 SQLite 的存储后端。"""
+
+    def __init__(self, db_file=SQLITE_DB_FILE):
+        if db_file == ":memory:":
+            # 每个内存数据库只属于一个连接，无法通过连接池共享
+            raise ValueError("SQLite 后端需要数据库文件路径，不支持 :memory:")
+        self.db_file = db_file
+        self.pool = ConnectionPool(
+            self._connect,
+            max_size=DB_POOL_MAX_SIZE,
+            min_size=DB_POOL_MIN_SIZE,
+            acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+            idle_timeout=DB_POOL_IDLE_TIMEOUT,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+        )
+        logger.info(f"SQLiteDatabaseManager: 正在初始化数据库文件 {db_file}。")
+        self.create_tables()
+        logger.info("SQLiteDatabaseManager: 数据库管理器初始化完成。")
+
+    def _connect(self):
+        """建立一个新的数据库连接并设置 PRAGMA（仅由连接池调用）。"""
+        # isolation_level=None 为自动提交，与 SQL Server 后端 autocommit=True 的语义一致；
+        # 连接由连接池在不同线程间借出，同一时刻只有一个线程使用，因此关闭 check_same_thread
+        conn = sqlite3.connect(self.db_file, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                               check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")  # WAL 模式下只在检查点时 fsync，掉电最多丢失最近的事务
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA cache_size = -{int(SQLITE_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+        logger.debug("SQLiteDatabaseManager: 成功建立新的数据库连接。")
+        return conn
+
+    def _get_connection(self):
+        """
+        从连接池借出一个数据库连接，调用 close() 即归还。
+        :raises PoolError: 等待超时或连接池已关闭；调用方与 SQLite 错误一起按 DB_ERRORS 捕获。
+        """
+        try:
+            return self.pool.acquire()
+        except PoolTimeoutError as ex:
+            logger.error(f"SQLiteDatabaseManager: 获取数据库连接超时: {ex} 连接池状态: {self.pool.stats()}")
+            raise
+        except PoolError as ex:
+            logger.warning(f"SQLiteDatabaseManager: 无法获取数据库连接: {ex}")
+            raise
+
+    @staticmethod
+    def _handle_query_error(conn, ex):
+        """
+        查询出错后处理借出的连接（在 finally 中 close() 归还之前调用），与 DatabaseManager 相同：
+        - 出错时仍处于事务中（BEGIN IMMEDIATE 的批量写入）：先回滚；OperationalError 或回滚失败时连接作废；
+        - InterfaceError（连接已不可用）时作废；
+        - 其他错误照常归还，但下次借出前先做健康检查（已关闭的连接在检查时被丢弃）。
+        """
+        if conn is None:
+            return
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error as rollback_ex:
+                logger.warning(f"SQLiteDatabaseManager: 出错后回滚事务失败: {rollback_ex}")
+            if isinstance(ex, sqlite3.OperationalError) or conn.in_transaction:
+                logger.warning(f"SQLiteDatabaseManager: 事务中发生错误 ({ex})，连接不再放回连接池。")
+                conn.invalidate()
+                return
+        if isinstance(ex, sqlite3.InterfaceError):
+            logger.warning(f"SQLiteDatabaseManager: 数据库连接已不可用 ({ex})，不再放回连接池。")
+            conn.invalidate()
+        else:
+            conn.mark_suspect()
+
+    def get_pool_stats(self):
+        """返回连接池指标。"""
+        return self.pool.stats()
+
+    def close(self):
+        """关闭连接池中的所有连接（服务器退出时调用）。"""
+        self.pool.close()
+
+    def create_tables(self):
+        """如果不存在，则创建数据库表和索引。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            conn.cursor().executescript(SCHEMA_SQL)
+            conn.cursor().execute("PRAGMA optimize")
+            logger.info("SQLiteDatabaseManager: 数据库表检查/创建完成。")
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 创建数据库表时出错: {ex}", exc_info=True)
+        finally:
+            if conn:
+                conn.close()
+
+    def register_user(self, username, password_hash, public_key):
+        """注册一个新用户，password_hash 为已计算好的密码哈希。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            conn.cursor().execute(
+                "INSERT INTO Users (Username, Password, PublicKey, PublicKeyFingerprint) VALUES (?, ?, ?, ?)",
+                (username, password_hash, public_key, key_fingerprint(public_key)))
+            logger.info(f"SQLiteDatabaseManager: 用户 '{username}' 注册成功。")
+            return True
+        except sqlite3.IntegrityError:
+            logger.warning(f"SQLiteDatabaseManager: 注册失败: 用户名 '{username}' 已存在。")
+            return False
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 注册用户 '{username}' 时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def get_user_credentials(self, username):
+        """:return: (UserID, 密码哈希, PublicKey)；用户不存在或出错时返回 (None, None, None)。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            row = conn.cursor().execute("SELECT UserID, Password, PublicKey FROM Users WHERE Username = ?",
+                                        (username,)).fetchone()
+            if row:
+                return row
+            logger.warning(f"SQLiteDatabaseManager: 用户 '{username}' 不存在。")
+            return None, None, None
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 获取用户 '{username}' 的认证信息时出错: {ex}", exc_info=True)
+            return None, None, None
+        finally:
+            if conn:
+                conn.close()
+
+    def update_password_hash(self, user_id, password_hash):
+        """更新用户的密码哈希。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor().execute("UPDATE Users SET Password = ? WHERE UserID = ?",
+                                           (password_hash, user_id))
+            return cursor.rowcount > 0
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 更新用户 {user_id} 的密码哈希时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def _fetch_value(self, sql, params, description):
+        """执行只返回单个值的查询，未找到或出错时返回 None。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            row = conn.cursor().execute(sql, params).fetchone()
+            if row:
+                return row[0]
+            logger.warning(f"SQLiteDatabaseManager: 未找到{description}。")
+            return None
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 查询{description}时出错: {ex}", exc_info=True)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def get_user_id(self, username):
+        """根据用户名获取用户ID。"""
+        return self._fetch_value("SELECT UserID FROM Users WHERE Username = ?", (username,),
+                                 f"用户名 '{username}' 对应的用户ID")
+
+    def get_username_by_id(self, user_id):
+        """根据用户ID获取用户名。"""
+        return self._fetch_value("SELECT Username FROM Users WHERE UserID = ?", (user_id,),
+                                 f"用户ID {user_id} 对应的用户名")
+
+    def get_public_key_info(self, username):
+        """根据用户名获取用户的公钥及其指纹，返回 (PublicKey, PublicKeyFingerprint)，未找到时返回 (None, None)。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            row = conn.cursor().execute("SELECT PublicKey, PublicKeyFingerprint FROM Users WHERE Username = ?",
+                                        (username,)).fetchone()
+            if row:
+                public_key, fingerprint = row
+                return public_key, fingerprint or key_fingerprint(public_key)
+            logger.warning(f"SQLiteDatabaseManager: 未找到用户 '{username}' 的公钥。")
+            return None, None
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 获取公钥 '{username}' 时出错: {ex}", exc_info=True)
+            return None, None
+        finally:
+            if conn:
+                conn.close()
+
+    def _execute_write(self, sql, params, description):
+        """执行写操作，返回受影响的行数；出错时返回 None。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            return conn.cursor().execute(sql, params).rowcount
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: {description}时出错: {ex}", exc_info=True)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def add_friendship(self, uid1, uid2):
+        """在两个用户之间建立好友关系。"""
+        if uid1 == uid2:
+            logger.warning(f"SQLiteDatabaseManager: 尝试添加自己为好友 (UserID: {uid1})，操作被拒绝。")
+            return False
+        user_id, friend_id = _ordered_pair(uid1, uid2)
+        rowcount = self._execute_write("INSERT OR IGNORE INTO Friendships (UserID, FriendID) VALUES (?, ?)",
+                                       (user_id, friend_id), f"添加好友关系 UserID={user_id}, FriendID={friend_id} ")
+        if rowcount:
+            logger.info(f"SQLiteDatabaseManager: 用户 {user_id} 添加好友 {friend_id} 成功。")
+            return True
+        if rowcount == 0:
+            logger.info(f"SQLiteDatabaseManager: 用户 {user_id} 和 {friend_id} 已经是好友。")
+        return False
+
+    def remove_friendship(self, uid1, uid2):
+        """删除好友关系。"""
+        if uid1 == uid2:
+            return False
+        user_id, friend_id = _ordered_pair(uid1, uid2)
+        rowcount = self._execute_write("DELETE FROM Friendships WHERE UserID = ? AND FriendID = ?",
+                                       (user_id, friend_id), f"删除好友关系 UserID={user_id}, FriendID={friend_id} ")
+        if rowcount:
+            logger.info(f"SQLiteDatabaseManager: 用户 {user_id} 成功移除好友 {friend_id}。")
+            return True
+        if rowcount == 0:
+            logger.warning(f"SQLiteDatabaseManager: 尝试移除好友失败: 用户 {user_id} 和 {friend_id} 可能不是好友。")
+        return False
+
+    def set_online_status(self, user_id, ip_address, p2p_port):
+        """设置或更新用户的在线状态。"""
+        rowcount = self._execute_write(SET_ONLINE_STATUS_SQL, (user_id, ip_address, p2p_port),
+                                       f"设置在线状态 UserID={user_id} ")
+        return rowcount is not None
+
+    def clear_online_status(self, user_id):
+        """清除用户的在线状态（用户登出）。"""
+        if user_id is None:
+            logger.warning("SQLiteDatabaseManager: 尝试清除在线状态时用户ID为None，跳过操作。")
+            return False
+        return bool(self._execute_write("DELETE FROM OnlineStatus WHERE UserID = ?", (user_id,),
+                                        f"清除在线状态 UserID={user_id} "))
+
+    def _execute_batch(self, sql, rows, description):
+        """在一个事务中用同一条预编译语句写入多行（整批只提交一次），失败时由 _handle_query_error 整批回滚。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany(sql, rows)
+            cursor.execute("COMMIT")
+            return True
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: {description}时出错: {ex}", exc_info=True)
+            return False
+        finally:
+            if conn:
+                conn.close()
+
+    def set_online_status_batch(self, rows):
+        """批量设置或更新多个用户的在线状态。:param rows: [(user_id, ip_address, p2p_port)]"""
+        return self._execute_batch(SET_ONLINE_STATUS_SQL, rows, f"批量设置 {len(rows)} 个用户的在线状态")
+
+    def clear_online_status_batch(self, user_ids):
+        """批量清除多个用户的在线状态。"""
+        return self._execute_batch("DELETE FROM OnlineStatus WHERE UserID = ?", [(user_id,) for user_id in user_ids],
+                                   f"批量清除 {len(user_ids)} 个用户的在线状态")
+
+    def clear_all_online_status(self):
+        """清空 OnlineStatus 表（服务器启动时调用）。"""
+        rowcount = self._execute_write("DELETE FROM OnlineStatus", (), "清空在线状态表")
+        if rowcount is None:
+            return False
+        logger.info(f"SQLiteDatabaseManager: 已清空在线状态表 ({rowcount} 条遗留记录)。")
+        return True
+
+    def get_friend_ids(self, user_id):
+        """获取指定用户所有好友的UserID集合，出错时返回 None。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor().execute(FRIEND_IDS_SQL, (user_id, user_id))
+            return {row[0] for row in _iter_rows(cursor)}
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: 获取好友ID UserID={user_id} 时出错: {ex}", exc_info=True)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def _fetch_page(self, sql, params, make_item, description):
+        """执行分页查询，把每一行转换为字典；出错时返回空列表。"""
+        conn = None
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor().execute(sql, params)
+            return [make_item(row) for row in _iter_rows(cursor)]
+        except DB_ERRORS as ex:
+            self._handle_query_error(conn, ex)
+            logger.error(f"SQLiteDatabaseManager: {description}时出错: {ex}", exc_info=True)
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    def get_online_friends_info(self, user_id, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """在线好友信息（UserID、IP、端口、公钥），返回 UserID 大于 after_user_id 的前 limit 个。"""
+        return self._fetch_page(
+            ONLINE_FRIENDS_PAGE_SQL, (user_id, after_user_id, user_id, after_user_id, limit),
+            lambda row: {"user_id": row[0], "username": row[1], "ip": row[2], "port": row[3],
+                         "public_key_pem": row[4]},
+            f"获取在线好友信息 UserID={user_id} ")
+
+    def get_all_friends_info(self, user_id, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """所有好友信息（UserID、用户名、IP、端口），返回 UserID 大于 after_user_id 的前 limit 个。"""
+        return self._fetch_page(
+            ALL_FRIENDS_PAGE_SQL, (user_id, after_user_id, user_id, after_user_id, limit),
+            lambda row: {"user_id": row[0], "username": row[1], "ip_address": row[2] or None,
+                         "p2p_port": row[3] or None},
+            f"获取所有好友信息 UserID={user_id} ")
+
+    def get_all_users_info(self, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """注册用户信息，返回 UserID 大于 after_user_id 的前 limit 个。"""
+        return self._fetch_page(
+            "SELECT UserID, Username FROM Users WHERE UserID > ? ORDER BY UserID LIMIT ?", (after_user_id, limit),
+            lambda row: {"user_id": row[0], "username": row[1]},
+            "获取所有用户信息")
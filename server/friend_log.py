@@ -0,0 +1,101 @@
+"""
+好友列表的版本化变更日志，供 SYNC_FRIENDS 增量同步使用。
+
+本进程上每个已登录用户有一个有界的变更日志，记录其好友的增删和好友的在线状态变化（上线、下线、P2P信息更新）。
+每条变更带有进程内全局递增的序号，用户好友列表的版本即其日志中最后一条变更的序号。
+客户端带着上次同步得到的版本发送 SYNC_FRIENDS，服务器只返回此后有变化的好友；
+日志已被截断（变更太多）、版本来自其他工作进程或服务器重启前时，返回完整快照。
+
+版本格式为 "<epoch>.<序号>"，epoch 在每个 FriendChangeLog 创建时随机生成，用来识别其他进程签发的版本。
+日志只记录“哪些好友变了、好友关系本身是否变了”，增量响应中好友的内容取自当前的内存状态，因此重复应用是幂等的。
+"""
+import secrets
+import threading
+from collections import deque
+
+from config import FRIEND_SYNC_LOG_SIZE
+
+
+class _UserLog:
+    __slots__ = ("base", "last", "changes")
+
+    def __init__(self, base, max_changes):
+        self.base = base  # 能够计算增量的最早版本（更早的版本需要完整快照）
+        self.last = base  # 当前版本
+        self.changes = deque(maxlen=max_changes)  # [(序号, 好友ID, 好友关系是否变化)]
+
+
+class FriendChangeLog:
+    """线程安全的好友变更日志 {user_id: _UserLog}，只为本进程上已登录的用户保留。"""
+
+    def __init__(self, max_changes=FRIEND_SYNC_LOG_SIZE):
+        self.epoch = secrets.token_hex(4)
+        self.max_changes = max_changes
+        self._seq = 0
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._deltas = 0
+        self._snapshots = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._logs)
+
+    def _format(self, seq):
+        return f"{self.epoch}.{seq}"
+
+    def open(self, user_id):
+        """用户登录（或会话转移到本进程）时创建新的日志；之前签发的任何版本都需要完整快照。"""
+        with self._lock:
+            self._seq += 1
+            self._logs[user_id] = _UserLog(self._seq, self.max_changes)
+
+    def close(self, user_id):
+        with self._lock:
+            self._logs.pop(user_id, None)
+
+    def record(self, user_id, friend_id, membership=False):
+        """
+        记录用户的好友 friend_id 有变化。用户不在本进程上登录时忽略。
+        :param membership: 好友关系本身是否变化（添加/删除好友）；False 表示只是在线状态变化。
+        """
+        with self._lock:
+            log = self._logs.get(user_id)
+            if log is None:
+                return
+            self._seq += 1
+            if len(log.changes) == log.changes.maxlen:
+                log.base = log.changes[0][0]  # 最早的一条即将被挤出，早于它的版本无法再计算增量
+            log.changes.append((self._seq, friend_id, membership))
+            log.last = self._seq
+
+    def current_version(self, user_id):
+        """返回用户好友列表的当前版本；用户没有日志时返回 None。"""
+        with self._lock:
+            log = self._logs.get(user_id)
+            return self._format(log.last) if log is not None else None
+
+    def changes_since(self, user_id, version):
+        """
+        计算客户端版本之后有变化的好友。
+        :return: ({好友ID: 好友关系是否变化}, 当前版本)；需要完整快照时返回 None。
+        """
+        epoch, _, seq = version.partition(".") if isinstance(version, str) else ("", "", "")
+        with self._lock:
+            log = self._logs.get(user_id)
+            if epoch != self.epoch or log is None or not seq.isdigit() \
+                    or not log.base <= int(seq) <= log.last:
+                self._snapshots += 1
+                return None
+            seq = int(seq)
+            changed = {}
+            for change_seq, friend_id, membership in reversed(log.changes):
+                if change_seq <= seq:
+                    break
+                changed[friend_id] = changed.get(friend_id, False) or membership
+            self._deltas += 1
+            return changed, self._format(log.last)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._logs), "deltas": self._deltas, "snapshots": self._snapshots}
@@ -0,0 +1,380 @@
+"""
+目录服务器的合成负载生成器。
+
+用 asyncio 模拟大量客户端，每个客户端与真实客户端一样使用分帧协议 + 请求流水线（HELLO），并且：
+1. 注册、登录；
+2. 按配置的社交图分布（uniform / powerlaw）添加好友；
+3. 稳定阶段：按指数分布的间隔并发刷新在线好友和全部好友列表（与客户端 refresh_friend_lists 相同），
+   并按配置的平均会话时长/离线时长反复登出、重新登录。
+结束后按阶段（setup / steady）输出每个命令的次数、错误数、吞吐量和 p50/p95/p99 延迟，可选写入 JSON 文件，
+用于跟踪性能回归。默认在本地启动一个使用 SQLite 后端的服务器子进程（数据库文件放在 /dev/shm 等内存文件系统中），
+也可以用 --target 对已经运行的服务器施压。
+
+示例:
+    python loadgen.py --clients 2000 --duration 60 --graph powerlaw --avg-friends 20 --json loadgen.json
+    python loadgen.py --clients 500 --mode threaded --workers 4
+    python loadgen.py --target 127.0.0.1:50000 --clients 200 --user-prefix staging_load_
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmark import raise_fd_limit, percentile, free_port, start_server, stop_server, storage_args
+from protocol import FRAME_HEADER, FRAME_HEADER_SIZE, FRAMING_LENGTH_PREFIXED, encode_frame
+
+GRAPH_DISTRIBUTIONS = ("uniform", "powerlaw")
+# 服务器过载拒绝（响应 data.reason）中可以按 data.retry_after 等待后重试的原因
+RETRYABLE_REASONS = ("rate_limited", "busy")
+
+
+class PhaseStats:
+    """一个阶段内每个命令的延迟与错误统计。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = defaultdict(list)  # {command: [秒, ...]}
+        self.errors = defaultdict(int)  # {command: 失败次数（错误响应、超时、连接断开）}
+        self.events = 0  # 收到的服务器推送事件（PRESENCE_DELTA）数
+        self.rejections = 0  # 被服务器过载拒绝后等待 retry_after 重试的次数
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, command, seconds, ok):
+        if ok:
+            self.latencies[command].append(seconds)
+        else:
+            self.errors[command] += 1
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        commands = {}
+        for command in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies.get(command, [])
+            commands[command] = {
+                "count": len(latencies),
+                "errors": self.errors.get(command, 0),
+                "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+                "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+                "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            }
+        total = sum(len(v) for v in self.latencies.values())
+        return {
+            "phase": self.name,
+            "seconds": round(elapsed, 3),
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "throughput_rps": round(total / elapsed, 1) if elapsed > 0 else None,
+            "events": self.events,
+            "rejections": self.rejections,
+            "commands": commands,
+        }
+
+
+class SimClient:
+    """一个模拟客户端的控制连接：分帧协议 + 请求流水线，响应按 request_id 交给等待者。"""
+
+    def __init__(self, index, username, timeout, max_retries=3):
+        self.index = index
+        self.username = username
+        self.timeout = timeout
+        self.max_retries = max_retries  # 被过载拒绝时最多按 retry_after 重试的次数
+        self.stats = None  # 当前阶段的 PhaseStats，由驱动代码切换
+        self._reader = None
+        self._writer = None
+        self._request_ids = itertools.count(1)
+        self._pending = {}  # {request_id: Future}
+        self._read_task = None
+        self._connected = False
+
+    async def connect(self, host, port):
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        # HELLO 使用旧格式发送，服务器以旧格式回复
+        hello = {"command": "HELLO", "payload": {"framing": [FRAMING_LENGTH_PREFIXED], "pipelining": True}}
+        self._writer.write(json.dumps(hello).encode('utf-8'))
+        await self._writer.drain()
+        response = json.loads((await asyncio.wait_for(self._reader.read(65536), self.timeout)).decode('utf-8'))
+        if response.get("status") != "success" or not response.get("data", {}).get("pipelining"):
+            raise ConnectionError(f"服务器不支持分帧协议/请求流水线: {response.get('message')}")
+        self._connected = True
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(FRAME_HEADER_SIZE)
+                (body_len,) = FRAME_HEADER.unpack(header)
+                message = json.loads((await self._reader.readexactly(body_len)).decode('utf-8'))
+                if "event" in message:
+                    if self.stats is not None:
+                        self.stats.events += 1
+                    continue
+                future = self._pending.pop(message.get("request_id"), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            error = e
+        except asyncio.CancelledError:
+            error = ConnectionError("连接已关闭")
+        self._connected = False
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"连接已断开: {error!r}"))
+        self._pending.clear()
+
+    async def request(self, command, payload=None):
+        """
+        发送一条命令并等待响应，结果记入当前阶段的统计。与真实客户端一样，被服务器过载拒绝时等待 retry_after 后重试，
+        记录的延迟包括等待重试的时间。:return: 响应字典；失败时返回 None。
+        """
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            response = await self._send_once(command, payload)
+            if response is None:
+                self.stats.record(command, 0, ok=False)
+                return None
+            data = response.get("data") or {}
+            if (response.get("status") == "success" or data.get("reason") not in RETRYABLE_REASONS
+                    or attempt == self.max_retries):
+                break
+            self.stats.rejections += 1
+            await asyncio.sleep(data.get("retry_after", 1.0))
+        ok = response.get("status") == "success"
+        self.stats.record(command, time.perf_counter() - start, ok)
+        return response
+
+    async def _send_once(self, command, payload):
+        """:return: 响应字典；连接已断开或超时时返回 None。"""
+        if not self._connected:
+            return None
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        body = json.dumps({"command": command, "payload": payload or {}, "request_id": request_id})
+        try:
+            self._writer.write(encode_frame(body.encode('utf-8')))
+            return await asyncio.wait_for(future, self.timeout)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            self._pending.pop(request_id, None)
+            return None
+
+    async def close(self):
+        if self._read_task:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        if self._writer:
+            self._writer.close()
+
+
+def build_friend_graph(count, avg_friends, distribution, rng, powerlaw_alpha=1.0):
+    """
+    生成无向好友关系 [(i, j)]，由 i 发起 ADD_FRIEND。
+    uniform:  每条边的两端均匀随机选取；
+    powerlaw: 一端均匀选取，另一端按“人气”排名的 Zipf 分布（权重 1/rank^alpha）选取，少数用户拥有大量好友。
+    """
+    if count < 2:
+        return []
+    target = min(count * avg_friends // 2, count * (count - 1) // 2)
+    if distribution == "powerlaw":
+        popularity = list(range(count))
+        rng.shuffle(popularity)
+        cum_weights = list(itertools.accumulate(1.0 / (rank + 1) ** powerlaw_alpha for rank in range(count)))
+    edges = set()
+    attempts = 0
+    while len(edges) < target and attempts < target * 20:
+        batch = target - len(edges)
+        attempts += batch
+        sources = [rng.randrange(count) for _ in range(batch)]
+        if distribution == "powerlaw":
+            targets = [popularity[rank] for rank in rng.choices(range(count), cum_weights=cum_weights, k=batch)]
+        else:
+            targets = [rng.randrange(count) for _ in range(batch)]
+        for i, j in zip(sources, targets):
+            if i != j and (j, i) not in edges:
+                edges.add((i, j))
+    return sorted(edges)
+
+
+async def gather_limited(coros, concurrency):
+    """以有限并发执行一组协程。"""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def run(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+def login_payload(client, args):
+    return {"username": client.username, "password": args.password, "p2p_ip": "127.0.0.1",
+            "p2p_port": 20000 + client.index % 40000}
+
+
+async def setup_clients(clients, graph, host, port, args, stats):
+    """连接、注册、登录并建立好友关系。连接或登录失败的客户端不参与稳定阶段。"""
+    for client in clients:
+        client.stats = stats
+
+    async def connect_and_login(client):
+        try:
+            await client.connect(host, port)
+        except (OSError, ConnectionError, asyncio.TimeoutError, ValueError):
+            stats.record("CONNECT", 0, ok=False)
+            return None
+        await client.request("REGISTER", {"username": client.username, "password": args.password,
+                                          "public_key": f"loadgen-key-{client.username}"})
+        response = await client.request("LOGIN", login_payload(client, args))
+        return client if response and response.get("status") == "success" else None
+
+    ready = [c for c in await gather_limited((connect_and_login(c) for c in clients), args.concurrency) if c]
+    by_index = {client.index: client for client in ready}
+    initiated = defaultdict(list)
+    for i, j in graph:
+        if i in by_index:
+            initiated[i].append(clients[j].username)
+
+    async def add_friends(client):
+        for friend_username in initiated.get(client.index, ()):
+            await client.request("ADD_FRIEND", {"friend_username": friend_username})
+
+    await gather_limited((add_friends(c) for c in ready), args.concurrency)
+    return ready
+
+
+async def drive_client(client, args, rng, deadline):
+    """稳定阶段：按指数分布的间隔刷新好友列表，并按平均会话时长登出/重新登录。"""
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    next_poll = now + rng.expovariate(1.0 / args.poll_interval)
+    next_logout = now + rng.expovariate(1.0 / args.session_length) if args.session_length > 0 else float("inf")
+    while True:
+        wake = min(next_poll, next_logout, deadline)
+        await asyncio.sleep(max(0.0, wake - loop.time()))
+        now = loop.time()
+        if now >= deadline:
+            return
+        if now >= next_logout:
+            await client.request("LOGOUT")
+            await asyncio.sleep(min(rng.expovariate(1.0 / args.offline_time), max(0.0, deadline - loop.time())))
+            if loop.time() >= deadline:
+                return
+            await client.request("LOGIN", login_payload(client, args))
+            now = loop.time()
+            next_logout = now + rng.expovariate(1.0 / args.session_length)
+            next_poll = min(next_poll, now)  # 与真实客户端一样，登录后立即刷新好友列表
+        if now >= next_poll:
+            page = {"limit": args.page_size}
+            await asyncio.gather(client.request("GET_ONLINE_FRIENDS", page),
+                                 client.request("GET_ALL_FRIENDS", page))
+            next_poll = loop.time() + rng.expovariate(1.0 / args.poll_interval)
+
+
+async def run_load(host, port, args):
+    rng = random.Random(args.seed)
+    clients = [SimClient(i, f"{args.user_prefix}{i}", args.timeout, args.max_retries) for i in range(args.clients)]
+    graph = build_friend_graph(args.clients, args.avg_friends, args.graph, rng, args.powerlaw_alpha)
+    degrees = defaultdict(int)
+    for i, j in graph:
+        degrees[i] += 1
+        degrees[j] += 1
+
+    setup = PhaseStats("setup")
+    ready = await setup_clients(clients, graph, host, port, args, setup)
+    setup.finish()
+    print(f"setup: {len(ready)}/{args.clients} 个客户端已登录，{len(graph)} 条好友关系 "
+          f"(最大好友数 {max(degrees.values(), default=0)})，用时 {setup.summary()['seconds']}s")
+
+    steady = PhaseStats("steady")
+    for client in ready:
+        client.stats = steady
+    deadline = asyncio.get_running_loop().time() + args.duration
+    await asyncio.gather(*(drive_client(client, args, random.Random(rng.random()), deadline) for client in ready))
+    steady.finish()
+    await asyncio.gather(*(client.close() for client in clients))
+    return {
+        "graph": {"edges": len(graph), "max_degree": max(degrees.values(), default=0),
+                  "avg_degree": round(2 * len(graph) / args.clients, 2) if args.clients else 0},
+        "clients_ready": len(ready),
+        "phases": [setup.summary(), steady.summary()],
+    }
+
+
+def print_summary(result):
+    for phase in result["phases"]:
+        print(f"\n[{phase['phase']}] {phase['seconds']}s, {phase['requests']} 请求, {phase['errors']} 错误, "
+              f"{phase['throughput_rps']} 请求/s, 推送事件 {phase['events']}, 过载重试 {phase['rejections']}")
+        print(f"  {'command':<20}{'count':>9}{'errors':>8}{'rps':>10}{'p50_ms':>10}{'p95_ms':>10}{'p99_ms':>10}")
+        for command, row in phase["commands"].items():
+            print(f"  {command:<20}{row['count']:>9}{row['errors']:>8}{row['throughput_rps'] or 0:>10}"
+                  f"{row['p50_ms'] or '-':>10}{row['p95_ms'] or '-':>10}{row['p99_ms'] or '-':>10}")
+
+
+def main(args):
+    raise_fd_limit()
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+        result = asyncio.run(run_load(host, int(port), args))
+    else:
+        # 数据库文件放在内存文件系统中（如果有），测得的是服务器本身而不是磁盘
+        shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        with tempfile.TemporaryDirectory(prefix="loadgen_", dir=shm) as workdir:
+            port = free_port()
+            extra = ["--backlog", str(args.backlog), "--workers", str(args.workers)] + storage_args(args, workdir)
+            if args.workers > 1:
+                extra += ["--presence-broker-socket", os.path.join(workdir, "presence.sock")]
+            proc = start_server(args.mode, port, extra)
+            try:
+                time.sleep(args.warmup)
+                result = asyncio.run(run_load("127.0.0.1", port, args))
+            finally:
+                stop_server(proc)
+    result["config"] = {key: value for key, value in vars(args).items() if key != "password"}
+    print_summary(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="目录服务器合成负载生成器")
+    parser.add_argument("--clients", type=int, default=1000, help="模拟客户端数")
+    parser.add_argument("--duration", type=float, default=60.0, help="稳定阶段持续时间（秒）")
+    parser.add_argument("--graph", choices=GRAPH_DISTRIBUTIONS, default="powerlaw", help="好友关系图的度分布")
+    parser.add_argument("--avg-friends", type=int, default=10, help="平均每个用户的好友数")
+    parser.add_argument("--powerlaw-alpha", type=float, default=1.0, help="powerlaw 分布的 Zipf 指数，越大越集中")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="刷新好友列表的平均间隔（秒，指数分布）")
+    parser.add_argument("--page-size", type=int, default=500, help="好友列表请求的分页大小")
+    parser.add_argument("--session-length", type=float, default=60.0,
+                        help="平均在线时长（秒，指数分布），到期后登出再重新登录；0 表示不登出")
+    parser.add_argument("--offline-time", type=float, default=2.0, help="登出后到重新登录的平均间隔（秒，指数分布）")
+    parser.add_argument("--concurrency", type=int, default=200, help="setup 阶段同时进行的连接/注册/登录数")
+    parser.add_argument("--timeout", type=float, default=30.0, help="单次连接/请求超时（秒）")
+    parser.add_argument("--max-retries", type=int, default=3,
+                        help="被服务器过载拒绝（限流/繁忙）时按 retry_after 重试的最多次数")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子（好友关系图与请求时间）")
+    parser.add_argument("--user-prefix", default="loadgen_", help="模拟用户名前缀")
+    parser.add_argument("--password", default="loadgen-password", help="模拟用户的密码")
+    parser.add_argument("--target", help="对已运行的服务器施压 (host:port)；不指定时在本地启动服务器子进程")
+    parser.add_argument("--mode", choices=("asyncio", "threaded"), default="asyncio", help="本地服务器的模式")
+    parser.add_argument("--workers", type=int, default=1, help="本地服务器的工作进程数")
+    parser.add_argument("--backlog", type=int, default=1024, help="本地服务器的 listen backlog")
+    parser.add_argument("--warmup", type=float, default=1.0, help="本地服务器启动后等待的时间（秒）")
+    parser.add_argument("--db-backend", choices=("sqlite", "sqlserver"), default="sqlite",
+                        help="本地服务器的存储后端；sqlite 每次使用临时数据库文件")
+    parser.add_argument("--json", help="将结果以JSON格式写入该文件")
+    return parser
+
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
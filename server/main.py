@@ -1,28 +1,78 @@
+import argparse
 import logging
 from server import SecureChatServer
-from config import LOG_FILE # 从 config 导入日志配置
+from async_server import AsyncSecureChatServer
+from storage import create_storage, STORAGE_BACKENDS
+from supervisor import run_workers
+from admission import CONNECTION_POLICIES
+from config import LOG_FILE, SERVER_HOST, SERVER_PORT, SERVER_MODE, SERVER_BACKLOG, DB_BACKEND, \
+    SQLITE_DB_FILE, SERVER_WORKERS, METRICS_PORT, MAX_CONNECTIONS, \
+    CONNECTION_OVERFLOW_POLICY, RESUME_GRACE_PERIOD  # 从 config 导入日志与服务器配置
 
 def setup_logging():
     """配置日志系统。"""
     # 根据字符串获取日志级别，如果配置中不存在，则默认为 INFO
     log_level = getattr(logging, 'INFO', logging.INFO)
+    handlers = [logging.StreamHandler()]  # 输出到控制台
+    if LOG_FILE:  # 未配置日志文件时只输出到控制台
+        handlers.append(logging.FileHandler(LOG_FILE, encoding='utf-8'))  # 输出到文件
     logging.basicConfig(
         level=log_level,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(LOG_FILE, encoding='utf-8'),  # 输出到文件
-            logging.StreamHandler()                           # 输出到控制台
-        ]
+        handlers=handlers
     )
 
+def parse_args():
+    """解析命令行参数，未指定的参数使用 config 中的默认值。"""
+    parser = argparse.ArgumentParser(description='启动安全聊天目录服务器')
+    parser.add_argument('--mode', choices=['asyncio', 'threaded'], default=SERVER_MODE,
+                        help=f'服务器I/O模型 (默认: {SERVER_MODE})')
+    parser.add_argument('--host', type=str, default=SERVER_HOST, help=f'监听地址 (默认: {SERVER_HOST})')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help=f'监听端口 (默认: {SERVER_PORT})')
+    parser.add_argument('--backlog', type=int, default=SERVER_BACKLOG,
+                        help=f'listen() 待处理连接队列长度 (默认: {SERVER_BACKLOG})')
+    parser.add_argument('--db-backend', choices=STORAGE_BACKENDS, default=DB_BACKEND,
+                        help=f'存储后端 (默认: {DB_BACKEND})')
+    parser.add_argument('--sqlite-file', type=str, default=SQLITE_DB_FILE,
+                        help=f'SQLite 后端的数据库文件 (默认: {SQLITE_DB_FILE})')
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help=f'工作进程数，大于1时以 SO_REUSEPORT 共享监听端口，在线状态经 presence broker 同步 '
+                             f'(默认: {SERVER_WORKERS})')
+    parser.add_argument('--presence-broker-socket', type=str, default=None,
+                        help='多进程模式下 presence broker 的 Unix 域套接字路径 (默认: 系统临时目录下按端口命名)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help=f'Prometheus 指标端点的本地端口，0 表示不启动；多进程模式下第 i 个工作进程使用该端口 + i '
+                             f'(默认: {METRICS_PORT})')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help=f'每个进程的最大客户端连接数 (默认: {MAX_CONNECTIONS})')
+    parser.add_argument('--connection-policy', choices=CONNECTION_POLICIES, default=CONNECTION_OVERFLOW_POLICY,
+                        help=f'连接数已满时的策略: reject 立即拒绝，queue 让新连接等待 (默认: {CONNECTION_OVERFLOW_POLICY})')
+    parser.add_argument('--no-rate-limits', dest='rate_limits', action='store_false',
+                        help='关闭按连接/用户/登录用户名的请求限流（测量服务器极限吞吐量时使用）')
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE_PERIOD,
+                        help=f'连接断开后保留在线状态、等待 RESUME 恢复会话的秒数，0 表示断开即下线 '
+                             f'(默认: {RESUME_GRACE_PERIOD:g})')
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
     setup_logging()
     logger = logging.getLogger(__name__)
 
-    logger.info("服务器程序启动。")
+    logger.info(f"服务器程序启动，模式: {args.mode}，存储后端: {args.db_backend}，工作进程数: {args.workers}。")
     try:
-        chat_server = SecureChatServer()
-        chat_server.start()
+        server_class = AsyncSecureChatServer if args.mode == 'asyncio' else SecureChatServer
+        server_options = {"rate_limits": args.rate_limits, "max_connections": args.max_connections,
+                          "connection_policy": args.connection_policy, "resume_grace_period": args.resume_grace}
+        if args.workers > 1:
+            run_workers(server_class, args.workers, args.host, args.port, args.backlog,
+                        args.db_backend, args.sqlite_file, broker_path=args.presence_broker_socket,
+                        metrics_port=args.metrics_port, **server_options)
+        else:
+            db_manager = create_storage(args.db_backend, sqlite_file=args.sqlite_file)
+            chat_server = server_class(host=args.host, port=args.port, backlog=args.backlog, db_manager=db_manager,
+                                       metrics_port=args.metrics_port, **server_options)
+            chat_server.start()
     except Exception as e:
         logger.critical(f"服务器主程序运行中发生严重错误: {e}", exc_info=True)
-    logger.info("服务器程序结束。")
\ No newline at end of file
+    logger.info("服务器程序结束。")
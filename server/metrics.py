@@ -0,0 +1,335 @@
+"""
+服务器内置的指标（metrics），以 Prometheus 文本格式在单独的本地 HTTP 端口上暴露（GET /metrics）。
+
+- MetricsRegistry: 计数器（Counter）、直方图（Histogram）、取值回调（gauge）和组件 stats() 的整组导出
+  （StatsCollector），不依赖 prometheus_client；
+- ChatServerMetrics: SecureChatServer 使用的具体指标：
+    chat_commands_total / chat_command_duration_seconds     每个命令的次数（按结果）与处理耗时
+    chat_db_operation_duration_seconds                         存储后端每个操作的耗时（_count 即次数）
+    chat_active_sessions / chat_online_users / chat_threads  当前连接数、在线用户数、线程数
+    chat_received_bytes_total / chat_sent_bytes_total         控制连接收发的字节数
+    chat_presence_writer_* / chat_db_pool_*                   PresenceWriter 与数据库连接池的指标
+    chat_rejected_total                                       被准入控制拒绝的请求与连接数（按原因）
+    chat_db_admission_* / chat_connection_limit_*             DB 操作并发/排队与连接数上限的当前状态
+    chat_resume_sessions_*                                    断开待恢复的会话数，以及已恢复/已过期的会话数
+    chat_friend_sync_*                                        有好友变更日志的用户数，SYNC_FRIENDS 增量/完整快照响应数
+    组件 stats() 中的累计值（如 chat_db_pool_checkouts_total）按 counter 导出，其余按 gauge 导出。
+- instrument_storage(): 为存储后端的每个操作加上计时。
+多进程模式下每个工作进程使用 METRICS_PORT + 工作进程编号，各自作为一个抓取目标。
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的桶上限（秒），覆盖内存命令（亚毫秒）到密码哈希和慢查询（秒级）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不减的计数器，按标签值分别计数。"""
+    type_name = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # {labelvalues: 数值}
+        self._lock = threading.Lock()
+
+    def inc(self, labelvalues=(), amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, labelvalues=()):
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, labels), value) for labels, value in values]
+
+
+class Histogram:
+    """累积直方图：每组标签值记录各桶计数、总和与次数。"""
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # {labelvalues: [各桶计数(非累积)..., +Inf 桶计数, 总和]}
+        self._lock = threading.Lock()
+
+    def observe(self, labelvalues, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(state)) for labels, state in self._values.items())
+        samples = []
+        for labels, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = _format_value(bound)
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, labels, [("le", le)]),
+                                cumulative))
+            label_text = _format_labels(self.labelnames, labels)
+            samples.append((f"{self.name}_sum", label_text, state[-1]))
+            samples.append((f"{self.name}_count", label_text, cumulative))
+        return samples
+
+
+class GaugeFunc:
+    """抓取时才调用回调取值的 gauge。回调返回一个数值，或者 {标签值元组: 数值}。"""
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, func, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._func = func
+
+    def samples(self):
+        value = self._func()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, _format_labels(self.labelnames, labels), v) for labels, v in sorted(value.items())]
+
+
+class StatsCollector:
+    """
+    把组件 stats() 返回的字典导出为一组指标（名称为 prefix_键名）。每次抓取只调用一次 stats_func，
+    各项取自同一份快照；counter_keys 中的累计值按 counter 导出（名称以 _total 结尾），其余数值项按 gauge 导出。
+    """
+
+    def __init__(self, prefix, description, stats_func, counter_keys=()):
+        self.name = prefix
+        self.description = description
+        self._func = stats_func
+        self._counter_keys = frozenset(counter_keys)
+
+    def families(self):
+        """返回 [(指标名, 说明, 类型, 样本列表)]。"""
+        families = []
+        for key, value in self._func().items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            if key in self._counter_keys:
+                # 按 Prometheus 惯例 counter 以 _total 结尾，如 wait_time_total_ms -> wait_time_ms_total
+                name, type_name = f"{self.name}_{key.replace('_total', '')}_total", Counter.type_name
+            else:
+                name, type_name = f"{self.name}_{key}", GaugeFunc.type_name
+            families.append((name, f"{self.description}: {key}", type_name, [(name, "", value)]))
+        return families
+
+
+class MetricsRegistry:
+    """指标注册表，render() 生成 Prometheus 文本格式。"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, func, labelnames=()):
+        return self._register(GaugeFunc(name, help_text, func, labelnames))
+
+    def stats_collector(self, prefix, description, stats_func, counter_keys=()):
+        return self._register(StatsCollector(prefix, description, stats_func, counter_keys))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                if isinstance(metric, StatsCollector):
+                    families = metric.families()
+                else:
+                    families = [(metric.name, metric.help_text, metric.type_name, metric.samples())]
+            except Exception as e:  # 单个回调出错不影响其他指标
+                logger.error(f"MetricsRegistry: 采集指标 {metric.name} 时出错: {e}", exc_info=True)
+                continue
+            for family_name, help_text, type_name, samples in families:
+                lines.append(f"# HELP {family_name} {help_text}")
+                lines.append(f"# TYPE {family_name} {type_name}")
+                lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsHTTPServer:
+    """在后台线程中运行的 HTTP 服务器，只提供 GET /metrics。"""
+
+    def __init__(self, registry, host, port):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # 抓取请求不写入服务器日志
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self.address = self._httpd.server_address
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"MetricsHTTPServer: 指标端点 http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# 不计时的存储后端方法：关闭与取指标本身
+_UNTIMED_STORAGE_METHODS = frozenset({"close", "get_pool_stats"})
+
+
+def instrument_storage(db_manager, metrics):
+    """
+    为存储后端实例的每个操作（StorageBackend 定义的方法）加上计时，结果记入 metrics 的 DB 指标。
+    在实例上替换绑定方法，不改变实例的类型；iter_all_users_info 等内部调用的操作同样会被计时。
+    """
+    for name in sorted(StorageBackend.__abstractmethods__ - _UNTIMED_STORAGE_METHODS):
+        method = getattr(db_manager, name)
+
+        @functools.wraps(method)
+        def timed(*args, _method=method, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                metrics.observe_db_operation(_name, time.perf_counter() - start)
+
+        setattr(db_manager, name, timed)
+    return db_manager
+
+
+class ChatServerMetrics:
+    """SecureChatServer 的指标。命令名只使用服务器认识的命令，其余一律记为 UNKNOWN，避免标签无限增长。"""
+
+    def __init__(self, known_commands):
+        self.registry = MetricsRegistry()
+        self._known_commands = frozenset(known_commands)
+        registry = self.registry
+        self._commands = registry.counter("chat_commands_total", "处理的命令数，按命令和结果（success/error）",
+                                          ("command", "status"))
+        self._command_duration = registry.histogram("chat_command_duration_seconds", "命令处理耗时（秒）",
+                                                     ("command",))
+        self._db_duration = registry.histogram("chat_db_operation_duration_seconds",
+                                               "存储后端操作耗时（秒），包括等待连接池的时间", ("operation",))
+        self._received_bytes = registry.counter("chat_received_bytes_total", "从客户端控制连接收到的字节数")
+        self._sent_bytes = registry.counter("chat_sent_bytes_total", "向客户端控制连接发送的字节数（响应与推送事件）")
+        self._connections = registry.counter("chat_connections_total", "接受的客户端连接数")
+        self._rejections = registry.counter("chat_rejected_total",
+                                            "被准入控制拒绝的请求与连接数，按原因（rate_limited/busy/too_many_connections）",
+                                            ("reason",))
+        self._active_sessions = 0
+        self._sessions_lock = threading.Lock()
+        registry.gauge("chat_active_sessions", "当前打开的客户端控制连接数", lambda: self._active_sessions)
+        registry.gauge("chat_threads", "服务器进程中的线程数", threading.active_count)
+        self._started = time.time()
+        registry.gauge("chat_uptime_seconds", "服务器运行时间（秒）", lambda: time.time() - self._started)
+
+    def attach(self, server):
+        """注册从服务器组件读取的指标（在服务器初始化完成后调用）。"""
+        self.registry.gauge("chat_online_users", "当前本进程注册表中的在线用户数（含其他工作进程的用户）",
+                            lambda: len(server.presence))
+        registry = self.registry
+        registry.stats_collector("chat_presence_writer", "PresenceWriter", server.presence_writer.stats,
+                                 ("ops", "coalesced", "flushes", "rows_written", "errors"))
+        registry.stats_collector("chat_db_pool", "数据库连接池（时间单位：毫秒）", server.db_manager.get_pool_stats,
+                                 ("checkouts", "timeouts", "created", "discarded", "recycled", "evicted_idle",
+                                  "health_check_failures", "wait_time_total_ms"))
+        registry.stats_collector("chat_db_admission", "DB 操作准入控制", server.db_limiter.stats,
+                                 ("completed", "rejected", "timed_out"))
+        registry.stats_collector("chat_connection_limit", "连接数上限", server.connection_limiter.stats)
+        registry.stats_collector("chat_resume_sessions", "断线会话恢复", server.detached_sessions.stats,
+                                 ("resumed", "expired"))
+        registry.stats_collector("chat_friend_sync", "好友列表增量同步", server.friend_log.stats,
+                                 ("deltas", "snapshots"))
+
+    def command_label(self, command):
+        return command if isinstance(command, str) and command in self._known_commands else "UNKNOWN"
+
+    def observe_command(self, command, status, seconds):
+        label = self.command_label(command)
+        self._commands.inc((label, "success" if status == "success" else "error"))
+        self._command_duration.observe((label,), seconds)
+
+    def observe_db_operation(self, operation, seconds):
+        self._db_duration.observe((operation,), seconds)
+
+    def observe_rejection(self, reason):
+        self._rejections.inc((reason,))
+
+    def add_received_bytes(self, count):
+        self._received_bytes.inc(amount=count)
+
+    def add_sent_bytes(self, count):
+        self._sent_bytes.inc(amount=count)
+
+    def session_opened(self):
+        self._connections.inc()
+        with self._sessions_lock:
+            self._active_sessions += 1
+
+    def session_closed(self):
+        with self._sessions_lock:
+            self._active_sessions -= 1
@@ -0,0 +1,48 @@
+"""
+在独立的进程池中计算和校验密码哈希。
+
+scrypt 每次计算需要数十毫秒并且全程持有 GIL，如果在处理请求的线程中直接计算，登录高峰时
+服务器进程的所有其他命令都会被拖慢。交给子进程计算后，调用方线程只是阻塞等待结果，不占用 GIL。
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from config import PASSWORD_HASH_WORKERS, SCRYPT_N, SCRYPT_R, SCRYPT_P
+from utils import hash_password, verify_password
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHasher:
+    """密码哈希进程池。hash / verify 会阻塞调用方线程直到子进程算完。"""
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self._params = (n, r, p)
+        # 服务器进程中已有后台线程和数据库连接，使用 spawn 而不是 fork 创建子进程
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        # 用户不存在时也对该哈希做一次校验，使响应时间与密码错误时一致，避免借此探测用户名；同时预热进程池
+        self._dummy_hash = self.hash(os.urandom(16).hex())
+        logger.info(f"PasswordHasher: 密码哈希进程池已启动 (进程数={workers}, scrypt n={n}, r={r}, p={p})。")
+
+    def hash(self, password):
+        """用当前参数计算密码哈希。"""
+        return self._executor.submit(hash_password, password, *self._params).result()
+
+    def verify(self, password, stored_hash):
+        """
+        校验密码。
+        :return: (是否匹配, 是否需要用当前参数重新哈希)
+        """
+        return self._executor.submit(verify_password, password, stored_hash, *self._params).result()
+
+    def verify_dummy(self, password):
+        """对一个固定的随机哈希做一次校验（结果总是不匹配），用于用户不存在的情况。"""
+        self.verify(password, self._dummy_hash)
+
+    def close(self):
+        # 等待进程池退出：在 multiprocessing 子进程（多进程模式的工作进程）中，不等待的话进程退出时
+        # 任务队列先被关闭，结束信号发不到哈希进程，工作进程会一直等待它们
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        logger.info("PasswordHasher: 密码哈希进程池已关闭。")
@@ -0,0 +1,258 @@
+"""
+服务器进程内的在线状态（presence）注册表。
+
+在线状态是系统中访问最频繁的数据：每次登录、登出、断线和好友列表刷新都会用到。
+PresenceRegistry 是在线状态的权威来源，按 UserID 保存 IP、P2P端口、最后活跃时间和控制连接会话；
+GET_ONLINE_FRIENDS 直接用好友集合与注册表求交集得到，不再访问数据库。
+OnlineStatus 表只由 PresenceWriter 在后台异步写入，用于持久化/分析。
+"""
+import heapq
+import logging
+import threading
+import time
+
+from config import PRESENCE_FLUSH_INTERVAL, PRESENCE_FLUSH_BATCH_SIZE
+from utils import key_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceEntry:
+    """一个在线用户的状态。"""
+    __slots__ = ("user_id", "username", "ip", "port", "public_key", "public_key_fingerprint", "session",
+                 "friend_ids", "login_time", "last_active")
+
+    def __init__(self, user_id, username, ip, port, public_key, session, friend_ids):
+        self.user_id = user_id
+        self.username = username
+        self.ip = ip
+        self.port = port
+        self.public_key = public_key
+        self.public_key_fingerprint = key_fingerprint(public_key)
+        self.session = session  # 控制连接的 ClientSession
+        self.friend_ids = set(friend_ids)  # 登录时从数据库加载，好友增删时同步更新
+        self.login_time = time.time()
+        self.last_active = self.login_time
+
+    def to_friend_info(self, include_key=True):
+        """
+        转换为 GET_ONLINE_FRIENDS 响应中的好友信息格式。
+        :param include_key: 接收方已持有该公钥（指纹相同）时为 False，只发送指纹而不发送完整的PEM。
+        """
+        info = {
+            "user_id": self.user_id,
+            "username": self.username,
+            "ip": self.ip,
+            "port": self.port,
+            "public_key_fingerprint": self.public_key_fingerprint,
+        }
+        if include_key:
+            info["public_key_pem"] = self.public_key
+        return info
+
+
+class PresenceRegistry:
+    """线程安全的在线状态注册表 {user_id: PresenceEntry}。"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return user_id in self._entries
+
+    def register(self, entry):
+        """
+        登记用户上线。
+        :return: True 登记成功；False 该用户已经在线（重复登录）。
+        """
+        with self._lock:
+            if entry.user_id in self._entries:
+                return False
+            self._entries[entry.user_id] = entry
+            return True
+
+    def unregister(self, user_id, session=None):
+        """
+        登记用户下线。指定 session 时只有该会话仍是此用户的当前会话才会移除，避免误删新会话。
+        :return: 被移除的 PresenceEntry，没有移除时返回 None。
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or (session is not None and entry.session is not session):
+                return None
+            del self._entries[user_id]
+            return entry
+
+    def get(self, user_id):
+        with self._lock:
+            return self._entries.get(user_id)
+
+    def update_p2p_info(self, user_id, ip, port):
+        """更新用户的P2P监听地址。:return: 用户是否在线。"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False
+            entry.ip = ip
+            entry.port = port
+            entry.last_active = time.time()
+            return True
+
+    def touch(self, user_id):
+        """刷新用户的最后活跃时间。"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.last_active = time.time()
+
+    def get_friend_ids(self, user_id):
+        """返回在线用户当前好友集合的副本；用户不在线时返回 None。"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return set(entry.friend_ids) if entry is not None else None
+
+    def get_online_friends(self, user_id, after_user_id=None, limit=None):
+        """
+        返回用户在线好友的 PresenceEntry 列表（好友集合与注册表的交集）。
+        指定 limit 时按 UserID 升序分页，只返回 UserID 大于 after_user_id 的前 limit 个。
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return []
+            friend_ids = entry.friend_ids
+            if after_user_id is not None:
+                friend_ids = (fid for fid in friend_ids if fid > after_user_id)
+            online = [fid for fid in friend_ids if fid in self._entries]
+            if limit is not None:
+                online = heapq.nsmallest(limit, online)
+            return [self._entries[fid] for fid in online]
+
+    def get_online_friends_of(self, entry):
+        """
+        与 get_online_friends 相同，但直接使用给定的 PresenceEntry（可以是刚刚 unregister 掉的条目），
+        用于向下线用户的在线好友推送状态变化。
+        """
+        with self._lock:
+            return [self._entries[fid] for fid in entry.friend_ids if fid in self._entries]
+
+    def add_friendship(self, uid1, uid2):
+        """好友关系建立后同步更新双方（如果在线）缓存的好友集合。"""
+        with self._lock:
+            if uid1 in self._entries:
+                self._entries[uid1].friend_ids.add(uid2)
+            if uid2 in self._entries:
+                self._entries[uid2].friend_ids.add(uid1)
+
+    def remove_friendship(self, uid1, uid2):
+        """好友关系删除后同步更新双方（如果在线）缓存的好友集合。"""
+        with self._lock:
+            if uid1 in self._entries:
+                self._entries[uid1].friend_ids.discard(uid2)
+            if uid2 in self._entries:
+                self._entries[uid2].friend_ids.discard(uid1)
+
+
+class PresenceWriter:
+    """
+    在后台线程中把在线状态变化批量写入数据库 OnlineStatus 表（write-behind）。
+    请求处理线程只负责记录变化；同一用户在一批内的多次变化只保留最后一次。
+    后台线程每隔 flush_interval 秒，或积累了 batch_size 个用户的变化时，
+    用一条多行 MERGE（上线/更新）和一条多行 DELETE（下线）写入。
+    """
+
+    def __init__(self, db_manager, flush_interval=PRESENCE_FLUSH_INTERVAL, batch_size=PRESENCE_FLUSH_BATCH_SIZE):
+        self._db_manager = db_manager
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._pending = {}  # {user_id: (ip, port)} 表示上线/更新，{user_id: None} 表示下线
+        self._cond = threading.Condition(threading.Lock())
+        self._stopping = False
+        # 指标
+        self._ops = 0
+        self._coalesced = 0
+        self._flushes = 0
+        self._rows_written = 0
+        self._errors = 0
+        self._thread = threading.Thread(target=self._run, name="presence-writer", daemon=True)
+        self._thread.start()
+
+    def set_online(self, user_id, ip, port):
+        self._enqueue(user_id, (ip, port))
+
+    def set_offline(self, user_id):
+        self._enqueue(user_id, None)
+
+    def _enqueue(self, user_id, value):
+        with self._cond:
+            self._ops += 1
+            if user_id in self._pending:
+                self._coalesced += 1
+            self._pending[user_id] = value
+            if len(self._pending) >= self._batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._stopping:
+                    # 第一条变化到达后最多再等 flush_interval 秒，期间积累的变化合并成一批
+                    deadline = time.monotonic() + self._flush_interval
+                    while len(self._pending) < self._batch_size and not self._stopping:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                batch, self._pending = self._pending, {}
+                stopping = self._stopping
+            if batch:
+                self._flush(batch)
+            if stopping:
+                with self._cond:
+                    if not self._pending:
+                        return
+
+    def _flush(self, batch):
+        online = [(user_id, *value) for user_id, value in batch.items() if value is not None]
+        offline = [user_id for user_id, value in batch.items() if value is None]
+        try:
+            ok = self._db_manager.set_online_status_batch(online) if online else True
+            ok = (self._db_manager.clear_online_status_batch(offline) if offline else True) and ok
+        except Exception as e:
+            logger.error(f"PresenceWriter: 批量写入 {len(batch)} 个用户的在线状态时出错: {e}", exc_info=True)
+            ok = False
+        with self._cond:
+            self._flushes += 1
+            if ok:
+                self._rows_written += len(batch)
+            else:
+                self._errors += 1
+        logger.debug(f"PresenceWriter: 已批量写入在线状态 (上线/更新 {len(online)}, 下线 {len(offline)})。")
+
+    def stats(self):
+        """返回写入指标：收到的变化数、被合并掉的变化数、批次数、写入行数、失败批次数和当前待写入数。"""
+        with self._cond:
+            return {
+                "ops": self._ops,
+                "coalesced": self._coalesced,
+                "flushes": self._flushes,
+                "rows_written": self._rows_written,
+                "errors": self._errors,
+                "pending": len(self._pending),
+            }
+
+    def stop(self, timeout=10.0):
+        """把尚未写入的变化全部写入数据库后停止后台线程。"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("PresenceWriter: 后台写入线程未能在超时时间内结束。")
@@ -0,0 +1,364 @@
+"""
+多进程模式（main.py --workers N）下各工作进程共享在线状态的本地代理（presence broker）。
+
+每个工作进程都有自己的 PresenceRegistry，其中既有本进程连接上的用户（带 ClientSession），
+也有其他工作进程连接上的用户（session 为 None 的副本）。PresenceBroker 运行在单独的进程中，
+通过 Unix 域套接字与各工作进程相连，负责：
+- 仲裁上线：同一用户同时只能在一个工作进程中在线（claim 请求，等待 broker 的 ack）；
+- 转发变化：上线、P2P信息更新、下线、好友关系变化、新注册用户，转发给其他所有工作进程；
+- 工作进程新连接时先发送当前全部在线用户的快照，工作进程退出时代其广播这些用户下线；
+- 会话恢复（RESUME）落到另一个工作进程时转移用户的归属（takeover 请求，以登录时登记的恢复ID校验）；
+- 凭密码重新登录落到另一个工作进程时，请用户所在的工作进程结束其断开待恢复的会话（evict 请求）。
+于是无论好友连接在哪个工作进程上，GET_ONLINE_FRIENDS 都只需查本进程的注册表。
+消息使用与控制连接相同的长度前缀分帧（protocol.encode_frame）+ JSON。
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from config import PRESENCE_BROKER_TIMEOUT, BUFFER_SIZE, MAX_FRAME_SIZE
+from presence import PresenceEntry
+from protocol import encode_frame, FrameReader, FRAME_HEADER, FRAME_HEADER_SIZE
+
+logger = logging.getLogger(__name__)
+
+# 工作进程 -> broker
+OP_CLAIM = "claim"            # {"seq", "entry", "resume_id"}：申请登记用户上线，broker 以 ack 回复
+OP_TAKEOVER = "takeover"      # {"seq", "user_id", "resume_id"}：在本进程恢复其他工作进程上用户的会话，以 ack 回复
+OP_EVICT = "evict"            # {"seq", "user_id"}：结束其他工作进程上该用户断开待恢复的会话，以 ack 回复
+OP_EVICTED = "evicted"        # {"evict_id", "ok"}：用户所在工作进程对 evict 的答复（ok 表示已结束并下线）
+OP_UPDATE = "update"          # {"user_id", "ip", "port"}：更新P2P信息
+OP_OFFLINE = "offline"        # {"user_id"}
+OP_FRIENDSHIP = "friendship"  # {"uid1", "uid2", "added"}
+OP_USER = "user"              # {"user_id", "username"}：新注册用户（用于各进程的用户名搜索索引）
+# broker -> 工作进程（以上除 claim 外的消息，以及：）
+OP_ONLINE = "online"          # {"entry"}
+OP_ACK = "ack"                # {"seq", "ok"}
+OP_SYNCED = "synced"          # 连接建立时的快照已发送完毕
+OP_RELEASED = "released"      # {"entry"}：用户的会话已在另一个工作进程上恢复，原工作进程交出该用户
+# broker -> 用户所在的工作进程：{"op": "evict", "evict_id", "user_id"}，该工作进程以 evicted 答复
+
+
+def _encode(message):
+    return encode_frame(json.dumps(message, ensure_ascii=False).encode('utf-8'))
+
+
+def entry_to_message(entry):
+    """把 PresenceEntry 转换为可在进程间传递的字典（不含会话）。"""
+    return {
+        "user_id": entry.user_id,
+        "username": entry.username,
+        "ip": entry.ip,
+        "port": entry.port,
+        "public_key": entry.public_key,
+        "friend_ids": sorted(entry.friend_ids),
+    }
+
+
+def entry_from_message(data):
+    """由 entry_to_message 的结果创建其他工作进程用户的 PresenceEntry 副本（session 为 None）。"""
+    return PresenceEntry(data["user_id"], data["username"], data["ip"], data["port"], data["public_key"],
+                         None, data["friend_ids"])
+
+
+class PresenceBroker:
+    """在线状态代理，在单独的进程中以 asyncio 事件循环运行，状态只在事件循环线程中访问，不需要加锁。"""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._sock = None
+        self._entries = {}  # {user_id: (所属工作进程的 writer, entry 字典)}
+        self._resume_ids = {}  # {user_id: 登录时登记的恢复ID}，只用于校验 takeover，不转发给其他工作进程
+        self._writers = set()
+        self._evictions = {}  # {evict_id: (请求方 writer, 请求 seq, 用户所在工作进程的 writer)}
+        self._evict_ids = itertools.count(1)
+
+    def bind(self):
+        """创建并监听 Unix 域套接字（在创建工作进程之前调用，工作进程启动后即可连接）。"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # 上次运行遗留的套接字文件
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        self._sock.listen(128)
+        logger.info(f"PresenceBroker: 正在监听 {self.socket_path}")
+
+    def close(self, remove_socket_file=True):
+        """关闭监听套接字。工作进程中关闭继承来的副本时 remove_socket_file 为 False。"""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if remove_socket_file:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        """运行代理直到收到 SIGTERM / SIGINT。"""
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+            logger.info("PresenceBroker: 已停止。")
+
+    async def _serve(self):
+        server = await asyncio.start_unix_server(self._handle_worker, sock=self._sock, limit=BUFFER_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    def _broadcast(self, message, exclude=None):
+        data = _encode(message)
+        for writer in self._writers:
+            if writer is not exclude and not writer.is_closing():
+                writer.write(data)
+
+    async def _handle_worker(self, reader, writer):
+        # 新连接的工作进程先收到当前全部在线用户
+        for _, entry in self._entries.values():
+            writer.write(_encode({"op": OP_ONLINE, "entry": self._entry_message(entry)}))
+        writer.write(_encode({"op": OP_SYNCED}))
+        self._writers.add(writer)
+        logger.info(f"PresenceBroker: 工作进程已连接，当前 {len(self._writers)} 个工作进程。")
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER_SIZE)
+                except asyncio.IncompleteReadError:
+                    break
+                (body_len,) = FRAME_HEADER.unpack(header)
+                message = json.loads((await reader.readexactly(body_len)).decode('utf-8'))
+                self._handle_message(writer, message)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.info(f"PresenceBroker: 与工作进程的连接中断: {e}")
+        except ValueError as e:
+            logger.error(f"PresenceBroker: 收到无效的消息: {e}")
+        finally:
+            self._writers.discard(writer)
+            lost = [user_id for user_id, (owner, _) in self._entries.items() if owner is writer]
+            for user_id in lost:
+                del self._entries[user_id]
+                self._resume_ids.pop(user_id, None)
+                self._broadcast({"op": OP_OFFLINE, "user_id": user_id})
+            # 等待该工作进程答复的 evict：用户已随之下线，按成功答复请求方
+            for evict_id, (requester, seq, owner) in list(self._evictions.items()):
+                if writer in (requester, owner):
+                    del self._evictions[evict_id]
+                    if requester is not writer:
+                        self._reply(requester, seq, True)
+            logger.warning(f"PresenceBroker: 工作进程已断开，{len(lost)} 个用户随之下线，"
+                           f"剩余 {len(self._writers)} 个工作进程。")
+            writer.close()
+
+    @staticmethod
+    def _entry_message(entry):
+        return dict(entry, friend_ids=sorted(entry["friend_ids"]))
+
+    @staticmethod
+    def _reply(writer, seq, ok):
+        if not writer.is_closing():
+            writer.write(_encode({"op": OP_ACK, "seq": seq, "ok": ok}))
+
+    def _handle_message(self, writer, message):
+        op = message.get("op")
+        if op == OP_CLAIM:
+            entry = message["entry"]
+            ok = entry["user_id"] not in self._entries
+            if ok:
+                self._entries[entry["user_id"]] = (writer, dict(entry, friend_ids=set(entry["friend_ids"])))
+                self._resume_ids[entry["user_id"]] = message.get("resume_id")
+                self._broadcast({"op": OP_ONLINE, "entry": entry}, exclude=writer)
+            writer.write(_encode({"op": OP_ACK, "seq": message["seq"], "ok": ok}))
+        elif op == OP_EVICT:
+            owned = self._entries.get(message["user_id"])
+            if owned is None:
+                self._reply(writer, message["seq"], True)  # 用户已下线
+            elif owned[0] is writer or owned[0].is_closing():
+                self._reply(writer, message["seq"], False)
+            else:
+                # 由用户所在的工作进程判断会话是否断开待恢复；它先发布 offline 再答复，
+                # 请求方收到 ack 时已删除该用户的副本，可以直接重新申请上线
+                evict_id = next(self._evict_ids)
+                self._evictions[evict_id] = (writer, message["seq"], owned[0])
+                owned[0].write(_encode({"op": OP_EVICT, "evict_id": evict_id, "user_id": message["user_id"]}))
+        elif op == OP_EVICTED:
+            pending = self._evictions.pop(message["evict_id"], None)
+            if pending is not None and pending[2] is writer:
+                self._reply(pending[0], pending[1], message["ok"])
+        elif op == OP_TAKEOVER:
+            user_id = message["user_id"]
+            owned = self._entries.get(user_id)
+            ok = (owned is not None and owned[0] is not writer and message.get("resume_id") is not None
+                  and self._resume_ids.get(user_id) == message["resume_id"])
+            if ok:
+                # 用户保持在线，其他工作进程无需感知；只通知原工作进程交出会话
+                self._entries[user_id] = (writer, owned[1])
+                if not owned[0].is_closing():
+                    owned[0].write(_encode({"op": OP_RELEASED, "entry": self._entry_message(owned[1])}))
+            writer.write(_encode({"op": OP_ACK, "seq": message["seq"], "ok": ok}))
+        elif op in (OP_UPDATE, OP_OFFLINE):
+            owned = self._entries.get(message["user_id"])
+            if owned is None or owned[0] is not writer:
+                return  # 只接受用户所在工作进程发来的变化
+            if op == OP_UPDATE:
+                owned[1]["ip"], owned[1]["port"] = message["ip"], message["port"]
+            else:
+                del self._entries[message["user_id"]]
+                self._resume_ids.pop(message["user_id"], None)
+            self._broadcast(message, exclude=writer)
+        elif op == OP_FRIENDSHIP:
+            uid1, uid2 = message["uid1"], message["uid2"]
+            for user_id, friend_id in ((uid1, uid2), (uid2, uid1)):
+                owned = self._entries.get(user_id)
+                if owned is None:
+                    continue
+                if message["added"]:
+                    owned[1]["friend_ids"].add(friend_id)
+                else:
+                    owned[1]["friend_ids"].discard(friend_id)
+            self._broadcast(message, exclude=writer)
+        elif op == OP_USER:
+            self._broadcast(message, exclude=writer)
+        else:
+            logger.warning(f"PresenceBroker: 收到未知消息: {op}")
+
+
+class PresenceBrokerClient:
+    """
+    工作进程到 PresenceBroker 的连接。
+    发送是线程安全的；后台线程读取 broker 转发的其他工作进程的变化，交给 handler(message) 处理。
+    与 broker 的连接断开时（broker 进程退出）向本进程发送 SIGTERM，使工作进程随之退出，
+    避免继续以不完整的在线状态提供服务。
+    """
+
+    def __init__(self, socket_path, handler, timeout=PRESENCE_BROKER_TIMEOUT):
+        self._handler = handler
+        self._timeout = timeout
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._send_lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._pending = {}  # {seq: Future}
+        self._pending_lock = threading.Lock()
+        self._closing = False
+        self._synced = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="presence-broker-client", daemon=True)
+        self._thread.start()
+        # 等待在线用户快照应用完成后再开始服务
+        if not self._synced.wait(timeout):
+            logger.warning("PresenceBrokerClient: 等待在线状态快照超时。")
+
+    def _send(self, message):
+        data = _encode(message)
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def _request(self, message):
+        """发送需要 broker 确认的请求，阻塞等待 ack。:return: ack 中的 ok；broker 无响应时抛出异常。"""
+        seq = next(self._seq)
+        future = Future()
+        with self._pending_lock:
+            self._pending[seq] = future
+        try:
+            self._send(dict(message, seq=seq))
+            return future.result(self._timeout)
+        finally:
+            with self._pending_lock:
+                self._pending.pop(seq, None)
+
+    def claim(self, entry, resume_id=None):
+        """
+        申请登记用户上线（阻塞等待 broker 的确认）。
+        :param resume_id: 本次登录的恢复ID，会话在其他工作进程上恢复时据此校验。
+        :return: True 申请成功；False 该用户已在某个工作进程中在线，或 broker 无响应。
+        """
+        try:
+            return self._request({"op": OP_CLAIM, "entry": entry_to_message(entry), "resume_id": resume_id})
+        except (OSError, FutureTimeoutError) as e:
+            logger.error(f"PresenceBrokerClient: 用户 {entry.username} 的上线申请失败: {e!r}")
+            return False
+
+    def takeover(self, user_id, resume_id):
+        """
+        把其他工作进程上的用户转移到本进程（会话恢复），阻塞等待 broker 的确认。
+        :return: True 转移成功；False 用户已下线、恢复ID不符，或 broker 无响应。
+        """
+        try:
+            return self._request({"op": OP_TAKEOVER, "user_id": user_id, "resume_id": resume_id})
+        except (OSError, FutureTimeoutError) as e:
+            logger.error(f"PresenceBrokerClient: 用户 {user_id} 的会话转移失败: {e!r}")
+            return False
+
+    def evict(self, user_id):
+        """
+        请用户所在的其他工作进程结束其断开待恢复的会话（用户凭密码重新登录），阻塞等待 broker 的确认。
+        :return: True 用户已下线（本进程中的副本也已删除）；False 用户确实在线，或 broker 无响应。
+        """
+        try:
+            return self._request({"op": OP_EVICT, "user_id": user_id})
+        except (OSError, FutureTimeoutError) as e:
+            logger.error(f"PresenceBrokerClient: 结束用户 {user_id} 的待恢复会话失败: {e!r}")
+            return False
+
+    def publish(self, op, **fields):
+        """把本进程的在线状态变化通知其他工作进程。失败只记录日志；关闭后（服务器退出时）直接忽略。"""
+        if self._closing:
+            return
+        try:
+            self._send(dict(fields, op=op))
+        except OSError as e:
+            logger.error(f"PresenceBrokerClient: 发送 {op} 消息失败: {e}")
+
+    def _run(self):
+        frame_reader = FrameReader(MAX_FRAME_SIZE)
+        try:
+            while True:
+                data = self._sock.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                for frame in frame_reader.feed(data):
+                    self._dispatch(json.loads(frame.decode('utf-8')))
+        except (OSError, ValueError) as e:
+            if not self._closing:
+                logger.error(f"PresenceBrokerClient: 读取 broker 消息时出错: {e}")
+        with self._pending_lock:
+            pending, self._pending = list(self._pending.values()), {}
+        for future in pending:
+            if not future.done():
+                future.set_result(False)
+        if not self._closing:
+            logger.critical("PresenceBrokerClient: 与 presence broker 的连接已断开，工作进程退出。")
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _dispatch(self, message):
+        op = message.get("op")
+        if op == OP_ACK:
+            with self._pending_lock:
+                future = self._pending.get(message["seq"])
+            if future is not None and not future.done():
+                future.set_result(message["ok"])
+        elif op == OP_SYNCED:
+            self._synced.set()
+        else:
+            try:
+                self._handler(message)
+            except Exception as e:
+                logger.error(f"PresenceBrokerClient: 处理 {op} 消息时出错: {e}", exc_info=True)
+
+    def close(self):
+        self._closing = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join(self._timeout)
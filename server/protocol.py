@@ -0,0 +1,148 @@
+"""
+客户端与服务器之间控制连接的分帧协议。
+
+旧协议：每次 recv() 得到的数据直接当作一条完整的 JSON 请求，超过缓冲区的响应会被截断，
+        同一个TCP段里的两条请求会被拼在一起而解析失败。
+新协议：每一帧 = 4字节大端无符号长度头 + 消息体。连接建立后客户端先用旧格式发送
+        {"command": "HELLO", "payload": {"framing": [...]}}，服务器以旧格式回复选中的分帧方式，
+        此后双方都改用分帧格式；不认识 HELLO 的旧服务器会回复“未知命令”，客户端继续使用旧协议，
+        不发送 HELLO 的旧客户端也照常工作。
+消息编码：HELLO 中客户端可以同时提供 "encodings"（按偏好排序，如 ["msgpack", "cbor", "json"]），
+        服务器选择第一个本机可用的，此后双方的分帧消息都使用该编码（HELLO 的请求和回复本身始终是 JSON）。
+        msgpack / cbor2 是可选依赖，都未安装时使用 JSON。
+        HELLO 中 "columnar": true 时，好友列表（GET_ONLINE_FRIENDS / GET_ALL_FRIENDS 的 data.friends）
+        以列式布局发送：{字段名: [各好友的值, ...]}，而不是每个好友一个重复字段名的字典。
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+FRAMING_LENGTH_PREFIXED = "length-prefixed-v1"
+SUPPORTED_FRAMINGS = (FRAMING_LENGTH_PREFIXED,)
+
+# 服务器主动推送的事件消息：{"event": <事件名>, "data": {...}}，没有 status 字段，以此与命令响应区分。
+# 事件只推送给已协商分帧协议的连接（旧协议一次 recv 即一条响应，无法区分主动推送的数据）。
+EVENT_PRESENCE_DELTA = "PRESENCE_DELTA"  # data: {"online": [好友信息, ...], "offline": [user_id, ...]}
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+ENCODING_CBOR = "cbor"
+
+# 本机可用的编码 -> (编码函数, 解码函数)，按服务器的偏好排序
+_CODECS = {}
+if msgpack is not None:
+    _CODECS[ENCODING_MSGPACK] = (lambda obj: msgpack.packb(obj, use_bin_type=True),
+                                 lambda data: msgpack.unpackb(data, raw=False))
+if cbor2 is not None:
+    _CODECS[ENCODING_CBOR] = (cbor2.dumps, cbor2.loads)
+_CODECS[ENCODING_JSON] = (lambda obj: json.dumps(obj, ensure_ascii=False).encode('utf-8'),
+                          lambda data: json.loads(data.decode('utf-8')))
+SUPPORTED_ENCODINGS = tuple(_CODECS)
+
+FRAME_HEADER = struct.Struct("!I")  # 4字节大端无符号整数，表示消息体长度
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+
+
+class FrameTooLargeError(ValueError):
+    """帧长度超过允许的最大值。"""
+
+
+class MessageDecodeError(ValueError):
+    """消息体不是所协商编码下的有效数据。"""
+
+
+def encode_frame(body_bytes):
+    """为消息体加上长度头。"""
+    return FRAME_HEADER.pack(len(body_bytes)) + body_bytes
+
+
+def choose_framing(offered):
+    """从客户端提供的分帧方式列表中选择服务器支持的第一个，没有则返回 None。"""
+    if isinstance(offered, str):
+        offered = [offered]
+    for framing in offered or ():
+        if framing in SUPPORTED_FRAMINGS:
+            return framing
+    return None
+
+
+def choose_encoding(offered):
+    """从客户端按偏好排序的编码列表中选择第一个本机可用的；没有提供或都不可用时使用 JSON。"""
+    if isinstance(offered, str):
+        offered = [offered]
+    for encoding in offered or ():
+        if encoding in _CODECS:
+            return encoding
+    return ENCODING_JSON
+
+
+def encode_message(message, encoding=ENCODING_JSON):
+    """按协商的编码序列化一条消息（字典），返回消息体字节。"""
+    return _CODECS[encoding][0](message)
+
+
+def decode_message(data, encoding=ENCODING_JSON):
+    """
+    按协商的编码解析一条消息体。
+    :raises MessageDecodeError: 数据无效。
+    """
+    try:
+        return _CODECS[encoding][1](data)
+    except ValueError as e:  # JSONDecodeError / UnicodeDecodeError / msgpack、cbor2 的格式错误都是 ValueError
+        raise MessageDecodeError(str(e)) from e
+
+
+def to_columns(rows):
+    """把字典列表转换为列式布局 {字段名: [值, ...]}；某行缺少的字段在该列中为 None。"""
+    keys = {}
+    for row in rows:
+        for key in row:
+            keys.setdefault(key)
+    return {key: [row.get(key) for row in rows] for key in keys}
+
+
+class FrameReader:
+    """
+    流式分帧读取器：不断喂入 recv() 得到的任意长度数据，返回其中已经完整的帧。
+    不完整的部分保留在内部缓冲区，等待后续数据拼接。
+    """
+
+    def __init__(self, max_frame_size):
+        self._max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        追加数据并取出所有完整的帧。
+        :param data: 新收到的字节数据。
+        :return: 完整帧消息体的列表（可能为空）。
+        :raises FrameTooLargeError: 帧头声明的长度超过上限。
+        """
+        self._buffer.extend(data)
+        frames = []
+        offset = 0
+        buffer_len = len(self._buffer)
+        while buffer_len - offset >= FRAME_HEADER_SIZE:
+            (body_len,) = FRAME_HEADER.unpack_from(self._buffer, offset)
+            if body_len > self._max_frame_size:
+                raise FrameTooLargeError(f"帧长度 {body_len} 超过上限 {self._max_frame_size}")
+            frame_end = offset + FRAME_HEADER_SIZE + body_len
+            if frame_end > buffer_len:
+                break
+            frames.append(bytes(self._buffer[offset + FRAME_HEADER_SIZE:frame_end]))
+            offset = frame_end
+        if offset:
+            del self._buffer[:offset]
+        return frames
+
+    def has_partial_frame(self):
+        """缓冲区中是否还有未完整的数据。"""
+        return bool(self._buffer)
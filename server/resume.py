@@ -0,0 +1,148 @@
+"""
+断线会话恢复（RESUME）。
+
+LOGIN 成功后服务器返回一个带 HMAC 签名的恢复令牌（resume token）。控制连接意外断开时，
+用户的在线状态不会立即清除，而是保留 RESUME_GRACE_PERIOD 秒（会话进入“断开待恢复”状态）；
+客户端在此期间重新连接并发送 RESUME 即可接管原来的在线状态，不需要再次校验密码、查询好友列表，
+也不会产生 OnlineStatus 的写入和好友端的下线/上线推送。超过宽限期仍未恢复时才按下线处理。
+
+- ResumeTokenSigner: 签发 / 校验令牌。令牌绑定用户ID和本次登录的恢复ID（每次 LOGIN 随机生成），
+  旧登录的令牌无法恢复新的登录；
+- DetachedSessions:  断开待恢复的会话表，后台线程在宽限期满时调用 on_expire(user_id, session)。
+"""
+import hashlib
+import heapq
+import hmac
+import logging
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def new_resume_id():
+    """为一次登录生成随机的恢复ID。"""
+    return secrets.token_hex(16)
+
+
+class ResumeTokenSigner:
+    """
+    恢复令牌的签发与校验。令牌格式为 "<user_id>.<resume_id>.<过期时间戳>.<HMAC-SHA256>"。
+    多进程模式下各工作进程必须使用同一个密钥，令牌才能在任一工作进程上恢复。
+    """
+
+    def __init__(self, secret, ttl):
+        """
+        :param secret: HMAC 密钥（bytes）。
+        :param ttl: 令牌自签发起的有效期（秒）。令牌只在会话断开后的宽限期内可用，有效期只是额外的上限。
+        """
+        self._secret = secret
+        self.ttl = ttl
+
+    def _sign(self, message):
+        return hmac.new(self._secret, message.encode('ascii'), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id, resume_id):
+        message = f"{user_id}.{resume_id}.{int(time.time() + self.ttl)}"
+        return f"{message}.{self._sign(message)}"
+
+    def verify(self, token):
+        """
+        校验令牌的签名和有效期。
+        :return: (user_id, resume_id)；令牌无效或已过期时返回 None。
+        """
+        if not isinstance(token, str) or not token.isascii():
+            return None
+        message, _, signature = token.rpartition(".")
+        if not hmac.compare_digest(self._sign(message), signature):
+            return None
+        try:
+            user_id, resume_id, expires = message.split(".")
+            user_id, expires = int(user_id), int(expires)
+        except ValueError:
+            return None
+        if expires < time.time():
+            return None
+        return user_id, resume_id
+
+
+class DetachedSessions:
+    """
+    断开待恢复的会话 {user_id: ClientSession}。
+    detach() 登记断开的会话，reattach() / discard() 在宽限期内取回（之后不再过期）；
+    宽限期满仍未取回的会话由后台线程交给 on_expire(user_id, session) 处理（在锁外调用）。
+    """
+
+    def __init__(self, grace_period, on_expire):
+        self.grace_period = grace_period
+        self._on_expire = on_expire
+        self._sessions = {}
+        self._deadlines = []  # 最小堆 [(到期时间, 序号, user_id, session)]，被取回的会话在到期时跳过
+        self._seq = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stopped = False
+        self._expired = 0
+        self._resumed = 0
+        self._thread = threading.Thread(target=self._run, name="detached-session-reaper", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._sessions)
+
+    def detach(self, user_id, session):
+        with self._cond:
+            self._sessions[user_id] = session
+            self._seq += 1
+            heapq.heappush(self._deadlines, (time.monotonic() + self.grace_period, self._seq, user_id, session))
+            self._cond.notify()
+
+    def reattach(self, user_id, session=None):
+        """
+        取回断开待恢复的会话。指定 session 时只有它仍是该用户的待恢复会话才取回。
+        :return: 取回的会话；不在表中（未断开、已过期或已被取回）时返回 None。
+        """
+        with self._cond:
+            detached = self._sessions.get(user_id)
+            if detached is None or (session is not None and detached is not session):
+                return None
+            del self._sessions[user_id]
+            self._resumed += 1
+            return detached
+
+    def discard(self, user_id):
+        """不经恢复直接取出用户断开待恢复的会话（用户凭密码重新登录时）。:return: 取出的会话或 None。"""
+        with self._cond:
+            return self._sessions.pop(user_id, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    timeout = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                _, _, user_id, session = heapq.heappop(self._deadlines)
+                if self._sessions.get(user_id) is not session:
+                    continue  # 已恢复，或同一用户又有了更新的待恢复会话
+                del self._sessions[user_id]
+                self._expired += 1
+            try:
+                self._on_expire(user_id, session)
+            except Exception as e:
+                logger.error(f"DetachedSessions: 清理用户 {user_id} 的过期会话时出错: {e}", exc_info=True)
+
+    def stats(self):
+        with self._cond:
+            return {"detached": len(self._sessions), "resumed": self._resumed, "expired": self._expired}
+
+    def stop(self, timeout=5.0):
+        """停止后台线程。服务器退出时仍待恢复的会话不再逐个清理（进程退出后在线状态随之消失）。"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout)
@@ -1,31 +1,181 @@
+import secrets
 import socket
 import threading
-import json
+import time
 import logging
 
 
-from db import DatabaseManager
-from config import SERVER_HOST, SERVER_PORT, BUFFER_SIZE
+from storage import create_storage
+from presence import PresenceRegistry, PresenceEntry, PresenceWriter
+from presence_broker import PresenceBrokerClient, entry_from_message, OP_ONLINE, OP_UPDATE, OP_OFFLINE, \
+    OP_FRIENDSHIP, OP_USER, OP_RELEASED, OP_EVICT, OP_EVICTED
+from user_index import UsernameIndex
+from password_hasher import PasswordHasher
+from metrics import ChatServerMetrics, MetricsHTTPServer, instrument_storage
+from admission import TokenBucket, KeyedRateLimiter, ConcurrencyLimiter, ConnectionLimiter, REASON_RATE_LIMITED, \
+    REASON_BUSY, REASON_TOO_MANY_CONNECTIONS
+from resume import ResumeTokenSigner, DetachedSessions, new_resume_id
+from friend_log import FriendChangeLog
+from config import SERVER_HOST, SERVER_PORT, BUFFER_SIZE, SERVER_BACKLOG, MAX_FRAME_SIZE, \
+    SEARCH_USERS_DEFAULT_LIMIT, SEARCH_USERS_MAX_LIMIT, LIST_PAGE_DEFAULT_LIMIT, LIST_PAGE_MAX_LIMIT, \
+    KNOWN_KEY_FINGERPRINTS_MAX, METRICS_HOST, METRICS_PORT, CONNECTION_RATE_LIMIT, CONNECTION_RATE_BURST, \
+    USER_RATE_LIMIT, USER_RATE_BURST, LOGIN_ATTEMPT_RATE_LIMIT, LOGIN_ATTEMPT_BURST, DB_MAX_CONCURRENT_OPERATIONS, \
+    DB_MAX_QUEUED_OPERATIONS, DB_QUEUE_TIMEOUT, BUSY_RETRY_AFTER, MAX_CONNECTIONS, CONNECTION_OVERFLOW_POLICY, \
+    CONNECTION_QUEUE_TIMEOUT, RESUME_GRACE_PERIOD, RESUME_TOKEN_TTL, RESUME_TOKEN_SECRET
+from protocol import FrameReader, FrameTooLargeError, encode_frame, choose_framing, SUPPORTED_FRAMINGS, \
+    EVENT_PRESENCE_DELTA, ENCODING_JSON, choose_encoding, encode_message, decode_message, MessageDecodeError, \
+    to_columns
 
 logger = logging.getLogger(__name__)
 
+
+class ClientSession:
+    """
+    单个客户端控制连接的会话状态。
+    与具体的I/O模型（每连接一个线程 / asyncio事件循环）无关，命令处理逻辑只通过它读写登录状态和发送数据。
+    """
+
+    def __init__(self, client_address, send_func, rate_limiter=None):
+        """
+        :param client_address: 客户端地址 (ip, port)。
+        :param send_func: 实际发送字节数据的函数，由具体的服务器实现提供。
+        :param rate_limiter: 本连接的请求限流令牌桶（admission.TokenBucket），为 None 时不限流。
+        """
+        self.client_address = client_address
+        self.rate_limiter = rate_limiter
+        self.user_id = None  # 当前连接上登录的用户ID
+        self.username = None  # 当前连接上登录的用户名
+        self.resume_id = None  # 本次登录的恢复ID（恢复令牌绑定该ID，RESUME 后沿用）
+        self.framed = False  # 是否已通过 HELLO 协商为长度前缀分帧协议
+        # 是否已协商请求流水线：请求携带 request_id，响应原样带回，同一连接上的请求可以并发处理、乱序返回
+        self.pipelined = False
+        self.encoding = ENCODING_JSON  # HELLO 中协商的分帧消息编码（json / msgpack / cbor）
+        self.columnar = False  # 是否以列式布局发送好友列表
+        # 客户端已持有的公钥指纹（客户端声明的 + 本连接上已发送过的），向其发送好友信息时不再重复发送这些PEM
+        self.known_key_fingerprints = set()
+        self._send_func = send_func
+        self._send_lock = threading.Lock()  # 保证同一连接上的多次发送不会交错
+
+    def send(self, data_bytes):
+        """线程安全地向客户端发送原始字节数据。"""
+        with self._send_lock:
+            self._send_func(data_bytes)
+
+    def remember_key_fingerprints(self, fingerprints):
+        """记录客户端声明已缓存的公钥指纹（最多 KNOWN_KEY_FINGERPRINTS_MAX 个）。"""
+        if not isinstance(fingerprints, list):
+            return
+        room = KNOWN_KEY_FINGERPRINTS_MAX - len(self.known_key_fingerprints)
+        self.known_key_fingerprints.update(fp for fp in fingerprints[:max(0, room)] if isinstance(fp, str))
+
+    def friend_info(self, entry):
+        """生成发送给本连接的好友信息：客户端已持有该公钥时只带指纹。"""
+        fingerprint = entry.public_key_fingerprint
+        info = entry.to_friend_info(include_key=fingerprint not in self.known_key_fingerprints)
+        self.known_key_fingerprints.add(fingerprint)
+        return info
+
+
 class SecureChatServer:
-    def __init__(self):
-        self.db_manager = DatabaseManager()
+    # 需要计算密码哈希的命令，处理时会长时间等待密码哈希进程池
+    AUTH_COMMANDS = frozenset({"LOGIN", "REGISTER"})
+    # 服务器认识的全部命令（指标按命令统计时只使用这些名称）
+    KNOWN_COMMANDS = frozenset({"HELLO", "REGISTER", "LOGIN", "LOGOUT", "GET_ONLINE_FRIENDS", "GET_ALL_FRIENDS",
+                                "ADD_FRIEND", "REMOVE_FRIEND", "GET_PUBLIC_KEY", "UPDATE_P2P_INFO", "GET_ALL_USERS",
+                                "SEARCH_USERS", "RESUME", "SYNC_FRIENDS"})
+    # 同步访问数据库的命令，受全局 DB 操作并发/排队上限（db_limiter）约束；其余命令只读写内存
+    DB_COMMANDS = frozenset({"REGISTER", "LOGIN", "GET_ALL_FRIENDS", "ADD_FRIEND", "REMOVE_FRIEND", "GET_PUBLIC_KEY",
+                             "GET_ALL_USERS"})
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, backlog=SERVER_BACKLOG, db_manager=None,
+                 presence_broker_path=None, metrics_port=METRICS_PORT, rate_limits=True,
+                 max_connections=MAX_CONNECTIONS, connection_policy=CONNECTION_OVERFLOW_POLICY,
+                 resume_grace_period=RESUME_GRACE_PERIOD, resume_secret=None):
+        """
+        :param db_manager: 存储后端（storage.StorageBackend），默认按 config.DB_BACKEND 创建。
+        :param metrics_port: Prometheus 指标端点的本地端口，为 0 或 None 时不启动指标端点。
+        :param rate_limits: 是否启用按连接/用户/登录用户名的令牌桶限流（测量服务器极限吞吐量的基准测试会关闭）。
+        :param max_connections: 最大客户端连接数；connection_policy 为超出时的策略（"reject" / "queue"）。
+        :param resume_grace_period: 连接断开后保留在线状态、等待 RESUME 的秒数，为 0 时断开即下线。
+        :param resume_secret: 恢复令牌的签名密钥（bytes），默认取 config.RESUME_TOKEN_SECRET，为空时随机生成。
+        :param presence_broker_path: 多进程模式下 presence broker 的 Unix 域套接字路径。
+            指定时监听端口以 SO_REUSEPORT 与其他工作进程共享，在线状态经 broker 与其他工作进程同步。
+        """
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.db_manager = db_manager or create_storage()
+        self.metrics = ChatServerMetrics(self.KNOWN_COMMANDS)
+        instrument_storage(self.db_manager, self.metrics)
+        self.metrics_port = metrics_port
+        self.metrics_server = None  # 在 start() 中启动
+        # 准入控制：过载时快速拒绝（响应中带 retry_after），而不是耗尽线程和数据库连接
+        self.rate_limits = rate_limits
+        self.user_rate_limiter = KeyedRateLimiter(USER_RATE_LIMIT, USER_RATE_BURST)
+        self.login_rate_limiter = KeyedRateLimiter(LOGIN_ATTEMPT_RATE_LIMIT, LOGIN_ATTEMPT_BURST)
+        self.db_limiter = ConcurrencyLimiter(DB_MAX_CONCURRENT_OPERATIONS, DB_MAX_QUEUED_OPERATIONS, DB_QUEUE_TIMEOUT)
+        self.connection_limiter = ConnectionLimiter(max_connections, connection_policy, CONNECTION_QUEUE_TIMEOUT)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.online_sessions = {}  # {user_id: client_socket}
-        self.session_lock = threading.Lock()  # 用于保护 online_sessions
+        if presence_broker_path:
+            # 多个工作进程绑定同一端口，由内核在它们之间分配新连接
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # 在线状态以内存注册表为准，OnlineStatus 表只由后台线程异步写入
+        self.presence = PresenceRegistry()  # {user_id: PresenceEntry}
+        self.presence_writer = PresenceWriter(self.db_manager)
+        # 断线会话恢复：断开的会话保留 resume_grace_period 秒，期满后才下线
+        self.resume_signer = ResumeTokenSigner(
+            resume_secret or RESUME_TOKEN_SECRET.encode('utf-8') or secrets.token_bytes(32), RESUME_TOKEN_TTL)
+        self.resume_grace_period = resume_grace_period
+        self.detached_sessions = DetachedSessions(resume_grace_period, self._expire_detached_session)
+        self._session_lock = threading.Lock()  # 串行化会话的断开、恢复和被其他连接接管
+        # 本进程上已登录用户的好友变更日志，SYNC_FRIENDS 据此只返回客户端上次同步之后的变化
+        self.friend_log = FriendChangeLog()
+        if not presence_broker_path:
+            # 丢弃上次运行遗留的在线记录（多进程模式下由主进程在启动工作进程前清理一次）
+            self.db_manager.clear_all_online_status()
+        # 用户名搜索索引，启动时加载一次，之后随 REGISTER 增量更新
+        self.user_index = UsernameIndex()
+        self.user_index.load(self.db_manager.iter_all_users_info())
+        self.password_hasher = PasswordHasher()  # 密码哈希在独立的进程池中计算
+        self.metrics.attach(self)
+        # 最后连接 broker：连接时会收到其他工作进程的在线用户快照，需要注册表和索引已经就绪
+        self.presence_broker = (PresenceBrokerClient(presence_broker_path, self._handle_broker_message)
+                                if presence_broker_path else None)
         logger.info("SecureChatServer: 服务器初始化完成。")
 
-    def start(self):
+    def _start_metrics_server(self):
+        """启动指标 HTTP 端点。端口不可用时只记录错误，服务器照常运行。"""
+        if not self.metrics_port:
+            return
         try:
-            self.server_socket.bind((SERVER_HOST, SERVER_PORT))
-            self.server_socket.listen(5)  # 最多5个待处理连接
-            logger.info(f"SecureChatServer: 服务器正在监听 {SERVER_HOST}:{SERVER_PORT}")
+            self.metrics_server = MetricsHTTPServer(self.metrics.registry, METRICS_HOST, self.metrics_port)
+            self.metrics_server.start()
+        except OSError as e:
+            logger.error(f"SecureChatServer: 无法在 {METRICS_HOST}:{self.metrics_port} 启动指标端点: {e}")
 
+    def _stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+
+    def start(self):
+        try:
+            self.server_socket.bind((self.host, self.port))
+            self._start_metrics_server()
+            self.server_socket.listen(self.backlog)
+            logger.info(f"SecureChatServer: 服务器正在监听 {self.host}:{self.port} (backlog={self.backlog}, "
+                        f"最大连接数={self.connection_limiter.max_connections}, "
+                        f"超出策略={self.connection_limiter.policy})")
+
+            queue_policy = self.connection_limiter.policy == "queue"
             while True:
+                if queue_policy:
+                    # 连接数已满时暂停 accept，新连接留在内核的 listen 队列中，直到有连接关闭
+                    self.connection_limiter.acquire()
                 client_socket, client_address = self.server_socket.accept()
+                if not queue_policy and not self.connection_limiter.try_acquire():
+                    self._reject_connection(client_socket, client_address)
+                    continue
                 logger.info(f"SecureChatServer: 收到来自 {client_address} 的新连接。")
                 client_thread = threading.Thread(target=self._handle_client, args=(client_socket, client_address))
                 client_thread.daemon = True  # 允许主程序在线程仍在运行时退出
@@ -40,266 +190,814 @@ class SecureChatServer:
                     logger.info("SecureChatServer: 服务器socket已关闭。")
                 except socket.error as e:
                     logger.error(f"SecureChatServer: 关闭服务器socket时出错: {e}", exc_info=True)
+            self._stop_metrics_server()
+            if self.presence_broker:
+                self.presence_broker.close()
+            self.detached_sessions.stop()
+            self.presence_writer.stop()
+            self.password_hasher.close()
+            self.db_manager.close()
             logger.info("SecureChatServer: 服务器已关闭。")
 
-    def _send_response(self, client_socket, status, message, data=None):
-        """向客户端发送标准化的JSON响应。"""
+    def _make_response(self, status, message, data=None):
+        """构造标准化的响应字典。"""
         response = {"status": status, "message": message}
         if data:
             response["data"] = data
+        return response
+
+    def _make_overload_response(self, reason, retry_after):
+        """构造过载拒绝响应：data.reason 为拒绝原因，data.retry_after 为建议客户端等待的秒数。"""
+        self.metrics.observe_rejection(reason)
+        messages = {
+            REASON_RATE_LIMITED: "请求过于频繁，请稍后重试。",
+            REASON_BUSY: "服务器繁忙，请稍后重试。",
+            REASON_TOO_MANY_CONNECTIONS: "服务器连接数已满，请稍后重试。",
+        }
+        return self._make_response("error", messages[reason],
+                                   data={"reason": reason, "retry_after": round(retry_after, 3)})
+
+    def _make_rate_limiter(self):
+        """为新连接创建请求限流令牌桶；未启用限流时返回 None。"""
+        return TokenBucket(CONNECTION_RATE_LIMIT, CONNECTION_RATE_BURST) if self.rate_limits else None
+
+    def _reject_connection(self, client_socket, client_address):
+        """连接数已满：以旧协议格式（客户端尚未发送 HELLO）回复拒绝原因后立即关闭连接。"""
+        logger.warning(f"SecureChatServer: 连接数已达上限 {self.connection_limiter.max_connections}，"
+                       f"拒绝来自 {client_address} 的连接。")
+        response = self._make_overload_response(REASON_TOO_MANY_CONNECTIONS, BUSY_RETRY_AFTER)
         try:
-            client_socket.sendall(json.dumps(response, ensure_ascii=False).encode('utf-8'))
-            logger.debug(f"SecureChatServer: 已向客户端发送响应: status={status}, message={message}, data={data}")
+            client_socket.settimeout(1.0)
+            client_socket.sendall(self._encode_response(response, framed=False))
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def _parse_page_params(self, payload):
+        """
+        解析列表类命令的游标分页参数。
+        :return: (after_user_id, limit)；参数无效时抛出 ValueError。
+        """
+        after_user_id = int(payload.get("after_user_id") or 0)
+        limit = int(payload.get("limit", LIST_PAGE_DEFAULT_LIMIT))
+        if after_user_id < 0 or limit < 1:
+            raise ValueError("分页参数超出范围")
+        return after_user_id, min(limit, LIST_PAGE_MAX_LIMIT)
+
+    def _make_page_data(self, key, items, limit, columnar=False):
+        """
+        构造分页响应数据：本页结果 + 下一页的游标（已是最后一页时为 None）。
+        :param columnar: 为 True 时本页结果以列式布局 {字段名: [值, ...]} 发送。
+        """
+        next_after_user_id = items[-1]["user_id"] if len(items) >= limit else None
+        return {key: to_columns(items) if columnar else items, "next_after_user_id": next_after_user_id}
+
+    def _make_friend_sync_data(self, session, version, member_ids, presence_ids, full):
+        """
+        构造 SYNC_FRIENDS 的响应数据，内容均取自当前的内存状态。
+        :param member_ids: 需要发送好友记录（与 GET_ALL_FRIENDS 的条目相同）的好友ID。
+        :param presence_ids: 需要发送在线状态的好友ID：在线的放入 online（与 GET_ONLINE_FRIENDS 的条目相同），
+            其余的放入 offline（完整快照不发送 offline）。
+        """
+        friends = []
+        for fid in member_ids:
+            entry = self.presence.get(fid)
+            friends.append({"user_id": fid,
+                            "username": self.user_index.get_username(fid) or (entry.username if entry else None),
+                            "ip_address": entry.ip if entry else None,
+                            "p2p_port": entry.port if entry else None})
+        online, offline = [], []
+        for fid in presence_ids:
+            entry = self.presence.get(fid)
+            if entry is not None:
+                online.append(session.friend_info(entry))
+            else:
+                offline.append(fid)
+        data = {"version": version, "full": full,
+                "friends": to_columns(friends) if session.columnar else friends,
+                "online": to_columns(online) if session.columnar else online}
+        if not full:
+            data["offline"] = offline
+        return data
+
+    def _encode_response(self, response, framed, encoding=ENCODING_JSON):
+        """
+        将响应字典序列化为发送到网络上的字节；framed 为 True 时按协商的编码序列化并加上长度头，
+        旧协议（包括 HELLO 的回复）始终是 JSON。
+        """
+        if not framed:
+            return encode_message(response)
+        return encode_frame(encode_message(response, encoding))
+
+    def _encode_event(self, event, data, encoding=ENCODING_JSON):
+        """将服务器推送事件序列化为分帧格式的字节（事件只推送给分帧协议的连接）。"""
+        return encode_frame(encode_message({"event": event, "data": data}, encoding))
+
+    def _push_event(self, session, event_bytes):
+        """向一个连接推送事件。失败只记录日志，连接的清理由其自身的处理程序负责。"""
+        if not session.framed:
+            return False
+        try:
+            session.send(event_bytes)
+            return True
+        except (ConnectionError, OSError) as e:
+            logger.debug(f"SecureChatServer: 向 {session.client_address} 推送事件失败: {e}")
+            return False
+
+    def _broadcast_presence(self, entry, online):
+        """用户上线/下线/更新P2P信息后，向其所有在线好友推送 PRESENCE_DELTA 事件。"""
+        # 按接收方是否已持有该公钥、以及连接协商的编码分别编码，每种组合只编码一次
+        encoded = {}
+        pushed = 0
+        for friend in self.presence.get_online_friends_of(entry):
+            session = friend.session
+            if session is None:
+                continue  # 连接在其他工作进程上的好友由该进程推送
+            self.friend_log.record(friend.user_id, entry.user_id)
+            include_key = online and entry.public_key_fingerprint not in session.known_key_fingerprints
+            event_bytes = encoded.get((include_key, session.encoding))
+            if event_bytes is None:
+                if online:
+                    delta = {"online": [entry.to_friend_info(include_key=include_key)]}
+                else:
+                    delta = {"offline": [entry.user_id]}
+                event_bytes = encoded[include_key, session.encoding] = self._encode_event(
+                    EVENT_PRESENCE_DELTA, delta, session.encoding)
+            if self._push_event(session, event_bytes):
+                if online:
+                    session.known_key_fingerprints.add(entry.public_key_fingerprint)
+                pushed += 1
+        logger.debug(f"SecureChatServer: 已向用户 {entry.username} 的 {pushed} 个在线好友推送状态变化 "
+                     f"({'上线' if online else '下线'})。")
+
+    def _push_friendship_change(self, uid1, uid2, added):
+        """好友关系变化后，记录到双方（如果在本进程上登录）的好友变更日志，并向双方（如果在线）推送对方的在线状态。"""
+        self.friend_log.record(uid1, uid2, membership=True)
+        self.friend_log.record(uid2, uid1, membership=True)
+        entry1 = self.presence.get(uid1)
+        entry2 = self.presence.get(uid2)
+        if entry1 is None or entry2 is None:
+            return
+        for receiver, subject in ((entry1, entry2), (entry2, entry1)):
+            if receiver.session is None or not receiver.session.framed:
+                continue
+            delta = {"online": [receiver.session.friend_info(subject)]} if added else {"offline": [subject.user_id]}
+            self._push_event(receiver.session,
+                             self._encode_event(EVENT_PRESENCE_DELTA, delta, receiver.session.encoding))
+
+    def _send_response(self, session, response, framed):
+        """向客户端发送标准化的JSON响应。"""
+        try:
+            session.send(self._encode_response(response, framed, session.encoding))
+            logger.debug(f"SecureChatServer: 已向客户端发送响应: status={response.get('status')}, "
+                         f"message={response.get('message')}, data={response.get('data')}")
         except socket.error as e:
             logger.error(f"SecureChatServer: 向客户端发送响应时出错: {e}", exc_info=True)
 
     def _handle_client(self, client_socket, client_address):
         logger.info(f"SecureChatServer: 客户端处理线程为 {client_address} 启动。")
-        logged_in_user_id = None
-        logged_in_username = None
+
+        def send_counted(data_bytes):
+            client_socket.sendall(data_bytes)
+            self.metrics.add_sent_bytes(len(data_bytes))
+
+        session = ClientSession(client_address, send_counted, self._make_rate_limiter())
+        frame_reader = FrameReader(MAX_FRAME_SIZE)
+        self.metrics.session_opened()
 
         try:
             while True:
-                data = client_socket.recv(BUFFER_SIZE).decode('utf-8')
+                data = client_socket.recv(BUFFER_SIZE)
                 if not data:
-                    # 客户端断开连接，但只有在用户已登录时才清除在线状态
-                    if logged_in_user_id is not None:
-                        self.db_manager.clear_online_status(logged_in_user_id)
-                        logger.info(f"SecureChatServer: 客户端 {client_address} 断开连接，已清除用户 {logged_in_username} (ID: {logged_in_user_id}) 的在线状态。")
-                    else:
-                        logger.info(f"SecureChatServer: 客户端 {client_address} 断开连接，用户未登录。")
+                    logger.info(f"SecureChatServer: 客户端 {client_address} 断开连接。")
                     break
+                self.metrics.add_received_bytes(len(data))
 
-                try:
-                    request = json.loads(data)
-                    command = request.get("command")
-                    payload = request.get("payload", {})
-                    logger.info(f"SecureChatServer: 收到来自 {client_address} 的命令: {command}")
-                    logger.debug(f"SecureChatServer: 收到命令Payload: {payload}")
-
-                    if command == "REGISTER":
-                        username = payload.get("username")
-                        password = payload.get("password")
-                        public_key = payload.get("public_key")
-
-                        if not (username and password and public_key):
-                            self._send_response(client_socket, "error", "缺少用户名、密码或公钥。")
-                            logger.warning(f"SecureChatServer: 注册请求缺少必要参数来自 {client_address}")
-                            continue
-
-                        if self.db_manager.register_user(username, password, public_key):
-                            self._send_response(client_socket, "success", "注册成功。")
-                            logger.info(f"SecureChatServer: 用户 {username} 已注册。")
-                        else:
-                            self._send_response(client_socket, "error", "注册失败，用户名可能已存在。")
-                            logger.warning(f"SecureChatServer: 用户 {username} 注册失败，可能已存在。")
-
-                    elif command == "LOGIN":
-                        username = payload.get("username")
-                        password = payload.get("password")
-                        client_p2p_ip = payload.get("p2p_ip", client_address[0])
-                        client_p2p_port = payload.get("p2p_port")
-
-                        if not (username and password and client_p2p_port is not None):
-                            self._send_response(client_socket, "error", "缺少用户名、密码或P2P端口。")
-                            logger.warning(f"SecureChatServer: 登录请求缺少必要参数来自 {client_address}")
-                            continue
-
-                        user_id, public_key = self.db_manager.authenticate_user(username, password)
-                        if user_id:
-                            with self.session_lock:
-                                if user_id in self.online_sessions:
-                                    self._send_response(client_socket, "error", "用户已登录。")
-                                    logger.warning(f"SecureChatServer: 用户 {username} 尝试重复登录。")
-                                    continue
-
-                                self.online_sessions[user_id] = client_socket  # 存储控制连接的socket
-
-                            self.db_manager.set_online_status(user_id, client_p2p_ip, client_p2p_port)
-                            logged_in_user_id = user_id
-                            logged_in_username = username
-                            self._send_response(client_socket, "success", "登录成功。",
-                                                data={"username": username, "user_id": user_id,
-                                                      "public_key": public_key})
-                            logger.info(f"SecureChatServer: 用户 {username} (ID: {user_id}) 从 {client_address} 登录。")
-                        else:
-                            self._send_response(client_socket, "error", "用户名或密码无效。")
-                            logger.warning(f"SecureChatServer: 用户 {username} 登录失败，凭据无效。")
-
-                    elif command == "LOGOUT":
-                        if logged_in_user_id:
-                            # 先记录用户信息，再清除
-                            user_id_to_logout = logged_in_user_id
-                            username_to_logout = logged_in_username
-                            
-                            self.db_manager.clear_online_status(logged_in_user_id)
-                            with self.session_lock:
-                                if logged_in_user_id in self.online_sessions:
-                                    del self.online_sessions[logged_in_user_id]
-                            self._send_response(client_socket, "success", "登出成功。")
-                            logger.info(f"SecureChatServer: 用户 {username_to_logout} (ID: {user_id_to_logout}) 已登出。")
-                            
-                            # 清除登录状态
-                            logged_in_user_id = None
-                            logged_in_username = None
-                        else:
-                            self._send_response(client_socket, "error", "未登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试登出，来自 {client_address}。")
-
-                    elif command == "GET_ONLINE_FRIENDS":
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试获取在线好友列表，来自 {client_address}。")
-                            continue
-
-                        online_friends_list = self.db_manager.get_online_friends_info(logged_in_user_id)
-                        self._send_response(client_socket, "success", "在线好友已检索。",
-                                            data={"friends": online_friends_list})
-                        logger.info(f"SecureChatServer: 向 {logged_in_username} 提供了 {len(online_friends_list)} 个在线好友列表。")
-
-                    elif command == "GET_ALL_FRIENDS":
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试获取所有好友列表，来自 {client_address}。")
-                            continue
-
-                        all_friends_list = self.db_manager.get_all_friends_info(logged_in_user_id)
-                        self._send_response(client_socket, "success", "所有好友已检索。",
-                                            data={"friends": all_friends_list})
-                        logger.info(
-                            f"SecureChatServer: 向 {logged_in_username} 提供了 {len(all_friends_list)} 个所有好友列表。")
-
-
-                    elif command == "ADD_FRIEND":
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试添加好友，来自 {client_address}。")
-                            continue
-
-                        friend_username_to_add = payload.get("friend_username")
-                        if not friend_username_to_add:
-                            self._send_response(client_socket, "error", "缺少好友用户名。")
-                            logger.warning(f"SecureChatServer: 添加好友请求缺少用户名来自 {logged_in_username}。")
-                            continue
-
-                        friend_id_to_add = self.db_manager.get_user_id(friend_username_to_add)
-                        if not friend_id_to_add:
-                            self._send_response(client_socket, "error", f"用户 '{friend_username_to_add}' 不存在。")
-                            logger.warning(f"SecureChatServer: 用户 {logged_in_username} 尝试添加不存在的用户 {friend_username_to_add}。")
-                        elif friend_id_to_add == logged_in_user_id:
-                            self._send_response(client_socket, "error", "不能添加自己为好友。")
-                            logger.warning(f"SecureChatServer: 用户 {logged_in_username} 尝试添加自己为好友。")
-                        elif self.db_manager.add_friendship(logged_in_user_id, friend_id_to_add):
-                            self._send_response(client_socket, "success",
-                                                f"'{friend_username_to_add}' 已添加到您的好友列表。")
-                            logger.info(f"SecureChatServer: 用户 {logged_in_username} 添加 {friend_username_to_add} (ID: {friend_id_to_add}) 为好友成功。")
-                        else:
-                            self._send_response(client_socket, "error",
-                                                f"无法添加 '{friend_username_to_add}' 为好友 (可能已经是好友)。")
-                            logger.warning(f"SecureChatServer: 用户 {logged_in_username} 无法添加 {friend_username_to_add} 为好友，可能已是好友。")
-
-                    elif command == "REMOVE_FRIEND":
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试删除好友，来自 {client_address}。")
-                            continue
-
-                        friend_username_to_remove = payload.get("friend_username")
-                        if not friend_username_to_remove:
-                            self._send_response(client_socket, "error", "缺少要删除的好友用户名。")
-                            logger.warning(f"SecureChatServer: 删除好友请求缺少用户名来自 {logged_in_username}。")
-                            continue
-
-                        friend_id_to_remove = self.db_manager.get_user_id(friend_username_to_remove)
-                        if not friend_id_to_remove:
-                            self._send_response(client_socket, "error", f"用户 '{friend_username_to_remove}' 不存在。")
-                            logger.warning(f"SecureChatServer: 用户 {logged_in_username} 尝试删除不存在的用户 {friend_username_to_remove}。")
-                        elif self.db_manager.remove_friendship(logged_in_user_id, friend_id_to_remove):
-                            self._send_response(client_socket, "success",
-                                                f"'{friend_username_to_remove}' 已从您的好友列表中移除。")
-                            logger.info(f"SecureChatServer: 用户 {logged_in_username} 成功移除了 {friend_username_to_remove} (ID: {friend_id_to_remove})。")
-                        else:
-                            self._send_response(client_socket, "error",
-                                                f"无法移除 '{friend_username_to_remove}' (可能不是好友)。")
-                            logger.warning(f"SecureChatServer: 用户 {logged_in_username} 无法移除 {friend_username_to_remove}，可能不是好友。")
-
-                    elif command == "GET_PUBLIC_KEY":
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试获取公钥，来自 {client_address}。")
-                            continue
-
-                        target_username = payload.get("username")
-                        if not target_username:
-                            self._send_response(client_socket, "error", "缺少目标用户名。")
-                            logger.warning(f"SecureChatServer: 获取公钥请求缺少用户名来自 {logged_in_username}。")
-                            continue
-
-                        public_key = self.db_manager.get_public_key(target_username)
-                        if public_key:
-                            self._send_response(client_socket, "success", f"已检索到 {target_username} 的公钥。",
-                                                data={"public_key": public_key})
-                            logger.info(f"SecureChatServer: 向 {logged_in_username} 提供了 {target_username} 的公钥。")
-                        else:
-                            self._send_response(client_socket, "error", f"未找到 {target_username} 的公钥。")
-                            logger.warning(f"SecureChatServer: 未找到用户 {target_username} 的公钥，请求来自 {logged_in_username}。")
-
-                    elif command == "UPDATE_P2P_INFO":  # 客户端更新其P2P监听信息
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试更新P2P信息，来自 {client_address}。")
-                            continue
-
-                        new_p2p_ip = payload.get("p2p_ip", client_address[0])
-                        new_p2p_port = payload.get("p2p_port")
-
-                        if new_p2p_port is None:
-                            self._send_response(client_socket, "error", "缺少新的P2P端口。")
-                            logger.warning(f"SecureChatServer: 更新P2P信息请求缺少P2P端口来自 {logged_in_username}。")
-                            continue
-
-                        if self.db_manager.set_online_status(logged_in_user_id, new_p2p_ip, new_p2p_port):
-                            self._send_response(client_socket, "success", "P2P信息更新成功。")
-                            logger.info(f"SecureChatServer: 用户 {logged_in_username}'s P2P信息已更新为 {new_p2p_ip}:{new_p2p_port}。")
-                        else:
-                            self._send_response(client_socket, "error", "更新P2P信息失败。")
-                            logger.error(f"SecureChatServer: 用户 {logged_in_username} 更新P2P信息失败。")
-
-                    elif command == "GET_ALL_USERS":  # 额外功能：获取所有用户，方便查找好友
-                        if not logged_in_user_id:
-                            self._send_response(client_socket, "error", "请先登录。")
-                            logger.warning(f"SecureChatServer: 未登录用户尝试获取所有用户列表，来自 {client_address}。")
-                            continue
-                        all_users = self.db_manager.get_all_users_info()
-                        self._send_response(client_socket, "success", "所有用户已检索。", data={"users": all_users})
-                        logger.info(f"SecureChatServer: 向 {logged_in_username} 提供了所有注册用户列表。")
-
-                    else:
-                        self._send_response(client_socket, "error", "未知命令。")
-                        logger.warning(f"SecureChatServer: 收到来自 {client_address} 的未知命令: {command}")
-
-                except json.JSONDecodeError:
-                    self._send_response(client_socket, "error", "无效的JSON格式。")
-                    logger.error(f"SecureChatServer: 收到来自 {client_address} 的无效JSON格式数据: {data}", exc_info=True)
-                except Exception as e:
-                    logger.error(f"SecureChatServer: 处理来自 {client_address} 的客户端请求时出错: {e}", exc_info=True)
-                    self._send_response(client_socket, "error", f"服务器内部错误: {str(e)}")
+                if not session.framed:
+                    # 旧协议：一次 recv 即一条请求。响应使用请求到达时的协议格式，HELLO 的回复因此仍是旧格式
+                    response = self._process_request_data(session, data)
+                    self._send_response(session, response, framed=False)
+                    continue
+
+                for frame in frame_reader.feed(data):
+                    response = self._process_request_data(session, frame)
+                    self._send_response(session, response, framed=True)
 
+        except FrameTooLargeError as e:
+            logger.warning(f"SecureChatServer: 客户端 {client_address} 发送了超长的帧，关闭连接: {e}")
+            self._send_response(session, self._make_response("error", "请求过大。"), framed=True)
         except Exception as e:
             logger.error(f"SecureChatServer: 客户端 {client_address} 处理程序发生错误: {e}", exc_info=True)
         finally:
-            # 只有在用户ID不为None时才清除在线状态（避免重复清除）
-            if logged_in_user_id is not None:
-                # 客户端断开连接时清除在线状态
-                self.db_manager.clear_online_status(logged_in_user_id)
-                with self.session_lock:
-                    if logged_in_user_id in self.online_sessions:
-                        del self.online_sessions[logged_in_user_id]
-                logger.info(f"SecureChatServer: 已清理用户 {logged_in_username} (ID: {logged_in_user_id}) 的会话并更新离线状态。")
-            else:
-                logger.debug(f"SecureChatServer: 客户端 {client_address} 断开连接，但用户已登出，无需清理在线状态。")
+            self._cleanup_session(session)
+            self.metrics.session_closed()
             try:
                 client_socket.close()
             except socket.error as e:
                 logger.warning(f"SecureChatServer: 关闭客户端socket {client_address} 时出错: {e}", exc_info=True)
-            logger.info(f"SecureChatServer: 与 {client_address} 的连接已关闭。")
\ No newline at end of file
+            self.connection_limiter.release()
+            logger.info(f"SecureChatServer: 与 {client_address} 的连接已关闭。")
+
+    def _cleanup_session(self, session):
+        """
+        连接关闭时清理会话。已登录的会话先进入断开待恢复状态，宽限期内没有 RESUME 才从在线状态注册表中移除
+        并异步清除数据库中的在线记录；未启用宽限期时立即清除。
+        """
+        with self._session_lock:
+            user_id, username = session.user_id, session.username
+            session.user_id = None
+            session.username = None
+            detached = user_id is not None and self._detach_session(user_id, session)
+        # 只有在用户ID不为None时才清除在线状态（避免重复清除）
+        if user_id is None:
+            logger.debug(f"SecureChatServer: 客户端 {session.client_address} 断开连接，但用户已登出，无需清理在线状态。")
+        elif detached:
+            logger.info(f"SecureChatServer: 用户 {username} (ID: {user_id}) 的连接已断开，"
+                        f"保留在线状态 {self.resume_grace_period:g} 秒等待恢复。")
+        else:
+            self._set_offline(user_id, session)
+            logger.info(f"SecureChatServer: 已清理用户 {username} (ID: {user_id}) 的会话并更新离线状态。")
+
+    def _detach_session(self, user_id, session):
+        """把断开的会话登记为待恢复（调用方持有 _session_lock）。:return: 是否已登记。"""
+        if self.resume_grace_period <= 0:
+            return False
+        entry = self.presence.get(user_id)
+        if entry is None or entry.session is not session:
+            return False
+        self.detached_sessions.detach(user_id, session)
+        return True
+
+    def _expire_detached_session(self, user_id, session):
+        """宽限期满仍未恢复的会话按下线处理（在 DetachedSessions 的后台线程中调用）。"""
+        self._set_offline(user_id, session)
+        logger.info(f"SecureChatServer: 用户 {user_id} 的断开会话未在宽限期内恢复，已更新为离线状态。")
+
+    def _evict_local_detached_session(self, user_id):
+        """
+        立即结束用户在本进程上断开待恢复的会话。
+        :return: 是否结束了一个待恢复的会话。
+        """
+        session = self.detached_sessions.discard(user_id)
+        if session is None:
+            return False
+        self._set_offline(user_id, session)
+        return True
+
+    def _evict_detached_session(self, user_id):
+        """
+        用户凭密码重新 LOGIN 时，立即结束其断开待恢复的会话。会话在其他工作进程上时
+        （本进程中只有副本，或副本尚未同步过来），经 presence broker 由该工作进程结束。
+        :return: 用户是否已下线（False 表示用户确实在线）。
+        """
+        if self._evict_local_detached_session(user_id):
+            return True
+        entry = self.presence.get(user_id)
+        if self.presence_broker and (entry is None or entry.session is None):
+            return self.presence_broker.evict(user_id)
+        return False
+
+    def _take_over_session(self, entry, session):
+        """
+        让新连接接管在线条目（调用方持有 _session_lock）。原会话如果是仍未发现断开的半开连接，
+        它随之变为未登录状态，之后关闭时不再清理在线状态。
+        """
+        old = entry.session
+        if old is not None:
+            self.detached_sessions.reattach(entry.user_id, old)
+            if old.user_id == entry.user_id:
+                old.user_id = None
+                old.username = None
+        entry.session = session
+
+    def _resume_session(self, session, user_id, resume_id):
+        """
+        用恢复令牌中的用户ID和恢复ID找回在线条目并交给 session，不访问数据库。
+        用户在其他工作进程上（断开的连接原来在那里）时，经 presence broker 把用户转移到本进程。
+        :return: 恢复的 PresenceEntry；会话已过期、已登出或恢复ID不符时返回 None。
+        """
+        entry = self.presence.get(user_id)
+        if entry is None:
+            return None
+        remote = entry.session is None
+        if remote:
+            # 不持有 _session_lock 等待 broker：broker 的读取线程处理 released 消息时也需要这把锁
+            if not (self.presence_broker and self.presence_broker.takeover(user_id, resume_id)):
+                return None
+            # 原工作进程中的 OnlineStatus 记录可能已被其过期清理删除，这里重新写入
+            self.presence_writer.set_online(user_id, entry.ip, entry.port)
+            self.friend_log.open(user_id)  # 客户端持有的好友列表版本来自原工作进程，下次同步时返回完整快照
+        with self._session_lock:
+            if self.presence.get(user_id) is not entry:
+                return None
+            if not remote and (entry.session is None or entry.session.resume_id != resume_id):
+                return None
+            self._take_over_session(entry, session)
+            session.user_id = user_id
+            session.username = entry.username
+            session.resume_id = resume_id
+        return entry
+
+    def _release_session(self, data):
+        """用户的会话在其他工作进程上恢复：交出本进程的会话，在线条目转为其他工作进程用户的副本。"""
+        logger.info(f"SecureChatServer: 用户 {data['username']} (ID: {data['user_id']}) 的会话已在其他工作进程上恢复，"
+                    f"本进程交出该用户。")
+        with self._session_lock:
+            entry = self.presence.get(data["user_id"])
+            if entry is not None:
+                if entry.session is not None:
+                    self._take_over_session(entry, None)
+                    self.friend_log.close(entry.user_id)
+                return
+        # 本进程已按宽限期满清理过（并推送了下线），按其他工作进程的用户重新登记
+        entry = entry_from_message(data)
+        if self.presence.register(entry):
+            self._broadcast_presence(entry, online=True)
+
+    def _set_offline(self, user_id, session):
+        """将会话对应的用户标记为离线，并通知其在线好友。"""
+        entry = self.presence.unregister(user_id, session)
+        if entry is not None:
+            self.friend_log.close(user_id)
+            self.presence_writer.set_offline(user_id)
+            if self.presence_broker:
+                self.presence_broker.publish(OP_OFFLINE, user_id=entry.user_id)
+            self._broadcast_presence(entry, online=False)
+
+    def _register_presence(self, entry):
+        """
+        登记用户上线，并发登录时以先登记者为准。
+        多进程模式下先向 presence broker 申请，保证同一用户同时只在一个工作进程中在线。
+        """
+        if self.presence_broker and not self.presence_broker.claim(entry, entry.session.resume_id):
+            return False
+        return self.presence.register(entry)
+
+    def _handle_broker_message(self, message):
+        """应用其他工作进程的在线状态变化（在 broker 连接的读取线程中调用），并推送给本进程上的相关连接。"""
+        op = message.get("op")
+        if op == OP_ONLINE:
+            entry = entry_from_message(message["entry"])
+            if self.presence.register(entry):
+                self._broadcast_presence(entry, online=True)
+        elif op == OP_UPDATE:
+            if self.presence.update_p2p_info(message["user_id"], message["ip"], message["port"]):
+                entry = self.presence.get(message["user_id"])
+                if entry is not None:
+                    self._broadcast_presence(entry, online=True)
+        elif op == OP_OFFLINE:
+            entry = self.presence.get(message["user_id"])
+            if entry is not None and entry.session is None:
+                self.presence.unregister(entry.user_id, None)
+                self._broadcast_presence(entry, online=False)
+        elif op == OP_FRIENDSHIP:
+            uid1, uid2 = message["uid1"], message["uid2"]
+            if message["added"]:
+                self.presence.add_friendship(uid1, uid2)
+            else:
+                self.presence.remove_friendship(uid1, uid2)
+            self._push_friendship_change(uid1, uid2, added=message["added"])
+        elif op == OP_USER:
+            self.user_index.add(message["user_id"], message["username"])
+        elif op == OP_RELEASED:
+            self._release_session(message["entry"])
+        elif op == OP_EVICT:
+            ok = self._evict_local_detached_session(message["user_id"])
+            self.presence_broker.publish(OP_EVICTED, evict_id=message["evict_id"], ok=ok)
+
+    def _decode_request(self, session, data):
+        """解析一条原始请求数据（分帧协议下按协商的编码），返回请求字典；不是有效的对象时返回 None。"""
+        encoding = session.encoding if session.framed else ENCODING_JSON
+        try:
+            request = decode_message(data, encoding)
+        except MessageDecodeError:
+            request = None
+        if not isinstance(request, dict):
+            logger.error(f"SecureChatServer: 收到来自 {session.client_address} 的无效{encoding}格式数据: {data[:256]!r}")
+            return None
+        return request
+
+    def _process_request_data(self, session, data):
+        """解析一条原始请求数据并执行对应命令，返回响应字典。该方法会阻塞（访问数据库）。"""
+        request = self._decode_request(session, data)
+        if request is None:
+            return self._make_response("error", "无效的JSON格式。")
+        return self._process_request(session, request)
+
+    def _admit(self, session, request):
+        """
+        请求的准入检查（不阻塞）：按连接、按用户、按登录用户名的令牌桶限流，以及 DB 操作的排队上限。
+        :return: 被拒绝时返回过载响应，命令名不是字符串或 payload 不是对象时返回普通的错误响应；
+                 通过时返回 None（DB 命令此时已被 db_limiter 接纳，必须随后执行）。
+        """
+        command = request.get("command")
+        if not isinstance(command, str):
+            # 列表、字典等不可哈希的命令名无法参与后面的集合查找，按未知命令拒绝，也不消耗限流令牌
+            logger.warning(f"SecureChatServer: 收到来自 {session.client_address} 的未知命令: {command!r:.256}")
+            return self._make_response("error", "未知命令。")
+        payload = request.get("payload")
+        if payload is not None and not isinstance(payload, dict):
+            logger.warning(f"SecureChatServer: 来自 {session.client_address} 的 {command} 请求的 payload 不是对象。")
+            return self._make_response("error", "无效的请求参数。")
+        if self.rate_limits:
+            retry_after = session.rate_limiter.try_acquire() if session.rate_limiter else 0.0
+            if not retry_after and session.user_id is not None:
+                retry_after = self.user_rate_limiter.try_acquire(session.user_id)
+            if not retry_after and command == "LOGIN":
+                # 同一用户名的登录尝试单独限流，限制从多个连接并发猜测密码
+                username = payload.get("username") if payload else None
+                if isinstance(username, str):
+                    retry_after = self.login_rate_limiter.try_acquire(username)
+            if retry_after:
+                logger.debug(f"SecureChatServer: 来自 {session.client_address} 的 {command} 请求被限流。")
+                return self._make_overload_response(REASON_RATE_LIMITED, retry_after)
+        if command in self.DB_COMMANDS and not self.db_limiter.admit():
+            logger.debug(f"SecureChatServer: DB 操作队列已满，拒绝来自 {session.client_address} 的 {command} 请求。")
+            return self._make_overload_response(REASON_BUSY, BUSY_RETRY_AFTER)
+        return None
+
+    def _finish_request(self, request, response, start):
+        """记录命令指标；请求中带有 request_id 时，响应中原样带回，客户端据此把响应交给对应的等待者。"""
+        self.metrics.observe_command(request.get("command"), response.get("status"), time.perf_counter() - start)
+        request_id = request.get("request_id")
+        if request_id is not None:
+            response["request_id"] = request_id
+        return response
+
+    def _process_request(self, session, request, admitted=False):
+        """
+        执行一条已解析的请求，返回响应字典。
+        :param admitted: 调用方是否已经通过 _admit() 完成准入检查（asyncio 模式在事件循环中检查）。
+        """
+        client_address = session.client_address
+        command = request.get("command")
+        payload = request.get("payload") or {}  # _admit() 已确认 payload 缺省、为 null 或是对象
+        start = time.perf_counter()
+        response = None if admitted else self._admit(session, request)
+        if response is None:
+            try:
+                logger.info(f"SecureChatServer: 收到来自 {client_address} 的命令: {command}")
+                logger.debug(f"SecureChatServer: 收到命令Payload: {payload}")
+                if command in self.DB_COMMANDS:
+                    # 等待 DB 执行名额；排队超时说明数据库已经跟不上，拒绝而不是继续堆积
+                    ran, response = self.db_limiter.run(self._dispatch_command, session, command, payload)
+                    if not ran:
+                        response = self._make_overload_response(REASON_BUSY, BUSY_RETRY_AFTER)
+                else:
+                    response = self._dispatch_command(session, command, payload)
+            except Exception as e:
+                logger.error(f"SecureChatServer: 处理来自 {client_address} 的客户端请求时出错: {e}", exc_info=True)
+                response = self._make_response("error", f"服务器内部错误: {str(e)}")
+        return self._finish_request(request, response, start)
+
+    def _authenticate(self, username, password):
+        """
+        校验用户名和密码（哈希在密码哈希进程池中计算）。旧格式或旧参数的哈希在校验成功后升级为当前格式。
+        :return: (user_id, public_key)；失败时返回 (None, None)。
+        """
+        user_id, password_hash, public_key = self.db_manager.get_user_credentials(username)
+        if not user_id:
+            self.password_hasher.verify_dummy(password)  # 用户不存在时同样计算一次哈希，避免通过响应时间探测用户名
+            return None, None
+        matched, needs_rehash = self.password_hasher.verify(password, password_hash)
+        if not matched:
+            return None, None
+        if needs_rehash and self.db_manager.update_password_hash(user_id, self.password_hasher.hash(password)):
+            logger.info(f"SecureChatServer: 用户 {username} 的密码哈希已升级为当前格式。")
+        return user_id, public_key
+
+    def _dispatch_command(self, session, command, payload):
+        """执行单条命令并返回响应字典。"""
+        client_address = session.client_address
+        if session.user_id is not None:
+            self.presence.touch(session.user_id)
+
+        if command == "HELLO":  # 连接建立后的协议协商，客户端应在发送其他命令之前发送
+            if session.framed:
+                return self._make_response("error", "协议已协商。")
+            framing = choose_framing(payload.get("framing"))
+            if not framing:
+                logger.info(f"SecureChatServer: 客户端 {client_address} 未提供受支持的分帧方式，继续使用旧协议。")
+                return self._make_response("error", "不支持的分帧方式。",
+                                           data={"supported_framings": list(SUPPORTED_FRAMINGS)})
+            session.framed = True
+            session.pipelined = payload.get("pipelining") is True
+            # 编码从下一帧开始生效，本条回复仍以旧协议的 JSON 发送
+            session.encoding = choose_encoding(payload.get("encodings"))
+            session.columnar = payload.get("columnar") is True
+            logger.info(f"SecureChatServer: 客户端 {client_address} 协商使用分帧协议 {framing}，编码 {session.encoding}"
+                        f"{'（请求流水线）' if session.pipelined else ''}{'（列式好友列表）' if session.columnar else ''}。")
+            return self._make_response("success", "协议协商成功。",
+                                       data={"framing": framing, "max_frame_size": MAX_FRAME_SIZE,
+                                             "pipelining": session.pipelined, "encoding": session.encoding,
+                                             "columnar": session.columnar})
+
+        elif command == "REGISTER":
+            username = payload.get("username")
+            password = payload.get("password")
+            public_key = payload.get("public_key")
+
+            if not (username and password and public_key):
+                logger.warning(f"SecureChatServer: 注册请求缺少必要参数来自 {client_address}")
+                return self._make_response("error", "缺少用户名、密码或公钥。")
+
+            if self.db_manager.register_user(username, self.password_hasher.hash(password), public_key):
+                new_user_id = self.db_manager.get_user_id(username)
+                if new_user_id:
+                    self.user_index.add(new_user_id, username)
+                    if self.presence_broker:
+                        self.presence_broker.publish(OP_USER, user_id=new_user_id, username=username)
+                logger.info(f"SecureChatServer: 用户 {username} 已注册。")
+                return self._make_response("success", "注册成功。")
+            logger.warning(f"SecureChatServer: 用户 {username} 注册失败，可能已存在。")
+            return self._make_response("error", "注册失败，用户名可能已存在。")
+
+        elif command == "LOGIN":
+            username = payload.get("username")
+            password = payload.get("password")
+            client_p2p_ip = payload.get("p2p_ip", client_address[0])
+            client_p2p_port = payload.get("p2p_port")
+
+            if not (username and password and client_p2p_port is not None):
+                logger.warning(f"SecureChatServer: 登录请求缺少必要参数来自 {client_address}")
+                return self._make_response("error", "缺少用户名、密码或P2P端口。")
+
+            user_id, public_key = self._authenticate(username, password)
+            if not user_id:
+                logger.warning(f"SecureChatServer: 用户 {username} 登录失败，凭据无效。")
+                return self._make_response("error", "用户名或密码无效。")
+
+            # 好友集合在整个会话期间用于在线状态推送，查询失败时拒绝登录，而不是以空好友集合登录
+            friend_ids = self.db_manager.get_friend_ids(user_id)
+            if friend_ids is None:
+                logger.error(f"SecureChatServer: 无法获取用户 {username} 的好友列表，登录失败。")
+                return self._make_response("error", "服务器繁忙，请稍后重试。")
+
+            session.resume_id = new_resume_id()
+            entry = PresenceEntry(user_id, username, client_p2p_ip, client_p2p_port, public_key, session, friend_ids)
+            # 断开待恢复的旧会话（可能在其他工作进程上）不算重复登录：凭密码重新登录时结束它再重新登记
+            if not self._register_presence(entry) and not (self._evict_detached_session(user_id)
+                                                           and self._register_presence(entry)):
+                logger.warning(f"SecureChatServer: 用户 {username} 尝试重复登录。")
+                return self._make_response("error", "用户已登录。")
+
+            self.friend_log.open(user_id)
+            self.presence_writer.set_online(user_id, client_p2p_ip, client_p2p_port)
+            self._broadcast_presence(entry, online=True)
+            session.user_id = user_id
+            session.username = username
+            logger.info(f"SecureChatServer: 用户 {username} (ID: {user_id}) 从 {client_address} 登录。")
+            return self._make_response("success", "登录成功。",
+                                       data={"username": username, "user_id": user_id,
+                                             "public_key": public_key,
+                                             "resume_token": self.resume_signer.issue(user_id, session.resume_id)})
+
+        elif command == "RESUME":  # 断线重连后凭 LOGIN 返回的恢复令牌恢复会话，不访问数据库
+            if session.user_id:
+                return self._make_response("error", "已登录。")
+            token = self.resume_signer.verify(payload.get("resume_token"))
+            if token is None:
+                logger.warning(f"SecureChatServer: 来自 {client_address} 的恢复令牌无效或已过期。")
+                return self._make_response("error", "恢复令牌无效或已过期，请重新登录。")
+            user_id, resume_id = token
+            entry = self._resume_session(session, user_id, resume_id)
+            if entry is None:
+                logger.info(f"SecureChatServer: 来自 {client_address} 的用户 {user_id} 的会话已过期，无法恢复。")
+                return self._make_response("error", "会话已过期，请重新登录。")
+
+            # P2P监听地址变化（如客户端重启）时同步更新并通知好友
+            client_p2p_ip = payload.get("p2p_ip", entry.ip)
+            client_p2p_port = payload.get("p2p_port", entry.port)
+            if (client_p2p_ip, client_p2p_port) != (entry.ip, entry.port):
+                self.presence.update_p2p_info(user_id, client_p2p_ip, client_p2p_port)
+                self.presence_writer.set_online(user_id, client_p2p_ip, client_p2p_port)
+                if self.presence_broker:
+                    self.presence_broker.publish(OP_UPDATE, user_id=user_id, ip=client_p2p_ip, port=client_p2p_port)
+                self._broadcast_presence(entry, online=True)
+            logger.info(f"SecureChatServer: 用户 {entry.username} (ID: {user_id}) 从 {client_address} 恢复会话。")
+            return self._make_response("success", "会话已恢复。",
+                                       data={"username": entry.username, "user_id": user_id,
+                                             "public_key": entry.public_key,
+                                             "resume_token": self.resume_signer.issue(user_id, resume_id)})
+
+        elif command == "LOGOUT":
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试登出，来自 {client_address}。")
+                return self._make_response("error", "未登录。")
+
+            # 先记录用户信息，再清除
+            user_id_to_logout = session.user_id
+            username_to_logout = session.username
+
+            self._set_offline(user_id_to_logout, session)
+            logger.info(f"SecureChatServer: 用户 {username_to_logout} (ID: {user_id_to_logout}) 已登出。")
+
+            # 清除登录状态
+            session.user_id = None
+            session.username = None
+            return self._make_response("success", "登出成功。")
+
+        elif command == "GET_ONLINE_FRIENDS":
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试获取在线好友列表，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            try:
+                after_user_id, limit = self._parse_page_params(payload)
+            except (TypeError, ValueError):
+                return self._make_response("error", "无效的分页参数。")
+
+            # 客户端声明已缓存的公钥只返回指纹，不再重复发送PEM
+            session.remember_key_fingerprints(payload.get("known_fingerprints"))
+            # 直接由内存中的好友集合与在线状态注册表求交集得到，不访问数据库
+            online_friends_list = [session.friend_info(entry) for entry in
+                                   self.presence.get_online_friends(session.user_id, after_user_id, limit)]
+            logger.info(f"SecureChatServer: 向 {session.username} 提供了 {len(online_friends_list)} 个在线好友列表。")
+            return self._make_response("success", "在线好友已检索。",
+                                       data=self._make_page_data("friends", online_friends_list, limit,
+                                                                 session.columnar))
+
+        elif command == "GET_ALL_FRIENDS":
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试获取所有好友列表，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            try:
+                after_user_id, limit = self._parse_page_params(payload)
+            except (TypeError, ValueError):
+                return self._make_response("error", "无效的分页参数。")
+
+            all_friends_list = self.db_manager.get_all_friends_info(session.user_id, after_user_id, limit)
+            # 在线信息以内存注册表为准（OnlineStatus 表是异步写入的，可能略有滞后）
+            for friend in all_friends_list:
+                entry = self.presence.get(friend["user_id"])
+                friend["ip_address"] = entry.ip if entry else None
+                friend["p2p_port"] = entry.port if entry else None
+            logger.info(
+                f"SecureChatServer: 向 {session.username} 提供了 {len(all_friends_list)} 个所有好友列表。")
+            return self._make_response("success", "所有好友已检索。",
+                                       data=self._make_page_data("friends", all_friends_list, limit,
+                                                                 session.columnar))
+
+        elif command == "SYNC_FRIENDS":  # 按版本增量同步好友列表和好友在线状态，只读内存
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试同步好友列表，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            session.remember_key_fingerprints(payload.get("known_fingerprints"))
+            # 先取版本再读取当前状态：两者之间发生的变化会在下次同步时重复发送，但不会丢失
+            changes = self.friend_log.changes_since(session.user_id, payload.get("version"))
+            version = self.friend_log.current_version(session.user_id) if changes is None else changes[1]
+            friend_ids = self.presence.get_friend_ids(session.user_id)
+            if friend_ids is None:
+                return self._make_response("error", "请先登录。")
+            if changes is None:
+                # 版本未知或日志已截断：返回完整快照（好友集合、用户名和在线状态都在内存中，同样不访问数据库）
+                friend_ids = sorted(friend_ids)
+                data = self._make_friend_sync_data(session, version, friend_ids, friend_ids, full=True)
+            else:
+                changed = changes[0]
+                changed_friends = sorted(fid for fid in changed if fid in friend_ids)
+                data = self._make_friend_sync_data(session, version,
+                                                   [fid for fid in changed_friends if changed[fid]],
+                                                   changed_friends, full=False)
+                data["removed"] = [fid for fid in changed if fid not in friend_ids]
+            logger.info(f"SecureChatServer: 向 {session.username} 提供了好友列表"
+                        f"{'完整快照' if changes is None else '增量'} (版本 {version}，"
+                        f"{len(friend_ids) if changes is None else len(changes[0])} 个好友)。")
+            return self._make_response("success", "好友列表已同步。", data=data)
+
+        elif command == "ADD_FRIEND":
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试添加好友，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            friend_username_to_add = payload.get("friend_username")
+            if not friend_username_to_add:
+                logger.warning(f"SecureChatServer: 添加好友请求缺少用户名来自 {session.username}。")
+                return self._make_response("error", "缺少好友用户名。")
+
+            friend_id_to_add = self.db_manager.get_user_id(friend_username_to_add)
+            if not friend_id_to_add:
+                logger.warning(f"SecureChatServer: 用户 {session.username} 尝试添加不存在的用户 {friend_username_to_add}。")
+                return self._make_response("error", f"用户 '{friend_username_to_add}' 不存在。")
+            elif friend_id_to_add == session.user_id:
+                logger.warning(f"SecureChatServer: 用户 {session.username} 尝试添加自己为好友。")
+                return self._make_response("error", "不能添加自己为好友。")
+            elif self.db_manager.add_friendship(session.user_id, friend_id_to_add):
+                self.presence.add_friendship(session.user_id, friend_id_to_add)
+                if self.presence_broker:
+                    self.presence_broker.publish(OP_FRIENDSHIP, uid1=session.user_id, uid2=friend_id_to_add, added=True)
+                self._push_friendship_change(session.user_id, friend_id_to_add, added=True)
+                logger.info(f"SecureChatServer: 用户 {session.username} 添加 {friend_username_to_add} (ID: {friend_id_to_add}) 为好友成功。")
+                return self._make_response("success", f"'{friend_username_to_add}' 已添加到您的好友列表。")
+            logger.warning(f"SecureChatServer: 用户 {session.username} 无法添加 {friend_username_to_add} 为好友，可能已是好友。")
+            return self._make_response("error", f"无法添加 '{friend_username_to_add}' 为好友 (可能已经是好友)。")
+
+        elif command == "REMOVE_FRIEND":
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试删除好友，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            friend_username_to_remove = payload.get("friend_username")
+            if not friend_username_to_remove:
+                logger.warning(f"SecureChatServer: 删除好友请求缺少用户名来自 {session.username}。")
+                return self._make_response("error", "缺少要删除的好友用户名。")
+
+            friend_id_to_remove = self.db_manager.get_user_id(friend_username_to_remove)
+            if not friend_id_to_remove:
+                logger.warning(f"SecureChatServer: 用户 {session.username} 尝试删除不存在的用户 {friend_username_to_remove}。")
+                return self._make_response("error", f"用户 '{friend_username_to_remove}' 不存在。")
+            elif self.db_manager.remove_friendship(session.user_id, friend_id_to_remove):
+                self.presence.remove_friendship(session.user_id, friend_id_to_remove)
+                if self.presence_broker:
+                    self.presence_broker.publish(OP_FRIENDSHIP, uid1=session.user_id, uid2=friend_id_to_remove,
+                                                 added=False)
+                self._push_friendship_change(session.user_id, friend_id_to_remove, added=False)
+                logger.info(f"SecureChatServer: 用户 {session.username} 成功移除了 {friend_username_to_remove} (ID: {friend_id_to_remove})。")
+                return self._make_response("success", f"'{friend_username_to_remove}' 已从您的好友列表中移除。")
+            logger.warning(f"SecureChatServer: 用户 {session.username} 无法移除 {friend_username_to_remove}，可能不是好友。")
+            return self._make_response("error", f"无法移除 '{friend_username_to_remove}' (可能不是好友)。")
+
+        elif command == "GET_PUBLIC_KEY":
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试获取公钥，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            target_username = payload.get("username")
+            if not target_username:
+                logger.warning(f"SecureChatServer: 获取公钥请求缺少用户名来自 {session.username}。")
+                return self._make_response("error", "缺少目标用户名。")
+
+            public_key, fingerprint = self.db_manager.get_public_key_info(target_username)
+            if public_key and payload.get("known_fingerprint") == fingerprint:
+                # 类似 HTTP If-None-Match：客户端已持有该公钥时只确认指纹
+                logger.info(f"SecureChatServer: {session.username} 持有的 {target_username} 公钥未变化。")
+                return self._make_response("success", f"{target_username} 的公钥未变化。",
+                                           data={"public_key_fingerprint": fingerprint, "not_modified": True})
+            if public_key:
+                logger.info(f"SecureChatServer: 向 {session.username} 提供了 {target_username} 的公钥。")
+                return self._make_response("success", f"已检索到 {target_username} 的公钥。",
+                                           data={"public_key": public_key, "public_key_fingerprint": fingerprint})
+            logger.warning(f"SecureChatServer: 未找到用户 {target_username} 的公钥，请求来自 {session.username}。")
+            return self._make_response("error", f"未找到 {target_username} 的公钥。")
+
+        elif command == "UPDATE_P2P_INFO":  # 客户端更新其P2P监听信息
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试更新P2P信息，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            new_p2p_ip = payload.get("p2p_ip", client_address[0])
+            new_p2p_port = payload.get("p2p_port")
+
+            if new_p2p_port is None:
+                logger.warning(f"SecureChatServer: 更新P2P信息请求缺少P2P端口来自 {session.username}。")
+                return self._make_response("error", "缺少新的P2P端口。")
+
+            if self.presence.update_p2p_info(session.user_id, new_p2p_ip, new_p2p_port):
+                self.presence_writer.set_online(session.user_id, new_p2p_ip, new_p2p_port)
+                if self.presence_broker:
+                    self.presence_broker.publish(OP_UPDATE, user_id=session.user_id, ip=new_p2p_ip, port=new_p2p_port)
+                entry = self.presence.get(session.user_id)
+                if entry is not None:
+                    self._broadcast_presence(entry, online=True)
+                logger.info(f"SecureChatServer: 用户 {session.username}'s P2P信息已更新为 {new_p2p_ip}:{new_p2p_port}。")
+                return self._make_response("success", "P2P信息更新成功。")
+            logger.error(f"SecureChatServer: 用户 {session.username} 更新P2P信息失败。")
+            return self._make_response("error", "更新P2P信息失败。")
+
+        elif command == "GET_ALL_USERS":  # 额外功能：获取所有用户，方便查找好友
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试获取所有用户列表，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+            try:
+                after_user_id, limit = self._parse_page_params(payload)
+            except (TypeError, ValueError):
+                return self._make_response("error", "无效的分页参数。")
+            all_users = self.db_manager.get_all_users_info(after_user_id, limit)
+            logger.info(f"SecureChatServer: 向 {session.username} 提供了 {len(all_users)} 个注册用户 (after={after_user_id})。")
+            return self._make_response("success", "所有用户已检索。",
+                                       data=self._make_page_data("users", all_users, limit))
+
+        elif command == "SEARCH_USERS":  # 按用户名前缀/子串搜索用户，用于查找好友
+            if not session.user_id:
+                logger.warning(f"SecureChatServer: 未登录用户尝试搜索用户，来自 {client_address}。")
+                return self._make_response("error", "请先登录。")
+
+            query = payload.get("query")
+            if not query or not isinstance(query, str):
+                logger.warning(f"SecureChatServer: 搜索用户请求缺少关键词来自 {session.username}。")
+                return self._make_response("error", "缺少搜索关键词。")
+            try:
+                limit = int(payload.get("limit", SEARCH_USERS_DEFAULT_LIMIT))
+            except (TypeError, ValueError):
+                return self._make_response("error", "无效的结果数量。")
+            limit = max(1, min(limit, SEARCH_USERS_MAX_LIMIT))
+
+            users = self.user_index.search(query, limit, exclude_user_id=session.user_id)
+            logger.info(f"SecureChatServer: 用户 {session.username} 搜索 '{query}'，返回 {len(users)} 个用户。")
+            return self._make_response("success", "搜索完成。", data={"users": users})
+
+        logger.warning(f"SecureChatServer: 收到来自 {client_address} 的未知命令: {command}")
+        return self._make_response("error", "未知命令。")
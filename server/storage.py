@@ -0,0 +1,130 @@
+"""
+服务器使用的存储接口。
+
+SecureChatServer 只通过 StorageBackend 定义的方法访问持久化数据，具体实现有两个：
+- db.DatabaseManager:             SQL Server（pyodbc + ODBC Driver 17），生产环境默认使用。
+- db_sqlite.SQLiteDatabaseManager: 内嵌 SQLite（WAL 模式），用于单节点部署、CI 和本地基准测试，不需要数据库服务。
+create_storage() 根据配置选择实现；各实现的驱动只在被选中时才导入。
+"""
+import abc
+
+from config import DB_BACKEND, SQLITE_DB_FILE, LIST_PAGE_DEFAULT_LIMIT
+
+# 支持的存储后端名称
+STORAGE_BACKENDS = ("sqlserver", "sqlite")
+
+
+class StorageBackend(abc.ABC):
+    """
+    存储后端接口。所有方法都是阻塞的，并且必须可以被多个线程同时调用。
+    查询失败时记录日志并返回表示“失败/没有数据”的值（False / None / 空列表），不向调用方抛出驱动异常。
+    """
+
+    @abc.abstractmethod
+    def create_tables(self):
+        """如果不存在，则创建数据库表和索引。"""
+
+    @abc.abstractmethod
+    def register_user(self, username, password_hash, public_key):
+        """注册新用户，用户名已存在时返回 False。"""
+
+    @abc.abstractmethod
+    def get_user_credentials(self, username):
+        """:return: (UserID, 密码哈希, PublicKey)；用户不存在时返回 (None, None, None)。"""
+
+    @abc.abstractmethod
+    def update_password_hash(self, user_id, password_hash):
+        """更新用户的密码哈希。"""
+
+    @abc.abstractmethod
+    def get_user_id(self, username):
+        """根据用户名获取用户ID，未找到时返回 None。"""
+
+    @abc.abstractmethod
+    def get_username_by_id(self, user_id):
+        """根据用户ID获取用户名，未找到时返回 None。"""
+
+    @abc.abstractmethod
+    def get_public_key_info(self, username):
+        """:return: (PublicKey, PublicKeyFingerprint)；未找到时返回 (None, None)。"""
+
+    @abc.abstractmethod
+    def add_friendship(self, uid1, uid2):
+        """建立好友关系，已经是好友或参数无效时返回 False。"""
+
+    @abc.abstractmethod
+    def remove_friendship(self, uid1, uid2):
+        """删除好友关系，原本不是好友时返回 False。"""
+
+    @abc.abstractmethod
+    def set_online_status(self, user_id, ip_address, p2p_port):
+        """设置或更新用户的在线状态。"""
+
+    @abc.abstractmethod
+    def clear_online_status(self, user_id):
+        """清除用户的在线状态。"""
+
+    @abc.abstractmethod
+    def set_online_status_batch(self, rows):
+        """批量设置或更新多个用户的在线状态。:param rows: [(user_id, ip_address, p2p_port)]，UserID 不重复。"""
+
+    @abc.abstractmethod
+    def clear_online_status_batch(self, user_ids):
+        """批量清除多个用户的在线状态。"""
+
+    @abc.abstractmethod
+    def clear_all_online_status(self):
+        """清空在线状态表。"""
+
+    @abc.abstractmethod
+    def get_friend_ids(self, user_id):
+        """获取用户所有好友的UserID集合；出错时返回 None（与“没有好友”的空集合区分）。"""
+
+    @abc.abstractmethod
+    def get_online_friends_info(self, user_id, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """在线好友信息，按 UserID 升序分页。"""
+
+    @abc.abstractmethod
+    def get_all_friends_info(self, user_id, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """所有好友信息（包括离线），按 UserID 升序分页。"""
+
+    @abc.abstractmethod
+    def get_all_users_info(self, after_user_id=0, limit=LIST_PAGE_DEFAULT_LIMIT):
+        """注册用户信息，按 UserID 升序分页。"""
+
+    @abc.abstractmethod
+    def get_pool_stats(self):
+        """返回连接池指标。"""
+
+    @abc.abstractmethod
+    def close(self):
+        """关闭所有数据库连接（服务器退出时调用）。"""
+
+    def get_public_key(self, username):
+        """根据用户名获取用户的公钥。"""
+        return self.get_public_key_info(username)[0]
+
+    def iter_all_users_info(self, page_size=LIST_PAGE_DEFAULT_LIMIT):
+        """逐页遍历全部注册用户（服务器启动时构建用户名索引使用），每页单独借用一次数据库连接。"""
+        after_user_id = 0
+        while True:
+            page = self.get_all_users_info(after_user_id, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1]["user_id"]
+
+
+def create_storage(backend=DB_BACKEND, sqlite_file=SQLITE_DB_FILE):
+    """
+    创建存储后端实例。
+    :param backend: "sqlserver" 或 "sqlite"。
+    :param sqlite_file: SQLite 数据库文件路径（仅 sqlite 后端使用）。
+    """
+    if backend == "sqlserver":
+        from db import DatabaseManager  # 只有使用 SQL Server 时才需要 pyodbc
+        return DatabaseManager()
+    if backend == "sqlite":
+        from db_sqlite import SQLiteDatabaseManager
+        return SQLiteDatabaseManager(sqlite_file)
+    raise ValueError(f"未知的存储后端: {backend}（可选: {', '.join(STORAGE_BACKENDS)}）")
@@ -0,0 +1,140 @@
+"""
+多进程模式（main.py --workers N）的主进程。
+
+主进程不处理客户端连接，只负责：
+1. 在一个短暂的子进程中清理数据库中上次运行遗留的在线记录（工作进程启动时不再各自清理）；
+2. 启动 presence broker 进程（见 presence_broker.py）；
+3. fork N 个工作进程，每个进程运行一个完整的服务器（threaded 或 asyncio），
+   以 SO_REUSEPORT 绑定同一端口，由内核把新连接分配给各工作进程；
+   各工作进程使用主进程生成的同一个恢复令牌密钥，断线的会话可以在任一工作进程上 RESUME；
+4. 工作进程意外退出时重新启动它；broker 进程退出时关闭全部工作进程后退出。
+主进程本身不创建线程（存储后端可能启动后台线程，例如 SQL Server 连接池的回收线程，因此它只在子进程中创建），
+之后启动和重启工作进程时 fork 是安全的。
+"""
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+import socket
+import tempfile
+import time
+from multiprocessing.connection import wait
+
+from storage import create_storage
+from presence_broker import PresenceBroker
+from config import PRESENCE_BROKER_SOCKET, METRICS_PORT, RESUME_TOKEN_SECRET
+
+logger = logging.getLogger(__name__)
+
+# 工作进程在启动后这么短的时间内退出时不再重启，避免配置错误（如端口被占用）导致无限重启
+WORKER_MIN_UPTIME = 5.0
+
+
+def default_broker_path(port):
+    """未配置 PRESENCE_BROKER_SOCKET 时，在系统临时目录下按端口生成 broker 套接字路径。"""
+    return PRESENCE_BROKER_SOCKET or os.path.join(tempfile.gettempdir(), f"secure_chat_presence_{port}.sock")
+
+
+def _broker_main(broker):
+    # Ctrl+C 会发给整个进程组；broker 只由主进程在所有工作进程退出后用 SIGTERM 停止
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    broker.serve_forever()
+
+
+def _clear_online_status_main(db_backend, sqlite_file):
+    db_manager = create_storage(db_backend, sqlite_file=sqlite_file)
+    try:
+        db_manager.clear_all_online_status()  # 丢弃上次运行遗留的在线记录
+    finally:
+        db_manager.close()
+
+
+def _worker_main(worker_id, server_class, server_kwargs, db_backend, sqlite_file):
+    # SIGTERM 与 Ctrl+C 一样抛出 KeyboardInterrupt，服务器的 finally 块会写完在线状态并关闭连接
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info(f"Supervisor: 工作进程 {worker_id} (PID {os.getpid()}) 启动。")
+    try:
+        db_manager = create_storage(db_backend, sqlite_file=sqlite_file)
+        server = server_class(db_manager=db_manager, **server_kwargs)
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.critical(f"Supervisor: 工作进程 {worker_id} 发生严重错误: {e}", exc_info=True)
+        raise SystemExit(1)
+
+
+def run_workers(server_class, workers, host, port, backlog, db_backend, sqlite_file, broker_path=None,
+                metrics_port=METRICS_PORT, **server_options):
+    """
+    启动 presence broker 和 workers 个工作进程，阻塞直到收到 Ctrl+C / SIGTERM。
+    :param server_class: SecureChatServer 或 AsyncSecureChatServer。
+    :param metrics_port: 第 i 个工作进程的指标端点使用 metrics_port + i；为 0 时不启动指标端点。
+    :param server_options: 原样传给每个工作进程的服务器构造函数（如 rate_limits、max_connections）；
+        连接数上限等限制对每个工作进程分别生效。
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("当前平台不支持 SO_REUSEPORT，无法以多进程模式运行。")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    broker_path = broker_path or default_broker_path(port)
+
+    ctx = multiprocessing.get_context("fork")
+    # 存储后端在子进程中创建，它启动的线程（如连接池回收线程）不会留在之后还要 fork 的主进程中
+    cleanup_process = ctx.Process(target=_clear_online_status_main, args=(db_backend, sqlite_file),
+                                  name="clear-online-status")
+    cleanup_process.start()
+    cleanup_process.join()
+    if cleanup_process.exitcode != 0:
+        raise RuntimeError(f"清理遗留在线记录失败 (exit={cleanup_process.exitcode})")
+    broker = PresenceBroker(broker_path)
+    broker.bind()
+    broker_process = ctx.Process(target=_broker_main, args=(broker,), name="presence-broker")
+    broker_process.start()
+    broker.close(remove_socket_file=False)  # 监听套接字只留在 broker 进程中
+
+    server_kwargs = dict(server_options, host=host, port=port, backlog=backlog, presence_broker_path=broker_path)
+    server_kwargs.setdefault("resume_secret", RESUME_TOKEN_SECRET.encode('utf-8') or secrets.token_bytes(32))
+
+    def start_worker(worker_id):
+        worker_kwargs = dict(server_kwargs, metrics_port=metrics_port + worker_id if metrics_port else 0)
+        process = ctx.Process(target=_worker_main, name=f"chat-worker-{worker_id}",
+                              args=(worker_id, server_class, worker_kwargs, db_backend, sqlite_file))
+        process.start()
+        return process, time.monotonic()
+
+    processes = {worker_id: start_worker(worker_id) for worker_id in range(workers)}
+    logger.info(f"Supervisor: 已启动 {workers} 个工作进程，共享端口 {host}:{port}，presence broker: {broker_path}")
+
+    try:
+        while True:
+            sentinels = {broker_process.sentinel: None}
+            sentinels.update({process.sentinel: worker_id for worker_id, (process, _) in processes.items()})
+            for sentinel in wait(list(sentinels)):
+                worker_id = sentinels[sentinel]
+                if worker_id is None:
+                    logger.critical(f"Supervisor: presence broker 进程已退出 (exit={broker_process.exitcode})，"
+                                    f"关闭全部工作进程。")
+                    return
+                process, started = processes[worker_id]
+                process.join()
+                if time.monotonic() - started < WORKER_MIN_UPTIME:
+                    logger.critical(f"Supervisor: 工作进程 {worker_id} 启动后立即退出 (exit={process.exitcode})，"
+                                    f"停止服务。")
+                    return
+                logger.error(f"Supervisor: 工作进程 {worker_id} 意外退出 (exit={process.exitcode})，正在重启。")
+                processes[worker_id] = start_worker(worker_id)
+    except KeyboardInterrupt:
+        logger.info("Supervisor: 收到中断信号，正在关闭工作进程。")
+    finally:
+        # 先停工作进程（各自写完在线状态），再停 broker，避免工作进程因 broker 断开而提前退出
+        for process, _ in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in processes.values():
+            process.join(15)
+        if broker_process.is_alive():
+            broker_process.terminate()
+        broker_process.join(5)
+        broker.close()
+        logger.info("Supervisor: 全部工作进程已退出。")
@@ -0,0 +1,98 @@
+"""
+服务器进程内的用户名索引，供 SEARCH_USERS 命令使用（SYNC_FRIENDS 也用它由用户ID查用户名）。
+
+- 按小写用户名排序的列表：前缀匹配用二分查找定位，复杂度 O(log n + k)。
+- 三元组（trigram）倒排索引：子串匹配取查询词各三元组对应用户集合的交集再校验，
+  只需检查少量候选而不是遍历全部用户。查询词不足3个字符时按顺序扫描排序列表做子串匹配，
+  找到 limit 个结果或检查了 short_query_scan_limit 个用户后停止。
+启动时从数据库加载一次，REGISTER 成功后增量加入新用户（bisect.insort 插入排序列表，O(n) 的内存移动）。
+"""
+import bisect
+import itertools
+import threading
+
+from config import SEARCH_USERS_SHORT_QUERY_SCAN_LIMIT
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class UsernameIndex:
+    """线程安全的用户名前缀/子串索引。"""
+
+    def __init__(self, short_query_scan_limit=SEARCH_USERS_SHORT_QUERY_SCAN_LIMIT):
+        self._lock = threading.Lock()
+        self._short_query_scan_limit = short_query_scan_limit
+        self._entries = []  # 按小写用户名排序的 [(小写用户名, user_id, username)]
+        self._trigram_index = {}  # {trigram: set(user_id)}
+        self._names = {}  # {user_id: username}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names)
+
+    def load(self, users):
+        """用 [{"user_id": .., "username": ..}] 重建整个索引。"""
+        rows = sorted((user["username"].casefold(), user["user_id"], user["username"]) for user in users)
+        trigram_index = {}
+        for key, user_id, _ in rows:
+            for gram in _trigrams(key):
+                trigram_index.setdefault(gram, set()).add(user_id)
+        with self._lock:
+            self._entries = rows
+            self._trigram_index = trigram_index
+            self._names = {user_id: username for _, user_id, username in rows}
+
+    def add(self, user_id, username):
+        """加入一个新注册的用户。"""
+        key = username.casefold()
+        with self._lock:
+            if user_id in self._names:
+                return
+            bisect.insort(self._entries, (key, user_id, username))
+            self._names[user_id] = username
+            for gram in _trigrams(key):
+                self._trigram_index.setdefault(gram, set()).add(user_id)
+
+    def get_username(self, user_id):
+        """:return: 用户ID对应的用户名，未知的用户ID返回 None。"""
+        with self._lock:
+            return self._names.get(user_id)
+
+    def search(self, query, limit, exclude_user_id=None):
+        """
+        按用户名搜索（不区分大小写）：先返回前缀匹配的用户，再补充子串匹配的用户，最多 limit 个。
+        :return: [{"user_id": .., "username": ..}]
+        """
+        key = query.casefold()
+        if not key or limit <= 0:
+            return []
+        results = []
+        seen = set()
+        with self._lock:
+            entries = self._entries
+            pos = bisect.bisect_left(entries, (key,))
+            while pos < len(entries) and entries[pos][0].startswith(key) and len(results) < limit:
+                _, user_id, username = entries[pos]
+                if user_id != exclude_user_id:
+                    results.append({"user_id": user_id, "username": username})
+                    seen.add(user_id)
+                pos += 1
+
+            if len(results) < limit and len(key) < 3:
+                # 1~2 个字符的子串：没有三元组可用，按用户名顺序扫描（前缀匹配的用户已经在 seen 中）
+                for name_key, user_id, username in itertools.islice(entries, self._short_query_scan_limit):
+                    if key in name_key and user_id not in seen and user_id != exclude_user_id:
+                        results.append({"user_id": user_id, "username": username})
+                        if len(results) >= limit:
+                            break
+            elif len(results) < limit:
+                postings = sorted((self._trigram_index.get(gram, ()) for gram in _trigrams(key)), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:]) if postings and postings[0] else set()
+                matches = sorted((self._names[user_id].casefold(), user_id) for user_id in candidates
+                                 if user_id not in seen and user_id != exclude_user_id
+                                 and key in self._names[user_id].casefold())
+                for _, user_id in matches[:limit - len(results)]:
+                    results.append({"user_id": user_id, "username": self._names[user_id]})
+        return results
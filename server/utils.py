@@ -1,10 +1,68 @@
+import base64
 import hashlib
+import hmac
+import os
 
+from config import SCRYPT_N, SCRYPT_R, SCRYPT_P
 
-def hash_password(password):
+# 带版本前缀的密码哈希格式: $scrypt$n=<N>,r=<r>,p=<p>$<盐 base64>$<哈希 base64>
+# 没有前缀的64位十六进制值是旧版本的未加盐 SHA-256，登录成功后会被升级为当前格式
+PASSWORD_HASH_PREFIX = "$scrypt$"
+PASSWORD_SALT_SIZE = 16
+PASSWORD_HASH_SIZE = 32
+
+
+def _scrypt(password, salt, n, r, p, dklen=PASSWORD_HASH_SIZE):
+    # maxmem 需覆盖 scrypt 实际使用的内存 (128 * n * r * p 字节)，OpenSSL 默认上限只有 32MB
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p + 1024 * 1024, dklen=dklen)
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
     """
-    hash格式存储密码。
+    使用随机盐和 scrypt 计算密码哈希。计算开销较大，服务器中应通过 password_hasher.PasswordHasher 在进程池中调用。
     :param password: 密码明文
-    :return: hash值
+    :return: 带算法与参数前缀的哈希字符串
+    """
+    salt = os.urandom(PASSWORD_SALT_SIZE)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"{PASSWORD_HASH_PREFIX}n={n},r={r},p={p}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+def verify_password(password, stored_hash, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """
+    校验密码是否与存储的哈希匹配。
+    :param n, r, p: 当前使用的 scrypt 参数，存储的哈希参数不同（或为旧格式）时需要重新哈希。
+    :return: (是否匹配, 是否需要用当前参数重新哈希)
+    """
+    if not stored_hash:
+        return False, False
+    if stored_hash.startswith(PASSWORD_HASH_PREFIX):
+        try:
+            params, salt_b64, digest_b64 = stored_hash[len(PASSWORD_HASH_PREFIX):].split("$")
+            params = dict(item.split("=", 1) for item in params.split(","))
+            stored_params = (int(params["n"]), int(params["r"]), int(params["p"]))
+            salt = base64.b64decode(salt_b64)
+            expected = base64.b64decode(digest_b64)
+        except (ValueError, KeyError):
+            return False, False
+        matched = hmac.compare_digest(_scrypt(password, salt, *stored_params, dklen=len(expected)), expected)
+        return matched, matched and stored_params != (n, r, p)
+    # 旧版本：未加盐的 SHA-256 十六进制值
+    legacy = hashlib.sha256(password.encode()).hexdigest()
+    matched = hmac.compare_digest(legacy.encode('ascii'), stored_hash.strip().encode('utf-8'))
+    return matched, matched
+
+
+def key_fingerprint(public_key_pem):
+    """
+    计算公钥的指纹（PEM 去掉首尾空白后 UTF-8 编码的 SHA-256 十六进制值）。
+    客户端 utils/KEYCACHE.py 使用相同的算法，双方以指纹判断对方是否已持有某个公钥。
+    :param public_key_pem: 公钥PEM字符串
+    :return: 64位十六进制字符串
     """
-    return hashlib.sha256(password.encode()).hexdigest()
+    return hashlib.sha256(public_key_pem.strip().encode('utf-8')).hexdigest()